@@ -4,18 +4,46 @@ Enables multi threading with worker and GUI threads for progress bar callback
 '''
 
 from PyQt6.QtCore import QThread, pyqtSignal
-from face_detection import save_faces_from_folder, find_matching_face, face_detector  # Import face_detector
+from face_detection import save_faces_from_folder, embed_probe_faces, match_probe_vectors, search_folder_probe_first
+from model_registry import get_face_detector, get_inference_version
+from embedding_heads import get_embedding_head
+from embedding_store import EmbeddingStore, STORE_FILE_NAME
+from face_index import open_index, INDEX_FILE_NAME
+from crop_writer import DEFAULT_CROP_FORMAT
+from pipeline_metrics import metrics, format_summary
+from console_verbosity import NORMAL, is_verbose
+from folder_watch import FolderWatcher, WatchedGallery, watch_gallery
+from exif_metadata import ExifCache, EXIF_CACHE_FILE_NAME, resolve_exif_data, resolve_match_exif
+from metadata_index import build_metadata_index, select_candidates
 import logging
+import os
 import traceback
 
+def face_data_for_gui(matches, face_data):
+    """
+    Copy the face data entries of the matched images for the GUI thread.
+
+    The worker thread keeps changing its face data while it watches the input folder, so the GUI
+    only ever receives copies it owns.
+
+    Parameters:
+    - matches (list): Match tuples.
+    - face_data (dict): Face data holding the matched images.
+
+    Returns:
+    - dict: Shallow copies of the matched images' entries, by img_hash.
+    """
+    return {img_hash: dict(face_data[img_hash]) for img_hash, *_ in matches if img_hash in face_data}
+
 class FaceProcessingThread(QThread):
     # Define signals to communicate with the main thread
     progress_signal = pyqtSignal(int)          # Signal to update progress
     processing_done = pyqtSignal(tuple)        # Signal to indicate completion
     error_signal = pyqtSignal(str)             # Signal to report errors
     partial_result_signal = pyqtSignal(object) # Signal for partial results
+    watch_update_signal = pyqtSignal(object)   # Signal for changes to the results while watching
 
-    def __init__(self, input_folder, output_folder, image_to_search):
+    def __init__(self, input_folder, output_folder, image_to_search, index_kind=None, workers=None, probe_first=False, top_k=None, detection_max_edge=None, near_duplicate_distance=None, crop_format=DEFAULT_CROP_FORMAT, crop_quality=None, discovery_manifest=False, watch=False, metadata_query=None):
         """
         Initialize the FaceProcessingThread.
 
@@ -23,11 +51,42 @@ class FaceProcessingThread(QThread):
         - input_folder (str): Path to the folder containing images to be processed.
         - output_folder (str): Path to the folder where processed images should be saved.
         - image_to_search (str): Path to the image containing the face to search for.
+        - index_kind (str, optional): Search a persistent 'flat', 'ivf' or 'hnsw' index kept in the
+          output folder instead of scanning face_data.
+        - workers (int, optional): Number of face detection processes. Runs detection in this thread if not set.
+        - probe_first (bool): Keep only matches and their image metadata instead of every face vector,
+          so memory use does not grow with the size of the input folder.
+        - top_k (int, optional): In probe first mode, keep only the top_k best matches per searched face.
+        - detection_max_edge (int, optional): Detect faces on images scaled down to this longest edge.
+        - near_duplicate_distance (int, optional): Reuse the faces of an earlier image whose perceptual
+          hash differs by at most this many bits.
+        - crop_format (str): Image format of the face crops: 'png', 'jpeg' or 'webp'.
+        - crop_quality (int, optional): Quality of the face crops.
+        - discovery_manifest (bool): Keep a directory manifest in the output folder so unchanged
+          directories of the input folder are not listed again.
+        - watch (bool): Once processing is done, keep indexing the images added to, changed in or
+          removed from the input folder and searching them, until cancelled.
+        - metadata_query (MetadataQuery, optional): Only search the images meeting these capture
+          date, device and location conditions.
         """
         super().__init__()
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.image_to_search = image_to_search
+        self.index_kind = index_kind
+        self.workers = workers
+        self.probe_first = probe_first
+        self.top_k = top_k
+        self.detection_max_edge = detection_max_edge
+        self.near_duplicate_distance = near_duplicate_distance
+        self.crop_format = crop_format
+        self.crop_quality = crop_quality
+        self.discovery_manifest = discovery_manifest
+        self.watch = watch
+        self.metadata_query = metadata_query
+        self.watcher = None
+        self.exif_cache = None
+        self.metadata_index = None
         self.cancel = False  # Initialize the cancel flag
 
     def cancel_processing(self):
@@ -38,27 +97,191 @@ class FaceProcessingThread(QThread):
         """
         Main execution method for the thread. It processes faces and searches for matches.
         """
+        metrics.reset()
         try:
-            # Extract and save faces from the input folder if not canceled
+            # EXIF data is read lazily, for the matched images just before they are shown and for
+            # every image when a metadata filter is used, and cached by image hash
+            self.exif_cache = ExifCache(os.path.join(self.output_folder, EXIF_CACHE_FILE_NAME))
+
+            if self.probe_first and not self.watch:
+                self.run_probe_first()
+                return
+            if self.probe_first:
+                print('Watching keeps every face of the input folder in memory, low memory mode is off.')
+
+            if self.watch:
+                # Started before the folder is processed so changes made meanwhile are picked up
+                self.watcher = FolderWatcher(self.input_folder, exclude=self.output_folder)
+                self.watcher.start()
+
+            face_index = None
+            if self.index_kind:
+                index_path = os.path.join(self.output_folder, INDEX_FILE_NAME)
+                face_index = open_index(index_path, self.index_kind, embedding_head=get_embedding_head().id,
+                                        inference_version=get_inference_version())
+
+            # Embed the face to search for first so images can be matched as soon as they are processed
+            if not self.cancel:
+                self.probe_vectors = embed_probe_faces(self.image_to_search, get_face_detector(), self.detection_max_edge)
+
+            # Extract and save faces from the input folder if not canceled.
+            # Results from previous runs are kept in a store inside the output folder
             if not self.cancel:
-                self.face_data = save_faces_from_folder(
-                    folder_path=self.input_folder,
-                    output_folder=self.output_folder,
-                    face_detector=face_detector,
-                    progress_callback=self.update_progress,
-                    cancel_flag=lambda: self.cancel
-                )
+                with EmbeddingStore(os.path.join(self.output_folder, STORE_FILE_NAME)) as store:
+                    self.face_data = save_faces_from_folder(
+                        folder_path=self.input_folder,
+                        output_folder=self.output_folder,
+                        face_detector=get_face_detector(),
+                        progress_callback=self.update_progress,
+                        cancel_flag=lambda: self.cancel,
+                        partial_update_callback=self.match_partial_result,
+                        store=store,
+                        face_index=face_index,
+                        workers=self.workers,
+                        detection_max_edge=self.detection_max_edge,
+                        near_duplicate_distance=self.near_duplicate_distance,
+                        crop_format=self.crop_format,
+                        crop_quality=self.crop_quality,
+                        discovery_manifest=self.discovery_manifest
+                    )
+                if face_index is not None:
+                    face_index.save(index_path)
 
             # Find matching faces in the extracted faces if not canceled
             if not self.cancel:
-                matching_faces = find_matching_face(self.image_to_search, self.face_data, face_detector)
-                self.processing_done.emit((matching_faces, self.face_data))
-                
+                candidates = None
+                if self.metadata_query:
+                    # Kept for the searches of the images that change while watching
+                    self.metadata_index = build_metadata_index(self.face_data, self.exif_cache)
+                    candidates = select_candidates(self.face_data, self.metadata_query, metadata_index=self.metadata_index)
+                matching_faces = match_probe_vectors(self.probe_vectors, self.face_data, face_index=face_index,
+                                                     candidates=candidates)
+                print(f'Number of matches found: {len(matching_faces)}')
+                if not matching_faces:
+                    print('No matching faces found for the image.')
+                resolve_match_exif(matching_faces, self.face_data, self.exif_cache)
+                self.processing_done.emit((matching_faces, face_data_for_gui(matching_faces, self.face_data)))
+
+            if self.watch and not self.cancel:
+                self.watch_input_folder(face_index)
+                if face_index is not None:
+                    face_index.save(index_path)
+
         except Exception as e:
             error_message = f"An error occurred during face processing: {str(e)}"
             logging.error(error_message)
             logging.error(traceback.format_exc())
             self.error_signal.emit(error_message)  # Emit the error message to be handled by the main thread
+        finally:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+            if self.exif_cache is not None:
+                self.exif_cache.close()
+                self.exif_cache = None
+            self.finish_metrics()
+
+    def watch_input_folder(self, face_index=None):
+        """
+        Keep the face data up to date with the input folder and emit how the matches change, until cancelled.
+
+        Parameters:
+        - face_index (FaceIndex, optional): Index kept in step with the face data.
+        """
+        print(f'Watching {self.input_folder} for new images. Press cancel to stop.')
+        with EmbeddingStore(os.path.join(self.output_folder, STORE_FILE_NAME)) as store:
+            gallery = WatchedGallery(self.input_folder, self.output_folder, self.face_data, store,
+                                     face_index=face_index, known_paths=self.watcher.known,
+                                     metadata_index=self.metadata_index, exif_cache=self.exif_cache,
+                                     workers=self.workers, detection_max_edge=self.detection_max_edge,
+                                     near_duplicate_distance=self.near_duplicate_distance,
+                                     crop_format=self.crop_format, crop_quality=self.crop_quality)
+            watch_gallery(self.watcher, gallery, get_face_detector(), self.probe_vectors, self.emit_watch_update,
+                          cancel_flag=lambda: self.cancel, metadata_query=self.metadata_query)
+        print('Stopped watching the input folder.')
+
+    def emit_watch_update(self, removed, matches, added):
+        """
+        Emit the images that left the face data and the matches among the images added to it.
+
+        Parameters:
+        - removed (set): Hashes of the removed images.
+        - matches (list): New match tuples.
+        - added (dict): Face data entries of the added images.
+        """
+        if matches and is_verbose(NORMAL):
+            print(f'Number of new matches found: {len(matches)}')
+        if removed or matches:
+            resolve_match_exif(matches, added, self.exif_cache)
+            self.watch_update_signal.emit((frozenset(removed), matches, face_data_for_gui(matches, added)))
+
+    def finish_metrics(self):
+        """
+        Stop the run clock of the pipeline metrics and log the run summary, if metrics are collected.
+        """
+        if not metrics.enabled:
+            return
+        metrics.finish()
+        summary = metrics.log_summary()
+        if is_verbose(NORMAL):
+            print(format_summary(summary))
+
+    def run_probe_first(self):
+        """
+        Search the input folder keeping only the matches, emitting them as they are found.
+        """
+        if self.cancel:
+            return
+        with EmbeddingStore(os.path.join(self.output_folder, STORE_FILE_NAME)) as store:
+            matching_faces, self.face_data = search_folder_probe_first(
+                self.image_to_search,
+                self.input_folder,
+                self.output_folder,
+                get_face_detector(),
+                top_k=self.top_k,
+                progress_callback=self.update_progress,
+                cancel_flag=lambda: self.cancel,
+                match_callback=self.emit_partial_result,
+                store=store,
+                workers=self.workers,
+                detection_max_edge=self.detection_max_edge,
+                near_duplicate_distance=self.near_duplicate_distance,
+                crop_format=self.crop_format,
+                crop_quality=self.crop_quality,
+                discovery_manifest=self.discovery_manifest,
+                metadata_query=self.metadata_query,
+                exif_cache=self.exif_cache
+            )
+        if not self.cancel:
+            resolve_match_exif(matching_faces, self.face_data, self.exif_cache)
+            self.processing_done.emit((matching_faces, face_data_for_gui(matching_faces, self.face_data)))
+
+    def emit_partial_result(self, matches, face_data):
+        """
+        Emit matches found so far, along with the face data of their images.
+
+        Parameters:
+        - matches (list): New match tuples.
+        - face_data (dict): Face data entries of the matched images.
+        """
+        resolve_match_exif(matches, face_data, self.exif_cache)
+        self.partial_result_signal.emit((matches, face_data_for_gui(matches, face_data)))
+
+    def match_partial_result(self, img_hash, face_entry):
+        """
+        Match a newly processed image against the face to search for and emit any matches.
+
+        Parameters:
+        - img_hash (str): Hash of the processed image.
+        - face_entry (dict): The image's face data entry.
+        """
+        if self.metadata_query:
+            resolve_exif_data({img_hash: face_entry}, self.exif_cache)
+            if not self.metadata_query.matches_entry(face_entry):
+                return
+        matches = match_probe_vectors(self.probe_vectors, {img_hash: face_entry})
+        if matches:
+            self.emit_partial_result(matches, {img_hash: face_entry})
 
     def update_progress(self, progress):
         """
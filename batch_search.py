@@ -0,0 +1,224 @@
+'''
+@file batch_search.py
+Match many probe images against the gallery in one pass.
+
+All probe faces are embedded together and scored against the packed gallery matrix with
+matrix-matrix products, so the gallery is ingested and packed once however many probes there are.
+
+Usage:
+    python batch_search.py --probes PROBE_FOLDER_OR_IMAGES... --gallery GALLERY_FOLDER --output OUTPUT_FOLDER
+'''
+
+import os
+import csv
+import json
+import logging
+import argparse
+import traceback
+from face_detection import (EMBEDDING_BATCH_SIZE, convert_images_to_vectors, extract_aligned_faces, is_valid_image_extension,
+                            iter_image_paths, save_faces_from_folder, detect_faces_in_image)
+from similarity_search import FaceMatrix
+from embedding_store import EmbeddingStore, STORE_FILE_NAME
+from model_registry import get_face_detector, set_inference_backend
+from inference_backends import INFERENCE_BACKENDS, DEFAULT_INFERENCE_BACKEND, DEFAULT_MODEL_DIR
+from image_loader import ImageBuffer
+from crop_writer import CROP_FORMATS, DEFAULT_CROP_FORMAT
+from console_verbosity import VERBOSITY_LEVELS, DEFAULT_VERBOSITY, set_verbosity
+from embedding_heads import EMBEDDING_HEADS, DEFAULT_EMBEDDING_HEAD, create_embedding_head, set_embedding_head
+from logging_setup import setup_logging
+
+logger = logging.getLogger()
+
+
+def collect_probe_paths(probes):
+    """
+    Expand a list of probe images and folders into image paths.
+
+    Parameters:
+    - probes (list): Paths of probe images or of folders containing them.
+
+    Returns:
+    - list: Paths of the probe images, folders expanded in walk order.
+    """
+    probe_paths = []
+    for probe in probes:
+        if os.path.isdir(probe):
+            probe_paths.extend(path for path in iter_image_paths(probe) if is_valid_image_extension(path))
+        elif is_valid_image_extension(probe):
+            probe_paths.append(probe)
+        else:
+            logger.warning(f"{probe} does not have a valid image extension. Skipping.")
+    return probe_paths
+
+
+def embed_probe_images(probe_paths, face_detector, batch_size=EMBEDDING_BATCH_SIZE, detection_max_edge=None):
+    """
+    Detect and align the faces of every probe image, then embed all of them in shared batches.
+
+    Parameters:
+    - probe_paths (list): Paths of the probe images.
+    - face_detector (MTCNN): The face detector.
+    - batch_size (int): Number of faces per ResNet batch.
+    - detection_max_edge (int, optional): Longest edge of the images passed to the detector.
+
+    Returns:
+    - tuple: (probe faces as (probe path, face number) pairs, one feature vector per probe face).
+    """
+    probe_faces = []
+    crops = []
+    for probe_path in probe_paths:
+        try:
+            img, detected_faces, _ = detect_faces_in_image(ImageBuffer.read(probe_path), face_detector, detection_max_edge)
+        except (OSError, ValueError):
+            logger.error(f"Unable to read image from {probe_path}. Skipping.")
+            continue
+
+        aligned = extract_aligned_faces(img, detected_faces)
+        print(f'{os.path.basename(probe_path)}: {len(aligned)} probe faces')
+        for i, (_, resized_face_img) in enumerate(aligned):
+            probe_faces.append((probe_path, i))
+            crops.append(resized_face_img)
+
+    probe_vectors = convert_images_to_vectors(crops, batch_size=batch_size) if crops else []
+    return probe_faces, probe_vectors
+
+
+def batch_match_probe_vectors(probe_faces, probe_vectors, face_data, threshold=.75, top_k=None, face_matrix=None):
+    """
+    Score all probe faces against face data at once and rank the matches of each probe image.
+
+    Parameters:
+    - probe_faces (list): (probe path, face number) pairs as returned by `embed_probe_images`.
+    - probe_vectors (list): One feature vector per probe face.
+    - face_data (dict): Mapping of image hash to face information.
+    - threshold (float): Maximum cosine distance for a face to count as a match.
+    - top_k (int, optional): Number of best matches to keep per probe image.
+    - face_matrix (FaceMatrix, optional): Prebuilt matrix of face_data.
+
+    Returns:
+    - dict: Probe path -> match tuples in the format of `find_matching_face`, most similar first.
+    """
+    if face_matrix is None:
+        face_matrix = FaceMatrix(face_data)
+
+    results = {}
+    for (probe_path, _), hits in zip(probe_faces, face_matrix.search_many(probe_vectors, threshold, top_k)):
+        results.setdefault(probe_path, []).extend(face_matrix.match_tuple(row, distance) for row, distance in hits)
+
+    for probe_path, matches in results.items():
+        # A probe image with several faces ranks the matches of all of them together
+        matches.sort(key=lambda match: match[3], reverse=True)
+        if top_k is not None:
+            del matches[top_k:]
+    return results
+
+
+def batch_find_matching_faces(probe_paths, face_data, face_detector, threshold=.75, top_k=None, face_matrix=None,
+                              batch_size=EMBEDDING_BATCH_SIZE, detection_max_edge=None):
+    """
+    Find the faces in face data matching any face of each probe image.
+
+    Returns:
+    - dict: Probe path -> ranked match tuples. Probe images without usable faces map to an empty list.
+    """
+    probe_faces, probe_vectors = embed_probe_images(probe_paths, face_detector, batch_size, detection_max_edge)
+    results = {probe_path: [] for probe_path in probe_paths}
+    results.update(batch_match_probe_vectors(probe_faces, probe_vectors, face_data, threshold, top_k, face_matrix))
+    return results
+
+
+def write_results(results, face_data, path):
+    """
+    Write ranked batch results to a CSV or JSON file, chosen by the file extension.
+
+    Parameters:
+    - results (dict): Probe path -> ranked match tuples.
+    - face_data (dict): Mapping of image hash to face information.
+    - path (str): Output file path.
+    """
+    rows = []
+    for probe_path, matches in results.items():
+        for rank, (img_hash, file_name, _, similarity, face_name) in enumerate(matches, start=1):
+            rows.append({"probe": probe_path, "rank": rank, "file_name": file_name,
+                         "full_path": face_data[img_hash]["full_path"], "similarity": round(float(similarity), 6),
+                         "img_hash": img_hash, "face_name": face_name})
+
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as json_file:
+            json.dump(rows, json_file, indent=2)
+        return
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["probe", "rank", "file_name", "full_path", "similarity", "img_hash", "face_name"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Match many probe images against a gallery folder in one pass.")
+    parser.add_argument('--probes', nargs='+', required=True, help="Probe images and/or folders of probe images")
+    parser.add_argument('--gallery', required=True, help="Folder of images to search")
+    parser.add_argument('--output', required=True, help="Folder for face crops and the embedding store")
+    parser.add_argument('--threshold', type=float, default=.75, help="Maximum cosine distance for a match")
+    parser.add_argument('--top-k', type=int, default=None, help="Keep only the best matches per probe image")
+    parser.add_argument('--workers', type=int, default=None, help="Number of face detection processes")
+    parser.add_argument('--results', default=None, help="Write the ranked results to this .csv or .json file")
+    parser.add_argument('--embedding-head', choices=list(EMBEDDING_HEADS), default=DEFAULT_EMBEDDING_HEAD,
+                        help="How ResNet feature maps are turned into face vectors")
+    parser.add_argument('--whitening', default=None, help="PCA whitening file to apply after pooling")
+    parser.add_argument('--detection-max-edge', type=int, default=None,
+                        help="Detect faces on images scaled down to this longest edge")
+    parser.add_argument('--crop-format', choices=list(CROP_FORMATS), default=DEFAULT_CROP_FORMAT,
+                        help="Image format of the face crops")
+    parser.add_argument('--crop-quality', type=int, default=None,
+                        help="JPEG/WebP quality (0-100) or PNG compression level (0-9) of the face crops")
+    parser.add_argument('--inference-backend', choices=list(INFERENCE_BACKENDS), default=DEFAULT_INFERENCE_BACKEND,
+                        help="Run the models with Keras or as quantised TFLite exports")
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR, help="Folder of the exported TFLite models")
+    parser.add_argument('--near-duplicate-distance', type=int, default=None,
+                        help="Reuse the faces of an earlier gallery image whose perceptual hash differs by at most this many bits")
+    parser.add_argument('--discovery-manifest', action='store_true',
+                        help="Keep a manifest of the gallery's directories so unchanged ones aren't listed again")
+    parser.add_argument('--verbosity', choices=list(VERBOSITY_LEVELS), default=DEFAULT_VERBOSITY,
+                        help="Print per image progress (normal), also per face details (verbose), or neither (quiet)")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    probe_paths = collect_probe_paths(args.probes)
+    if not probe_paths:
+        print('No probe images found.')
+        return 1
+
+    try:
+        set_embedding_head(create_embedding_head(args.embedding_head, args.whitening))
+        set_inference_backend(args.inference_backend, args.model_dir)
+        set_verbosity(args.verbosity)
+        face_detector = get_face_detector()
+        with EmbeddingStore(os.path.join(args.output, STORE_FILE_NAME)) as store:
+            face_data = save_faces_from_folder(args.gallery, args.output, face_detector, store=store, workers=args.workers,
+                                               detection_max_edge=args.detection_max_edge,
+                                               near_duplicate_distance=args.near_duplicate_distance,
+                                               crop_format=args.crop_format, crop_quality=args.crop_quality,
+                                               discovery_manifest=args.discovery_manifest)
+        results = batch_find_matching_faces(probe_paths, face_data, face_detector, args.threshold, args.top_k,
+                                            detection_max_edge=args.detection_max_edge)
+    except Exception:
+        traceback.print_exc()
+        logger.exception("Error occurred in batch search")
+        return 1
+
+    for probe_path, matches in results.items():
+        print(f'{probe_path}: {len(matches)} matches')
+        for rank, (_, file_name, _, similarity, _) in enumerate(matches, start=1):
+            print(f'  {rank}. {file_name} ({similarity:.4f})')
+
+    if args.results:
+        write_results(results, face_data, args.results)
+        print(f'Results written to {args.results}')
+    return 0
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+'''
+@file bench_embedding_heads.py
+Compare the embedding heads against the flattened feature maps: memory per face, search speed
+and how often the pooled heads return the same nearest faces.
+
+Faces are read from a folder of 224x224 crops, such as the output folder of a previous run.
+`--synthetic N` uses N random feature maps instead, which exercises memory and speed without
+TensorFlow but makes the agreement figures meaningless.
+
+The whitening is fitted on the benchmarked faces themselves, so its agreement is an upper bound.
+
+Usage:
+    python benchmarks/bench_embedding_heads.py --crops OUTPUT_FOLDER [--queries 200] [--k 10] [--json results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_heads import EMBEDDING_HEADS, PCAWhitening  # noqa: E402
+from similarity_search import FaceMatrix  # noqa: E402
+from crop_writer import iter_crop_paths  # noqa: E402
+
+BATCH_SIZE = 32
+
+
+def iter_feature_maps(args):
+    """
+    Yield batches of ResNet feature maps for the benchmarked faces.
+    """
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        for start in range(0, args.synthetic, BATCH_SIZE):
+            count = min(BATCH_SIZE, args.synthetic - start)
+            yield np.maximum(rng.normal(size=(count, 7, 7, 2048)), 0).astype(np.float32)
+        return
+
+    import cv2
+    from tensorflow.keras.applications.resnet import preprocess_input
+    from model_registry import get_resnet_model
+
+    paths = list(iter_crop_paths(args.crops))
+    if args.limit:
+        paths = paths[:args.limit]
+    for start in range(0, len(paths), BATCH_SIZE):
+        imgs = [cv2.imread(path) for path in paths[start:start + BATCH_SIZE]]
+        imgs = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs if img is not None and img.shape[:2] == (224, 224)]
+        if imgs:
+            yield get_resnet_model().predict_on_batch(preprocess_input(np.stack(imgs)))
+
+
+def as_face_data(vectors):
+    """Wrap vectors as face_data with one face per image so FaceMatrix can pack them."""
+    return {f"{i:08d}": {"file_name": str(i), "full_path": str(i), "faces": [vector]} for i, vector in enumerate(vectors)}
+
+
+def nearest(face_matrix, queries, k):
+    """
+    Time an all-queries search and return each query's k nearest rows, the query itself excluded.
+    """
+    start = time.perf_counter()
+    hits = face_matrix.search_many([face_matrix.matrix[q] for q in queries], threshold=2.1, top_k=k + 1)
+    elapsed = time.perf_counter() - start
+    return [[row for row, _ in rows if row != q][:k] for q, rows in zip(queries, hits)], elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the embedding heads against flattened feature maps.")
+    parser.add_argument('--crops', default=None, help="Folder of 224x224 face crops")
+    parser.add_argument('--synthetic', type=int, default=0, help="Use this many random feature maps instead of crops")
+    parser.add_argument('--limit', type=int, default=0, help="Use at most this many crops")
+    parser.add_argument('--queries', type=int, default=200, help="Number of faces used as probes")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours compared per probe")
+    parser.add_argument('--dims', type=int, nargs='+', default=[256, 512], help="Whitening sizes to try")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+    if not args.crops and not args.synthetic:
+        parser.error("one of --crops or --synthetic is required")
+
+    heads = {name: head_type() for name, head_type in EMBEDDING_HEADS.items()}
+    vectors = {name: [] for name in heads}
+    embed_time = {name: 0.0 for name in heads}
+    for feature_maps in iter_feature_maps(args):
+        for name, head in heads.items():
+            start = time.perf_counter()
+            vectors[name].extend(head(feature_maps))
+            embed_time[name] += time.perf_counter() - start
+
+    count = len(vectors["flat"])
+    if count < 2:
+        print("Not enough faces to benchmark.")
+        return 1
+
+    for name in [name for name in heads if name != "flat"]:
+        for dims in args.dims:
+            whitening = PCAWhitening.fit(vectors[name], dims, source_head=heads[name].pooled_id)
+            start = time.perf_counter()
+            vectors[f"{name}+pca{len(whitening.components)}"] = list(whitening.transform(np.stack(vectors[name])))
+            embed_time[f"{name}+pca{len(whitening.components)}"] = embed_time[name] + time.perf_counter() - start
+
+    queries = list(range(min(args.queries, count)))
+    results = {"faces": count, "queries": len(queries), "k": args.k, "heads": {}}
+    reference = None
+    print(f"{count} faces, {len(queries)} probes, top {args.k}")
+    print(f"{'head':16s} {'dims':>7s} {'KB/face':>8s} {'matrix MB':>10s} {'build s':>8s} {'ms/probe':>9s} {'top-k agree':>11s}")
+    for name, head_vectors in vectors.items():
+        start = time.perf_counter()
+        face_matrix = FaceMatrix(as_face_data(head_vectors))
+        build_time = time.perf_counter() - start
+        neighbours, search_time = nearest(face_matrix, queries, args.k)
+        if reference is None:
+            reference = neighbours
+        agreement = np.mean([len(set(a) & set(b)) / max(1, len(a)) for a, b in zip(neighbours, reference)])
+
+        row = {"dims": face_matrix.dim, "bytes_per_face": int(head_vectors[0].nbytes),
+               "matrix_bytes": int(face_matrix.matrix.nbytes), "embed_s": embed_time[name], "build_s": build_time,
+               "search_ms_per_probe": search_time / len(queries) * 1000, "topk_agreement": float(agreement)}
+        results["heads"][name] = row
+        print(f"{name:16s} {row['dims']:7d} {row['bytes_per_face'] / 1024:8.1f} {row['matrix_bytes'] / 2**20:10.1f} "
+              f"{build_time:8.3f} {row['search_ms_per_probe']:9.3f} {agreement:11.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
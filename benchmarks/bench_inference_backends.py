@@ -0,0 +1,188 @@
+'''
+@file bench_inference_backends.py
+Compare the quantised TFLite inference backends against the Keras models: per-face latency,
+batched throughput, and how closely their outputs agree with the Keras reference.
+
+The embedder is measured on a folder of 224x224 face crops, such as the output folder of a
+previous run, or on `--synthetic N` random crops. Its agreement is the cosine similarity between
+each face's Keras and TFLite vectors, both for the flattened feature map and the GeM head. With
+`--images`, MTCNN is measured on those images as well, and its agreement is the fraction of
+images with the same number of faces and the mean IoU of their boxes.
+
+TFLite models missing from the model folder are exported first, which takes a while once.
+
+Usage:
+    python benchmarks/bench_inference_backends.py --crops OUTPUT_FOLDER [--images IMAGE_FOLDER] [--json results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_backends import (INFERENCE_BACKENDS, KERAS_BACKEND, DEFAULT_MODEL_DIR, RESNET_INPUT_SHAPE,  # noqa: E402
+                                build_tflite_face_detector, build_tflite_resnet)
+from model_registry import build_face_detector, build_resnet_model  # noqa: E402
+from embedding_heads import GeMHead  # noqa: E402
+from crop_writer import iter_crop_paths  # noqa: E402
+
+BATCH_SIZE = 32
+# Faces timed one at a time for the latency figures
+LATENCY_FACES = 50
+
+
+def load_crops(args):
+    """
+    Return the benchmarked faces, preprocessed for ResNet.
+    """
+    import cv2
+    from tensorflow.keras.applications.resnet import preprocess_input
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        crops = rng.integers(0, 256, size=(args.synthetic,) + RESNET_INPUT_SHAPE, dtype=np.uint8)
+    else:
+        paths = list(iter_crop_paths(args.crops))[:args.limit or None]
+        crops = [cv2.imread(path) for path in paths]
+        crops = np.stack([cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) for crop in crops
+                          if crop is not None and crop.shape == RESNET_INPUT_SHAPE])
+    return preprocess_input(crops.astype(np.float32))
+
+
+def load_images(folder, limit):
+    """
+    Return the RGB images MTCNN is benchmarked on.
+    """
+    import cv2
+    from face_detection import is_valid_image_extension
+
+    names = sorted(name for name in os.listdir(folder) if is_valid_image_extension(name))[:limit or None]
+    images = [cv2.imread(os.path.join(folder, name)) for name in names]
+    return [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in images if img is not None]
+
+
+def cosine(a, b):
+    """Row-wise cosine similarity of two batches of vectors."""
+    a = a.reshape(len(a), -1)
+    b = b.reshape(len(b), -1)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)
+
+
+def bench_embedder(model, crops):
+    """
+    Time a ResNet model one face at a time and in batches, returning the timings and its feature maps.
+    """
+    model.predict_on_batch(crops[:1])  # first call allocates and compiles
+
+    latency_faces = min(LATENCY_FACES, len(crops))
+    start = time.perf_counter()
+    for i in range(latency_faces):
+        model.predict_on_batch(crops[i:i + 1])
+    latency = (time.perf_counter() - start) / latency_faces
+
+    start = time.perf_counter()
+    feature_maps = np.concatenate([np.asarray(model.predict_on_batch(crops[i:i + BATCH_SIZE]))
+                                   for i in range(0, len(crops), BATCH_SIZE)])
+    throughput = len(crops) / (time.perf_counter() - start)
+    return {"ms_per_face": latency * 1000, "faces_per_s": throughput}, feature_maps
+
+
+def box_iou(a, b):
+    """Intersection over union of two [x, y, width, height] boxes."""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def bench_detector(face_detector, images):
+    """
+    Time MTCNN on every image, returning the timing and the detected boxes of each image.
+    """
+    face_detector.detect_faces(images[0])
+    start = time.perf_counter()
+    boxes = [[face['box'] for face in face_detector.detect_faces(img)] for img in images]
+    return {"ms_per_image": (time.perf_counter() - start) / len(images) * 1000}, boxes
+
+
+def detection_agreement(boxes, reference):
+    """
+    Fraction of images with as many faces as the reference, and the mean IoU of each reference
+    box with its best match.
+    """
+    same_count = np.mean([len(a) == len(b) for a, b in zip(boxes, reference)])
+    ious = [max((box_iou(ref_box, box) for box in image_boxes), default=0.0)
+            for image_boxes, ref_boxes in zip(boxes, reference) for ref_box in ref_boxes]
+    return float(same_count), float(np.mean(ious)) if ious else 1.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the TFLite inference backends against Keras.")
+    parser.add_argument('--crops', default=None, help="Folder of 224x224 face crops")
+    parser.add_argument('--synthetic', type=int, default=0, help="Use this many random crops instead")
+    parser.add_argument('--limit', type=int, default=256, help="Use at most this many crops or images")
+    parser.add_argument('--images', default=None, help="Folder of images to benchmark MTCNN on")
+    parser.add_argument('--backends', nargs='+', choices=list(INFERENCE_BACKENDS), default=list(INFERENCE_BACKENDS),
+                        help="Backends to compare; keras is always measured as the reference")
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR, help="Folder of the exported TFLite models")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+    if not args.crops and not args.synthetic:
+        parser.error("one of --crops or --synthetic is required")
+
+    backends = [KERAS_BACKEND] + [backend for backend in args.backends if backend != KERAS_BACKEND]
+    crops = load_crops(args)
+    if len(crops) == 0:
+        print("No face crops to benchmark.")
+        return 1
+    images = load_images(args.images, args.limit) if args.images else []
+
+    gem = GeMHead()
+    results = {"faces": len(crops), "images": len(images), "backends": {}}
+    reference_maps = reference_boxes = None
+    print(f"{len(crops)} faces, {len(images)} images")
+    print(f"{'backend':12s} {'ms/face':>8s} {'faces/s':>8s} {'cos flat':>9s} {'cos min':>8s} {'cos gem':>8s} "
+          f"{'ms/image':>9s} {'same #':>7s} {'box IoU':>8s}")
+    for backend in backends:
+        if backend == KERAS_BACKEND:
+            resnet_model = build_resnet_model()
+        else:
+            resnet_model = build_tflite_resnet(backend, args.model_dir)
+        row, feature_maps = bench_embedder(resnet_model, crops)
+        del resnet_model
+        if reference_maps is None:
+            reference_maps = feature_maps
+        flat_cosine = cosine(feature_maps, reference_maps)
+        gem_cosine = cosine(np.stack(gem(feature_maps)), np.stack(gem(reference_maps)))
+        row.update(cosine_flat_mean=float(flat_cosine.mean()), cosine_flat_min=float(flat_cosine.min()),
+                   cosine_gem_mean=float(gem_cosine.mean()))
+
+        line = (f"{backend:12s} {row['ms_per_face']:8.2f} {row['faces_per_s']:8.1f} {row['cosine_flat_mean']:9.4f} "
+                f"{row['cosine_flat_min']:8.4f} {row['cosine_gem_mean']:8.4f}")
+        if images:
+            if backend == KERAS_BACKEND:
+                face_detector = build_face_detector()
+            else:
+                face_detector = build_tflite_face_detector(backend, args.model_dir)
+            detection, boxes = bench_detector(face_detector, images)
+            if reference_boxes is None:
+                reference_boxes = boxes
+            detection["same_face_count"], detection["box_iou"] = detection_agreement(boxes, reference_boxes)
+            row.update(detection)
+            line += f" {row['ms_per_image']:9.1f} {row['same_face_count']:7.3f} {row['box_iou']:8.3f}"
+        results["backends"][backend] = row
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
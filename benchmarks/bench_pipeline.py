@@ -0,0 +1,308 @@
+'''
+@file bench_pipeline.py
+End-to-end benchmark of indexing a folder and searching it, with the time of every stage.
+
+The corpus is a synthetic one from `synthetic_corpus` (generated on first use and reused while its
+settings don't change) or any folder of images given with `--corpus`. Two kinds of figures are
+reported:
+
+- stages: each image is taken through discovery, reading, hashing, decoding, EXIF parsing, MTCNN
+  detection, alignment, ResNet embedding, crop writing and matching one stage at a time, so every
+  stage is timed on its own, with its total, mean, p50, p95 and items per second.
+- end_to_end: `save_faces_from_folder` on a fresh output folder, the same again restoring
+  everything from its embedding store, and `find_matching_face` for a few probe images.
+
+Models are loaded before anything is timed and their load times are reported apart. TensorFlow
+is kept off the GPU unless `--gpu` is given, so figures from different machines compare CPU to CPU.
+The results are printed as a table and, with `--json`, written with the environment and settings
+so runs of different releases can be compared.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--count 200] [--size 1920x1080] [--face-source CROPS] [--json results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from importlib import metadata
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_corpus import add_corpus_arguments, generate_corpus  # noqa: E402
+from inference_backends import INFERENCE_BACKENDS, DEFAULT_INFERENCE_BACKEND  # noqa: E402
+from embedding_heads import EMBEDDING_HEADS, DEFAULT_EMBEDDING_HEAD  # noqa: E402
+from crop_writer import CROP_FORMATS, DEFAULT_CROP_FORMAT  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Version of the layout of the JSON results
+RESULTS_SCHEMA = 1
+STAGES = ["discovery", "read", "hash", "decode", "exif", "detect", "align", "embed", "write", "index", "match"]
+PACKAGES = ["numpy", "Pillow", "tensorflow", "mtcnn"]
+
+
+def stage_stats(samples, items=None):
+    """
+    Summarise the timings of a stage.
+
+    Parameters:
+    - samples (list): Seconds taken by each call of the stage.
+    - items (int, optional): Items the stage processed, if not one per call (e.g. faces per batch).
+
+    Returns:
+    - dict: Calls, items, total seconds, mean, p50, p95 and max milliseconds per call, and items per second.
+    """
+    times = np.asarray(samples, dtype=np.float64)
+    if not len(times):
+        return {"calls": 0, "items": 0, "total_s": 0.0}
+    total = float(times.sum())
+    items = len(times) if items is None else items
+    return {"calls": len(times), "items": items, "total_s": total, "mean_ms": float(times.mean() * 1000),
+            "p50_ms": float(np.percentile(times, 50) * 1000), "p95_ms": float(np.percentile(times, 95) * 1000),
+            "max_ms": float(times.max() * 1000), "per_s": items / total if total > 0 else None}
+
+
+def environment():
+    """Describe the machine and software the benchmark ran on."""
+    versions = {}
+    for package in PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    # OpenCV comes in several differently named wheels
+    versions["opencv"] = cv2.__version__
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(), "python": platform.python_version(), "packages": versions,
+            "git_commit": commit or None, "cuda_visible_devices": os.environ.get("CUDA_VISIBLE_DEVICES")}
+
+
+def time_call(func, *args, **kwargs):
+    """Call a function, returning its result and the seconds it took."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_stages(folder, output_folder, face_detector, args):
+    """
+    Take every image through the pipeline one stage at a time.
+
+    Returns:
+    - tuple: (stage statistics, face_data of the embedded faces, number of faces detected).
+    """
+    from face_detection import (EMBEDDING_BATCH_SIZE, find_image_paths, get_image_exif_data, detect_faces_in_image,
+                                extract_aligned_faces, convert_images_to_vectors, new_face_entry)
+    from image_loader import ImageBuffer
+    from crop_writer import CropWriter
+    from similarity_search import FaceMatrix
+
+    samples = {stage: [] for stage in STAGES}
+    items = {}
+    image_paths, elapsed = time_call(find_image_paths, folder)
+    samples["discovery"].append(elapsed)
+    items["discovery"] = len(image_paths)
+
+    face_data = {}
+    crops = []  # (img_hash, face image)
+    faces_detected = 0
+    for image_path in image_paths:
+        image = ImageBuffer.read(image_path)
+        samples["read"].append(image.read_s)
+        img_hash, elapsed = time_call(image.md5)
+        samples["hash"].append(elapsed)
+        exif_data, elapsed = time_call(get_image_exif_data, image_path, image)
+        samples["exif"].append(elapsed)
+
+        img, detected_faces, timing = detect_faces_in_image(image, face_detector, args.detection_max_edge)
+        samples["decode"].append(timing["decode_s"])
+        samples["detect"].append(timing["detect_s"])
+        faces_detected += len(detected_faces)
+        # Exact duplicates are skipped by the pipeline before detection, so only the first copy counts
+        if img is None or not detected_faces or img_hash in face_data:
+            continue
+        aligned, elapsed = time_call(extract_aligned_faces, img, detected_faces)
+        samples["align"].append(elapsed)
+        face_data[img_hash] = new_face_entry(image_path, exif_data)
+        crops.extend((img_hash, face_img) for _, face_img in aligned)
+
+    for start in range(0, len(crops), EMBEDDING_BATCH_SIZE):
+        batch = [face_img for _, face_img in crops[start:start + EMBEDDING_BATCH_SIZE]]
+        vectors, elapsed = time_call(convert_images_to_vectors, batch)
+        samples["embed"].append(elapsed)
+        for (img_hash, _), vector in zip(crops[start:start + EMBEDDING_BATCH_SIZE], vectors):
+            face_data[img_hash]["faces"].append(vector)
+    items["embed"] = len(crops)
+
+    start = time.perf_counter()
+    with CropWriter(output_folder, args.crop_format, args.crop_quality) as writer:
+        for (img_hash, face_img), n in zip(crops, face_numbers(crops)):
+            crop_name = writer.crop_name(img_hash, n)
+            face_data[img_hash]["crop_names"].append(crop_name)
+            writer.write(crop_name, face_img)
+    # Crops are written on a background thread, so only the total until the last one is on disk is known
+    samples["write"].append(time.perf_counter() - start)
+    items["write"] = len(crops)
+
+    face_matrix, elapsed = time_call(FaceMatrix, face_data)
+    samples["index"].append(elapsed)
+    items["index"] = len(face_matrix)
+    # Every embedded face is searched for once, so each search finds at least itself
+    for _, face_entry in face_data.items():
+        for face_vector in face_entry["faces"]:
+            _, elapsed = time_call(face_matrix.find_matches, face_vector, args.threshold)
+            samples["match"].append(elapsed)
+
+    stats = {stage: stage_stats(samples[stage], items.get(stage)) for stage in STAGES}
+    return stats, face_data, faces_detected
+
+
+def face_numbers(crops):
+    """Yield the 1 based number of each crop among the crops of its image."""
+    seen = {}
+    for img_hash, _ in crops:
+        seen[img_hash] = seen.get(img_hash, 0) + 1
+        yield seen[img_hash]
+
+
+def run_end_to_end(folder, output_folder, face_detector, args):
+    """
+    Index the folder from scratch, index it again from the embedding store, and search it.
+
+    Returns:
+    - dict: Wall times and throughputs of each run.
+    """
+    from face_detection import save_faces_from_folder, find_matching_face, find_image_paths
+    from embedding_store import EmbeddingStore, STORE_FILE_NAME
+    from similarity_search import FaceMatrix
+
+    image_paths = find_image_paths(folder)
+    results = {}
+    with EmbeddingStore(os.path.join(output_folder, STORE_FILE_NAME)) as store:
+        for run in ("cold", "warm"):
+            face_data, elapsed = time_call(save_faces_from_folder, folder, output_folder, face_detector, store=store,
+                                           workers=args.workers, detection_max_edge=args.detection_max_edge,
+                                           crop_format=args.crop_format, crop_quality=args.crop_quality)
+            faces = sum(len(face_entry["faces"]) for face_entry in face_data.values())
+            results[f"index_{run}"] = {"total_s": elapsed, "images": len(image_paths), "faces": faces,
+                                       "images_per_s": len(image_paths) / elapsed if elapsed > 0 else None,
+                                       "faces_per_s": faces / elapsed if elapsed > 0 else None}
+
+    face_matrix = FaceMatrix(face_data)
+    searches = []
+    matches = 0
+    for probe_path in image_paths[:args.probes]:
+        found, elapsed = time_call(find_matching_face, probe_path, face_data, face_detector, args.threshold,
+                                   face_matrix=face_matrix, detection_max_edge=args.detection_max_edge)
+        searches.append(elapsed)
+        matches += len(found)
+    results["search"] = stage_stats(searches)
+    results["search"]["matches"] = matches
+    return results
+
+
+def print_results(results):
+    print(f"{'stage':10s} {'calls':>7s} {'items':>7s} {'total s':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'items/s':>9s}")
+    for stage, stats in results["stages"].items():
+        if not stats["calls"]:
+            continue
+        per_s = f"{stats['per_s']:9.1f}" if stats["per_s"] else f"{'-':>9s}"
+        print(f"{stage:10s} {stats['calls']:7d} {stats['items']:7d} {stats['total_s']:9.3f} "
+              f"{stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {per_s}")
+    for run, stats in results.get("end_to_end", {}).items():
+        if run == "search":
+            if stats["calls"]:
+                print(f"search     {stats['calls']} probes, p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, "
+                      f"{stats['matches']} matches")
+            continue
+        print(f"{run:10s} {stats['total_s']:.2f}s, {stats['images_per_s'] or 0:.2f} images/s, "
+              f"{stats['faces_per_s'] or 0:.2f} faces/s ({stats['faces']} faces)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of indexing and searching a folder.")
+    parser.add_argument('--corpus', default=None,
+                        help="Folder of images to benchmark; a synthetic corpus is generated in it if it holds none")
+    add_corpus_arguments(parser)
+    parser.add_argument('--embedding-head', choices=list(EMBEDDING_HEADS), default=DEFAULT_EMBEDDING_HEAD,
+                        help="How ResNet feature maps are turned into face vectors")
+    parser.add_argument('--inference-backend', choices=list(INFERENCE_BACKENDS), default=DEFAULT_INFERENCE_BACKEND,
+                        help="Run the models with Keras or as quantised TFLite exports")
+    parser.add_argument('--model-dir', default=None, help="Folder of the exported TFLite models")
+    parser.add_argument('--detection-max-edge', type=int, default=None,
+                        help="Detect faces on images scaled down to this longest edge")
+    parser.add_argument('--crop-format', choices=list(CROP_FORMATS), default=DEFAULT_CROP_FORMAT,
+                        help="Image format of the face crops")
+    parser.add_argument('--crop-quality', type=int, default=None, help="Quality of the face crops")
+    parser.add_argument('--workers', type=int, default=None, help="Detection processes for the end-to-end runs")
+    parser.add_argument('--threshold', type=float, default=.75, help="Maximum cosine distance for a match")
+    parser.add_argument('--probes', type=int, default=5, help="Corpus images searched for in the end-to-end run")
+    parser.add_argument('--skip-end-to-end', action='store_true', help="Only time the stages")
+    parser.add_argument('--gpu', action='store_true', help="Let TensorFlow use a GPU")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    if not args.gpu:
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+
+    from console_verbosity import QUIET, set_verbosity
+    from embedding_heads import create_embedding_head, set_embedding_head
+    from model_registry import get_face_detector, get_resnet_model, set_inference_backend
+    from face_detection import find_image_paths
+
+    work_folder = tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        corpus = args.corpus or os.path.join(work_folder, "corpus")
+        manifest = None
+        if not args.corpus or not find_image_paths(args.corpus):
+            start = time.perf_counter()
+            manifest = generate_corpus(corpus, args.count, args.size, args.faces_per_image, args.seed, args.face_source)
+            print(f"Generated {len(manifest['images'])} images with {manifest['faces']} faces "
+                  f"in {time.perf_counter() - start:.1f}s")
+
+        set_verbosity(QUIET)
+        set_embedding_head(create_embedding_head(args.embedding_head))
+        set_inference_backend(args.inference_backend, args.model_dir)
+        face_detector, detector_load_s = time_call(get_face_detector)
+        _, resnet_load_s = time_call(get_resnet_model)
+
+        image_paths = find_image_paths(corpus)
+        results = {"schema": RESULTS_SCHEMA, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                   "environment": environment(), "settings": {k: v for k, v in vars(args).items() if k != "json"},
+                   "corpus": {"folder": os.path.abspath(corpus), "images": len(image_paths),
+                              "bytes": sum(os.path.getsize(path) for path in image_paths),
+                              "faces_placed": manifest["faces"] if manifest else None,
+                              "synthetic": manifest["settings"] if manifest else None},
+                   "models": {"face_detector_load_s": detector_load_s, "resnet_load_s": resnet_load_s}}
+
+        stages, _, faces_detected = run_stages(corpus, os.path.join(work_folder, "stages"), face_detector, args)
+        results["stages"] = stages
+        results["corpus"]["faces_detected"] = faces_detected
+        results["corpus"]["faces_embedded"] = stages["embed"]["items"]
+        if not args.skip_end_to_end:
+            results["end_to_end"] = run_end_to_end(corpus, os.path.join(work_folder, "end_to_end"), face_detector, args)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    print(f"{results['corpus']['images']} images, {faces_detected} faces detected, "
+          f"{results['corpus']['faces_embedded']} embedded")
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,72 @@
+'''
+@file bench_startup.py
+Measure cold-start cost: importing the backend and GUI modules, and loading each model.
+
+Every measurement runs in a fresh interpreter so module and model caches don't carry over.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat N] [--json results.json]
+'''
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each snippet prints the seconds taken by the measured step
+CASES = {
+    "import face_detection": "import face_detection",
+    "import face_matcher_app_class": "import face_matcher_app_class",
+    "load mtcnn": "import model_registry\nmodel_registry.get_face_detector()",
+    "load resnet152": "import model_registry\nmodel_registry.get_resnet_model()",
+}
+
+TIMER = '''
+import time
+start = time.perf_counter()
+{code}
+print("ELAPSED", time.perf_counter() - start)
+'''
+
+
+def time_case(code):
+    """
+    Run a snippet in a fresh interpreter inside the repository and return the seconds it took.
+    """
+    result = subprocess.run([sys.executable, "-c", TIMER.format(code=code)], cwd=REPO_DIR,
+                            capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        if line.startswith("ELAPSED "):
+            return float(line.split()[1])
+    raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "no timing printed")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import and model loading times.")
+    parser.add_argument('--repeat', type=int, default=3, help="Fresh interpreters per measurement")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, code in CASES.items():
+        try:
+            times = [time_case(code) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:32s} failed: {e}")
+            results[name] = {"error": str(e)}
+            continue
+        results[name] = {"median_s": statistics.median(times), "min_s": min(times), "runs": times}
+        print(f"{name:32s} median {statistics.median(times):7.3f}s  min {min(times):7.3f}s")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
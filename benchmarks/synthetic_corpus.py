@@ -0,0 +1,303 @@
+'''
+@file synthetic_corpus.py
+Deterministic synthetic image folders for benchmarking the face pipeline offline.
+
+Every image is a random background with a number of faces pasted on it, and EXIF make, model,
+date and GPS tags so the EXIF stage has work to do. Faces are either rendered from simple shapes
+or, with `--face-source`, augmented copies of real face crops (flipped, scaled, rotated and
+relit), for example the output folder of an earlier run. MTCNN finds the augmented faces far more
+reliably than the rendered ones, so use a face source when detection and embedding figures matter.
+
+Image `i` is drawn from its own random generator seeded with (seed, i), so a corpus is the same on
+every machine and the first N images of a larger corpus are the same as an N image corpus.
+A manifest.json next to the images records the settings and the box of every pasted face.
+
+Usage:
+    python benchmarks/synthetic_corpus.py OUTPUT_FOLDER [--count 200] [--size 1920x1080] [--faces-per-image 1-3] [--face-source CROPS]
+'''
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crop_writer import iter_crop_paths  # noqa: E402
+
+MANIFEST_FILE_NAME = "manifest.json"
+JPEG_QUALITY = 90
+
+# Face height as a fraction of the image's shorter edge
+FACE_SCALE_RANGE = (0.15, 0.4)
+SKIN_TONES = [(198, 224, 255), (160, 195, 234), (120, 160, 205), (80, 120, 170), (50, 80, 120)]  # BGR
+HAIR_COLOURS = [(20, 20, 20), (30, 50, 90), (60, 90, 140), (150, 170, 190), (40, 40, 60)]
+
+# EXIF tag numbers
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_IFD = 0x8769
+EXIF_DATETIME_DIGITIZED = 0x9004
+GPS_IFD = 0x8825
+CAMERAS = [("Canon", "EOS 80D"), ("NIKON CORPORATION", "NIKON D750"), ("Apple", "iPhone 12"), ("samsung", "SM-G991B")]
+
+
+def parse_size(text):
+    """Parse a WIDTHxHEIGHT image size."""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_range(text):
+    """Parse a face count given as N or MIN-MAX into (min, max)."""
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def render_face(rng, height):
+    """
+    Draw a frontal face from ellipses, with eyes, brows, nose and mouth where MTCNN expects them.
+
+    Parameters:
+    - rng (numpy.random.Generator): Random generator of the image.
+    - height (int): Height of the face in pixels.
+
+    Returns:
+    - tuple: (BGR face image, mask of the face) of size height x 3/4 height.
+    """
+    width = max(8, int(height * 0.75))
+    face = np.zeros((height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    centre = (width // 2, int(height * 0.55))
+    axes = (int(width * 0.45), int(height * 0.43))
+    skin = tuple(int(c) for c in SKIN_TONES[rng.integers(len(SKIN_TONES))])
+    hair = tuple(int(c) for c in HAIR_COLOURS[rng.integers(len(HAIR_COLOURS))])
+
+    cv2.ellipse(face, (centre[0], int(height * 0.4)), (int(width * 0.5), int(height * 0.4)), 0, 180, 360, hair, -1)
+    cv2.ellipse(mask, (centre[0], int(height * 0.4)), (int(width * 0.5), int(height * 0.4)), 0, 180, 360, 255, -1)
+    cv2.ellipse(face, centre, axes, 0, 0, 360, skin, -1)
+    cv2.ellipse(mask, centre, axes, 0, 0, 360, 255, -1)
+
+    # Shading towards the edges of the face
+    ys, xs = np.mgrid[0:height, 0:width]
+    distance = ((xs - centre[0]) / axes[0]) ** 2 + ((ys - centre[1]) / axes[1]) ** 2
+    shade = np.clip(1.05 - 0.35 * distance, 0.6, 1.0)[..., None]
+    face = (face * shade).astype(np.uint8)
+
+    eye_y = int(height * 0.47)
+    eye_dx = int(width * 0.2)
+    eye_axes = (max(2, int(width * 0.09)), max(1, int(height * 0.035)))
+    iris = int(rng.integers(20, 90))
+    for eye_x in (centre[0] - eye_dx, centre[0] + eye_dx):
+        cv2.ellipse(face, (eye_x, eye_y), eye_axes, 0, 0, 360, (235, 235, 235), -1)
+        cv2.circle(face, (eye_x, eye_y), max(1, eye_axes[1]), (iris, iris // 2, iris // 3), -1)
+        cv2.circle(face, (eye_x, eye_y), max(1, eye_axes[1] // 2), (10, 10, 10), -1)
+        cv2.line(face, (eye_x - eye_axes[0], eye_y - 2 * eye_axes[1] - 2), (eye_x + eye_axes[0], eye_y - 2 * eye_axes[1] - 3),
+                 hair, max(1, height // 40))
+
+    nose_top, nose_bottom = (centre[0], int(height * 0.5)), (centre[0], int(height * 0.66))
+    nostril = tuple(int(c * 0.7) for c in skin)
+    cv2.line(face, nose_top, nose_bottom, nostril, max(1, height // 60))
+    cv2.ellipse(face, nose_bottom, (max(2, int(width * 0.07)), max(1, height // 50)), 0, 0, 180, nostril, -1)
+
+    lips = (int(skin[0] * 0.5), int(skin[1] * 0.45), min(255, int(skin[2] * 0.85)))
+    cv2.ellipse(face, (centre[0], int(height * 0.77)), (int(width * 0.15), max(1, int(height * 0.03))), 0, 0, 360, lips, -1)
+
+    blur = max(1, height // 80) * 2 + 1
+    return cv2.GaussianBlur(face, (blur, blur), 0), mask
+
+
+def augment_face(rng, crop, height):
+    """
+    Turn a real face crop into a new face: flipped, rotated a little, relit and scaled to `height`.
+
+    Returns:
+    - tuple: (BGR face image, mask of the face).
+    """
+    if rng.random() < 0.5:
+        crop = cv2.flip(crop, 1)
+    angle = float(rng.uniform(-10, 10))
+    h, w = crop.shape[:2]
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    crop = cv2.warpAffine(crop, rotation, (w, h), borderMode=cv2.BORDER_REFLECT)
+    gain, offset = float(rng.uniform(0.75, 1.25)), float(rng.uniform(-25, 25))
+    crop = np.clip(crop.astype(np.float32) * gain + offset, 0, 255).astype(np.uint8)
+    width = max(8, int(height * w / h))
+    face = cv2.resize(crop, (width, height), interpolation=cv2.INTER_AREA)
+
+    # Feathered elliptical mask so the crop's own background blends in
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (int(width * 0.48), int(height * 0.48)), 0, 0, 360, 255, -1)
+    feather = max(1, height // 20) * 2 + 1
+    return face, cv2.GaussianBlur(mask, (feather, feather), 0)
+
+
+def make_background(rng, width, height):
+    """Draw a gradient with random blocks and noise, so decoding and detection see some texture."""
+    top = rng.integers(0, 256, 3).astype(np.float32)
+    bottom = rng.integers(0, 256, 3).astype(np.float32)
+    ramp = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    img = np.broadcast_to(top * (1 - ramp) + bottom * ramp, (height, width, 3)).copy()
+    for _ in range(int(rng.integers(5, 20))):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(width // 20, width // 3)), int(rng.integers(height // 20, height // 3))
+        cv2.rectangle(img, (x, y), (x + w, y + h), tuple(float(c) for c in rng.integers(0, 256, 3)), -1)
+    img += rng.normal(0, 6, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def paste(img, face, mask, x, y):
+    """Alpha blend a face into the image at (x, y)."""
+    h, w = mask.shape
+    alpha = (mask.astype(np.float32) / 255)[..., None]
+    region = img[y:y + h, x:x + w].astype(np.float32)
+    img[y:y + h, x:x + w] = (face * alpha + region * (1 - alpha)).astype(np.uint8)
+
+
+def place_faces(rng, img, count, face_crops):
+    """
+    Paste up to `count` faces into the image without overlapping each other.
+
+    Returns:
+    - list: [x, y, width, height] box of every pasted face.
+    """
+    height, width = img.shape[:2]
+    boxes = []
+    for _ in range(count):
+        face_height = int(min(width, height) * rng.uniform(*FACE_SCALE_RANGE))
+        if face_crops:
+            face, mask = augment_face(rng, face_crops[rng.integers(len(face_crops))], face_height)
+        else:
+            face, mask = render_face(rng, face_height)
+        h, w = mask.shape
+        if w >= width or h >= height:
+            continue
+        # A few attempts at a free spot; crowded images simply get fewer faces
+        for _ in range(20):
+            x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+            if all(x + w <= bx or bx + bw <= x or y + h <= by or by + bh <= y for bx, by, bw, bh in boxes):
+                paste(img, face, mask, x, y)
+                boxes.append([x, y, w, h])
+                break
+    return boxes
+
+
+def dms(value):
+    """Split a positive decimal degree value into EXIF degrees, minutes and seconds."""
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600, 2)
+    return (float(degrees), float(minutes), seconds)
+
+
+def make_exif(rng):
+    """Return EXIF tags with a camera, a capture date and a GPS position, as read by get_image_exif_data."""
+    exif = Image.Exif()
+    make, model = CAMERAS[rng.integers(len(CAMERAS))]
+    exif[EXIF_MAKE] = make
+    exif[EXIF_MODEL] = model
+    day = int(rng.integers(0, 365 * 10))
+    year, day_of_year = 2014 + day // 365, day % 365
+    exif.get_ifd(EXIF_IFD)[EXIF_DATETIME_DIGITIZED] = (
+        f"{year}:{day_of_year // 31 % 12 + 1:02d}:{day_of_year % 28 + 1:02d} "
+        f"{int(rng.integers(0, 24)):02d}:{int(rng.integers(0, 60)):02d}:{int(rng.integers(0, 60)):02d}")
+    latitude, longitude = float(rng.uniform(-80, 80)), float(rng.uniform(-180, 180))
+    gps = exif.get_ifd(GPS_IFD)
+    gps[1], gps[2] = ('N' if latitude >= 0 else 'S'), dms(abs(latitude))
+    gps[3], gps[4] = ('E' if longitude >= 0 else 'W'), dms(abs(longitude))
+    return exif
+
+
+def load_face_crops(folder, limit=500):
+    """Read up to `limit` face crops to augment."""
+    crops = []
+    for path in iter_crop_paths(folder):
+        crop = cv2.imread(path)
+        if crop is not None:
+            crops.append(crop)
+            if len(crops) >= limit:
+                break
+    return crops
+
+
+def generate_image(seed, i, size, faces_per_image, face_crops=None):
+    """
+    Draw image `i` of a corpus.
+
+    Returns:
+    - tuple: (BGR image, face boxes, PIL EXIF tags).
+    """
+    rng = np.random.default_rng([seed, i])
+    width, height = size
+    img = make_background(rng, width, height)
+    boxes = place_faces(rng, img, int(rng.integers(faces_per_image[0], faces_per_image[1] + 1)), face_crops)
+    return img, boxes, make_exif(rng)
+
+
+def generate_corpus(output_folder, count, size=(1920, 1080), faces_per_image=(1, 3), seed=0, face_source=None):
+    """
+    Write a synthetic corpus and its manifest. An existing corpus with the same settings is reused.
+
+    Parameters:
+    - output_folder (str): Folder the JPEG images are written to.
+    - count (int): Number of images.
+    - size (tuple): (width, height) of the images.
+    - faces_per_image (tuple): Smallest and largest number of faces per image.
+    - seed (int): Seed of the corpus.
+    - face_source (str, optional): Folder of face crops to augment instead of rendering faces.
+
+    Returns:
+    - dict: The manifest, with the settings and the path and face boxes of every image.
+    """
+    settings = {"count": count, "size": list(size), "faces_per_image": list(faces_per_image), "seed": seed,
+                "face_source": os.path.abspath(face_source) if face_source else None}
+    manifest_path = os.path.join(output_folder, MANIFEST_FILE_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("settings") == settings:
+            return manifest
+
+    face_crops = load_face_crops(face_source) if face_source else None
+    if face_source and not face_crops:
+        raise ValueError(f"No face crops found in {face_source}")
+    os.makedirs(output_folder, exist_ok=True)
+    images = []
+    for i in range(count):
+        img, boxes, exif = generate_image(seed, i, size, faces_per_image, face_crops)
+        name = f"synthetic_{i + 1:06d}.jpg"
+        Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).save(os.path.join(output_folder, name), quality=JPEG_QUALITY,
+                                                                   exif=exif)
+        images.append({"file_name": name, "faces": boxes})
+
+    manifest = {"settings": settings, "faces": sum(len(image["faces"]) for image in images), "images": images}
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def add_corpus_arguments(parser):
+    """Add the corpus settings to an argument parser."""
+    parser.add_argument('--count', type=int, default=200, help="Number of images")
+    parser.add_argument('--size', type=parse_size, default=(1920, 1080), help="Image size as WIDTHxHEIGHT")
+    parser.add_argument('--faces-per-image', type=parse_range, default=(1, 3), help="Faces per image, as N or MIN-MAX")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the corpus")
+    parser.add_argument('--face-source', default=None, help="Folder of face crops to augment instead of rendering faces")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic image corpus.")
+    parser.add_argument('output_folder', help="Folder for the images and manifest.json")
+    add_corpus_arguments(parser)
+    args = parser.parse_args(argv)
+
+    manifest = generate_corpus(args.output_folder, args.count, args.size, args.faces_per_image, args.seed, args.face_source)
+    print(f"{len(manifest['images'])} images with {manifest['faces']} faces in {args.output_folder}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
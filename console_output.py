@@ -1,23 +1,78 @@
-from PyQt6.QtWidgets import QTextEdit, QVBoxLayout, QWidget
-from PyQt6.QtCore import QThread, pyqtSignal
+'''
+@file console_output.py
+Console panel showing everything printed to standard output.
+
+Printing from the pipeline only appends to a buffer. A timer on the GUI thread moves the buffered
+lines into the panel a few times a second in a single append, so a burst of per-face messages costs
+the event loop one update instead of one per line. Both the buffer and the panel keep a bounded
+number of lines, dropping the oldest ones first.
+'''
+
 import sys
+import threading
+from collections import deque
+from PyQt6.QtWidgets import QPlainTextEdit, QVBoxLayout, QHBoxLayout, QWidget, QLabel, QComboBox
+from PyQt6.QtCore import QTimer
+from console_verbosity import VERBOSITY_LEVELS, NORMAL, get_verbosity, set_verbosity
+
+# How often buffered lines are moved into the panel
+FLUSH_INTERVAL_MS = 100
+# Lines kept in the panel, and in the buffer between two flushes
+MAX_RETAINED_LINES = 5000
+
 
-class ConsoleOutputThread(QThread):
-    '''A thread that captures standard output and emits it as a signal.'''
-    
-    signal = pyqtSignal(str)  # signal to emit text
+class BufferedConsoleSink:
+    '''
+    File-like replacement of standard output that buffers complete lines for the console panel.
+
+    `write` may be called from any thread and never touches Qt. The lines are kept in a ring
+    buffer, so if the panel falls behind only the most recent `max_lines` are shown.
+    '''
+
+    def __init__(self, max_lines=MAX_RETAINED_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0  # Lines pushed out of the buffer before they were shown
+        self._partial = ""
+        self._lock = threading.Lock()
 
     def write(self, s):
-        '''Capture write calls and emit as signal.'''
-        self.signal.emit(s)  # emit the signal with the text
+        '''Buffer text, keeping an unfinished last line until the rest of it is written.'''
+        if not s:
+            return 0
+        with self._lock:
+            text = self._partial + s
+            *lines, self._partial = text.split("\n")
+            overflow = len(self.lines) + len(lines) - self.lines.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self.lines.extend(lines)
+        return len(s)
 
     def flush(self):
         '''Implement a flush method to maintain a file-like interface.'''
-        pass  # needed for file-like interface
+        pass  # lines are moved to the panel by its timer
+
+    def isatty(self):
+        return False
+
+    def drain(self):
+        '''
+        Take every buffered line.
+
+        Returns:
+        - tuple: (lines, dropped), the complete lines written since the last drain and the
+          number of lines dropped in the meantime.
+        '''
+        with self._lock:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
+
 
 class ConsoleWidget(QWidget):
-    '''A widget that displays standard output in a QTextEdit.'''
-    
+    '''A widget that displays standard output in a read-only text panel.'''
+
     def __init__(self, parent=None):
         '''Initialize the ConsoleWidget with layout and console output.'''
         super().__init__(parent)
@@ -26,18 +81,47 @@ class ConsoleWidget(QWidget):
         layout = QVBoxLayout()
         self.setLayout(layout)
 
-        # Console output
-        self.console_output = QTextEdit()
+        # Verbosity of the pipeline messages; per face details are left out by default
+        verbosity_layout = QHBoxLayout()
+        verbosity_layout.addWidget(QLabel("Console detail:"))
+        self.verbosity_combo = QComboBox()
+        self.verbosity_combo.addItems([name.capitalize() for name in VERBOSITY_LEVELS])
+        verbosity_layout.addWidget(self.verbosity_combo)
+        verbosity_layout.addStretch()
+        layout.addLayout(verbosity_layout)
+        set_verbosity(min(get_verbosity(), NORMAL))
+        self.verbosity_combo.setCurrentIndex(get_verbosity())
+        self.verbosity_combo.currentIndexChanged.connect(set_verbosity)
+
+        # Console output, holding at most MAX_RETAINED_LINES lines
+        self.console_output = QPlainTextEdit()
         self.console_output.setReadOnly(True)
+        self.console_output.setMaximumBlockCount(MAX_RETAINED_LINES)
+        self.console_output.setUndoRedoEnabled(False)
         layout.addWidget(self.console_output)
 
-        # ConsoleOutputThread instance
-        self.console_output_thread = ConsoleOutputThread()
-        self.console_output_thread.signal.connect(self.console_output.append)  # connect signal to append method of QTextEdit
+        # Replace the standard output with the buffered sink
+        self.console_sink = BufferedConsoleSink()
+        sys.stdout = self.console_sink
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setInterval(FLUSH_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush_console_output)
+
+    def start_console_output(self):
+        '''Start moving buffered output into the panel.'''
+        self.flush_timer.start()
 
-        # Replace the standard output with ConsoleOutputThread instance
-        sys.stdout = self.console_output_thread
+    def flush_console_output(self):
+        '''Append every buffered line to the panel in one go.'''
+        lines, dropped = self.console_sink.drain()
+        if not lines:
+            return
+        if dropped:
+            lines.insert(0, f"... {dropped} lines skipped ...")
+        self.console_output.appendPlainText("\n".join(lines))
 
-    def start_console_output_thread(self):
-        '''Start the thread that listens for standard output.'''
-        self.console_output_thread.start()
+    def clear(self):
+        '''Remove the shown and the buffered output.'''
+        self.console_sink.drain()
+        self.console_output.clear()
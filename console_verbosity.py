@@ -0,0 +1,42 @@
+'''
+@file console_verbosity.py
+How much the pipeline prints to the console.
+
+Progress messages are printed per image and per face, and some of them are expensive to format
+(EXIF dictionaries, detection timings). The pipeline asks `is_verbose` before building such a
+message, so nothing is formatted for a level nobody is listening to.
+'''
+
+QUIET = 0  # Only results and errors
+NORMAL = 1  # One line per image
+VERBOSE = 2  # Per face confidences, detection timings and EXIF data
+
+VERBOSITY_LEVELS = {"quiet": QUIET, "normal": NORMAL, "verbose": VERBOSE}
+DEFAULT_VERBOSITY = "verbose"
+
+_verbosity = VERBOSITY_LEVELS[DEFAULT_VERBOSITY]
+
+
+def set_verbosity(level):
+    """
+    Set how much the pipeline prints.
+
+    Parameters:
+    - level (int or str): One of QUIET, NORMAL and VERBOSE, or its name in `VERBOSITY_LEVELS`.
+    """
+    global _verbosity
+    if isinstance(level, str):
+        if level not in VERBOSITY_LEVELS:
+            raise ValueError(f"Unknown verbosity '{level}'. Choose from: {', '.join(VERBOSITY_LEVELS)}")
+        level = VERBOSITY_LEVELS[level]
+    _verbosity = int(level)
+
+
+def get_verbosity():
+    """Return the current verbosity level."""
+    return _verbosity
+
+
+def is_verbose(level):
+    """Return True if messages of the given level are printed."""
+    return _verbosity >= level
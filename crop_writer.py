@@ -0,0 +1,243 @@
+'''
+@file crop_writer.py
+Background writing of face crops into an output folder sharded by image hash.
+
+Crops are encoded and written on a separate thread fed through a bounded queue, so detection and
+embedding don't wait for the disk unless the writer falls behind by more than the queue holds.
+Each crop goes into a subfolder named after the first characters of its image hash, which keeps
+every folder small enough to list quickly however many faces are indexed. Output folders written
+before sharding keep working: crops are looked up in their shard first and then at the top level.
+'''
+
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+import cv2
+from pipeline_metrics import metrics
+
+logger = logging.getLogger()
+
+# File extension and cv2.imwrite quality parameter of each crop format
+CROP_FORMATS = {
+    "png": (".png", cv2.IMWRITE_PNG_COMPRESSION),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+DEFAULT_CROP_FORMAT = "png"
+# Default quality of each format; for PNG this is the zlib compression level, as it is lossless
+DEFAULT_CROP_QUALITY = {"png": 3, "jpeg": 95, "webp": 90}
+
+# Number of leading image hash characters naming a crop's shard folder, giving 256 shards
+SHARD_PREFIX_LENGTH = 2
+
+# Crops waiting to be written before `write` blocks
+DEFAULT_MAX_QUEUED = 256
+
+
+def crop_path(output_folder, crop_name):
+    """
+    Return the sharded path a crop is written to.
+
+    Parameters:
+    - output_folder (str): The output folder.
+    - crop_name (str): Name of the crop, starting with its image hash.
+
+    Returns:
+    - str: Path of the crop.
+    """
+    return os.path.join(output_folder, crop_name[:SHARD_PREFIX_LENGTH], crop_name)
+
+
+def resolve_crop_path(output_folder, crop_name):
+    """
+    Return the path of an existing crop, looking in its shard and then at the top level of the
+    output folder, where crops were written before sharding.
+
+    Returns:
+    - str: Path of the crop, or its sharded path if it doesn't exist.
+    """
+    path = crop_path(output_folder, crop_name)
+    if not os.path.exists(path):
+        legacy_path = os.path.join(output_folder, crop_name)
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+
+def crop_exists(output_folder, crop_name):
+    """Return True if a crop is present in the output folder, sharded or not."""
+    return os.path.exists(resolve_crop_path(output_folder, crop_name))
+
+
+def iter_crop_paths(output_folder):
+    """
+    Yield the path of every face crop in an output folder, sharded or not, sorted by name.
+    """
+    extensions = tuple(extension for extension, _ in CROP_FORMATS.values())
+    paths = []
+    with os.scandir(output_folder) as entries:
+        for entry in entries:
+            if entry.is_dir() and len(entry.name) == SHARD_PREFIX_LENGTH:
+                paths.extend(os.path.join(entry.path, name) for name in os.listdir(entry.path)
+                             if name.lower().endswith(extensions))
+            elif entry.name.lower().endswith(extensions):
+                paths.append(entry.path)
+    yield from sorted(paths, key=os.path.basename)
+
+
+def crop_name_for(face_entry, img_hash, i):
+    """
+    Return the crop name of face `i` of an image.
+
+    Parameters:
+    - face_entry (dict): The image's face_data entry.
+    - img_hash (str): The image hash.
+    - i (int): 0 based index of the face.
+
+    Returns:
+    - str: The crop name recorded for the face, or the PNG name crops had before their format
+      was configurable.
+    """
+    crop_names = face_entry.get("crop_names") or []
+    if i < len(crop_names):
+        return crop_names[i]
+    return f"{img_hash}_{i + 1}.png"
+
+
+class CropWriter:
+    """
+    Encodes and writes face crops on a background thread, in the order they were queued.
+
+    A single thread is enough to keep up with detection, since encoding a 224x224 crop takes a
+    few milliseconds and cv2 releases the GIL while doing it. Keeping one thread also means a crop
+    is always written before a later request to link a copy of it.
+    """
+
+    def __init__(self, output_folder, crop_format=DEFAULT_CROP_FORMAT, quality=None, max_queued=DEFAULT_MAX_QUEUED):
+        """
+        Parameters:
+        - output_folder (str): Folder the crops are written to.
+        - crop_format (str): One of `CROP_FORMATS`.
+        - quality (int, optional): Quality of JPEG and WebP crops, from 0 to 100, or the PNG
+          compression level, from 0 to 9. Defaults to `DEFAULT_CROP_QUALITY`.
+        - max_queued (int): Crops that may wait to be written before `write` blocks.
+        """
+        if crop_format not in CROP_FORMATS:
+            raise ValueError(f"Unknown crop format '{crop_format}'. Choose from: {', '.join(CROP_FORMATS)}")
+        self.output_folder = output_folder
+        self.extension, quality_flag = CROP_FORMATS[crop_format]
+        self.params = [quality_flag, DEFAULT_CROP_QUALITY[crop_format] if quality is None else int(quality)]
+        self.crops_written = 0
+        self.bytes_written = 0
+        self.failed = []  # Names of the crops that could not be written
+        self.blocked_s = 0.0  # Time callers spent waiting for room in the queue
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = None
+        self._shards = set()  # Shard folders known to exist
+
+    def crop_name(self, img_hash, n):
+        """Return the name of the n-th (1 based) face crop of an image."""
+        return f"{img_hash}_{n}{self.extension}"
+
+    def write(self, crop_name, img):
+        """
+        Queue a crop to be written.
+
+        Parameters:
+        - crop_name (str): Name of the crop, from `crop_name`.
+        - img (numpy.ndarray): The BGR crop. It must not be modified afterwards.
+        """
+        self._put(("write", crop_name, img))
+
+    def link(self, source_name, crop_name):
+        """
+        Queue a second name for a crop, hard linked where the file system allows, once every
+        crop queued before it is written.
+        """
+        self._put(("link", crop_name, source_name))
+
+    def _put(self, job):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="crop-writer", daemon=True)
+            self._thread.start()
+        start = time.perf_counter()
+        self._queue.put(job)
+        blocked = time.perf_counter() - start
+        self.blocked_s += blocked
+        metrics.record("write_wait", blocked)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                action, crop_name, payload = job
+                try:
+                    if action == "write":
+                        self._write(crop_name, payload)
+                    else:
+                        self._link(payload, crop_name)
+                except Exception as e:
+                    logger.exception(f"Could not write face crop {crop_name}: {str(e)}")
+                    self.failed.append(crop_name)
+            finally:
+                self._queue.task_done()
+
+    def _destination(self, crop_name):
+        path = crop_path(self.output_folder, crop_name)
+        shard = os.path.dirname(path)
+        if shard not in self._shards:
+            os.makedirs(shard, exist_ok=True)
+            self._shards.add(shard)
+        return path
+
+    def _write(self, crop_name, img):
+        start = time.perf_counter()
+        ok, encoded = cv2.imencode(self.extension, img, self.params)
+        if not ok:
+            raise ValueError(f"cv2 could not encode {crop_name}")
+        path = self._destination(crop_name)
+        # Written under a temporary name so a crop that exists is always complete
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as crop_file:
+            crop_file.write(encoded.tobytes())
+        os.replace(temp_path, path)
+        self.crops_written += 1
+        self.bytes_written += encoded.nbytes
+        metrics.record("write", time.perf_counter() - start)
+
+    def _link(self, source_name, crop_name):
+        destination = self._destination(crop_name)
+        if os.path.exists(destination):
+            return
+        source = resolve_crop_path(self.output_folder, source_name)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def flush(self):
+        """Wait until every queued crop is written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Write every queued crop and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        logger.debug(f"Wrote {self.crops_written} face crops ({self.bytes_written / 2**20:.1f} MB), "
+                     f"waited {self.blocked_s:.2f}s for the writer, {len(self.failed)} failed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
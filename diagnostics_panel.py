@@ -0,0 +1,101 @@
+'''
+@file diagnostics_panel.py
+Window showing the live pipeline metrics and the face preview cache statistics.
+'''
+
+from PyQt6.QtWidgets import QWidget, QVBoxLayout, QLabel, QCheckBox, QTableWidget, QTableWidgetItem, QHeaderView
+from PyQt6.QtCore import Qt, QTimer
+from pipeline_metrics import metrics, set_metrics_enabled
+
+# How often the shown figures are refreshed while the window is open
+REFRESH_INTERVAL_MS = 1000
+
+STAGE_COLUMNS = ['Stage', 'Calls', 'Items', 'Total s', 'Share', 'Mean ms', 'p50 ms', 'p95 ms', 'Items/s']
+
+
+def format_number(value, precision=2):
+    """Format an optional number for a table cell."""
+    return "-" if value is None else f"{value:.{precision}f}"
+
+
+class DiagnosticsPanel(QWidget):
+    """
+    Throughput, peak memory, counters and per-stage latencies of the current or last run, refreshed
+    every second while the window is shown.
+    """
+
+    def __init__(self, preview_cache=None, parent=None):
+        """
+        Parameters:
+        - preview_cache (PreviewCache, optional): Cache whose statistics are shown as well.
+        - parent (QWidget, optional): Parent widget; the panel opens as a window of its own.
+        """
+        super().__init__(parent, Qt.WindowType.Window)
+        self.setWindowTitle('Diagnostics')
+        self.preview_cache = preview_cache
+        layout = QVBoxLayout(self)
+
+        self.enabled_checkbox = QCheckBox('Collect pipeline metrics')
+        self.enabled_checkbox.setChecked(metrics.enabled)
+        self.enabled_checkbox.toggled.connect(set_metrics_enabled)
+        layout.addWidget(self.enabled_checkbox)
+
+        self.overview_label = QLabel()
+        self.overview_label.setWordWrap(True)
+        layout.addWidget(self.overview_label)
+
+        self.stage_table = QTableWidget(0, len(STAGE_COLUMNS))
+        self.stage_table.setHorizontalHeaderLabels(STAGE_COLUMNS)
+        self.stage_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.stage_table.verticalHeader().setVisible(False)
+        self.stage_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        layout.addWidget(self.stage_table)
+
+        self.counters_label = QLabel()
+        self.counters_label.setWordWrap(True)
+        layout.addWidget(self.counters_label)
+
+        self.preview_cache_label = QLabel()
+        layout.addWidget(self.preview_cache_label)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(REFRESH_INTERVAL_MS)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.resize(720, 420)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        """Show the latest figures."""
+        summary = metrics.summary()
+        peak = summary["peak_rss_mb"]
+        self.overview_label.setText(
+            f"{summary['images']} images, {summary['faces']} faces in {summary['elapsed_s']:.1f}s: "
+            f"{format_number(summary['images_per_s'])} images/s, {format_number(summary['faces_per_s'])} faces/s. "
+            f"Peak memory: {format_number(peak, 0)} MB")
+
+        stages = summary["stages"]
+        self.stage_table.setRowCount(len(stages))
+        for row, (stage, stats) in enumerate(stages.items()):
+            share = stats["share"] * 100 if stats["share"] is not None else None
+            values = [stage, str(stats["calls"]), str(stats["items"]), format_number(stats["total_s"]),
+                      f"{format_number(share, 0)}%", format_number(stats["mean_ms"]), format_number(stats["p50_ms"]),
+                      format_number(stats["p95_ms"]), format_number(stats["items_per_s"], 1)]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 0:
+                    item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self.stage_table.setItem(row, column, item)
+
+        counters = summary["counters"]
+        self.counters_label.setText("Counters: " + (", ".join(f"{name} {count}" for name, count in sorted(counters.items()))
+                                                    if counters else "none yet"))
+        if self.preview_cache is not None:
+            self.preview_cache_label.setText(self.preview_cache.summary())
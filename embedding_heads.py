@@ -0,0 +1,217 @@
+'''
+@file embedding_heads.py
+Heads that turn ResNet152 feature maps into face vectors.
+
+The default `flat` head keeps the whole 7x7x2048 feature map (100,352 values per face). The
+pooled heads reduce it to 2048 values, and a fitted PCA whitening can shrink that further to a
+few hundred. Every head has an `id` that is stored with the vectors it produces, so vectors
+from different heads are never compared with each other.
+'''
+
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger()
+
+# Head that produced vectors stored before heads were versioned
+LEGACY_HEAD_ID = "flat-v1"
+DEFAULT_EMBEDDING_HEAD = "flat"
+DEFAULT_WHITENING_DIMS = 256
+
+
+class PCAWhitening:
+    """
+    PCA projection that decorrelates pooled vectors and scales every component to unit variance.
+    """
+
+    def __init__(self, mean, components, variances, source_head):
+        """
+        Parameters:
+        - mean (numpy.ndarray): Mean of the training vectors.
+        - components (numpy.ndarray): Principal axes, one per row.
+        - variances (numpy.ndarray): Variance of the training vectors along each axis.
+        - source_head (str): id of the pooled head the whitening was fitted on.
+        """
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.variances = np.asarray(variances, dtype=np.float32)
+        self.source_head = source_head
+        self.scale = (1.0 / np.sqrt(self.variances + 1e-6)).astype(np.float32)
+        digest = hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()[:8]
+        self.id = f"pca{len(self.components)}-{digest}"
+
+    @classmethod
+    def fit(cls, vectors, dims=DEFAULT_WHITENING_DIMS, source_head=None):
+        """
+        Fit the whitening on pooled vectors.
+
+        Parameters:
+        - vectors (list): Pooled face vectors, all produced by the same head.
+        - dims (int): Number of dimensions to keep.
+        - source_head (str): id of the head that produced the vectors.
+
+        Returns:
+        - PCAWhitening: The fitted whitening.
+        """
+        data = np.stack([np.asarray(v, dtype=np.float64).ravel() for v in vectors])
+        dims = min(dims, data.shape[0] - 1, data.shape[1])
+        if dims < 1:
+            raise ValueError("At least two vectors are needed to fit a whitening")
+
+        mean = data.mean(axis=0)
+        _, singular_values, axes = np.linalg.svd(data - mean, full_matrices=False)
+        variances = singular_values[:dims] ** 2 / (data.shape[0] - 1)
+        return cls(mean, axes[:dims], variances, source_head)
+
+    def transform(self, vectors):
+        """
+        Project and whiten a batch of pooled vectors.
+
+        Parameters:
+        - vectors (numpy.ndarray): Pooled vectors, one per row.
+
+        Returns:
+        - numpy.ndarray: Whitened vectors, one per row.
+        """
+        return ((vectors - self.mean) @ self.components.T) * self.scale
+
+    def save(self, path):
+        """
+        Save the whitening to a `.npz` file.
+        """
+        np.savez(path, mean=self.mean, components=self.components, variances=self.variances,
+                 source_head=np.array(self.source_head or ""))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a whitening saved with `save`.
+        """
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"], data["variances"], str(data["source_head"]) or None)
+
+
+class EmbeddingHead:
+    """
+    Base class of the embedding heads. Subclasses implement `pool`.
+    """
+    name = None
+    version = 1
+
+    def __init__(self, whitening=None):
+        """
+        Parameters:
+        - whitening (PCAWhitening, optional): Whitening applied after pooling.
+        """
+        if whitening is not None and whitening.source_head not in (None, self.pooled_id):
+            raise ValueError(f"Whitening was fitted on '{whitening.source_head}' vectors, not '{self.pooled_id}'")
+        self.whitening = whitening
+
+    @property
+    def pooled_id(self):
+        """id of the head without its whitening."""
+        return f"{self.name}-v{self.version}"
+
+    @property
+    def id(self):
+        """id stored alongside the vectors this head produces."""
+        if self.whitening is None:
+            return self.pooled_id
+        return f"{self.pooled_id}+{self.whitening.id}"
+
+    def pool(self, feature_maps):
+        raise NotImplementedError
+
+    def __call__(self, feature_maps):
+        """
+        Turn a batch of ResNet feature maps into face vectors.
+
+        Parameters:
+        - feature_maps (numpy.ndarray): Batch of 7x7x2048 feature maps.
+
+        Returns:
+        - list: One float32 vector per feature map.
+        """
+        vectors = self.pool(np.asarray(feature_maps, dtype=np.float32))
+        if self.whitening is not None:
+            vectors = self.whitening.transform(vectors)
+        return [np.ascontiguousarray(vector, dtype=np.float32) for vector in vectors]
+
+
+class FlattenHead(EmbeddingHead):
+    """
+    Keeps the whole feature map, as face vectors always were before heads were added.
+    """
+    name = "flat"
+
+    def __init__(self, whitening=None):
+        if whitening is not None:
+            raise ValueError("The flat head cannot be whitened")
+        super().__init__()
+
+    def pool(self, feature_maps):
+        return feature_maps.reshape(len(feature_maps), -1)
+
+
+class GlobalAveragePoolingHead(EmbeddingHead):
+    """
+    Averages every channel over the 7x7 grid.
+    """
+    name = "gap"
+
+    def pool(self, feature_maps):
+        return feature_maps.mean(axis=(1, 2))
+
+
+class GeMHead(EmbeddingHead):
+    """
+    Generalised mean pooling, which weighs strong activations more than plain averaging.
+    """
+    name = "gem"
+    p = 3.0
+
+    def pool(self, feature_maps):
+        pooled = np.power(np.maximum(feature_maps, 1e-6), self.p).mean(axis=(1, 2))
+        return np.power(pooled, 1.0 / self.p)
+
+
+EMBEDDING_HEADS = {head.name: head for head in (FlattenHead, GlobalAveragePoolingHead, GeMHead)}
+
+
+def create_embedding_head(name=DEFAULT_EMBEDDING_HEAD, whitening_path=None):
+    """
+    Create an embedding head by name.
+
+    Parameters:
+    - name (str): One of `EMBEDDING_HEADS`.
+    - whitening_path (str, optional): `.npz` file of a PCA whitening fitted on this head's vectors.
+
+    Returns:
+    - EmbeddingHead: The head.
+    """
+    if name not in EMBEDDING_HEADS:
+        raise ValueError(f"Unknown embedding head '{name}'. Choose from: {', '.join(EMBEDDING_HEADS)}")
+    whitening = PCAWhitening.load(whitening_path) if whitening_path else None
+    return EMBEDDING_HEADS[name](whitening)
+
+
+# Head used for every face embedded in this process, gallery and probe alike
+_active_head = FlattenHead()
+
+
+def get_embedding_head():
+    """Return the active embedding head."""
+    return _active_head
+
+
+def set_embedding_head(head):
+    """
+    Make a head the active one for all faces embedded from now on.
+
+    Parameters:
+    - head (EmbeddingHead): The head to use.
+    """
+    global _active_head
+    logger.info(f"Using embedding head {head.id}")
+    _active_head = head
@@ -0,0 +1,222 @@
+'''
+@file embedding_store.py
+Persistent on-disk store of face detection and embedding results so unchanged images are not re-processed.
+'''
+
+import os
+import pickle
+import sqlite3
+import logging
+from crop_writer import crop_exists
+from embedding_heads import LEGACY_HEAD_ID
+from inference_backends import KERAS_BACKEND
+
+logger = logging.getLogger()
+
+STORE_FILE_NAME = "face_store.db"
+# Models that produced records stored before the inference version was recorded
+LEGACY_INFERENCE_VERSION = KERAS_BACKEND
+
+
+def record_matches_models(record, embedding_head=None, inference_version=None):
+    """
+    Check whether a record was produced by the given models.
+
+    Parameters:
+    - record (dict): A store record.
+    - embedding_head (str, optional): id of the embedding head its vectors must come from. Only
+      checked if the record has faces, since the head plays no part in detection.
+    - inference_version (str, optional): `inference_version` of the models its detections and
+      vectors must come from.
+
+    Returns:
+    - bool: True if the record matches every model given.
+    """
+    if inference_version is not None and record.get("inference_version", LEGACY_INFERENCE_VERSION) != inference_version:
+        return False
+    if embedding_head is not None and record.get("faces") and record.get("embedding_head", LEGACY_HEAD_ID) != embedding_head:
+        return False
+    return True
+
+
+class EmbeddingStore:
+    """
+    SQLite backed store of per-image face records.
+
+    Records are keyed by the md5 `img_hash` of the image contents. A second table maps
+    each file path to its size, modification time and hash so that unchanged files can
+    be recognised from a single `os.stat` call without reading them again.
+
+    A record is a dict holding the face vectors, boxes, keypoints, crop file names and
+    EXIF data produced by `save_faces_from_folder`.
+    """
+
+    def __init__(self, db_path):
+        """
+        Open (or create) the store at the given path.
+
+        Parameters:
+        - db_path (str): Path to the SQLite database file.
+        """
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS images (img_hash TEXT PRIMARY KEY, record BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (full_path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                          "mtime REAL NOT NULL, img_hash TEXT NOT NULL)")
+        self.conn.commit()
+
+    def lookup_path(self, full_path, size, mtime):
+        """
+        Return the image hash recorded for a file if its size and mtime are unchanged.
+
+        Parameters:
+        - full_path (str): Path of the image file.
+        - size (int): Current file size in bytes.
+        - mtime (float): Current modification time.
+
+        Returns:
+        - str or None: The stored img_hash, or None if the file is unknown or has changed.
+        """
+        row = self.conn.execute("SELECT size, mtime, img_hash FROM files WHERE full_path = ?",
+                                (full_path,)).fetchone()
+        if row is None:
+            return None
+        stored_size, stored_mtime, img_hash = row
+        if stored_size != size or stored_mtime != mtime:
+            return None
+        return img_hash
+
+    def get(self, img_hash, embedding_head=None, inference_version=None):
+        """
+        Fetch the face record stored for an image hash.
+
+        Parameters:
+        - img_hash (str): md5 hash of the image contents.
+        - embedding_head (str, optional): Treat a record whose vectors come from another embedding head as missing.
+        - inference_version (str, optional): Treat a record produced by other models, such as
+          another inference backend or quantisation, as missing.
+
+        Returns:
+        - dict or None: The stored record, or None if nothing (usable) is stored.
+        """
+        row = self.conn.execute("SELECT record FROM images WHERE img_hash = ?", (img_hash,)).fetchone()
+        if row is None:
+            return None
+        try:
+            record = pickle.loads(row[0])
+        except Exception:
+            logger.exception(f"Discarding unreadable store record for {img_hash}")
+            self.delete(img_hash)
+            return None
+        if not record_matches_models(record, embedding_head, inference_version):
+            # Kept until the image is processed again, which replaces it
+            return None
+        return record
+
+    def put(self, img_hash, record, full_path=None, size=None, mtime=None):
+        """
+        Store the face record for an image and, optionally, remember the file it came from.
+
+        Parameters:
+        - img_hash (str): md5 hash of the image contents.
+        - record (dict): Face record to store.
+        - full_path (str, optional): Path of the image file.
+        - size (int, optional): File size in bytes.
+        - mtime (float, optional): File modification time.
+        """
+        blob = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO images (img_hash, record) VALUES (?, ?)",
+                          (img_hash, sqlite3.Binary(blob)))
+        if full_path is not None:
+            self.remember_path(full_path, size, mtime, img_hash)
+
+    def remember_path(self, full_path, size, mtime, img_hash):
+        """
+        Record which image hash a file path currently holds.
+
+        Parameters:
+        - full_path (str): Path of the image file.
+        - size (int): File size in bytes.
+        - mtime (float): File modification time.
+        - img_hash (str): md5 hash of the image contents.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO files (full_path, size, mtime, img_hash) VALUES (?, ?, ?, ?)",
+                          (full_path, size, mtime, img_hash))
+
+    def path_hash(self, full_path):
+        """
+        Return the image hash last recorded for a file path, whether or not the file has changed since.
+
+        Parameters:
+        - full_path (str): Path of the image file.
+
+        Returns:
+        - str or None: The recorded img_hash, or None if the path is unknown.
+        """
+        row = self.conn.execute("SELECT img_hash FROM files WHERE full_path = ?", (full_path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def forget_path(self, full_path):
+        """
+        Forget a file path, e.g. because the file was deleted. The image's record is kept, so a
+        file with the same contents is still recognised without running the models.
+
+        Parameters:
+        - full_path (str): Path of the image file.
+        """
+        self.conn.execute("DELETE FROM files WHERE full_path = ?", (full_path,))
+
+    def delete(self, img_hash):
+        """
+        Remove the record for an image hash along with any file paths pointing at it.
+
+        Parameters:
+        - img_hash (str): md5 hash of the image contents.
+        """
+        self.conn.execute("DELETE FROM images WHERE img_hash = ?", (img_hash,))
+        self.conn.execute("DELETE FROM files WHERE img_hash = ?", (img_hash,))
+
+    def iter_paths(self):
+        """
+        Yield (full_path, img_hash) for every file the store knows, ordered by path.
+        """
+        yield from self.conn.execute("SELECT full_path, img_hash FROM files ORDER BY full_path").fetchall()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def commit(self):
+        """Flush pending writes to disk."""
+        self.conn.commit()
+
+    def close(self):
+        """Commit any pending writes and close the database connection."""
+        try:
+            self.conn.commit()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+
+def crops_exist(record, output_folder):
+    """
+    Check that every face crop referenced by a stored record is present in the output folder.
+
+    Parameters:
+    - record (dict): Face record as stored by `EmbeddingStore.put`.
+    - output_folder (str): Folder the crops are expected in.
+
+    Returns:
+    - bool: True if all crops are present.
+    """
+    return all(crop_exists(output_folder, name) for name in record.get("crop_names", []))
@@ -0,0 +1,309 @@
+'''
+@file exif_metadata.py
+Header-only EXIF extraction, resolved lazily for the images that are shown and cached across runs.
+
+Only the EXIF block of a file is read: the APP1 segment of a JPEG, found by walking its marker
+segments up to the start of the image data, or the eXIf chunk of a PNG. The block is parsed with
+PIL's `Image.Exif` without opening or decoding the image, and usually costs a single small read.
+
+Ingestion leaves `exif_data` as None in face data entries, and store records don't keep it.
+`resolve_exif_data` fills it in for the entries about to be displayed, exported or filtered on,
+taking it from a cache keyed by `img_hash` in the output folder when the image has been parsed
+before. That cache is the only place parsed EXIF data is persisted.
+'''
+
+import io
+import os
+import json
+import struct
+import sqlite3
+import logging
+from PIL import Image
+from pipeline_metrics import metrics
+
+logger = logging.getLogger()
+
+EXIF_CACHE_FILE_NAME = "exif_cache.db"
+
+JPEG_SOI = b"\xff\xd8"
+APP1_MARKER = 0xE1
+# Markers after which no metadata segments follow: start of scan and end of image
+JPEG_IMAGE_DATA_MARKERS = (0xDA, 0xD9)
+EXIF_HEADER = b"Exif\x00\x00"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IMAGE_DATA_CHUNKS = (b"IDAT", b"IEND")
+
+# EXIF tags kept in face data
+MAKE_TAG = 0x010F
+MODEL_TAG = 0x0110
+EXIF_IFD_TAG = 0x8769
+GPS_IFD_TAG = 0x8825
+DATE_TIME_DIGITIZED_TAG = 0x9004
+
+# Largest number of hashes looked up in one query, below SQLite's variable limit
+CACHE_LOOKUP_CHUNK = 500
+
+
+def convert_to_decimal(coord, direction):
+    """
+    Convert GPS coordinates to decimal format.
+    """
+    degrees, minutes, seconds = coord
+    decimal = degrees + minutes / 60 + seconds / 3600
+    if direction in ['S', 'W']:
+        decimal *= -1
+    return float(decimal)
+
+
+def read_jpeg_exif_segment(image_file):
+    """
+    Return the EXIF block of a JPEG, reading its marker segments up to the image data.
+
+    Parameters:
+    - image_file (file): Binary file positioned after the SOI marker.
+
+    Returns:
+    - bytes or None: The APP1 payload after the "Exif" header, None if there is none.
+    """
+    while True:
+        marker = image_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF:  # Fill bytes before a marker
+            fill = image_file.read(1)
+            if not fill:
+                return None
+            code = fill[0]
+        if code in JPEG_IMAGE_DATA_MARKERS:
+            return None
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue  # Markers without a length
+        length_bytes = image_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if code == APP1_MARKER:
+            payload = image_file.read(length)
+            if payload.startswith(EXIF_HEADER):
+                return payload[len(EXIF_HEADER):]
+            continue  # XMP is stored in APP1 segments as well
+        image_file.seek(length, os.SEEK_CUR)
+
+
+def read_png_exif_chunk(image_file):
+    """
+    Return the eXIf chunk of a PNG, reading its chunks up to the image data.
+
+    Parameters:
+    - image_file (file): Binary file positioned after the PNG signature.
+
+    Returns:
+    - bytes or None: The chunk data, None if there is none.
+    """
+    while True:
+        header = image_file.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in PNG_IMAGE_DATA_CHUNKS:
+            return None
+        if chunk_type == b"eXIf":
+            return image_file.read(length)
+        image_file.seek(length + 4, os.SEEK_CUR)  # Data and CRC
+
+
+def read_exif_segment(image_file):
+    """
+    Return the raw EXIF block of a JPEG or PNG image without reading its image data.
+
+    Parameters:
+    - image_file (file): Binary file positioned at the start of the image.
+
+    Returns:
+    - bytes or None: TIFF structured EXIF data, None if the image has none or isn't a JPEG or PNG.
+    """
+    signature = image_file.read(8)
+    if signature.startswith(JPEG_SOI):
+        image_file.seek(2)
+        return read_jpeg_exif_segment(image_file)
+    if signature == PNG_SIGNATURE:
+        return read_png_exif_chunk(image_file)
+    return None
+
+
+def parse_exif_segment(segment):
+    """
+    Pull the fields kept in face data out of a raw EXIF block.
+
+    Parameters:
+    - segment (bytes or None): TIFF structured EXIF data, as returned by `read_exif_segment`.
+
+    Returns:
+    - dict: "Make", "Model", "DateDigitized", "TimeDigitized" and "GPSInfo" with the "Latitude"
+      and "Longitude" in decimal degrees, for the fields present.
+    """
+    if not segment:
+        return {}
+    exif = Image.Exif()
+    exif.load(segment)
+
+    exif_info = {}
+    for tag, name in ((MAKE_TAG, "Make"), (MODEL_TAG, "Model")):
+        if tag in exif:
+            exif_info[name] = exif[tag]
+
+    date_time = exif.get_ifd(EXIF_IFD_TAG).get(DATE_TIME_DIGITIZED_TAG)
+    if isinstance(date_time, str) and len(date_time.split()) == 2:
+        exif_info['DateDigitized'], exif_info['TimeDigitized'] = date_time.split()
+
+    gps_info = exif.get_ifd(GPS_IFD_TAG)
+    if all(key in gps_info for key in (1, 2, 3, 4)):
+        try:
+            lat = round(convert_to_decimal(gps_info[2], gps_info[1]), 6)
+            lon = round(convert_to_decimal(gps_info[4], gps_info[3]), 6)
+            exif_info['GPSInfo'] = {'Latitude': lat, 'Longitude': lon}
+        except (TypeError, ValueError, ZeroDivisionError):
+            logger.debug("Ignoring malformed GPS data %s", gps_info)
+    return exif_info
+
+
+def read_image_exif(image_path, data=None):
+    """
+    Read the EXIF data of an image from the EXIF block of its file.
+
+    Parameters:
+    - image_path (str): Path of the image.
+    - data (bytes, optional): Contents of the file if it has already been read.
+
+    Returns:
+    - dict or None: The EXIF data as returned by `parse_exif_segment`, empty if the image has
+      none or it can't be parsed, None if the file can't be read.
+    """
+    try:
+        with (io.BytesIO(data) if data is not None else open(image_path, 'rb')) as image_file:
+            segment = read_exif_segment(image_file)
+    except OSError as e:
+        logger.warning(f"Could not read the EXIF data of {image_path}: {e}")
+        return None
+    try:
+        return parse_exif_segment(segment)
+    except Exception:
+        logger.exception(f'Error while reading EXIF data from {image_path}')
+        return {}
+
+
+class ExifCache:
+    """
+    SQLite backed cache of the EXIF data of images, keyed by the md5 `img_hash` of their contents.
+    """
+
+    def __init__(self, db_path):
+        """
+        Open (or create) the cache at the given path.
+
+        Parameters:
+        - db_path (str): Path to the SQLite database file.
+        """
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS exif (img_hash TEXT PRIMARY KEY, exif_data TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get_many(self, img_hashes):
+        """
+        Fetch the cached EXIF data of several images.
+
+        Parameters:
+        - img_hashes (list): md5 hashes of the image contents.
+
+        Returns:
+        - dict: EXIF data by img_hash, for the images that are cached.
+        """
+        found = {}
+        for start in range(0, len(img_hashes), CACHE_LOOKUP_CHUNK):
+            chunk = img_hashes[start:start + CACHE_LOOKUP_CHUNK]
+            rows = self.conn.execute(f"SELECT img_hash, exif_data FROM exif WHERE img_hash IN ({','.join('?' * len(chunk))})",
+                                     chunk).fetchall()
+            for img_hash, exif_json in rows:
+                try:
+                    found[img_hash] = json.loads(exif_json)
+                except ValueError:
+                    logger.warning(f"Discarding unreadable cached EXIF data for {img_hash}")
+        return found
+
+    def put_many(self, items):
+        """
+        Cache the EXIF data of several images.
+
+        Parameters:
+        - items (iterable): (img_hash, EXIF data) pairs.
+        """
+        self.conn.executemany("INSERT OR REPLACE INTO exif (img_hash, exif_data) VALUES (?, ?)",
+                              [(img_hash, json.dumps(exif_data, default=str)) for img_hash, exif_data in items])
+        self.conn.commit()
+
+    def close(self):
+        """Commit any pending writes and close the database connection."""
+        try:
+            self.conn.commit()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+
+def resolve_exif_data(face_data, cache=None):
+    """
+    Fill in the EXIF data of the face data entries that haven't had it read yet.
+
+    Parameters:
+    - face_data (dict): Face data entries, or the lighter metadata entries of probe first
+      searches, by img_hash. Each needs a "full_path".
+    - cache (ExifCache, optional): Cache consulted first and updated with newly parsed images.
+
+    Returns:
+    - int: Number of images whose EXIF data was parsed from their file.
+    """
+    unresolved = {img_hash: entry for img_hash, entry in face_data.items() if entry.get("exif_data") is None}
+    if not unresolved:
+        return 0
+    cached = cache.get_many(list(unresolved)) if cache is not None else {}
+    parsed = {}
+    for img_hash, entry in unresolved.items():
+        exif_data = cached.get(img_hash)
+        if exif_data is None:
+            with metrics.timer("exif"):
+                exif_data = read_image_exif(entry["full_path"])
+            if exif_data is None:
+                # Unreadable for now, e.g. deleted, so it is not cached and is tried again in a later run
+                entry["exif_data"] = {}
+                continue
+            parsed[img_hash] = exif_data
+        entry["exif_data"] = exif_data
+    if cache is not None and parsed:
+        cache.put_many(parsed.items())
+    metrics.count("exif_cached", len(unresolved) - len(parsed))
+    return len(parsed)
+
+
+def resolve_match_exif(matches, face_data, cache=None):
+    """
+    Fill in the EXIF data of the images that have matches, before the matches are shown or written.
+
+    Parameters:
+    - matches (list): Match tuples as returned by find_matching_face.
+    - face_data (dict): Face data holding the matched images.
+    - cache (ExifCache, optional): Cache of parsed EXIF data.
+    """
+    matched = {img_hash: face_data[img_hash] for img_hash, *_ in matches if img_hash in face_data}
+    resolve_exif_data(matched, cache)
@@ -0,0 +1,422 @@
+'''
+@file face_cli.py
+Headless command line entry point for indexing folders and searching them for a face.
+
+Nothing here imports Qt, so it runs on machines without a display.
+
+Usage:
+    python face_cli.py index INPUT_FOLDER OUTPUT_FOLDER [--workers N] [--index-kind flat|ivf|hnsw]
+    python face_cli.py search IMAGE INPUT_FOLDER OUTPUT_FOLDER [--results matches.csv|.json] [--threshold T] [--top-k K] [FILTERS]
+    python face_cli.py watch IMAGE INPUT_FOLDER OUTPUT_FOLDER [--results matches.csv|.json] [--threshold T] [--poll] [FILTERS]
+    python face_cli.py export OUTPUT_FOLDER RESULTS_FILE
+    python face_cli.py fit-whitening OUTPUT_FOLDER WHITENING_FILE [--embedding-head gap|gem] [--dims N]
+    python face_cli.py export-models --inference-backend tflite-fp16|tflite-int8 [--calibration-crops OUTPUT_FOLDER]
+
+watch indexes and searches the folder like search, then keeps indexing the images added to,
+changed in or removed from it and searching them until interrupted, rewriting the results file
+whenever the matches change.
+
+search and watch only search the images meeting the metadata FILTERS, applied before any face
+vectors are scored: --date-from DATE and --date-to DATE (YYYY-MM-DD) on the EXIF capture date,
+--device TEXT on the camera make and model, --near LAT LON with --radius-km KM, and --bbox SOUTH
+WEST NORTH EAST. The first filtered search reads the EXIF header of every image once and caches it
+in the output folder. For example, taken in June 2021 within 5 km of a point:
+    python face_cli.py search face.jpg photos out --date-from 2021-06-01 --date-to 2021-06-30 --near 52.37 4.89 --radius-km 5
+
+index, search and watch take --embedding-head flat|gap|gem and --whitening WHITENING_FILE to embed faces
+with a pooled head instead of the full ResNet feature map, and --inference-backend to run the
+models as quantised TFLite exports instead of Keras.
+
+Exit codes: 0 on success, 1 if a search found no matches, 2 for invalid arguments, 3 if an input
+is missing or unreadable, 4 if processing failed and 130 if interrupted.
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+from face_detection import save_faces_from_folder, find_matching_face, embed_probe_faces, match_probe_vectors
+from model_registry import get_face_detector, get_inference_version, set_inference_backend
+from inference_backends import (INFERENCE_BACKENDS, KERAS_BACKEND, DEFAULT_INFERENCE_BACKEND, DEFAULT_MODEL_DIR,
+                                export_mtcnn, export_resnet)
+from embedding_heads import (EMBEDDING_HEADS, DEFAULT_EMBEDDING_HEAD, DEFAULT_WHITENING_DIMS, PCAWhitening,
+                             create_embedding_head, get_embedding_head, set_embedding_head)
+from embedding_store import EmbeddingStore, STORE_FILE_NAME
+from face_index import INDEX_TYPES, INDEX_FILE_NAME, open_index
+from results_export import RESULT_COLUMNS, match_row, exif_columns, write_rows
+from crop_writer import CROP_FORMATS, DEFAULT_CROP_FORMAT
+from console_verbosity import VERBOSITY_LEVELS, DEFAULT_VERBOSITY, set_verbosity
+from pipeline_metrics import metrics, set_metrics_enabled, format_summary
+from folder_watch import FolderWatcher, WatchedGallery, watch_gallery
+from logging_setup import setup_logging
+from exif_metadata import ExifCache, EXIF_CACHE_FILE_NAME, resolve_exif_data, resolve_match_exif
+from metadata_index import MetadataQuery, DEFAULT_RADIUS_KM, build_metadata_index, select_candidates
+
+logger = logging.getLogger()
+
+EXIT_OK = 0
+EXIT_NO_MATCHES = 1
+EXIT_USAGE = 2
+EXIT_INPUT_ERROR = 3
+EXIT_FAILURE = 4
+EXIT_INTERRUPTED = 130
+
+# Columns written by the export command, one row per stored image
+EXPORT_COLUMNS = ['Original Image File', 'Image Hash', 'Faces', 'Latitude', 'Longitude', 'Device', 'Date', 'Time', 'Resized Image Names']
+
+
+class RunSummary:
+    """
+    Counts the images and faces an ingest run went through and reports its throughput.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.images = 0
+        self.faces = 0
+
+    def on_progress(self, progress):
+        """Progress callback for `save_faces_from_folder`, called once per image."""
+        self.images += 1
+
+    def report(self, face_data):
+        """Print the totals and per second rates of the run."""
+        elapsed = time.perf_counter() - self.start
+        self.faces = sum(len(entry["faces"]) for entry in face_data.values())
+        rate = lambda count: count / elapsed if elapsed > 0 else 0.0
+        print(f"Processed {self.images} images ({len(face_data)} with faces, {self.faces} faces) in {elapsed:.1f}s: "
+              f"{rate(self.images):.2f} images/s, {rate(self.faces):.2f} faces/s")
+
+
+def ingest(args):
+    """
+    Run `save_faces_from_folder` over the input folder, keeping results in the output folder's store.
+
+    Returns:
+    - tuple: (face_data of the input folder, the updated FaceIndex or None).
+    """
+    face_index = None
+    if args.index_kind:
+        index_path = os.path.join(args.output_folder, INDEX_FILE_NAME)
+        face_index = open_index(index_path, args.index_kind, embedding_head=get_embedding_head().id,
+                                inference_version=get_inference_version())
+
+    summary = RunSummary()
+    with EmbeddingStore(os.path.join(args.output_folder, STORE_FILE_NAME)) as store:
+        face_data = save_faces_from_folder(args.input_folder, args.output_folder, get_face_detector(),
+                                           progress_callback=summary.on_progress, store=store,
+                                           face_index=face_index, workers=args.workers,
+                                           detection_max_edge=args.detection_max_edge,
+                                           near_duplicate_distance=args.near_duplicate_distance,
+                                           crop_format=args.crop_format, crop_quality=args.crop_quality,
+                                           discovery_manifest=args.discovery_manifest)
+    if face_index is not None:
+        face_index.save(index_path)
+    summary.report(face_data)
+    return face_data, face_index
+
+
+def run_index(args):
+    ingest(args)
+    return EXIT_OK
+
+
+def run_search(args):
+    if not os.path.isfile(args.image):
+        print(f"Image to search not found: {args.image}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    face_data, face_index = ingest(args)
+    with ExifCache(os.path.join(args.output_folder, EXIF_CACHE_FILE_NAME)) as exif_cache:
+        start = time.perf_counter()
+        candidates = select_candidates(face_data, args.metadata_query, exif_cache) if args.metadata_query else None
+        matching_faces = find_matching_face(args.image, face_data, get_face_detector(), threshold=args.threshold,
+                                            top_k=args.top_k, face_index=face_index,
+                                            detection_max_edge=args.detection_max_edge, candidates=candidates)
+        print(f"Search took {time.perf_counter() - start:.2f}s")
+
+        if args.results:
+            resolve_match_exif(matching_faces, face_data, exif_cache)
+            rows = [match_row(i, match, face_data) for i, match in enumerate(matching_faces)]
+            write_rows(args.results, RESULT_COLUMNS, rows)
+            print(f"Wrote {len(rows)} matches to {args.results}")
+    return EXIT_OK if matching_faces else EXIT_NO_MATCHES
+
+
+def run_watch(args):
+    if not os.path.isfile(args.image):
+        print(f"Image to search not found: {args.image}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    probe_vectors = embed_probe_faces(args.image, get_face_detector(), args.detection_max_edge)
+    # Started before the folder is indexed so changes made meanwhile are picked up
+    watcher = FolderWatcher(args.input_folder, exclude=args.output_folder, use_events=not args.poll)
+    watcher.start()
+    face_index = None
+    exif_cache = ExifCache(os.path.join(args.output_folder, EXIF_CACHE_FILE_NAME))
+    try:
+        face_data, face_index = ingest(args)
+        # The gallery keeps the metadata index in step with the folder for the searches of later changes
+        metadata_index = build_metadata_index(face_data, exif_cache) if args.metadata_query else None
+        candidates = None
+        if args.metadata_query:
+            candidates = select_candidates(face_data, args.metadata_query, metadata_index=metadata_index)
+        matching_faces = match_probe_vectors(probe_vectors, face_data, args.threshold, face_index=face_index,
+                                             candidates=candidates)
+        print(f"Number of matches found: {len(matching_faces)}")
+
+        def write_results():
+            resolve_match_exif(matching_faces, face_data, exif_cache)
+            rows = [match_row(i, match, face_data) for i, match in enumerate(matching_faces)]
+            write_rows(args.results, RESULT_COLUMNS, rows)
+            print(f"Wrote {len(rows)} matches to {args.results}")
+
+        def on_update(removed, matches, added):
+            matching_faces[:] = [match for match in matching_faces if match[0] not in removed]
+            for img_hash, _, _, similarity, _ in matches:
+                print(f"New match: {face_data[img_hash]['full_path']} ({similarity * 100:.2f}%)")
+            matching_faces.extend(matches)
+            if args.results and (removed or matches):
+                write_results()
+
+        if args.results:
+            write_results()
+        print(f"Watching {args.input_folder} for changes, press Ctrl+C to stop")
+        with EmbeddingStore(os.path.join(args.output_folder, STORE_FILE_NAME)) as store:
+            gallery = WatchedGallery(args.input_folder, args.output_folder, face_data, store, face_index=face_index,
+                                     known_paths=watcher.known, metadata_index=metadata_index, exif_cache=exif_cache,
+                                     workers=args.workers,
+                                     detection_max_edge=args.detection_max_edge,
+                                     near_duplicate_distance=args.near_duplicate_distance,
+                                     crop_format=args.crop_format, crop_quality=args.crop_quality)
+            try:
+                watch_gallery(watcher, gallery, get_face_detector(), probe_vectors, on_update, threshold=args.threshold,
+                              metadata_query=args.metadata_query)
+            except KeyboardInterrupt:
+                print("Stopped watching.")
+    finally:
+        watcher.stop()
+        exif_cache.close()
+        if face_index is not None:
+            face_index.save(os.path.join(args.output_folder, INDEX_FILE_NAME))
+    return EXIT_OK
+
+
+def run_export(args):
+    store_path = os.path.join(args.output_folder, STORE_FILE_NAME)
+    if not os.path.isfile(store_path):
+        print(f"No embedding store found in {args.output_folder}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    rows = []
+    with EmbeddingStore(store_path) as store, ExifCache(os.path.join(args.output_folder, EXIF_CACHE_FILE_NAME)) as exif_cache:
+        for full_path, img_hash in store.iter_paths():
+            record = store.get(img_hash)
+            if record is None:
+                continue
+            # EXIF data is read when first exported and cached from then on
+            image = {"full_path": full_path, "exif_data": record.get("exif_data")}
+            resolve_exif_data({img_hash: image}, exif_cache)
+            rows.append([full_path, img_hash, len(record["faces"]), *exif_columns(image["exif_data"]),
+                         " ".join(record.get("crop_names", []))])
+    write_rows(args.results, EXPORT_COLUMNS, rows)
+    print(f"Wrote {len(rows)} images to {args.results}")
+    return EXIT_OK
+
+
+def run_fit_whitening(args):
+    store_path = os.path.join(args.output_folder, STORE_FILE_NAME)
+    if not os.path.isfile(store_path):
+        print(f"No embedding store found in {args.output_folder}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    head_id = create_embedding_head(args.embedding_head).id
+    vectors = []
+    with EmbeddingStore(store_path) as store:
+        for _, img_hash in store.iter_paths():
+            record = store.get(img_hash)
+            if record is not None and record.get("embedding_head") == head_id:
+                vectors.extend(record["faces"])
+    if len(vectors) < 2:
+        print(f"Found {len(vectors)} faces embedded with '{head_id}'. Index the folder with "
+              f"--embedding-head {args.embedding_head} first.", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    whitening = PCAWhitening.fit(vectors, args.dims, source_head=head_id)
+    whitening.save(args.whitening_file)
+    print(f"Fitted {whitening.id} on {len(vectors)} '{head_id}' faces, saved to {args.whitening_file}")
+    return EXIT_OK
+
+
+def run_export_models(args):
+    if args.inference_backend == KERAS_BACKEND:
+        print("The keras backend uses the Keras models directly and has nothing to export.", file=sys.stderr)
+        return EXIT_USAGE
+    if args.calibration_crops and not os.path.isdir(args.calibration_crops):
+        print(f"Calibration folder not found: {args.calibration_crops}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+
+    # Exporting again replaces the models, e.g. to add int8 calibration to an earlier export
+    export_resnet(args.inference_backend, args.model_dir, args.calibration_crops)
+    export_mtcnn(args.inference_backend, args.model_dir)
+    print(f"Exported the {args.inference_backend} models to {args.model_dir}")
+    return EXIT_OK
+
+
+def build_metadata_query(args):
+    """
+    Build the metadata filter of a search from its arguments.
+
+    Returns:
+    - MetadataQuery: The filter, without conditions if none were given.
+
+    Raises:
+    - ValueError: If a date or coordinate is invalid.
+    """
+    return MetadataQuery(date_from=args.date_from, date_to=args.date_to, devices=args.device, near=args.near,
+                         radius_km=args.radius_km, bbox=args.bbox)
+
+
+def write_metrics(path):
+    """Finish the run's metrics, print them and write them to a JSON file."""
+    metrics.finish()
+    summary = metrics.log_summary(path)
+    print(format_summary(summary))
+    print(f"Wrote the run summary to {path}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Index image folders and search them for a face without the GUI.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_ingest_arguments(subparser):
+        subparser.add_argument('input_folder', help="Folder of images to process")
+        subparser.add_argument('output_folder', help="Folder for face crops, the embedding store and the index")
+        subparser.add_argument('--workers', type=int, default=None, help="Number of face detection processes")
+        subparser.add_argument('--index-kind', choices=list(INDEX_TYPES), default=None,
+                               help="Keep a persistent index of this kind in the output folder and search it")
+        subparser.add_argument('--embedding-head', choices=list(EMBEDDING_HEADS), default=DEFAULT_EMBEDDING_HEAD,
+                               help="How ResNet feature maps are turned into face vectors")
+        subparser.add_argument('--whitening', default=None, help="PCA whitening file from fit-whitening to apply after pooling")
+        subparser.add_argument('--detection-max-edge', type=int, default=None,
+                               help="Detect faces on images scaled down to this longest edge")
+        subparser.add_argument('--near-duplicate-distance', type=int, default=None,
+                               help="Reuse the faces of an earlier image whose perceptual hash differs by at most this many bits")
+        subparser.add_argument('--crop-format', choices=list(CROP_FORMATS), default=DEFAULT_CROP_FORMAT,
+                               help="Image format of the face crops")
+        subparser.add_argument('--crop-quality', type=int, default=None,
+                               help="JPEG/WebP quality (0-100) or PNG compression level (0-9) of the face crops")
+        subparser.add_argument('--verbosity', choices=list(VERBOSITY_LEVELS), default=DEFAULT_VERBOSITY,
+                               help="Print per image progress (normal), also per face details (verbose), or neither (quiet)")
+        subparser.add_argument('--discovery-manifest', action='store_true',
+                               help="Keep a manifest of the input folder's directories so unchanged ones aren't listed again")
+        subparser.add_argument('--metrics', default=None,
+                               help="Time every pipeline stage and write the run summary to this JSON file")
+        add_backend_arguments(subparser)
+
+    def add_filter_arguments(subparser):
+        subparser.add_argument('--date-from', default=None, help="Only search images taken on or after this date (YYYY-MM-DD)")
+        subparser.add_argument('--date-to', default=None, help="Only search images taken on or before this date (YYYY-MM-DD)")
+        subparser.add_argument('--device', action='append', default=[],
+                               help="Only search images from a camera whose make or model contains this text, may be repeated")
+        subparser.add_argument('--near', type=float, nargs=2, metavar=('LAT', 'LON'), default=None,
+                               help="Only search images taken within --radius-km of this location")
+        subparser.add_argument('--radius-km', type=float, default=DEFAULT_RADIUS_KM, help="Radius of --near in kilometres")
+        subparser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'), default=None,
+                               help="Only search images taken inside this bounding box")
+
+    def add_backend_arguments(subparser):
+        subparser.add_argument('--inference-backend', choices=list(INFERENCE_BACKENDS), default=DEFAULT_INFERENCE_BACKEND,
+                               help="Run the models with Keras or as quantised TFLite exports")
+        subparser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR, help="Folder of the exported TFLite models")
+
+    index_parser = subparsers.add_parser('index', help="Detect and embed the faces of a folder")
+    add_ingest_arguments(index_parser)
+    index_parser.set_defaults(func=run_index)
+
+    search_parser = subparsers.add_parser('search', help="Find the faces of an image in a folder")
+    search_parser.add_argument('image', help="Image containing the face to search for")
+    add_ingest_arguments(search_parser)
+    search_parser.add_argument('--threshold', type=float, default=.75, help="Maximum cosine distance for a match")
+    search_parser.add_argument('--top-k', type=int, default=None, help="Keep only the best matches per searched face")
+    search_parser.add_argument('--results', default=None, help="Write the matches to this .csv or .json file")
+    add_filter_arguments(search_parser)
+    search_parser.set_defaults(func=run_search)
+
+    watch_parser = subparsers.add_parser('watch', help="Search a folder for a face and keep searching the images that arrive in it")
+    watch_parser.add_argument('image', help="Image containing the face to search for")
+    add_ingest_arguments(watch_parser)
+    watch_parser.add_argument('--threshold', type=float, default=.75, help="Maximum cosine distance for a match")
+    watch_parser.add_argument('--results', default=None, help="Keep the current matches in this .csv or .json file")
+    watch_parser.add_argument('--poll', action='store_true',
+                              help="Rescan the folder every few seconds instead of using file system events")
+    add_filter_arguments(watch_parser)
+    watch_parser.set_defaults(func=run_watch)
+
+    export_parser = subparsers.add_parser('export', help="Write every indexed image and its metadata to a file")
+    export_parser.add_argument('output_folder', help="Output folder of a previous index or search run")
+    export_parser.add_argument('results', help="Destination .csv or .json file")
+    export_parser.set_defaults(func=run_export)
+
+    whitening_parser = subparsers.add_parser('fit-whitening', help="Fit a PCA whitening on the stored vectors of a pooled head")
+    whitening_parser.add_argument('output_folder', help="Output folder indexed with the pooled head")
+    whitening_parser.add_argument('whitening_file', help="Destination .npz file")
+    whitening_parser.add_argument('--embedding-head', choices=[name for name in EMBEDDING_HEADS if name != 'flat'], default='gem',
+                                  help="Pooled head whose stored vectors to fit on")
+    whitening_parser.add_argument('--dims', type=int, default=DEFAULT_WHITENING_DIMS, help="Number of dimensions to keep")
+    whitening_parser.set_defaults(func=run_fit_whitening)
+
+    models_parser = subparsers.add_parser('export-models', help="Export the TFLite models of an inference backend")
+    add_backend_arguments(models_parser)
+    models_parser.add_argument('--calibration-crops', default=None,
+                               help="Output folder whose face crops calibrate int8 activations")
+    models_parser.set_defaults(func=run_export_models)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    setup_logging()
+
+    if getattr(args, 'input_folder', None) and not os.path.isdir(args.input_folder):
+        print(f"Input folder not found: {args.input_folder}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+    if getattr(args, 'whitening', None) and not os.path.isfile(args.whitening):
+        print(f"Whitening file not found: {args.whitening}", file=sys.stderr)
+        return EXIT_INPUT_ERROR
+    if hasattr(args, 'date_from'):
+        try:
+            args.metadata_query = build_metadata_query(args)
+        except ValueError as e:
+            print(f"Invalid metadata filter: {e}", file=sys.stderr)
+            return EXIT_USAGE
+
+    try:
+        if getattr(args, 'input_folder', None):
+            set_embedding_head(create_embedding_head(args.embedding_head, args.whitening))
+            set_inference_backend(args.inference_backend, args.model_dir)
+            set_verbosity(args.verbosity)
+        if getattr(args, 'metrics', None):
+            set_metrics_enabled(True)
+            metrics.reset()
+            try:
+                return args.func(args)
+            finally:
+                write_metrics(args.metrics)
+        return args.func(args)
+    except KeyboardInterrupt:
+        print("Interrupted.", file=sys.stderr)
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        logger.exception(f"{args.command} failed")
+        traceback.print_exc()
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return EXIT_FAILURE
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
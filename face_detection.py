@@ -8,62 +8,32 @@ import os
 import cv2
 #import sys
 import hashlib
+import time
 import numpy as np
-print("Loading MTCNN Face Recognition...")
-from mtcnn import MTCNN
-print("MTCNN Face Recognition loaded.")
-from scipy.spatial import distance
-from tensorflow.keras.applications.resnet import ResNet152, preprocess_input
-from PIL import Image
-import PIL.ExifTags
+from embedding_store import crops_exist
+from similarity_search import FaceMatrix, ProbeMatcher
+from model_registry import get_face_detector, get_resnet_model, get_inference_version
+from embedding_heads import get_embedding_head
+from image_loader import ImageBuffer
+from perceptual_hash import BKTree, image_fingerprint, similar_aspect
+from crop_writer import CropWriter, DEFAULT_CROP_FORMAT
+from console_verbosity import NORMAL, VERBOSE, is_verbose
+from pipeline_metrics import metrics
+from file_discovery import DISCOVERY_MANIFEST_FILE_NAME, discover_images, is_image_name
+from exif_metadata import read_image_exif, resolve_exif_data
 
+logger = logging.getLogger()
 
-def is_hidden(filepath):
-
-    """ 
-    Check if a given filepath corresponds to a hidden file.
-    For UNIX-like systems, a file is considered hidden if its name starts with a dot.
-    For Windows, the function checks for the FILE_ATTRIBUTE_HIDDEN attribute.
-    """
-    try:
-        # For Windows
-        import os
-        import ctypes
-
-        attrs = ctypes.windll.kernel32.GetFileAttributesW(str(filepath))
-        assert attrs != -1
-
-        result = attrs & 2  # FILE_ATTRIBUTE_HIDDEN = 2
-
-        # If the path has the FILE_ATTRIBUTE_HIDDEN attribute set, it's hidden
-        if result:
-            return True
-
-    except (ImportError, AttributeError, AssertionError):
-        # For UNIX-like systems
-        # If the basename of the path starts with a dot, it's hidden
-        if os.path.basename(filepath).startswith('.'):
-            return True
+output_folder = "./output/"
 
-    return False
+# Number of face crops passed to the ResNet model per call
+EMBEDDING_BATCH_SIZE = 32
 
-try:
-    logging.basicConfig(filename=r'.\debug.log',
-                        filemode='w',
-                        level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    logging.debug('Logging setup successful')
-    print("Logging setup1 successful.")
-except Exception as e:
-    print(f"Logging setup failed: {str(e)}")
+# Minimum MTCNN confidence for a detected face to be cropped and embedded
+FACE_CONFIDENCE_THRESHOLD = 0.9
 
-logger = logging.getLogger()
-
-output_folder = "./output/"
-face_detector = MTCNN()
-print("Initialising Resnet models...")
-resnet_model = ResNet152(weights='imagenet', include_top=False)
-print('Resnet models initialized successfully.')
+# JPEG decoding modes that scale the image down by 8, 4 or 2 while decoding
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
 
 # Create output directory if it doesn't exist
 if not os.path.exists(output_folder):
@@ -73,56 +43,17 @@ def is_valid_image_extension(file_path):
     """ 
     Check if the given file path has a valid image extension.
     """
-    valid_extensions = ['.png', '.jpeg', '.jpg', '.bmp']
-    ext = os.path.splitext(file_path)[-1].lower()
-    return ext in valid_extensions
-
+    return is_image_name(file_path)
 
-def convert_to_decimal(coord, direction):
-    """ 
-    Convert GPS coordinates to decimal format.
-    """
-    degrees, minutes, seconds = coord
-    decimal = degrees + minutes / 60 + seconds / 3600
-    if direction in ['S', 'W']:
-        decimal *= -1
-    return float(decimal)
 
-def get_image_exif_data(image_path):
+def get_image_exif_data(image_path, image=None):
     """
-    Extract EXIF data from the provided image path.
+    Extract EXIF data from the provided image path, or from the already read `ImageBuffer` of it.
+    Only the EXIF block of the file is read and parsed (see `exif_metadata`).
     """
-    try:
-        img_obj = Image.open(image_path)
-        exif_data = img_obj._getexif()
-        
-        if exif_data is not None:
-            desired_fields = ["Make", "Model", "DateTimeDigitized", "GPSInfo"]
-            exif_info = {
-                PIL.ExifTags.TAGS[k]: v
-                for k, v in exif_data.items()
-                if k in PIL.ExifTags.TAGS and PIL.ExifTags.TAGS[k] in desired_fields
-            }
-            
-            if 'DateTimeDigitized' in exif_info:
-                date_time = exif_info.pop('DateTimeDigitized')  # Pop returns the value and removes the key
-                date, time = date_time.split()
-                exif_info['DateDigitized'] = date
-                exif_info['TimeDigitized'] = time
-
-            if 'GPSInfo' in exif_info:
-                gps_info = exif_info['GPSInfo']
-                lat = round(convert_to_decimal(gps_info[2], gps_info[1]), 6)
-                lon = round(convert_to_decimal(gps_info[4], gps_info[3]), 6)
-                exif_info['GPSInfo'] = {'Latitude': lat, 'Longitude': lon}
-                
-            print(f"EXIF data for {image_path}: {exif_info}")
-            return exif_info
-        else:
-            return {}
-    except Exception as e:
-        logger.exception(f'Error while reading EXIF data from {image_path}')
-        return {}
+    exif_info = read_image_exif(image_path, image.data if image is not None else None) or {}
+    logger.debug("EXIF data for %s: %s", image_path, exif_info)
+    return exif_info
 
 def align_face(face_img, left_eye, right_eye):
     """
@@ -184,16 +115,53 @@ def resize_image_with_aspect_ratio(img, size):
         logger.exception(f'Error while resizing image')
         return None
 
+def __getattr__(name):
+    """
+    Build the models on first access of the `face_detector` and `resnet_model` module attributes,
+    so importing this module stays cheap.
+    """
+    if name == "face_detector":
+        return get_face_detector()
+    if name == "resnet_model":
+        return get_resnet_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def convert_images_to_vectors(imgs, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    Convert a list of face images to feature vectors using the ResNet152 model, running
+    the model on up to `batch_size` images at a time. The active embedding head turns the
+    feature maps into vectors.
+
+    A face's vector does not depend on the other faces in its batch, but it is not guaranteed
+    to be bit-identical across batch sizes: the model's float32 kernels may sum in a different
+    order for a different batch size. The differences are float32 rounding errors, within 1e-5
+    of a vector's largest component, far below the distances faces are matched at.
+
+    Parameters:
+    - imgs (list): 224x224 BGR face images.
+    - batch_size (int): Maximum number of images per model call.
+
+    Returns:
+    - list: One feature vector per image, in the same order as `imgs`.
+    """
+    from tensorflow.keras.applications.resnet import preprocess_input
+
+    embedding_head = get_embedding_head()
+    vectors = []
+    for start in range(0, len(imgs), batch_size):
+        with metrics.timer("embed", len(imgs[start:start + batch_size])):
+            batch = np.stack([cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs[start:start + batch_size]])
+            batch = preprocess_input(batch)
+            feature_maps = get_resnet_model().predict_on_batch(batch)
+            vectors.extend(embedding_head(feature_maps))
+    return vectors
+
 def convert_image_to_vector(img):
     """
     Convert an image to a feature vector using the ResNet152 model.
     """
     try:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = np.expand_dims(img, axis=0)
-        img = preprocess_input(img)
-        feature_vector = resnet_model.predict(img)
-        return feature_vector.flatten()
+        return convert_images_to_vectors([img], batch_size=1)[0]
 
     except Exception as e:
         traceback.print_exc()
@@ -202,177 +170,901 @@ def convert_image_to_vector(img):
         print('An error occurred. Please check the logs for more details.')
         raise e
 
-def save_faces_from_folder(folder_path, output_folder, face_detector, progress_callback=None, cancel_flag=None, partial_update_callback=None):
+def new_face_entry(image_path, exif_data=None):
     """
-    Detect and save faces from all images within the provided folder path.
+    Create the face_data entry for an image before its faces are embedded. Its EXIF data is left
+    as None until `exif_metadata.resolve_exif_data` reads it for display.
     """
-    face_data = {}
-    valid_extensions = ['.png', '.jpeg', '.jpg', '.bmp']
-    processed_images = set()  # Keep track of processed images
-    processed_faces = set()  # Keep track of processed faces
+    return {"file_name": os.path.basename(image_path), "full_path": image_path, "faces": [], "exif_data": exif_data,
+            "boxes": [], "keypoints": [], "crop_names": []}
+
+def face_entry_from_record(record, image_path):
+    """
+    Create the face_data entry for an image from its embedding store record. Records don't keep
+    EXIF data, which lives in the EXIF cache of the output folder only; the "exif_data" of
+    records written by older versions is ignored.
+    """
+    face_entry = new_face_entry(image_path)
+    face_entry["faces"] = list(record["faces"])
+    face_entry["boxes"] = list(record.get("boxes", []))
+    face_entry["keypoints"] = list(record.get("keypoints", []))
+    face_entry["crop_names"] = list(record.get("crop_names", []))
+    return face_entry
+
+def build_store_record(face_entry, num_detected, face_hashes, fingerprint=None):
+    """
+    Build the record persisted in the embedding store for a processed image.
 
-    # Use os.walk to traverse directories
-    image_paths = [os.path.join(root, name)
-                   for root, dirs, files in os.walk(folder_path)
-                   for name in files if not is_hidden(os.path.join(root, name))
-                   if os.path.splitext(name)[-1].lower() in valid_extensions]
+    Parameters:
+    - face_entry (dict or None): The image's entry in face_data, or None if no faces were detected.
+    - num_detected (int): Number of faces MTCNN detected in the image.
+    - face_hashes (list): sha256 hashes of the face vectors that were kept.
+    - fingerprint (dict, optional): Perceptual hash and size of the image.
 
-    num_images = len(image_paths)
+    Returns:
+    - dict: The record to store.
+    """
+    face_entry = face_entry or {}
+    return {**(fingerprint or {}),
+            "num_detected": num_detected,
+            "faces": face_entry.get("faces", []),
+            "boxes": face_entry.get("boxes", []),
+            "keypoints": face_entry.get("keypoints", []),
+            "crop_names": face_entry.get("crop_names", []),
+            "face_hashes": face_hashes,
+            "embedding_head": get_embedding_head().id,
+            "inference_version": get_inference_version()}
+
+def lookup_stored_record(store, image_path, output_folder, img_hash=None):
+    """
+    Look an image up in the embedding store.
+
+    Parameters:
+    - store (EmbeddingStore): The embedding store.
+    - image_path (str): Path of the image.
+    - output_folder (str): Folder the face crops are expected in.
+    - img_hash (str, optional): md5 hash of the image contents, if already known.
+
+    Returns:
+    - tuple: (record, img_hash, file_stat). record is None unless a record exists, all its crops
+      are present and it was produced with the active embedding head and inference backend. img_hash is None
+      when the file is unknown to the store and was not hashed.
+    """
+    # Paths from discovery carry the status read while listing their directory
+    file_stat = getattr(image_path, "stat_result", None) or os.stat(image_path)
+    if img_hash is None:
+        img_hash = store.lookup_path(image_path, file_stat.st_size, file_stat.st_mtime)
+    if img_hash is None:
+        return None, None, file_stat
+
+    # Vectors from another head or backend can't be compared with the ones embedded now
+    record = store.get(img_hash, get_embedding_head().id, get_inference_version())
+    if record is None or not crops_exist(record, output_folder):
+        return None, img_hash, file_stat
+    return record, img_hash, file_stat
+
+def triage_image(queue, store, image_path, output_folder):
+    """
+    Decide how to handle an image before any detection work is spent on it, in this order:
+    restore it from the embedding store if its path or contents are known, skip it if it is an
+    exact copy of an image seen earlier in the run, reuse the faces of an earlier image it is a
+    near duplicate of, or else detect its faces.
+
+    Must be called in folder order, since the first of several copies is the one processed.
+
+    Parameters:
+    - queue (FaceIngestQueue): The queue the image will be added to.
+    - store (EmbeddingStore or None): The embedding store.
+    - image_path (str): Path of the image.
+    - output_folder (str): Folder the face crops are written to.
+
+    Returns:
+    - dict: "action" ('restore', 'duplicate', 'near_duplicate' or 'detect') with the "img_hash"
+      and "file_stat" of the image, plus the "record" to restore, or the "image" buffer and
+      "fingerprint" to detect with, or the "original_hash" of a near duplicate.
+    """
+    triage = {"action": "detect", "img_hash": None, "file_stat": None, "record": None, "image": None,
+              "fingerprint": None, "original_hash": None}
+
+    def restore(img_hash, record, file_stat):
+        triage.update(img_hash=img_hash, file_stat=file_stat)
+        if not queue.claim(img_hash):
+            triage["action"] = "duplicate"
+            return triage
+        queue.remember_fingerprint(img_hash, record)
+        triage.update(action="restore", record=record)
+        return triage
+
+    # Unchanged files are recognised from a stat call without reading them
+    if store is not None:
+        try:
+            with metrics.timer("store_lookup"):
+                record, triage["img_hash"], triage["file_stat"] = lookup_stored_record(store, image_path, output_folder)
+            if record is not None:
+                return restore(triage["img_hash"], record, triage["file_stat"])
+        except Exception as e:
+            logger.exception(f"Error looking up {image_path} in the embedding store: {str(e)}")
+            triage.update(img_hash=None, file_stat=None)
+
+    # The file is read once here and the buffer reused for detection
+    image = triage["image"] = ImageBuffer.read(image_path)
+    metrics.record("read", image.read_s)
+    hash_from_contents = triage["img_hash"] is None
+    if hash_from_contents:
+        with metrics.timer("hash"):
+            triage["img_hash"] = image.md5()
+
+    # The file may be a renamed or copied image the store already knows
+    if store is not None and hash_from_contents and triage["file_stat"] is not None:
+        try:
+            with metrics.timer("store_lookup"):
+                record, _, _ = lookup_stored_record(store, image_path, output_folder, triage["img_hash"])
+            if record is not None:
+                return restore(triage["img_hash"], record, triage["file_stat"])
+        except Exception as e:
+            logger.exception(f"Error looking up {image_path} in the embedding store: {str(e)}")
+            triage["file_stat"] = None
+
+    if not queue.claim(triage["img_hash"]):
+        triage["action"] = "duplicate"
+        return triage
+
+    if queue.near_duplicates is not None:
+        with metrics.timer("fingerprint"):
+            triage["fingerprint"] = image_fingerprint(image)
+        original_hash = queue.find_near_duplicate(triage["fingerprint"])
+        if original_hash is not None:
+            triage.update(action="near_duplicate", original_hash=original_hash)
+            return triage
+        queue.remember_fingerprint(triage["img_hash"], triage["fingerprint"])
+    return triage
+
+class FaceIngestQueue:
+    """
+    Carries images through batched embedding while keeping them in folder order.
+
+    Images are added in folder order once they have been detected, restored from the embedding
+    store or skipped. Face crops are embedded `batch_size` at a time and `drain` yields the
+    result of every image as soon as no earlier image is still waiting for the model.
+
+    Store writes are committed once per embedding batch (or every `batch_size` images without
+    faces), not per image, so a crash loses at most one batch of records.
+
+    Callers `claim` every image hash before running detection so exact copies of an image seen
+    earlier in the run are skipped without any detection work. With `near_duplicate_distance`
+    set, resized or re-encoded copies are recognised by their perceptual hash and reuse the face
+    records of the original instead.
+    """
+
+    def __init__(self, output_folder, batch_size=EMBEDDING_BATCH_SIZE, store=None, face_index=None, near_duplicate_distance=None,
+                 crop_format=DEFAULT_CROP_FORMAT, crop_quality=None):
+        """
+        Parameters:
+        - output_folder (str): Folder where the face crops are written.
+        - batch_size (int): Number of faces per model call.
+        - store (EmbeddingStore, optional): Store newly processed images are recorded in.
+        - face_index (FaceIndex, optional): Index new and restored faces are inserted into.
+        - near_duplicate_distance (int, optional): Largest Hamming distance between the 64 bit
+          perceptual hashes of an image and a copy of it. Needs a store to fetch the original's record.
+        - crop_format (str): Format of the face crops, one of `crop_writer.CROP_FORMATS`.
+        - crop_quality (int, optional): Quality of the face crops.
+        """
+        self.output_folder = output_folder
+        self.crop_writer = CropWriter(output_folder, crop_format, crop_quality)
+        self.batch_size = batch_size
+        self.store = store
+        self.face_index = face_index
+        self.processed_images = set()  # Keep track of processed images
+        self.processed_faces = set()  # Keep track of processed faces
+        self.claimed_hashes = set()  # Every image hash seen in this run, claimed before detection
+        self.pending = []  # Images in folder order whose results have not been yielded yet
+        self.pending_crops = 0
+        self.uncommitted = 0  # Store writes since the last commit
+        self.near_duplicate_distance = near_duplicate_distance
+        self.near_duplicates = None  # Perceptual hashes of the images seen in this run
+        if near_duplicate_distance is not None:
+            if store is None:
+                logger.warning("Near duplicate detection needs an embedding store, it is disabled")
+            else:
+                self.near_duplicates = BKTree()
+
+    def claim(self, img_hash):
+        """
+        Claim an image hash before running detection on the image.
+
+        Returns:
+        - bool: True the first time the hash is seen in this run, False for exact duplicates.
+        """
+        if img_hash in self.claimed_hashes:
+            return False
+        self.claimed_hashes.add(img_hash)
+        return True
+
+    def add_duplicate(self, idx, image_path, img_hash, file_stat):
+        """
+        Queue an exact copy of an image seen earlier in this run. Its path is remembered in the
+        store so the copy is recognised from a stat call next time.
+        """
+        if self.store is not None and file_stat is not None:
+            self.store.remember_path(image_path, file_stat.st_size, file_stat.st_mtime, img_hash)
+            self.uncommitted += 1
+        logger.debug(f"{image_path} is a duplicate of an image processed earlier, skipping it")
+        metrics.count("duplicates")
+        self.add_skipped(idx, image_path)
+
+    def remember_fingerprint(self, img_hash, fingerprint):
+        """
+        Make an image available as the original of later near duplicates.
+
+        Parameters:
+        - img_hash (str): md5 hash of the image contents.
+        - fingerprint (dict or None): Perceptual hash and size from `image_fingerprint`, or a store
+          record holding them.
+        """
+        if self.near_duplicates is not None and fingerprint and "dhash" in fingerprint:
+            self.near_duplicates.add(fingerprint["dhash"], (img_hash, tuple(fingerprint["image_size"])))
+
+    def find_near_duplicate(self, fingerprint):
+        """
+        Look for an earlier image this one is a resized or re-encoded copy of.
+
+        Returns:
+        - str or None: The hash of the closest such image.
+        """
+        if self.near_duplicates is None or fingerprint is None:
+            return None
+        for _, (img_hash, image_size) in self.near_duplicates.search(fingerprint["dhash"], self.near_duplicate_distance):
+            if similar_aspect(image_size, fingerprint["image_size"]):
+                return img_hash
+        return None
+
+    def add_near_duplicate(self, idx, image_path, img_hash, file_stat, fingerprint, original_hash):
+        """
+        Queue a near duplicate of an earlier image. It takes over the original's faces once the
+        original's record is in the store, without detection or embedding of its own.
+        """
+        entry = {"idx": idx, "image_path": image_path, "img_hash": img_hash, "file_stat": file_stat,
+                 "num_detected": 0, "crops": [], "face_entry": None,
+                 "fingerprint": fingerprint, "near_duplicate_of": original_hash}
+        metrics.count("near_duplicates")
+        self.pending.append(entry)
+        # Otherwise the original is still waiting for the model and `embed` resolves the copy after it
+        if self.pending_crops == 0:
+            self._resolve_near_duplicate(entry)
+
+    def _resolve_near_duplicate(self, entry):
+        """Fill in a near duplicate's faces from its original's store record."""
+        original_hash = entry.pop("near_duplicate_of")
+        img_hash = entry["img_hash"]
+        # The copy is only stored here, with the original's faces, never by `embed`
+        file_stat, entry["file_stat"] = entry["file_stat"], None
+        record = self.store.get(original_hash, get_embedding_head().id, get_inference_version())
+        if record is None or "image_size" not in record:
+            logger.warning(f"The original of near duplicate {entry['image_path']} is not stored, skipping it")
+            return
+
+        scale_x = entry["fingerprint"]["image_size"][0] / record["image_size"][0]
+        scale_y = entry["fingerprint"]["image_size"][1] / record["image_size"][1]
+        faces = [{'box': box, 'keypoints': keypoints} for box, keypoints in zip(record.get("boxes", []), record.get("keypoints", []))]
+        rescale_detections(faces, scale_x, scale_y)
+
+        crop_names = []
+        for i, crop_name in enumerate(record.get("crop_names", [])):
+            # The copy keeps the original's format, which may differ from the current one
+            copy_name = f"{img_hash}_{i + 1}{os.path.splitext(crop_name)[1]}"
+            self.crop_writer.link(crop_name, copy_name)
+            crop_names.append(copy_name)
+
+        copy_record = dict(record, boxes=[face['box'] for face in faces], keypoints=[face['keypoints'] for face in faces],
+                           crop_names=crop_names, near_duplicate_of=original_hash, **entry["fingerprint"])
+        # The copy has EXIF data of its own, which is read like any other image's
+        copy_record.pop("exif_data", None)
+        logger.debug(f"{entry['image_path']} is a near duplicate of {original_hash}, reusing its faces")
+        self._store_record(dict(entry, file_stat=file_stat), copy_record)
+
+        if copy_record.get("num_detected", 0) > 0 and img_hash not in self.processed_images:
+            self.processed_images.add(img_hash)
+            entry["face_entry"] = face_entry_from_record(copy_record, entry["image_path"])
+            if self.face_index is not None:
+                faces = entry["face_entry"]["faces"]
+                self.face_index.add([(img_hash, i) for i in range(len(faces))], faces)
+
+    def _store_record(self, entry, record):
+        """Write an image's record to the store, if there is one and the file status is known."""
+        if self.store is None or entry["file_stat"] is None:
+            return
+        try:
+            self.store.put(entry["img_hash"], record, entry["image_path"], entry["file_stat"].st_size, entry["file_stat"].st_mtime)
+            self.uncommitted += 1
+        except Exception as e:
+            logger.exception(f"Error saving {entry['image_path']} to the embedding store: {str(e)}")
+
+    def commit(self, force=False):
+        """
+        Commit the store writes made since the last commit, once there are `batch_size` of them
+        or if forced.
+        """
+        if self.store is None or self.uncommitted == 0 or (not force and self.uncommitted < self.batch_size):
+            return
+        try:
+            self.store.commit()
+        except Exception as e:
+            logger.exception(f"Error committing to the embedding store: {str(e)}")
+        self.uncommitted = 0
+
+    def add_skipped(self, idx, image_path):
+        """
+        Queue an image that contributes nothing, e.g. because it could not be read.
+        """
+        self.pending.append({"idx": idx, "image_path": image_path, "img_hash": None, "file_stat": None,
+                             "num_detected": 0, "crops": [], "face_entry": None})
+
+    def add_triaged(self, idx, image_path, triage):
+        """
+        Queue an image that `triage_image` found needs no detection.
+        """
+        if triage["action"] == "restore":
+            logger.debug(f'Restoring {os.path.basename(image_path)} from the embedding store')
+            file_stat = triage["file_stat"]
+            self.store.remember_path(image_path, file_stat.st_size, file_stat.st_mtime, triage["img_hash"])
+            self.add_restored(idx, image_path, triage["img_hash"], triage["record"])
+        elif triage["action"] == "duplicate":
+            self.add_duplicate(idx, image_path, triage["img_hash"], triage["file_stat"])
+        else:
+            self.add_near_duplicate(idx, image_path, triage["img_hash"], triage["file_stat"], triage["fingerprint"],
+                                    triage["original_hash"])
+
+    def add_restored(self, idx, image_path, img_hash, record):
+        """
+        Queue an image whose faces were restored from the embedding store.
+        """
+        metrics.count("restored")
+        face_entry = None
+        # Images in which MTCNN found nothing never appear in face_data
+        if record.get("num_detected", 0) > 0 and img_hash not in self.processed_images:
+            self.processed_images.add(img_hash)
+            self.processed_faces.update(record.get("face_hashes", []))
+            face_entry = face_entry_from_record(record, image_path)
+            if self.face_index is not None:
+                self.face_index.add([(img_hash, i) for i in range(len(face_entry["faces"]))], face_entry["faces"])
+
+        # file_stat is left out so the record isn't written back to the store
+        self.pending.append({"idx": idx, "image_path": image_path, "img_hash": img_hash, "file_stat": None,
+                             "num_detected": record.get("num_detected", 0), "crops": [], "face_entry": face_entry})
+
+    def add_detected(self, idx, image_path, img_hash, file_stat, detected_faces, crops, fingerprint=None):
+        """
+        Queue an image that went through detection, along with its aligned face crops.
+
+        Parameters:
+        - idx (int): 1 based position of the image in the folder listing.
+        - image_path (str): Path of the image.
+        - img_hash (str): md5 hash of the image contents.
+        - file_stat (os.stat_result or None): File status recorded in the embedding store.
+        - detected_faces (list): MTCNN detections for the image.
+        - crops (list): (detection, face image) pairs from `extract_aligned_faces`.
+        - fingerprint (dict, optional): Perceptual hash and size of the image, kept in its store record.
+        """
+        metrics.count("detected")
+        face_entry = None
+        if len(detected_faces) > 0:
+            # If we have processed this image, continue to the next
+            if img_hash in self.processed_images:
+                self.add_skipped(idx, image_path)
+                return
+
+            # Mark this image as processed
+            self.processed_images.add(img_hash)
+            face_entry = new_face_entry(image_path)
+        else:
+            crops = []
+
+        entry = {"idx": idx, "image_path": image_path, "img_hash": img_hash, "file_stat": file_stat,
+                 "num_detected": len(detected_faces), "crops": crops, "face_entry": face_entry,
+                 "fingerprint": fingerprint}
+        self.pending.append(entry)
+        self.pending_crops += len(crops)
+
+        # Nothing to embed, so the record is complete and can be stored straight away
+        if not crops:
+            self._store_record(entry, build_store_record(face_entry, entry["num_detected"], [], fingerprint))
+            entry["file_stat"] = None
+
+    def embed(self):
+        """
+        Embed the face crops of every queued image in batches and fill in their face entries.
+        """
+        crops = [resized_face_img for entry in self.pending for _, resized_face_img in entry["crops"]]
+        embedding_failed = False
+        try:
+            vectors = convert_images_to_vectors(crops, batch_size=self.batch_size) if crops else []
+        except Exception as e:
+            logger.exception(f"Error occurred in save_faces_from_folder: {e}")
+            vectors = [None] * len(crops)
+            embedding_failed = True
+
+        vector_iter = iter(vectors)
+        for entry in self.pending:
+            if "near_duplicate_of" in entry:
+                # The original comes earlier in the queue, so its record has just been stored
+                self._resolve_near_duplicate(entry)
+                continue
+            img_hash = entry["img_hash"]
+            face_entry = entry["face_entry"]
+            had_crops = bool(entry["crops"])
+            face_hashes = []
+            for face, resized_face_img in entry["crops"]:
+                face_vector = next(vector_iter)
+                if face_vector is None:
+                    continue
+
+                face_img_hash = hashlib.sha256(face_vector.tobytes()).hexdigest()
+
+                # If we have processed this face, continue to the next
+                if face_img_hash in self.processed_faces:
+                    continue
+
+                # Mark this face as processed
+                self.processed_faces.add(face_img_hash)
+                face_hashes.append(face_img_hash)
+                metrics.count("faces")
+
+                try:
+                    face_entry["faces"].append(face_vector)
+                    crop_name = self.crop_writer.crop_name(img_hash, len(face_entry['faces']))
+                    face_entry["boxes"].append(face['box'])
+                    face_entry["keypoints"].append(face['keypoints'])
+                    face_entry["crop_names"].append(crop_name)
+                    self.crop_writer.write(crop_name, resized_face_img)
+
+                    if self.face_index is not None:
+                        self.face_index.add([(img_hash, len(face_entry["faces"]) - 1)], [face_vector])
+                except Exception as e:
+                    logger.exception(f"Error occurred in save_faces_from_folder: {e}")
+            entry["crops"] = []
+
+            # Don't cache images whose faces could not be embedded so they are retried next run
+            if not (embedding_failed and had_crops):
+                self._store_record(entry, build_store_record(face_entry, entry["num_detected"], face_hashes, entry.get("fingerprint")))
+            entry["file_stat"] = None
+
+        self.pending_crops = 0
+        self.commit(force=True)
+
+    def pop_all(self):
+        """
+        Yield (idx, image_path, img_hash, face_entry) for every queued image and empty the queue.
+        face_entry is None for images that add nothing to face_data.
+        """
+        pending, self.pending = self.pending, []
+        self.commit()
+        metrics.count("images", len(pending))
+        for entry in pending:
+            yield entry["idx"], entry["image_path"], entry["img_hash"], entry["face_entry"]
+
+    def drain(self):
+        """
+        Yield the results that are ready, running the model first if a full batch of faces is waiting.
+        """
+        if self.pending_crops >= self.batch_size:
+            self.embed()
+        if self.pending_crops == 0:
+            yield from self.pop_all()
+
+    def finish(self):
+        """
+        Embed whatever is still queued and yield all remaining results once every crop is written.
+        """
+        self.embed()
+        self.crop_writer.close()
+        self.commit(force=True)
+        yield from self.pop_all()
+
+def discovery_manifest_path(output_folder, discovery_manifest):
+    """
+    Return where the directory manifest of the input folder is kept, or None if it isn't used.
+    """
+    return os.path.join(output_folder, DISCOVERY_MANIFEST_FILE_NAME) if discovery_manifest else None
+
+def iter_image_paths(folder_path, manifest_path=None):
+    """
+    Lazily yield all non-hidden images with a valid extension within the folder and its sub-folders,
+    as they are found by the concurrent directory scan of `file_discovery`.
+
+    Parameters:
+    - folder_path (str): The folder to search.
+    - manifest_path (str, optional): Directory manifest letting unchanged directories be skipped.
+    """
+    return discover_images(folder_path, manifest_path=manifest_path)
+
+def find_image_paths(folder_path, manifest_path=None):
+    """
+    List all non-hidden images with a valid extension within the folder and its sub-folders.
+    """
+    start = time.perf_counter()
+    image_paths = list(iter_image_paths(folder_path, manifest_path))
+    metrics.record("discovery", time.perf_counter() - start, len(image_paths))
+    return image_paths
+
+def load_detection_image(image, detection_max_edge=None):
+    """
+    Decode an image at a resolution suited to face detection.
+
+    JPEGs much larger than `detection_max_edge` are decoded directly at 1/2, 1/4 or 1/8 size, and
+    the full resolution image is left to be decoded only if it is needed for cropping.
+
+    Parameters:
+    - image (ImageBuffer): The image file contents.
+    - detection_max_edge (int, optional): Longest edge of the image passed to the detector.
+      The full resolution image is used if not set.
+
+    Returns:
+    - tuple: (detection image, full resolution image or None if not decoded yet). Both are None
+      if the image could not be decoded.
+    """
+    if not detection_max_edge:
+        img = image.decode()
+        return img, img
+
+    img = None
+    detection_img = None
+    if os.path.splitext(image.path)[-1].lower() in ('.jpg', '.jpeg'):
+        long_edge = max(image.header_size() or (0, 0))
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if long_edge / factor >= detection_max_edge:
+                detection_img = image.decode(flag)
+                break
+
+    if detection_img is None:
+        img = detection_img = image.decode()
+        if img is None:
+            return None, None
+
+    height, width = detection_img.shape[:2]
+    if max(height, width) > detection_max_edge:
+        scale = detection_max_edge / max(height, width)
+        detection_img = cv2.resize(detection_img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                   interpolation=cv2.INTER_AREA)
+    return detection_img, img
+
+def rescale_detections(detected_faces, scale_x, scale_y):
+    """
+    Map MTCNN boxes and keypoints from a resized image back to the original, in place.
+
+    Parameters:
+    - detected_faces (list): MTCNN detections.
+    - scale_x (float): Ratio of the original width to the detection width.
+    - scale_y (float): Ratio of the original height to the detection height.
+    """
+    for face in detected_faces:
+        left, top, width, height = face['box']
+        face['box'] = [int(round(left * scale_x)), int(round(top * scale_y)),
+                       int(round(width * scale_x)), int(round(height * scale_y))]
+        face['keypoints'] = {name: (int(round(x * scale_x)), int(round(y * scale_y)))
+                             for name, (x, y) in face['keypoints'].items()}
+
+def detect_faces_in_image(image, face_detector, detection_max_edge=None):
+    """
+    Decode an image and detect its faces, optionally on a downscaled copy.
+
+    Boxes and keypoints are returned in full resolution coordinates so faces are cropped at full
+    quality. The full resolution image is only decoded when a face is confident enough to crop.
+
+    Parameters:
+    - image (ImageBuffer): The image file contents.
+    - face_detector (MTCNN): The face detector.
+    - detection_max_edge (int, optional): Longest edge of the image passed to the detector.
+
+    Returns:
+    - tuple: (full resolution image or None if no face needs cropping, detections, timing dict
+      with the detection size, the bytes read and the seconds spent reading, decoding and detecting).
+    """
+    start = time.perf_counter()
+    detection_img, img = load_detection_image(image, detection_max_edge)
+    if detection_img is None:
+        raise ValueError(f"Failed to read image from {image.path}")
+    decoded = time.perf_counter()
+
+    detected_faces = face_detector.detect_faces(detection_img)
+    detected = time.perf_counter()
+
+    if img is None and any(face['confidence'] >= FACE_CONFIDENCE_THRESHOLD for face in detected_faces):
+        img = image.decode()
+        if img is None:
+            raise ValueError(f"Failed to read image from {image.path}")
+
+    if img is not None and img is not detection_img:
+        rescale_detections(detected_faces, img.shape[1] / detection_img.shape[1], img.shape[0] / detection_img.shape[0])
+    elif img is None and detected_faces:
+        # Only low confidence faces, so approximate the original size from the file header
+        scale = max(image.header_size() or detection_img.shape[:2]) / max(detection_img.shape[:2])
+        rescale_detections(detected_faces, scale, scale)
+
+    timing = {"detection_size": (detection_img.shape[1], detection_img.shape[0]),
+              "bytes_read": image.nbytes, "read_s": image.read_s,
+              "decode_s": decoded - start + (time.perf_counter() - detected),
+              "detect_s": detected - decoded}
+    return img, detected_faces, timing
+
+def print_detection_timing(image_name, timing):
+    """
+    Print how long reading and detecting faces in an image took, and at what resolution.
+    """
+    printed = is_verbose(VERBOSE)
+    if not printed and not logger.isEnabledFor(logging.DEBUG):
+        return
+    width, height = timing["detection_size"]
+    message = (f"Image: {image_name}, detection at {width}x{height} took {timing['detect_s']:.2f}s "
+               f"(read {timing['bytes_read'] / 2**20:.1f} MB in {timing['read_s']:.2f}s, decoding {timing['decode_s']:.2f}s)")
+    logger.debug(message)
+    if printed:
+        print(message)
+
+def record_detection_timing(timing):
+    """
+    Add the stage times of one image's detection to the pipeline metrics. Besides the timing of
+    `detect_faces_in_image`, it may hold the "align_s" measured by a worker process.
+    """
+    if not metrics.enabled:
+        return
+    metrics.record("decode", timing["decode_s"])
+    metrics.record("detect", timing["detect_s"])
+    if "align_s" in timing:
+        metrics.record("align", timing["align_s"], timing.get("faces", 1))
+
+def extract_aligned_faces(img, detected_faces):
+    """
+    Crop, align and resize every sufficiently confident face detected in an image.
+
+    Parameters:
+    - img (numpy.ndarray): The BGR image the faces were detected in.
+    - detected_faces (list): MTCNN detections for the image.
+
+    Returns:
+    - list: (detection, 224x224 face image) pairs ready for embedding.
+    """
+    crops = []
+    for face in detected_faces:
+        confidence = face['confidence']
+        if confidence < FACE_CONFIDENCE_THRESHOLD:  # adjust this threshold as needed
+            continue
+        left, top, width, height = face['box']
+        right, bottom = left + width, top + height
+        face_img = img[top:bottom, left:right] 
+        
+        # Align the face
+        keypoints = face['keypoints']
+        aligned_face_img = align_face(face_img, keypoints['left_eye'], keypoints['right_eye'])
+
+        # Resize the aligned face to the desired size
+        resized_face_img = resize_image_with_aspect_ratio(aligned_face_img, (224, 224))
+        if resized_face_img is None:
+            continue
+
+        crops.append((face, resized_face_img))
+    return crops
+
+def print_detections(image_name, detected_faces):
+    """
+    Print the number of faces detected in an image and, when verbose, their confidence scores.
+    """
+    if not is_verbose(NORMAL):
+        return
+    print(f'Number of faces detected: {len(detected_faces)}')
+
+    if not detected_faces:
+        print('No faces detected in the image.')
+
+    if not is_verbose(VERBOSE):
+        return
+
+    # Print confidence scores
+    for face in detected_faces:
+        confidence_score = face['confidence']
+        print(f"Image: {image_name}, Face Confidence: {confidence_score}")
+
+def iter_faces_from_folder(folder_path, output_folder, face_detector, cancel_flag=None, store=None, batch_size=EMBEDDING_BATCH_SIZE, face_index=None, workers=None, image_paths=None, detection_max_edge=None, near_duplicate_distance=None, crop_format=DEFAULT_CROP_FORMAT, crop_quality=None, discovery_manifest=False):
+    """
+    Detect, embed and save faces image by image, yielding each image's result as soon as it is ready.
+
+    The folder is walked lazily unless `image_paths` is given. Results are yielded in folder order
+    as (idx, image_path, img_hash, face_entry) tuples, where idx is the 1 based position of the
+    image and face_entry is the image's face_data entry, or None if it adds nothing to face_data.
+    The other arguments are as for `save_faces_from_folder`.
+    """
+    if workers is not None and workers > 1:
+        from parallel_pipeline import iter_faces_from_folder_parallel
+        yield from iter_faces_from_folder_parallel(folder_path, output_folder, cancel_flag=cancel_flag, store=store,
+                                                   batch_size=batch_size, face_index=face_index, workers=workers,
+                                                   image_paths=image_paths, detection_max_edge=detection_max_edge,
+                                                   near_duplicate_distance=near_duplicate_distance,
+                                                   crop_format=crop_format, crop_quality=crop_quality,
+                                                   discovery_manifest=discovery_manifest)
+        return
+
+    queue = FaceIngestQueue(output_folder, batch_size=batch_size, store=store, face_index=face_index,
+                            near_duplicate_distance=near_duplicate_distance, crop_format=crop_format,
+                            crop_quality=crop_quality)
+    if image_paths is None:
+        image_paths = iter_image_paths(folder_path, discovery_manifest_path(output_folder, discovery_manifest))
 
     for idx, image_path in enumerate(image_paths, start=1):
-        img_hash = None 
         # Check if processing should be cancelled
         if cancel_flag and cancel_flag():
             break
+        yield from queue.drain()
+
         if not is_valid_image_extension(image_path):
             logger.warning(f"{image_path} does not have a valid image extension. Skipping.")
+            queue.add_skipped(idx, image_path)
             continue
 
         image_name = os.path.basename(image_path)
-        logger.debug(f'Processing image {idx} of {num_images}: {image_name}')
+        logger.debug(f'Processing image {idx}: {image_name}')
 
         try:
-            img = cv2.imread(image_path)
-            if img is None:
-                raise ValueError(f"Failed to read image from {image_path}")
+            triage = triage_image(queue, store, image_path, output_folder)
         except Exception as e:
-            logger.exception(f"Error reading or processing image {image_name} in save_faces_from_folder: {str(e)}")
+            logger.exception(f"Error reading image {image_name} in save_faces_from_folder: {str(e)}")
+            queue.add_skipped(idx, image_path)
             continue  # Skip to the next image
 
-        # Only retrieve EXIF data for the original input images
-        if os.path.splitext(image_name)[-1].lower() in valid_extensions:
-            exif_data = get_image_exif_data(image_path)
-        else:
-            exif_data = {}
+        if triage["action"] != "detect":
+            queue.add_triaged(idx, image_path, triage)
+            continue
+        image = triage["image"]
 
-        # Print the EXIF data
-        logger.debug(f"EXIF data for {image_name}: {exif_data}")
-            
         try:
             # Using MTCNN for face detection
-            detected_faces = face_detector.detect_faces(img)
-            print(f'Number of faces detected: {len(detected_faces)}')
-
-            # Print confidence scores
-            
-            if not detected_faces:
-                print('No faces detected in the image.')
-
-            for face in detected_faces:
-                        confidence_score = face['confidence']
-                        print(f"Image: {image_name}, Face Confidence: {confidence_score}")
-                    
+            img, detected_faces, timing = detect_faces_in_image(image, face_detector, detection_max_edge)
+            record_detection_timing(timing)
+            print_detections(image_name, detected_faces)
+            print_detection_timing(image_name, timing)
         except Exception as e:
             logger.exception(f'Error detecting faces in {image_name}. Skipping...')
+            queue.add_skipped(idx, image_path)
             continue
 
+        crops = []
         if len(detected_faces) > 0:
             try:
-                img_hash = hashlib.md5(open(image_path, 'rb').read()).hexdigest()
-
-                # If we have processed this image, continue to the next
-                if img_hash in processed_images:
-                    continue
-                
-                # Mark this image as processed
-                processed_images.add(img_hash)
-
-                face_data[img_hash] = {"file_name": image_name, "full_path": image_path, "faces": [], "exif_data": exif_data}
-
-                
-                if not detected_faces:
-                    print('No faces detected in the image.')
-
-                for face in detected_faces:
-                                confidence = face['confidence']
-                                if confidence < 0.9:  # adjust this threshold as needed
-                                    continue
-                                left, top, width, height = face['box']
-                                right, bottom = left + width, top + height
-                                face_img = img[top:bottom, left:right] 
-                                
-                                # Align the face
-                                keypoints = face['keypoints']
-                                aligned_face_img = align_face(face_img, keypoints['left_eye'], keypoints['right_eye'])
-
-                                # Resize the aligned face to the desired size
-                                resized_face_img = resize_image_with_aspect_ratio(aligned_face_img, (224, 224))
-                                
-                                # Convert the face image into a feature vector
-                                face_vector = convert_image_to_vector(resized_face_img)
-
-                                face_img_hash = hashlib.sha256(face_vector.tobytes()).hexdigest()
-                                
-                                # If we have processed this face, continue to the next
-                                if face_img_hash in processed_faces:
-                                    continue
-                                
-                                # Mark this face as processed
-                                processed_faces.add(face_img_hash)
-
-                                face_data[img_hash]["faces"].append(face_vector)
-                                image_output_path = os.path.join(output_folder, f"{img_hash}_{len(face_data[img_hash]['faces'])}.png")
-                                cv2.imwrite(image_output_path, resized_face_img)
+                with metrics.timer("align", len(detected_faces)):
+                    crops = extract_aligned_faces(img, detected_faces)
             except Exception as e:
                 logger.exception(f"Error occurred in save_faces_from_folder: {e}")
+                queue.add_skipped(idx, image_path)
                 continue
 
+        queue.add_detected(idx, image_path, triage["img_hash"], triage["file_stat"], detected_faces, crops,
+                           triage["fingerprint"])
+
+    # Embed whatever is still queued, including after a cancellation
+    yield from queue.finish()
+
+def save_faces_from_folder(folder_path, output_folder, face_detector, progress_callback=None, cancel_flag=None, partial_update_callback=None, store=None, batch_size=EMBEDDING_BATCH_SIZE, face_index=None, workers=None, detection_max_edge=None, near_duplicate_distance=None, crop_format=DEFAULT_CROP_FORMAT, crop_quality=None, discovery_manifest=False):
+    """
+    Detect and save faces from all images within the provided folder path.
+
+    Aligned face crops are queued across images and embedded `batch_size` faces at a time.
+    `partial_update_callback`, if given, is called with (img_hash, face_entry) for every image as
+    soon as its faces have been added.
+
+    If an `EmbeddingStore` is given, images that are unchanged since a previous run are restored
+    from it instead of going through detection and embedding again, and newly processed images
+    are added to it.
+
+    If a `FaceIndex` is given, every face is inserted into it as soon as it has been embedded.
+
+    With `workers` greater than one, decoding and detection run in that many worker processes
+    (see `parallel_pipeline`) while embedding stays in this process. Results are identical to a
+    sequential run.
+
+    With `detection_max_edge` set, MTCNN runs on a copy of each image scaled down to that longest
+    edge, which is much faster on large photos, while faces are still cropped from the full image.
+    Faces that are small at the reduced size may be missed.
+
+    Exact duplicate files are recognised by their md5 hash before any detection. With
+    `near_duplicate_distance` set and a store given, resized or re-encoded copies of an image are
+    recognised by a perceptual hash within that many bits and take over the original's faces.
+
+    Face crops are written in the background, in `crop_format` ("png", "jpeg" or "webp") at
+    `crop_quality`, into subfolders of `output_folder` named after their image hash (see
+    `crop_writer`). All of them are on disk by the time this function returns.
+
+    Images are found by a concurrent directory scan (see `file_discovery`). With
+    `discovery_manifest`, the listing of every directory is kept in the output folder and
+    directories that haven't changed since are not listed again on the next run.
+    """
+    face_data = {}
+    image_paths = find_image_paths(folder_path, discovery_manifest_path(output_folder, discovery_manifest))
+    num_images = len(image_paths)
+
+    for idx, image_path, img_hash, face_entry in iter_faces_from_folder(folder_path, output_folder, face_detector,
+                                                                          cancel_flag=cancel_flag, store=store,
+                                                                          batch_size=batch_size, face_index=face_index,
+                                                                          workers=workers, image_paths=image_paths,
+                                                                          detection_max_edge=detection_max_edge,
+                                                                          near_duplicate_distance=near_duplicate_distance,
+                                                                          crop_format=crop_format, crop_quality=crop_quality,
+                                                                          discovery_manifest=discovery_manifest):
+        logger.debug(f'Finished image {idx} of {num_images}: {os.path.basename(image_path)}')
+        if face_entry is not None:
+            face_data[img_hash] = face_entry
+            if partial_update_callback:
+                partial_update_callback(img_hash, face_entry)
+
         if progress_callback:
             progress = idx / num_images * 100
             progress_callback(progress)
 
     return face_data
 
-def find_matching_face(image_path, face_data, face_detector, threshold=.75):
-    """
-    Find faces in the provided image that match with any face from the given face data.
+def embed_probe_faces(image_path, face_detector, detection_max_edge=None):
     """
-    logger.debug(f'Starting to find matching face for image at {image_path}')
-    matching_faces = []
-    try:
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError(f"Unable to read image from {image_path}")
+    Detect, align and embed every sufficiently confident face in the image to search for.
 
-        # Using MTCNN for face detection
-        detected_faces = face_detector.detect_faces(img)
-        print(f'Number of faces detected: {len(detected_faces)}')
-        
-        if not detected_faces:
-            print('No faces detected in the image.')
+    Parameters:
+    - image_path (str): Path of the probe image.
+    - face_detector (MTCNN): The face detector.
+    - detection_max_edge (int, optional): Longest edge of the image passed to the detector.
 
-        for face in detected_faces:
-                confidence = face['confidence']
-                if confidence < 0.9:  # adjust this threshold as needed
-                    continue
-                # Get face box
-                left, top, width, height = face['box']
-                right, bottom = left + width, top + height
+    Returns:
+    - list: One feature vector per probe face.
+    """
+    # Using MTCNN for face detection
+    img, detected_faces, timing = detect_faces_in_image(ImageBuffer.read(image_path), face_detector, detection_max_edge)
+    record_detection_timing(timing)
+    print_detection_timing(os.path.basename(image_path), timing)
+    print(f'Number of faces detected: {len(detected_faces)}')
+    
+    if not detected_faces:
+        print('No faces detected in the image.')
 
-                face_img = img[top:bottom, left:right]  # Extract the face from the image
+    crops = [resized_face_img for _, resized_face_img in extract_aligned_faces(img, detected_faces)]
+    return convert_images_to_vectors(crops) if crops else []
 
-                # Align the face
-                keypoints = face['keypoints']
-                aligned_face_img = align_face(face_img, keypoints['left_eye'], keypoints['right_eye'])
+def match_probe_vectors(probe_vectors, face_data, threshold=.75, face_matrix=None, top_k=None, face_index=None, candidates=None):
+    """
+    Match already embedded probe faces against face data. Arguments are as for `find_matching_face`.
 
-                # Resize the aligned face to the desired size
-                resized_face_img = resize_image_with_aspect_ratio(aligned_face_img, (224, 224))
+    Returns:
+    - list: Match tuples, grouped by probe face.
+    """
+    matching_faces = []
+    with metrics.timer("match", len(probe_vectors)):
+        for face_vector in probe_vectors:
+            # Compare vectors instead of images
+            if face_index is not None:
+                matching_faces.extend(face_index.find_matches(face_data, face_vector, threshold, top_k, candidates))
+                continue
+            if face_matrix is None and candidates is not None:
+                # Only the candidates are packed, which is cheaper than packing everything to score a part of it
+                face_matrix = FaceMatrix({img_hash: face_data[img_hash] for img_hash in candidates if img_hash in face_data})
+                candidates = None
+            elif face_matrix is None:
+                face_matrix = FaceMatrix(face_data)
+            matching_faces.extend(face_matrix.find_matches(face_vector, threshold, top_k, candidates))
+    return matching_faces
 
-                # Convert face image to vector
-                face_vector = convert_image_to_vector(resized_face_img)
+def find_matching_face(image_path, face_data, face_detector, threshold=.75, face_matrix=None, top_k=None, face_index=None, detection_max_edge=None, candidates=None):
+    """
+    Find faces in the provided image that match with any face from the given face data.
 
-                for img_hash, stored_data in face_data.items():
-                    stored_faces = stored_data["faces"]
-                    for i, stored_face in enumerate(stored_faces):
-                        if stored_face.size == 0:  # Add this check for empty vectors
-                            continue
+    The stored vectors are scored with a single matrix-vector product per probe face. A prebuilt
+    `FaceMatrix` can be passed to avoid repacking face_data on every call, and `top_k` limits the
+    matches per probe face to the most similar ones.
 
-                        # Compare vectors instead of images
-                        similarity = distance.cosine(face_vector, stored_face)
-                        p_similarity = abs(similarity - 1)
+    If a `FaceIndex` is given it is searched instead, returning every match within the threshold
+    (or the `top_k` best) per probe face, best first.
 
-                        if similarity < threshold:
-                            matching_faces.append((img_hash, stored_data["file_name"], stored_face, p_similarity, f"{img_hash}_{i+1}.png"))
+    `candidates`, e.g. the images selected by a `MetadataIndex`, restricts the search to those
+    images before any vectors are scored.
+    """
+    logger.debug(f'Starting to find matching face for image at {image_path}')
+    matching_faces = []
+    try:
+        probe_vectors = embed_probe_faces(image_path, face_detector, detection_max_edge)
+        matching_faces = match_probe_vectors(probe_vectors, face_data, threshold, face_matrix, top_k, face_index, candidates)
 
     except Exception as e:
         traceback.print_exc()
@@ -386,4 +1078,60 @@ def find_matching_face(image_path, face_data, face_detector, threshold=.75):
     if not matching_faces:
         print('No matching faces found for the image.')
 
-    return matching_faces
\ No newline at end of file
+    return matching_faces
+
+def search_folder_probe_first(image_path, folder_path, output_folder, face_detector, threshold=.75, top_k=None, progress_callback=None, cancel_flag=None, match_callback=None, store=None, batch_size=EMBEDDING_BATCH_SIZE, workers=None, detection_max_edge=None, near_duplicate_distance=None, crop_format=DEFAULT_CROP_FORMAT, crop_quality=None, discovery_manifest=False, metadata_query=None, exif_cache=None):
+    """
+    Embed the faces of the image to search for first, then score every face in the folder as it
+    is produced, keeping only matches (or the `top_k` best per probe face) and the metadata of
+    their images. Memory use stays flat regardless of the size of the folder.
+
+    Parameters:
+    - image_path (str): Path of the image containing the faces to search for.
+    - match_callback (callable, optional): Called with (new matches, {img_hash: metadata}) for every
+      image that produced retained matches.
+    - metadata_query (MetadataQuery, optional): Only score the faces of images meeting these conditions.
+      The EXIF data of every image with faces is read for it.
+    - exif_cache (ExifCache, optional): Cache of parsed EXIF data used with `metadata_query`.
+    - The other arguments are as for `save_faces_from_folder` and `find_matching_face`.
+
+    Returns:
+    - tuple: (matching faces, face data limited to the matched images, without face vectors).
+    """
+    probe_vectors = embed_probe_faces(image_path, face_detector, detection_max_edge)
+    matcher = ProbeMatcher(probe_vectors, threshold=threshold, top_k=top_k)
+    num_images = None
+
+    image_paths = None
+    if progress_callback:
+        image_paths = find_image_paths(folder_path, discovery_manifest_path(output_folder, discovery_manifest))
+        num_images = len(image_paths)
+
+    for idx, _, img_hash, face_entry in iter_faces_from_folder(folder_path, output_folder, face_detector,
+                                                                 cancel_flag=cancel_flag, store=store,
+                                                                 batch_size=batch_size, workers=workers,
+                                                                 image_paths=image_paths,
+                                                                 detection_max_edge=detection_max_edge,
+                                                                 near_duplicate_distance=near_duplicate_distance,
+                                                                 crop_format=crop_format, crop_quality=crop_quality,
+                                                                 discovery_manifest=discovery_manifest):
+        if face_entry is not None and metadata_query:
+            resolve_exif_data({img_hash: face_entry}, exif_cache)
+            if not metadata_query.matches_entry(face_entry):
+                face_entry = None
+        if face_entry is not None:
+            with metrics.timer("match"):
+                new_matches = matcher.add(img_hash, face_entry)
+            if new_matches and match_callback:
+                match_callback(new_matches, {img_hash: matcher.metadata[img_hash]})
+
+        if progress_callback:
+            progress_callback(idx / num_images * 100)
+
+    matching_faces, face_data = matcher.results()
+    print(f'Number of faces compared: {matcher.faces_scored}')
+    print(f'Number of matches found: {len(matching_faces)}')
+    if not matching_faces:
+        print('No matching faces found for the image.')
+
+    return matching_faces, face_data
@@ -0,0 +1,680 @@
+'''
+@file face_index.py
+Pluggable nearest-neighbour indexes over face vectors: exact flat scan, IVF and HNSW graph.
+'''
+
+import heapq
+import logging
+import math
+import os
+import pickle
+import numpy as np
+from crop_writer import crop_name_for
+from embedding_store import LEGACY_INFERENCE_VERSION
+
+logger = logging.getLogger()
+
+INDEX_FILE_NAME = "face_index.pkl"
+DEFAULT_INDEX_KIND = "flat"
+# Neighbours fetched by the first search of `find_matches`, doubled until every match is found
+DEFAULT_SEARCH_K = 100
+# Fraction of the index past which `find_matches` scans every vector instead of fetching more neighbours
+EXACT_SCAN_FRACTION = 0.25
+
+
+def normalise(vectors):
+    """
+    L2 normalise vectors row-wise as float32. Zero rows are left as zeros.
+
+    Parameters:
+    - vectors (numpy.ndarray): A single vector or a 2-D array of vectors.
+
+    Returns:
+    - numpy.ndarray: 2-D float32 array of unit length rows.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    vectors = vectors.reshape(vectors.shape[0], -1).copy()
+    norms = np.linalg.norm(vectors, axis=1)
+    nonzero = norms > 0
+    vectors[nonzero] /= norms[nonzero, None]
+    return vectors
+
+
+class FaceIndex:
+    """
+    Base class for face vector indexes.
+
+    Every face is identified by a key `(img_hash, face_index)` where `face_index` is the 0 based
+    position of the vector in `face_data[img_hash]["faces"]`. Vectors are stored L2 normalised so
+    inner products are cosine similarities. Subclasses implement `_insert` and `_search`.
+
+    Removed faces stay in place as tombstones that searches skip, so IVF lists and HNSW links
+    don't have to be rebuilt.
+    """
+
+    kind = None
+
+    def __init__(self):
+        self.embedding_head = None  # id of the embedding head that produced the vectors
+        self.inference_version = None  # inference backend and quantisation of the models that produced them
+        self.dim = None
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.count = 0
+        self.keys = []
+        self.key_to_id = {}
+        self.removed = set()  # ids of removed vectors
+
+    def __len__(self):
+        return self.count - len(self.removed)
+
+    def __contains__(self, key):
+        return tuple(key) in self.key_to_id
+
+    def _append_vector(self, vector):
+        """Append a normalised vector to the growable vector buffer and return its id."""
+        if self.dim is None:
+            self.dim = vector.size
+            self.vectors = np.empty((64, self.dim), dtype=np.float32)
+        if self.count == self.vectors.shape[0]:
+            grown = np.empty((max(64, self.vectors.shape[0] * 2), self.dim), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+        self.vectors[self.count] = vector
+        self.count += 1
+        return self.count - 1
+
+    def add(self, keys, vectors):
+        """
+        Insert face vectors into the index. Keys that are already indexed are skipped, since a
+        key's vector is fixed by the image content it was hashed from.
+
+        Parameters:
+        - keys (list): `(img_hash, face_index)` tuples.
+        - vectors (list): Face vectors matching `keys`.
+        """
+        if len(keys) == 0:
+            return
+        vectors = normalise(np.stack([np.asarray(v).ravel() for v in vectors]))
+        for key, vector in zip(keys, vectors):
+            key = tuple(key)
+            if key in self.key_to_id:
+                continue
+            if self.dim is not None and vector.size != self.dim:
+                logger.warning(f"Skipping face {key}: vector size {vector.size} does not match index size {self.dim}")
+                continue
+            vector_id = self._append_vector(vector)
+            self.keys.append(key)
+            self.key_to_id[key] = vector_id
+            self._insert(vector_id)
+
+    def add_face_data(self, face_data):
+        """
+        Insert every face in face_data that is not indexed yet.
+
+        Parameters:
+        - face_data (dict): Face data as produced by `save_faces_from_folder`.
+        """
+        keys = []
+        vectors = []
+        for img_hash, stored_data in face_data.items():
+            for i, stored_face in enumerate(stored_data["faces"]):
+                if stored_face.size and (img_hash, i) not in self.key_to_id:
+                    keys.append((img_hash, i))
+                    vectors.append(stored_face)
+        self.add(keys, vectors)
+
+    def remove(self, keys):
+        """
+        Remove faces from the index, e.g. those of a deleted image. A removed key can be added again.
+
+        Parameters:
+        - keys (list): `(img_hash, face_index)` tuples. Keys that aren't indexed are ignored.
+        """
+        for key in keys:
+            vector_id = self.key_to_id.pop(tuple(key), None)
+            if vector_id is not None:
+                self.removed.add(vector_id)
+
+    def _insert(self, vector_id):
+        raise NotImplementedError
+
+    def _search(self, query, k):
+        raise NotImplementedError
+
+    def search(self, face_vector, k=10, keys=None):
+        """
+        Find the `k` indexed faces most similar to the probe vector.
+
+        Parameters:
+        - face_vector (numpy.ndarray): The probe face vector.
+        - k (int): Number of neighbours to return.
+        - keys (iterable, optional): Only search these `(img_hash, face_index)` keys. They are
+          scored exactly, since a prefiltered set is mostly far smaller than the index and the
+          approximate structures can't be restricted to it without losing neighbours.
+
+        Returns:
+        - list: `(key, cosine similarity)` pairs, most similar first.
+        """
+        if len(self) == 0:
+            return []
+        query = normalise(face_vector)[0]
+        if query.size != self.dim:
+            raise ValueError(f"Probe vector size {query.size} does not match index size {self.dim}")
+        if keys is not None:
+            ids = np.array([self.key_to_id[key] for key in map(tuple, keys) if key in self.key_to_id], dtype=np.int64)
+            positions, similarities = top_k(self.vectors[ids] @ query, k)
+            return [(self.keys[i], float(s)) for i, s in zip(ids[positions], similarities)]
+        # Removed vectors may be among the nearest, so enough are fetched to leave k after skipping them
+        ids, similarities = self._search(query, min(k + len(self.removed), self.count))
+        neighbours = [(self.keys[i], float(s)) for i, s in zip(ids, similarities) if i not in self.removed]
+        return neighbours[:k]
+
+    def search_within(self, face_vector, threshold, keys=None):
+        """
+        Find every indexed face within a cosine distance of the probe vector with one exact scan.
+
+        Parameters:
+        - face_vector (numpy.ndarray): The probe face vector.
+        - threshold (float): Maximum cosine distance, exclusive.
+        - keys (iterable, optional): Only search these `(img_hash, face_index)` keys.
+
+        Returns:
+        - list: `(key, cosine similarity)` pairs, most similar first.
+        """
+        if len(self) == 0:
+            return []
+        query = normalise(face_vector)[0]
+        if query.size != self.dim:
+            raise ValueError(f"Probe vector size {query.size} does not match index size {self.dim}")
+        if keys is not None:
+            ids = np.array([self.key_to_id[key] for key in map(tuple, keys) if key in self.key_to_id], dtype=np.int64)
+        else:
+            live = np.ones(self.count, dtype=bool)
+            live[list(self.removed)] = False
+            ids = np.flatnonzero(live)
+        similarities = self.vectors[ids] @ query
+        # Decided on the same float64 distances as the neighbours of `find_matches`
+        within = np.flatnonzero(1 - similarities.astype(np.float64) < threshold)
+        within = within[np.argsort(-similarities[within], kind='stable')]
+        return [(self.keys[i], float(s)) for i, s in zip(ids[within], similarities[within])]
+
+    def exact_search(self, query, k):
+        """
+        Brute force scan of every indexed vector, used as the ground truth for recall.
+
+        Parameters:
+        - query (numpy.ndarray): Normalised probe vector.
+        - k (int): Number of neighbours to return.
+
+        Returns:
+        - tuple: (ids, similarities) of the `k` most similar vectors, most similar first.
+        """
+        return top_k(self.vectors[:self.count] @ query, k)
+
+    def recall(self, queries, k=10):
+        """
+        Measure recall@k of this index against an exact scan of the same vectors.
+
+        Parameters:
+        - queries (list): Probe vectors.
+        - k (int): Number of neighbours compared per query.
+
+        Returns:
+        - float: Mean fraction of the exact top `k` neighbours returned by the index.
+        """
+        if self.count == 0 or len(queries) == 0:
+            return 1.0
+        k = min(k, self.count)
+        hits = 0
+        for query in normalise(np.stack([np.asarray(q).ravel() for q in queries])):
+            exact_ids, _ = self.exact_search(query, k)
+            approx_ids, _ = self._search(query, k)
+            hits += len(set(exact_ids.tolist()) & set(np.asarray(approx_ids).tolist()))
+        return hits / (k * len(queries))
+
+    def find_matches(self, face_data, face_vector, threshold=.75, k=None, candidates=None):
+        """
+        Search the index and return matches in the tuple format the GUI consumes.
+
+        Neighbours are fetched `DEFAULT_SEARCH_K` at first and twice as many each time until the
+        furthest one is past the threshold or the index has no more to return, so matches are not
+        cut off at a fixed number, and faces of images missing from face_data can't crowd them out.
+        Once the fetch would cover `EXACT_SCAN_FRACTION` of the index, every vector is scored in a
+        single exact pass instead, which is cheaper than more approximate searches of that size.
+
+        Parameters:
+        - face_data (dict): Face data the matches are looked up in. Indexed faces of images
+          that are not in face_data are ignored.
+        - face_vector (numpy.ndarray): The probe face vector.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - k (int, optional): Only return the `k` best matches. Returns every match within the threshold if not set.
+        - candidates (iterable, optional): Hashes of the only images to search.
+
+        Returns:
+        - list: (img_hash, file_name, face_vector, similarity, resized image name) tuples, best first.
+        """
+        keys = None
+        if candidates is not None:
+            keys = [(img_hash, i) for img_hash in candidates if img_hash in face_data
+                    for i in range(len(face_data[img_hash]["faces"]))]
+        fetch = DEFAULT_SEARCH_K if k is None else max(k, 1)
+        searched = self.count if keys is None else len(keys)
+        while True:
+            if fetch >= searched * EXACT_SCAN_FRACTION:
+                matches = self._match_tuples(face_data, self.search_within(face_vector, threshold, keys), threshold)
+                return matches if k is None else matches[:k]
+            neighbours = self.search(face_vector, fetch, keys)
+            matches = self._match_tuples(face_data, neighbours, threshold)
+            # IVF and HNSW return fewer neighbours than asked for once their candidates run out
+            exhausted = len(neighbours) < fetch
+            past_threshold = bool(neighbours) and 1 - neighbours[-1][1] >= threshold
+            if exhausted or past_threshold or (k is not None and len(matches) >= k):
+                return matches if k is None else matches[:k]
+            fetch *= 2
+
+    @staticmethod
+    def _match_tuples(face_data, neighbours, threshold):
+        """Turn `(key, similarity)` neighbours into match tuples, keeping those within the threshold."""
+        matches = []
+        for (img_hash, i), similarity in neighbours:
+            stored_data = face_data.get(img_hash)
+            if stored_data is None or i >= len(stored_data["faces"]):
+                continue
+            distance = 1 - similarity
+            if distance < threshold:
+                matches.append((img_hash, stored_data["file_name"], stored_data["faces"][i], abs(distance - 1), crop_name_for(stored_data, img_hash, i)))
+        return matches
+
+    def _state(self):
+        """Return the subclass specific state to persist."""
+        return {}
+
+    def _restore(self, state):
+        """Restore the subclass specific state written by `_state`."""
+        pass
+
+    def _params(self):
+        """Return the constructor arguments of this index."""
+        return {}
+
+    def save(self, path):
+        """
+        Persist the index to disk.
+
+        Parameters:
+        - path (str): Destination file.
+        """
+        state = {"kind": self.kind, "params": self._params(), "embedding_head": self.embedding_head,
+                 "inference_version": self.inference_version, "dim": self.dim,
+                 "vectors": self.vectors[:self.count].copy(), "keys": self.keys, "removed": sorted(self.removed),
+                 "state": self._state()}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as index_file:
+            pickle.dump(state, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+def top_k(scores, k):
+    """
+    Select the `k` highest scores.
+
+    Parameters:
+    - scores (numpy.ndarray): Scores to select from.
+    - k (int): Number of scores to keep.
+
+    Returns:
+    - tuple: (positions, scores) of the selected entries, highest first.
+    """
+    k = min(k, scores.shape[0])
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    if k < scores.shape[0]:
+        positions = np.argpartition(-scores, k - 1)[:k]
+    else:
+        positions = np.arange(scores.shape[0])
+    positions = positions[np.argsort(-scores[positions], kind='stable')]
+    return positions, scores[positions]
+
+
+class FlatIndex(FaceIndex):
+    """
+    Exact index that scans every vector with one matrix-vector product.
+    """
+
+    kind = "flat"
+
+    def _insert(self, vector_id):
+        pass
+
+    def _search(self, query, k):
+        return self.exact_search(query, k)
+
+
+class IVFIndex(FaceIndex):
+    """
+    Inverted file index. A spherical k-means coarse quantiser splits the vectors into `nlist`
+    cells and a query only scans the `nprobe` cells whose centroids are closest to it.
+
+    Until `nlist * train_factor` vectors have been added the index has no quantiser and
+    searches exhaustively; the quantiser is then trained once on everything added so far and
+    later inserts are assigned to their nearest centroid.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, nlist=256, nprobe=8, train_factor=8, iterations=10, seed=0):
+        """
+        Parameters:
+        - nlist (int): Number of k-means cells.
+        - nprobe (int): Number of cells scanned per query.
+        - train_factor (int): Vectors per cell required before the quantiser is trained.
+        - iterations (int): k-means iterations.
+        - seed (int): Seed for the k-means initialisation.
+        """
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_factor = train_factor
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+
+    def _params(self):
+        return {"nlist": self.nlist, "nprobe": self.nprobe, "train_factor": self.train_factor,
+                "iterations": self.iterations, "seed": self.seed}
+
+    def train(self):
+        """
+        Train the coarse quantiser on every vector added so far and rebuild the cell lists.
+        """
+        data = self.vectors[:self.count]
+        nlist = min(self.nlist, self.count)
+        rng = np.random.default_rng(self.seed)
+        centroids = data[rng.choice(self.count, nlist, replace=False)].copy()
+
+        for _ in range(self.iterations):
+            assignment = self._assign(data, centroids)
+            for c in range(nlist):
+                members = data[assignment == c]
+                if len(members) == 0:
+                    # Re-seed empty cells with a random vector
+                    centroids[c] = data[rng.integers(self.count)]
+                else:
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalise(centroids)
+
+        self.centroids = centroids
+        assignment = self._assign(data, centroids)
+        self.lists = [[] for _ in range(nlist)]
+        for vector_id, c in enumerate(assignment):
+            self.lists[c].append(vector_id)
+
+    @staticmethod
+    def _assign(data, centroids, chunk_size=4096):
+        """Return the index of the most similar centroid for every row of `data`."""
+        assignment = np.empty(data.shape[0], dtype=np.int64)
+        for start in range(0, data.shape[0], chunk_size):
+            assignment[start:start + chunk_size] = np.argmax(data[start:start + chunk_size] @ centroids.T, axis=1)
+        return assignment
+
+    def _insert(self, vector_id):
+        if self.centroids is None:
+            if self.count >= self.nlist * self.train_factor:
+                self.train()
+            return
+        c = int(np.argmax(self.centroids @ self.vectors[vector_id]))
+        self.lists[c].append(vector_id)
+
+    def _search(self, query, k):
+        if self.centroids is None:
+            return self.exact_search(query, k)
+
+        cells, _ = top_k(self.centroids @ query, self.nprobe)
+        candidates = np.fromiter((i for c in cells for i in self.lists[c]), dtype=np.int64)
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        positions, scores = top_k(self.vectors[candidates] @ query, k)
+        return candidates[positions], scores
+
+    def _state(self):
+        return {"centroids": self.centroids, "lists": self.lists}
+
+    def _restore(self, state):
+        self.centroids = state["centroids"]
+        self.lists = state["lists"]
+
+
+class HNSWIndex(FaceIndex):
+    """
+    Hierarchical navigable small world graph index.
+
+    Each vector is linked to its `M` closest neighbours (`2 * M` on the bottom layer) on a
+    randomly drawn number of layers. A query greedily descends from the sparse top layer and
+    runs a best-first search of width `ef_search` on the bottom layer.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, M=16, ef_construction=100, ef_search=64, seed=0):
+        """
+        Parameters:
+        - M (int): Number of links per vector on the upper layers.
+        - ef_construction (int): Search width used when inserting vectors.
+        - ef_search (int): Search width used when querying.
+        - seed (int): Seed for the layer assignment.
+        """
+        super().__init__()
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self.level_multiplier = 1 / math.log(max(M, 2))
+        self.rng = np.random.default_rng(seed)
+        self.links = []  # links[vector_id][level] -> list of neighbour ids
+        self.entry_point = None
+        self.max_level = -1
+
+    def _params(self):
+        return {"M": self.M, "ef_construction": self.ef_construction, "ef_search": self.ef_search, "seed": self.seed}
+
+    def _max_links(self, level):
+        return self.M * 2 if level == 0 else self.M
+
+    def _similarities(self, query, ids):
+        return self.vectors[ids] @ query
+
+    def _search_layer(self, query, entry_points, ef, level):
+        """
+        Best-first search on one layer.
+
+        Returns:
+        - list: (similarity, id) pairs of the `ef` closest vectors found, in no particular order.
+        """
+        visited = set(entry_points)
+        entry_similarities = self._similarities(query, list(entry_points))
+        candidates = [(-s, i) for s, i in zip(entry_similarities.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(s, i) for s, i in zip(entry_similarities.tolist(), entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_similarity, current = heapq.heappop(candidates)
+            if -negative_similarity < results[0][0] and len(results) >= ef:
+                break
+
+            neighbours = [n for n in self.links[current][level] if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for similarity, neighbour in zip(self._similarities(query, neighbours).tolist(), neighbours):
+                if len(results) < ef or similarity > results[0][0]:
+                    heapq.heappush(candidates, (-similarity, neighbour))
+                    heapq.heappush(results, (similarity, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return results
+
+    def _select_neighbours(self, scored, count):
+        """
+        Choose up to `count` links from (similarity, id) pairs with the HNSW heuristic: a candidate
+        is kept only if it is more similar to the new vector than to every link kept so far, which
+        preserves links between clusters. Free slots are then filled with the closest rejects.
+        """
+        scored = sorted(scored, reverse=True)
+        if len(scored) <= count:
+            return [i for _, i in scored]
+
+        candidates = [i for _, i in scored]
+        pairwise = self.vectors[candidates] @ self.vectors[candidates].T
+        # closest[p] is the highest similarity between candidate p and any link kept so far
+        closest = [-np.inf] * len(candidates)
+        selected = []
+        rejected = []
+        for position, (similarity, candidate) in enumerate(scored):
+            if len(selected) >= count:
+                break
+            if closest[position] > similarity:
+                rejected.append(position)
+                continue
+            selected.append(position)
+            closest = np.maximum(closest, pairwise[position]).tolist()
+        selected += rejected[:count - len(selected)]
+        return [candidates[position] for position in selected]
+
+    def _insert(self, vector_id):
+        query = self.vectors[vector_id]
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_multiplier)
+        self.links.append([[] for _ in range(level + 1)])
+
+        if self.entry_point is None:
+            self.entry_point = vector_id
+            self.max_level = level
+            return
+
+        entry_points = [self.entry_point]
+        for current_level in range(self.max_level, level, -1):
+            nearest = self._search_layer(query, entry_points, 1, current_level)
+            entry_points = [max(nearest)[1]]
+
+        for current_level in range(min(level, self.max_level), -1, -1):
+            scored = self._search_layer(query, entry_points, self.ef_construction, current_level)
+            max_links = self._max_links(current_level)
+            neighbours = self._select_neighbours(scored, max_links)
+            self.links[vector_id][current_level] = neighbours
+
+            for neighbour in neighbours:
+                neighbour_links = self.links[neighbour][current_level]
+                neighbour_links.append(vector_id)
+                if len(neighbour_links) > max_links:
+                    similarities = self._similarities(self.vectors[neighbour], neighbour_links)
+                    self.links[neighbour][current_level] = self._select_neighbours(
+                        list(zip(similarities.tolist(), neighbour_links)), max_links)
+
+            entry_points = [i for _, i in scored]
+
+        if level > self.max_level:
+            self.entry_point = vector_id
+            self.max_level = level
+
+    def _search(self, query, k):
+        entry_points = [self.entry_point]
+        for current_level in range(self.max_level, 0, -1):
+            nearest = self._search_layer(query, entry_points, 1, current_level)
+            entry_points = [max(nearest)[1]]
+
+        results = heapq.nlargest(k, self._search_layer(query, entry_points, max(self.ef_search, k), 0))
+        ids = np.array([i for _, i in results], dtype=np.int64)
+        similarities = np.array([s for s, _ in results], dtype=np.float32)
+        return ids, similarities
+
+    def _state(self):
+        return {"links": self.links, "entry_point": self.entry_point, "max_level": self.max_level,
+                "rng": self.rng.bit_generator.state}
+
+    def _restore(self, state):
+        self.links = state["links"]
+        self.entry_point = state["entry_point"]
+        self.max_level = state["max_level"]
+        self.rng.bit_generator.state = state["rng"]
+
+
+INDEX_TYPES = {index_type.kind: index_type for index_type in (FlatIndex, IVFIndex, HNSWIndex)}
+
+
+def create_index(kind=DEFAULT_INDEX_KIND, **params):
+    """
+    Create an empty index of the given kind.
+
+    Parameters:
+    - kind (str): One of 'flat', 'ivf' or 'hnsw'.
+    - params: Constructor arguments for the index type.
+
+    Returns:
+    - FaceIndex: The new index.
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{kind}'. Choose from: {', '.join(INDEX_TYPES)}")
+    return INDEX_TYPES[kind](**params)
+
+
+def load_index(path):
+    """
+    Load an index written by `FaceIndex.save`.
+
+    Parameters:
+    - path (str): Path of the index file.
+
+    Returns:
+    - FaceIndex: The loaded index.
+    """
+    with open(path, 'rb') as index_file:
+        state = pickle.load(index_file)
+
+    index = create_index(state["kind"], **state["params"])
+    index.embedding_head = state.get("embedding_head")
+    # Indexes saved before the inference version was recorded hold Keras vectors
+    index.inference_version = state.get("inference_version", LEGACY_INFERENCE_VERSION)
+    index.dim = state["dim"]
+    index.vectors = state["vectors"]
+    index.count = state["vectors"].shape[0]
+    index.keys = [tuple(key) for key in state["keys"]]
+    index.removed = set(state.get("removed", []))
+    index.key_to_id = {key: i for i, key in enumerate(index.keys) if i not in index.removed}
+    index._restore(state["state"])
+    return index
+
+
+def open_index(path, kind=DEFAULT_INDEX_KIND, embedding_head=None, inference_version=None, **params):
+    """
+    Load the index at `path` if it exists and is of the requested kind, otherwise create a new one.
+
+    Parameters:
+    - path (str): Path of the index file.
+    - kind (str): Index type to use.
+    - embedding_head (str, optional): id of the embedding head the indexed vectors must come from.
+      An index built from another head's vectors is rebuilt.
+    - inference_version (str, optional): `inference_version` of the models the indexed vectors must
+      come from. An index built by another inference backend or quantisation is rebuilt.
+    - params: Constructor arguments used when a new index is created.
+
+    Returns:
+    - FaceIndex: The loaded or newly created index.
+    """
+    if os.path.exists(path):
+        try:
+            index = load_index(path)
+            if (index.kind == kind and index.embedding_head == embedding_head
+                    and (inference_version is None or index.inference_version == inference_version)):
+                return index
+            logger.info(f"Index at {path} is '{index.kind}' over '{index.embedding_head}' vectors from "
+                        f"'{index.inference_version}', rebuilding as '{kind}' over '{embedding_head}' vectors "
+                        f"from '{inference_version}'")
+        except Exception:
+            logger.exception(f"Could not load index from {path}, rebuilding it")
+    index = create_index(kind, **params)
+    index.embedding_head = embedding_head
+    index.inference_version = inference_version
+    return index
@@ -5,30 +5,25 @@ GUI related functions to handle the UI, inputs, outputs, table, console, etc
 print("Loading Application...") # inform user applcation is loading
 import os
 from platform import win32_ver
-import cv2
 import types
 from gui_init import initUI
-from PyQt6.QtWidgets import QMainWindow, QFileDialog, QMessageBox, QTableWidgetItem, QWidget, QHBoxLayout, QCheckBox
+from PyQt6.QtWidgets import QMainWindow, QFileDialog, QMessageBox
 from PyQt6.QtGui import QImage, QPixmap
 from PyQt6.QtCore import Qt
-from gui_elements import NumericTableWidgetItem, MatchTableWidgetItem
+from results_export import RESULT_COLUMNS
+from match_store import PATH_COLUMN
+from crop_writer import resolve_crop_path
+from preview_cache import PreviewCache, DEFAULT_PREFETCH_ROWS
+from diagnostics_panel import DiagnosticsPanel
+from pipeline_metrics import set_metrics_enabled
 from PyQt6.QtGui import QAction
 from FaceProcessingThread import FaceProcessingThread
+from metadata_index import MetadataQuery
 from themes import apply_dark_theme, apply_light_theme
 import logging
 import csv
 import shutil
 
-try:
-    logging.basicConfig(filename=r'.\debug.log',
-                        filemode='w',
-                        level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    logging.debug('Logging setup successful')
-    print("Logging setup2 successful.")
-except Exception as e:
-    print(f"Logging setup failed: {str(e)}")
-
 logger = logging.getLogger()
 
 print("Application loaded.")
@@ -39,16 +34,23 @@ class FaceMatcherApp(QMainWindow):
     
     Parameters:
     - face_data (dict, optional): Data related to the faces. Defaults to None.
+    - options (argparse.Namespace, optional): Command line options from `main.build_parser`, such as
+      the number of face detection `workers`. Defaults to None.
     """
-    def __init__(self, face_data=None):
+    def __init__(self, face_data=None, options=None):
         super().__init__()
         self.face_data = face_data
+        self.options = options
         self.dark_theme_enabled = False
         self.worker = None
         self.initUI = types.MethodType(initUI, self)  # This binds the initUI function as an instance method
         self.initUI()
-        self.result_table.cellDoubleClicked.connect(self.open_image_in_default_viewer)
+        self.result_table.doubleClicked.connect(self.open_image_in_default_viewer)
         self.matching_faces = []
+        self.preview_cache = PreviewCache(parent=self)
+        self.diagnostics_panel = None
+        # Collecting stage timings costs little next to detection, so runs from the GUI always log a summary
+        set_metrics_enabled(True)
 
     def create_menu_bar(self):
         """
@@ -73,6 +75,11 @@ class FaceMatcherApp(QMainWindow):
             toggle_dark_theme_action.triggered.connect(self.toggle_dark_theme)
             view_menu.addAction(toggle_dark_theme_action)
 
+            # Create Diagnostics action
+            diagnostics_action = QAction('Diagnostics', self)
+            diagnostics_action.triggered.connect(self.show_diagnostics)
+            view_menu.addAction(diagnostics_action)
+
             # Create Export to CSV action
             export_csv_action = QAction('Export to CSV', self)
             export_csv_action.triggered.connect(self.export_table_to_csv)
@@ -93,6 +100,15 @@ class FaceMatcherApp(QMainWindow):
             logging.exception("An error occurred while creating the menu bar")
             raise e
 
+    def show_diagnostics(self):
+        """
+        Open the window showing the pipeline metrics and preview cache statistics.
+        """
+        if self.diagnostics_panel is None:
+            self.diagnostics_panel = DiagnosticsPanel(self.preview_cache, self)
+        self.diagnostics_panel.show()
+        self.diagnostics_panel.raise_()
+
     def help_dialogue(self):
         """ 
         Displays help message from menu bar selection.
@@ -115,35 +131,47 @@ class FaceMatcherApp(QMainWindow):
 
     def get_matched_face_by_row(self, row):
         """
-        Retrieves the matched face image based on the provided table row index.
+        Retrieves the preview of the matched face in a row of the results table, from the preview
+        cache if it is there.
         
         Parameters:
-        - row (int): Index of the row in the results table.
+        - row (int): Index of the row in the results table, in the current sort order.
         
         Returns:
-        Image or None: The matched face image or None if not found.
+        QPixmap or None: The matched face preview or None if not found.
         """        
-        if row >= 0 and row < self.result_table.rowCount():
-            resized_image_name = self.result_table.item(row, 4).text()
-            matched_face_path = os.path.join(self.output_folder_edit.text(), resized_image_name)
-            matched_face = cv2.imread(matched_face_path)
-
-            return matched_face
+        if row >= 0 and row < self.result_model.rowCount():
+            resized_image_name = self.result_model.store.crop_name(self.result_model.store_row(row))
+            matched_face_path = resolve_crop_path(self.output_folder_edit.text(), resized_image_name)
+            return self.preview_cache.get(resized_image_name, matched_face_path)
         return None
 
+    def prefetch_neighbouring_faces(self, row):
+        """
+        Loads the previews of the rows around the given one in the background, nearest first,
+        so stepping through the results doesn't wait for the disk.
+        
+        Parameters:
+        - row (int): Index of the row in the results table, in the current sort order.
+        """
+        output_folder = self.output_folder_edit.text()
+        crops = []
+        for distance in range(1, DEFAULT_PREFETCH_ROWS + 1):
+            for neighbour in (row + distance, row - distance):
+                if 0 <= neighbour < self.result_model.rowCount():
+                    crop_name = self.result_model.store.crop_name(self.result_model.store_row(neighbour))
+                    crops.append((crop_name, resolve_crop_path(output_folder, crop_name)))
+        self.preview_cache.prefetch(crops)
+
     def previous_matched_face(self):
         """
         Displays the matched face from the previous row in the results table.
         """        
         try:
-            current_row = self.result_table.currentRow()
+            current_row = self.result_table.currentIndex().row()
             if current_row > 0:
+                # Selecting the row displays its face
                 self.result_table.selectRow(current_row - 1)
-                matched_face = self.get_matched_face_by_row(current_row - 1)
-                if matched_face is not None:
-                    similarity = float(self.result_table.item(current_row - 1, 1).text().rstrip('%')) / 100
-                    original_image_name = self.result_table.item(current_row - 1, 2).text()
-                    self.display_matched_face(matched_face, similarity, original_image_name)
         except Exception as e:
             logging.exception("An error occurred while navigating to the previous matched face")
             raise e
@@ -153,51 +181,14 @@ class FaceMatcherApp(QMainWindow):
         Displays the matched face from the next row in the results table.
         """
         try:
-            current_row = self.result_table.currentRow()
-            if current_row < self.result_table.rowCount() - 1:
+            current_row = self.result_table.currentIndex().row()
+            if current_row < self.result_model.rowCount() - 1:
+                # Selecting the row displays its face
                 self.result_table.selectRow(current_row + 1)
-                matched_face = self.get_matched_face_by_row(current_row + 1)
-                if matched_face is not None:
-                    similarity = float(self.result_table.item(current_row + 1, 1).text().rstrip('%')) / 100
-                    original_image_name = self.result_table.item(current_row + 1, 2).text()
-                    self.display_matched_face(matched_face, similarity, original_image_name)
         except Exception as e:
             logging.exception("An error occurred while navigating to the next matched face")
             raise e
 
-    def on_result_table_selection_changed(self):
-        """
-        Handles the event when the selection in the results table changes. It displays relevant data 
-        for the selected face.
-        """
-        try:
-            current_row = self.result_table.currentRow()
-            if current_row != -1:
-                print("Selection changed")  # debug print
-                img_hash = self.result_table.item(current_row, 3).text()
-                print(f"Selected image hash: {img_hash}")
-
-                # access face_data using the selected image hash
-                face_info = self.face_data.get(img_hash, {})
-
-                # print the face_info to the console
-                print(face_info)
-
- 
-                self.console_output.append("\nSelected face:")
-                self.console_output.append(f"\nImage file: {face_info.get('file_name', 'N/A')}")
-
-                # EXIF data
-                self.console_output.append("\nEXIF data:")
-                exif_data = face_info.get('exif_data', {})
-                for k, v in exif_data.items():
-                    self.console_output.append(f"{k}: {v}")
-
-                self.display_selected_matched_face()
-        except Exception as e:
-            logging.exception("An error occurred while handling the selection change in the result table")
-            raise e
-
     def on_table_selection_changed_and_display_face(self): 
         try:
             self.display_selected_matched_face()
@@ -286,7 +277,7 @@ class FaceMatcherApp(QMainWindow):
         Displays a matched face image, its similarity score, and the name of the original image.
         
         Parameters:
-        - matched_face (Image): The matched face image.
+        - matched_face (QPixmap): The matched face preview, from the preview cache.
         - similarity (float): Similarity score between 0 and 1.
         - original_image_name (str): Name of the original image where the face was found.
         """
@@ -296,18 +287,13 @@ class FaceMatcherApp(QMainWindow):
                 return
             
             print("Displaying matched face")
-            height, width, _ = matched_face.shape
-            bytes_per_line = width * 3
-            matched_face = cv2.cvtColor(matched_face, cv2.COLOR_BGR2RGB)
-            q_image = QImage(matched_face.data.tobytes(), width, height, bytes_per_line, QImage.Format.Format_RGB888)
-            
-            pixmap = QPixmap.fromImage(q_image)
-            if pixmap.isNull():
+            if matched_face.isNull():
                 print("Error: QPixmap is null. Cannot display.")
                 return
                 
-            scaled_pixmap = pixmap.scaled(100, 100, Qt.AspectRatioMode.KeepAspectRatio)
-            self.matched_face_label.setPixmap(scaled_pixmap)
+            # Previews are already scaled to fit the label
+            self.matched_face_label.setPixmap(matched_face)
+            self.matched_face_label.setToolTip(self.preview_cache.summary())
             self.similarity_original_image_label.setText(f"Similarity: {similarity * 100:.2f}% | Original Image: {original_image_name}")
             print("Finished displaying matched face")
         except Exception as e:
@@ -342,6 +328,12 @@ class FaceMatcherApp(QMainWindow):
                 QMessageBox.critical(self, "Error", "Please select all required folders and files.")
                 return
 
+            try:
+                metadata_query = MetadataQuery.parse(self.metadata_filter_edit.text())
+            except ValueError as e:
+                QMessageBox.critical(self, "Error", f"Invalid metadata filter: {e}")
+                return
+
             if hasattr(self, 'face_processing_thread'):
                 # Stop the thread if it's running
                 if self.face_processing_thread.isRunning():
@@ -350,11 +342,17 @@ class FaceMatcherApp(QMainWindow):
                 del self.face_processing_thread
 
             # Reinitialize the thread
-            self.face_processing_thread = FaceProcessingThread(input_folder, output_folder, image_to_search)
+            self.face_processing_thread = FaceProcessingThread(input_folder, output_folder, image_to_search,
+                                                               workers=getattr(self.options, 'workers', None),
+                                                               probe_first=self.low_memory_checkbox.isChecked(),
+                                                               watch=self.watch_checkbox.isChecked(),
+                                                               metadata_query=metadata_query if metadata_query else None)
             self.face_processing_thread.cancel = False  # Reset the cancel flag
 
             # Connect the signals
             self.face_processing_thread.processing_done.connect(self.on_face_processing_done)
+            self.face_processing_thread.partial_result_signal.connect(self.on_partial_results)
+            self.face_processing_thread.watch_update_signal.connect(self.on_watch_update)
             self.face_processing_thread.progress_signal.connect(self.update_progress_bar)
             self.face_processing_thread.error_signal.connect(self.show_error_message)
             self.face_processing_thread.start()
@@ -429,6 +427,48 @@ class FaceMatcherApp(QMainWindow):
         self.cancel_button.setEnabled(False)  # To disable
         self.cancel_button.setEnabled(True)   # To enable
     
+    def on_partial_results(self, result):
+        """
+        Appends matches found so far to the results table while face processing continues.
+        
+        Parameters:
+        - result (tuple): Contains the new matching faces and the face data of their images.
+        """
+        try:
+            matches, face_data = result
+            if self.face_data is None:
+                self.face_data = {}
+            self.face_data.update(face_data)
+
+            self.result_model.append_matches(matches, self.face_data)
+            self.matching_faces.extend(matches)
+        except Exception as e:
+            logging.exception("An error occurred while handling partial face processing results")
+            raise e
+
+    def on_watch_update(self, result):
+        """
+        Updates the results table while the input folder is watched: removes the matches of images
+        that were deleted or changed and appends the matches found in new images.
+
+        Parameters:
+        - result (tuple): Hashes of the removed images, the new matching faces and the face data of their images.
+        """
+        try:
+            removed, matches, face_data = result
+            if removed:
+                self.result_model.remove_images(removed)
+                self.matching_faces = [match for match in self.matching_faces if match[0] not in removed]
+                for img_hash in removed:
+                    self.face_data.pop(img_hash, None)
+            self.face_data.update(face_data)
+
+            self.result_model.append_matches(matches, self.face_data)
+            self.matching_faces.extend(matches)
+        except Exception as e:
+            logging.exception("An error occurred while handling a change to the watched input folder")
+            raise e
+
     def on_face_processing_done(self, result):
         """
         Handles the event when face processing is done. Updates the UI with the results.
@@ -439,52 +479,14 @@ class FaceMatcherApp(QMainWindow):
         try:
             self.matching_faces, self.face_data = result
             logging.debug("Processing finished")
-            self.cancel_button.setEnabled(False)  # Disable the Cancel button here
+            # A watching thread keeps running until it is cancelled
+            if not self.face_processing_thread.watch:
+                self.cancel_button.setEnabled(False)  # Disable the Cancel button here
 
+            # Replace any partial results with the final, ordered matches
+            self.result_model.set_matches(self.matching_faces, self.face_data)
             if len(self.matching_faces) > 0:
-                # Setup the table columns
-                columns = ['Match', 'Similarity', 'Tags', 'Original Image File', 'Latitude', 'Longitude', 'Device', 'Date', 'Time', 'Resized Image Name']
-                self.result_table.setRowCount(len(self.matching_faces))  # Set the row count based on matching faces
-                self.result_table.setColumnCount(len(columns))
-                self.result_table.setHorizontalHeaderLabels(columns)
-
-                for i, (img_hash, original_image_name, face_vector, similarity, resized_image_name) in enumerate(self.matching_faces):
-                    face_info = self.face_data.get(img_hash, {})  # This line retrieves the relevant data for the current img_hash
-                    self.result_table.setItem(i, 0, MatchTableWidgetItem(f"Match {i + 1}"))
-                    self.result_table.setItem(i, 1, NumericTableWidgetItem(f"{similarity * 100:.2f}%"))
-                    original_image_full_path = face_info.get('full_path', '')
-                    self.result_table.setItem(i, 3, QTableWidgetItem(original_image_full_path))
-
-                    
-                    exif_data = face_info.get('exif_data', {})
-                    latitude = exif_data.get('GPSInfo', {}).get('Latitude', '')
-                    longitude = exif_data.get('GPSInfo', {}).get('Longitude', '')
-                    device = f"{exif_data.get('Make', '')} {exif_data.get('Model', '')}".strip()
-                    date = exif_data.get('DateDigitized', '')
-                    time = exif_data.get('TimeDigitized', '')
-
-                    self.result_table.setItem(i, 4, QTableWidgetItem(str(latitude)))
-                    self.result_table.setItem(i, 5, QTableWidgetItem(str(longitude)))
-                    self.result_table.setItem(i, 6, QTableWidgetItem(device))
-                    self.result_table.setItem(i, 7, QTableWidgetItem(date))
-                    self.result_table.setItem(i, 8, QTableWidgetItem(time))
-                    self.result_table.setItem(i, 9, QTableWidgetItem(resized_image_name))
-                    
-                    checkbox_widget = QWidget()
-                    checkbox_layout = QHBoxLayout(checkbox_widget)
-                    checkbox = QCheckBox()
-                    checkbox_layout.addWidget(checkbox)
-                    checkbox_layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                    checkbox_layout.setContentsMargins(0, 0, 0, 0)
-                    checkbox_widget.setLayout(checkbox_layout)
-                    self.result_table.setCellWidget(i, 2, checkbox_widget)  # Set the checkbox in the "Tags" column for this row
-
-                    print(f"Storing resized_image_name for row {i}: {resized_image_name}")
-
                 self.result_table.resizeColumnsToContents()
-            else:
-                self.result_table.setRowCount(0)
-                self.result_table.setColumnCount(0)
         except Exception as e:
             logging.exception("An error occurred while handling the face processing done event")
             raise e
@@ -506,16 +508,12 @@ class FaceMatcherApp(QMainWindow):
             QMessageBox.warning(self, "Warning", "Please select an output directory first!")
             return
 
-        for row in range(self.result_table.rowCount()):
+        for original_image_path in self.result_model.tagged_paths():
             try:
-                checkbox_widget = self.result_table.cellWidget(row, 2)  
-                checkbox = checkbox_widget.children()[1]  # QCheckBox is the second child of the widget
-                if checkbox.isChecked():
-                    original_image_path = self.result_table.item(row, 3).text()  # This is the full path now
-                    dest_path = os.path.join(output_directory, os.path.basename(original_image_path))
-                    shutil.copy2(original_image_path, dest_path)
+                dest_path = os.path.join(output_directory, os.path.basename(original_image_path))
+                shutil.copy2(original_image_path, dest_path)
             except Exception as e:
-                logger.exception(f"Error in export_tagged_photos at row {row}: {str(e)}")
+                logger.exception(f"Error in export_tagged_photos for {original_image_path}: {str(e)}")
 
         QMessageBox.information(self, "Done", "Tagged photos exported successfully!")
 
@@ -524,28 +522,23 @@ class FaceMatcherApp(QMainWindow):
         Displays the matched face image for the currently selected row in the results table.
         """
         try:
-            current_row = self.result_table.currentRow()
+            current_row = self.result_table.currentIndex().row()
             if current_row != -1:
                 print("Displaying selected matched face")
+                store_row = self.result_model.store_row(current_row)
                 
                 # Fetch the 'Resized Image Name' from the table
-                resized_image_name = self.result_table.item(current_row, 9).text()
-                matched_face_path = os.path.join(self.output_folder_edit.text(), resized_image_name)
-                
-                # Print the matched face path for debugging
-                print(f"Attempting to read image from: {matched_face_path}")
-                
-                # Check if the file exists before trying to read
-                if not os.path.exists(matched_face_path):
-                    print(f"Image file does not exist at: {matched_face_path}")
+                resized_image_name = self.result_model.store.crop_name(store_row)
+                matched_face = self.get_matched_face_by_row(current_row)
+                self.prefetch_neighbouring_faces(current_row)
+                if matched_face is None:
+                    print(f"Could not read the face crop {resized_image_name}")
                     return
 
-                matched_face = cv2.imread(matched_face_path)
-
-                similarity = float(self.result_table.item(current_row, 1).text().replace('%', '')) / 100.0
+                similarity = self.result_model.store.similarity(store_row)
 
                 # Fetch the 'Original Image Name' from the table CB
-                original_image_name = self.result_table.item(current_row, 3).text()
+                original_image_name = self.result_model.store.full_path(store_row)
 
                 self.display_matched_face(matched_face, similarity, original_image_name)
                 print(f"Retrieved resized_image_name for row {current_row}: {resized_image_name}")
@@ -568,23 +561,22 @@ class FaceMatcherApp(QMainWindow):
             logging.exception("An error occurred while updating the progress bar")
             raise e
 
-    def on_result_table_selection_changed(self):
+    def on_result_table_selection_changed(self, *args):
         try:
             self.display_selected_matched_face()
         except Exception as e:
             logging.exception("An error occurred while handling the selection change in the result table")
             raise e
 
-    def open_image_in_default_viewer(self, row, column):
+    def open_image_in_default_viewer(self, index):
         """
         Opens the image in the default viewer when the corresponding cell in the results table is double-clicked.
         
         Parameters:
-        - row (int): The row index of the double-clicked cell.
-        - column (int): The column index of the double-clicked cell.
+        - index (QModelIndex): The double-clicked cell.
         """
-        if column == 3: 
-            original_image_full_path = self.result_table.item(row, 3).text()
+        if index.column() == PATH_COLUMN: 
+            original_image_full_path = self.result_model.store.full_path(self.result_model.store_row(index.row()))
             print(original_image_full_path)
                 
             # Open the image using the default viewer
@@ -593,13 +585,23 @@ class FaceMatcherApp(QMainWindow):
             else:
                 QMessageBox.critical(self, "Error", f"File not found: {original_image_full_path}")
         
+    def closeEvent(self, event):
+        """
+        Stops the preview prefetch threads when the window is closed.
+
+        Parameters:
+        - event (QCloseEvent): The close event.
+        """
+        self.preview_cache.shutdown()
+        super().closeEvent(event)
+
     def clear_outputs_and_data(self):
         """
         Clears all outputs in the UI and internal data structures.
         """
-        # Clear the table
-        self.result_table.setRowCount(0)
-        self.result_table.setColumnCount(0)
+        # Clear the table and the previews of its faces
+        self.result_model.clear()
+        self.preview_cache.clear()
         
         # Clear any displayed images or labels
         self.matched_face_label.clear()
@@ -607,12 +609,17 @@ class FaceMatcherApp(QMainWindow):
         self.similarity_original_image_label.clear()
         
         # Clear any other relevant outputs (e.g., console outputs)
-        self.console_widget.console_output.clear()
+        self.console_widget.clear()
 
         
         # Clear internal data structures
         self.face_data = None
+        self.matching_faces = []
         if hasattr(self, 'face_processing_thread'):
+            # A watching thread is asked to stop so it can end its file system watch
+            if self.face_processing_thread.watch and self.face_processing_thread.isRunning():
+                self.face_processing_thread.cancel_processing()
+                self.face_processing_thread.wait(5000)
             # Stop the thread if it's running
             if self.face_processing_thread.isRunning():
                 self.face_processing_thread.terminate()
@@ -633,12 +640,10 @@ class FaceMatcherApp(QMainWindow):
             with open(path, 'w', newline='') as csv_file:
                 writer = csv.writer(csv_file)
                 # Write headers
-                headers = [self.result_table.horizontalHeaderItem(i).text() if self.result_table.horizontalHeaderItem(i) else "" for i in range(self.result_table.columnCount())]
-                writer.writerow(headers)
-                # Write data
-                for row in range(self.result_table.rowCount()):
-                    row_data = [self.result_table.item(row, col).text() if self.result_table.item(row, col) else "" for col in range(self.result_table.columnCount())]
-                    writer.writerow(row_data)
+                writer.writerow(RESULT_COLUMNS)
+                # Write data, in the order shown in the table
+                for row in range(self.result_model.rowCount()):
+                    writer.writerow(self.result_model.row_values(row))
             QMessageBox.information(self, "Success", "Exported to CSV successfully!")   
 
         except Exception as e:
@@ -655,28 +660,24 @@ class FaceMatcherApp(QMainWindow):
             return
 
         try:
-            html_content = "<table border='1'>\n"
+            html_parts = ["<table border='1'>\n"]
             
             # Headers
-            html_content += "<thead>\n<tr>\n"
-            for i in range(self.result_table.columnCount()):
-                header_item = self.result_table.horizontalHeaderItem(i)
-                header_text = header_item.text() if header_item else ""
-                html_content += f"<th>{header_text}</th>\n"
-            html_content += "</tr>\n</thead>\n<tbody>\n"
+            html_parts.append("<thead>\n<tr>\n")
+            for header_text in RESULT_COLUMNS:
+                html_parts.append(f"<th>{header_text}</th>\n")
+            html_parts.append("</tr>\n</thead>\n<tbody>\n")
             
             # Rows
-            for row in range(self.result_table.rowCount()):
-                html_content += "<tr>\n"
-                for col in range(self.result_table.columnCount()):
-                    item = self.result_table.item(row, col)
-                    cell_text = item.text() if item else ""
-                    html_content += f"<td>{cell_text}</td>\n"
-                html_content += "</tr>\n"
-            html_content += "</tbody>\n</table>"
+            for row in range(self.result_model.rowCount()):
+                html_parts.append("<tr>\n")
+                for cell_text in self.result_model.row_values(row):
+                    html_parts.append(f"<td>{cell_text}</td>\n")
+                html_parts.append("</tr>\n")
+            html_parts.append("</tbody>\n</table>")
 
             with open(path, 'w') as html_file:
-                html_file.write(html_content)
+                html_file.write("".join(html_parts))
             QMessageBox.information(self, "Success", "Exported to HTML successfully!")
 
         except Exception as e:
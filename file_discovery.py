@@ -0,0 +1,208 @@
+'''
+@file file_discovery.py
+Concurrent discovery of the images in a folder tree.
+
+Directories are listed with `os.scandir` on a pool of threads, so the round trips to a network
+share overlap instead of adding up. Hidden files and other extensions are filtered out using the
+status each directory entry carries; on Windows that status comes with the listing itself, so no
+file is stat'ed twice. Paths are yielded as soon as their directory has been listed, in a fixed
+order: the files of a directory sorted by name, then each subdirectory in name order.
+
+Optionally, a manifest records the image names and subdirectories of every directory along with
+the directory's modification time. A directory whose modification time has not changed since then
+is not listed again on the next scan. Files are always stat'ed afresh, since editing a file in place
+does not change its directory's modification time.
+'''
+
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_metrics import metrics
+
+logger = logging.getLogger()
+
+VALID_IMAGE_EXTENSIONS = ('.png', '.jpeg', '.jpg', '.bmp')
+# Directories listed at the same time
+DEFAULT_DISCOVERY_THREADS = 8
+DISCOVERY_MANIFEST_FILE_NAME = "discovery_manifest.json"
+MANIFEST_VERSION = 1
+FILE_ATTRIBUTE_HIDDEN = 2
+
+if os.name == 'nt':
+    import ctypes
+    _get_file_attributes = ctypes.windll.kernel32.GetFileAttributesW
+else:
+    _get_file_attributes = None
+
+
+class ImagePath(str):
+    """
+    Path of a discovered image. Behaves as the path string and carries the `os.stat_result` read
+    while discovering it, so the embedding store lookup doesn't stat the file again.
+    """
+
+    def __new__(cls, path, stat_result=None):
+        image_path = super().__new__(cls, path)
+        image_path.stat_result = stat_result
+        return image_path
+
+    def __reduce__(self):
+        return (ImagePath, (str(self), self.stat_result))
+
+
+def is_image_name(name):
+    """Return True if a file name has one of the `VALID_IMAGE_EXTENSIONS`."""
+    return os.path.splitext(name)[1].lower() in VALID_IMAGE_EXTENSIONS
+
+
+def is_hidden(filepath):
+    """
+    Check if a given filepath corresponds to a hidden file.
+    For UNIX-like systems, a file is considered hidden if its name starts with a dot.
+    For Windows, the function checks for the FILE_ATTRIBUTE_HIDDEN attribute.
+    """
+    if _get_file_attributes is not None:
+        attrs = _get_file_attributes(str(filepath))
+        return attrs != -1 and bool(attrs & FILE_ATTRIBUTE_HIDDEN)
+    return os.path.basename(filepath).startswith('.')
+
+
+def is_hidden_entry(entry, stat_result):
+    """
+    Like `is_hidden`, for a directory entry whose status has already been read.
+    """
+    if _get_file_attributes is not None:
+        return bool(getattr(stat_result, 'st_file_attributes', 0) & FILE_ATTRIBUTE_HIDDEN)
+    return entry.name.startswith('.')
+
+
+def scan_directory(path, cached=None):
+    """
+    List the images and subdirectories of one directory.
+
+    Parameters:
+    - path (str): The directory.
+    - cached (dict, optional): The directory's manifest entry from a previous scan.
+
+    Returns:
+    - tuple: (images as `ImagePath` sorted by name, subdirectory paths sorted by name, manifest
+      entry of the directory, True if the listing came from the manifest).
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError as e:
+        logger.warning(f"Could not read directory {path}: {e}")
+        return [], [], None, False
+
+    if cached is not None and cached.get("mtime_ns") == mtime_ns:
+        images = []
+        for name in cached["files"]:
+            image_path = os.path.join(path, name)
+            try:
+                images.append(ImagePath(image_path, os.stat(image_path)))
+            except OSError:
+                continue  # Removed without the directory changing, e.g. on some network file systems
+        return images, [os.path.join(path, name) for name in cached["dirs"]], cached, True
+
+    images = []
+    dirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    # Like os.walk, symbolic links to directories are not followed
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                        continue
+                    if not is_image_name(entry.name) or (_get_file_attributes is None and entry.name.startswith('.')):
+                        continue
+                    stat_result = entry.stat()
+                    if not is_hidden_entry(entry, stat_result):
+                        images.append(ImagePath(entry.path, stat_result))
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.warning(f"Could not list directory {path}: {e}")
+        return [], [], None, False
+
+    images.sort(key=lambda image_path: os.path.basename(image_path))
+    dirs.sort()
+    entry = {"mtime_ns": mtime_ns, "files": [os.path.basename(image_path) for image_path in images], "dirs": dirs}
+    return images, [os.path.join(path, name) for name in dirs], entry, False
+
+
+def load_manifest(manifest_path, root):
+    """
+    Read the directory manifest of a folder tree.
+
+    Returns:
+    - dict: Manifest entries by directory path, empty if there is no usable manifest.
+    """
+    if not manifest_path or not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable discovery manifest {manifest_path}: {e}")
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("root") != root:
+        return {}
+    return manifest.get("directories", {})
+
+
+def save_manifest(manifest_path, root, directories):
+    """Write the directory manifest of a folder tree, replacing the previous one in one step."""
+    temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({"version": MANIFEST_VERSION, "root": root, "directories": directories}, manifest_file)
+        os.replace(temp_path, manifest_path)
+    except OSError as e:
+        logger.warning(f"Could not write discovery manifest {manifest_path}: {e}")
+
+
+def discover_images(folder_path, threads=DEFAULT_DISCOVERY_THREADS, manifest_path=None):
+    """
+    Yield every non-hidden image with a valid extension within the folder and its sub-folders.
+
+    Subdirectories are listed ahead on `threads` threads while the paths found so far are consumed.
+    The manifest, if given, is only rewritten once the whole tree has been walked.
+
+    Parameters:
+    - folder_path (str): The folder to search.
+    - threads (int): Number of directories listed at the same time.
+    - manifest_path (str, optional): Directory manifest to reuse and update.
+
+    Yields:
+    - ImagePath: Each image, with the status read while discovering it.
+    """
+    root = os.path.abspath(folder_path)
+    cached = load_manifest(manifest_path, root)
+    directories = {}
+    reused = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="discovery")
+
+    def submit(path):
+        directory = os.path.abspath(path)
+        return directory, pool.submit(scan_directory, path, cached.get(directory))
+
+    try:
+        # Depth first in name order; the pending listings run in the background meanwhile
+        stack = [submit(folder_path)]
+        while stack:
+            directory, listing = stack.pop()
+            images, subdirs, entry, from_manifest = listing.result()
+            stack.extend(submit(subdir) for subdir in reversed(subdirs))
+            if entry is not None:
+                directories[directory] = entry
+            reused += from_manifest
+            yield from images
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    metrics.count("directories", len(directories))
+    metrics.count("directories_from_manifest", reused)
+    if manifest_path:
+        save_manifest(manifest_path, root, directories)
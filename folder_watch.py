@@ -0,0 +1,401 @@
+'''
+@file folder_watch.py
+Watch mode: keeps the gallery of an input folder up to date while images are added, changed or removed.
+
+Changes are picked up from file system events when the watchdog package is installed (inotify on
+Linux, ReadDirectoryChangesW on Windows, FSEvents on macOS) and by rescanning the folder every few
+seconds otherwise. A file is only passed on once its size and modification time are the same on
+two checks in a row, so images that are still being copied in are not read half written.
+
+Changed images go through the same pipeline as a full run, restricted to those files, so the
+embedding store still recognises touched files, renames and copies without running the models.
+'''
+
+import os
+import time
+import logging
+import threading
+from file_discovery import ImagePath, discover_images, is_hidden, is_image_name
+from face_detection import iter_faces_from_folder, match_probe_vectors
+from console_verbosity import NORMAL, is_verbose
+from exif_metadata import resolve_exif_data
+from metadata_index import build_metadata_index
+
+logger = logging.getLogger()
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# Seconds between checks for settled changes when events are received
+EVENT_CHECK_INTERVAL_S = 1.0
+# Seconds between rescans of the folder when polling
+POLL_INTERVAL_S = 2.0
+# Events that don't change a file
+IGNORED_EVENT_TYPES = ('opened', 'closed_no_write')
+
+
+def file_signature(stat_result):
+    """Return what identifies a version of a file: its size and modification time."""
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+
+def is_within(path, folder):
+    """Return True if the path is the folder or lies inside it."""
+    return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+
+class FolderChanges:
+    """
+    Images added to, modified in and deleted from a watched folder since the previous check.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.deleted = []
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.deleted)
+
+    def __str__(self):
+        return f"{len(self.added)} added, {len(self.modified)} modified, {len(self.deleted)} deleted"
+
+
+class _EventCollector(FileSystemEventHandler):
+    """
+    Collects the paths touched by file system events until the watcher picks them up.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.directories = set()
+
+    def on_any_event(self, event):
+        if event.event_type in IGNORED_EVENT_TYPES:
+            return
+        # A directory's own modification only means its contents changed, which has events of its own
+        if event.is_directory and event.event_type == 'modified':
+            return
+        touched = self.directories if event.is_directory else self.paths
+        with self.lock:
+            for path in (event.src_path, getattr(event, 'dest_path', None)):
+                if path:
+                    touched.add(os.fsdecode(path))
+
+    def take(self):
+        """
+        Return the file and directory paths collected since the last call.
+        """
+        with self.lock:
+            paths, self.paths = self.paths, set()
+            directories, self.directories = self.directories, set()
+        return paths, directories
+
+
+class FolderWatcher:
+    """
+    Detects the images added to, modified in and deleted from a folder tree.
+
+    `start` records the images present at that moment as already indexed. Each `check` then
+    returns the changes that have settled since.
+    """
+
+    def __init__(self, folder_path, exclude=None, use_events=True):
+        """
+        Parameters:
+        - folder_path (str): The folder to watch.
+        - exclude (str, optional): Folder to ignore, e.g. the output folder if it lies inside the watched one.
+        - use_events (bool): Use file system events if watchdog is installed, instead of polling.
+        """
+        self.folder_path = folder_path
+        self.exclude = None
+        if exclude and is_within(os.path.abspath(exclude), os.path.abspath(folder_path)):
+            self.exclude = os.path.abspath(exclude)
+        self.use_events = use_events and Observer is not None
+        self.known = {}  # Signature of every image passed on, by path
+        self.pending = {}  # Signature seen on the last check of changed images that haven't settled yet
+        self.observer = None
+        self.collector = None
+
+    @property
+    def interval(self):
+        """Seconds between checks."""
+        return EVENT_CHECK_INTERVAL_S if self.observer is not None else POLL_INTERVAL_S
+
+    def start(self):
+        """
+        Start receiving events and record the images currently in the folder.
+        """
+        if self.use_events:
+            try:
+                self.collector = _EventCollector()
+                self.observer = Observer()
+                # Scheduled before the folder is scanned so no change is missed in between
+                self.observer.schedule(self.collector, self.folder_path, recursive=True)
+                self.observer.start()
+            except Exception as e:
+                logger.warning(f"Could not receive file system events for {self.folder_path}, polling instead: {e}")
+                self.observer = None
+        self.known = {path: file_signature(path.stat_result) for path in self._scan(self.folder_path)}
+        how = "file system events" if self.observer is not None else f"a rescan every {POLL_INTERVAL_S:.0f}s"
+        logger.info(f"Watching {self.folder_path} ({len(self.known)} images) using {how}")
+
+    def stop(self):
+        """Stop receiving events."""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def _excluded(self, path):
+        return self.exclude is not None and is_within(os.path.abspath(path), self.exclude)
+
+    def _scan(self, folder):
+        """List the images in a folder, with the status read while listing them."""
+        return [path for path in discover_images(folder) if not self._excluded(path)]
+
+    def _candidates(self):
+        """
+        Return the paths that may have changed since the last check, with their current status,
+        or None for paths that no longer hold an image.
+        """
+        if self.observer is None:
+            candidates = {path: path.stat_result for path in self._scan(self.folder_path)}
+            for path in list(self.known) + list(self.pending):
+                candidates.setdefault(path, None)
+            return candidates
+
+        paths, directories = self.collector.take()
+        paths.update(self.pending)
+        for directory in directories:
+            # Directories created, moved or deleted as a whole
+            paths.update(path for path in self.known if is_within(path, directory))
+            if os.path.isdir(directory):
+                paths.update(self._scan(directory))
+
+        candidates = {}
+        for path in paths:
+            if self._excluded(path) or not is_image_name(path):
+                continue
+            try:
+                candidates[path] = None if is_hidden(path) else os.stat(path)
+            except OSError:
+                candidates[path] = None
+        return candidates
+
+    def check(self):
+        """
+        Return the changes since the last check. Added and modified images are only included once
+        their size and modification time have stayed the same for a whole check interval.
+
+        Returns:
+        - FolderChanges: The settled changes, with added and modified images as `ImagePath`.
+        """
+        changes = FolderChanges()
+        for path, stat_result in self._candidates().items():
+            if stat_result is None:
+                self.pending.pop(path, None)
+                if self.known.pop(path, None) is not None:
+                    changes.deleted.append(path)
+                continue
+
+            signature = file_signature(stat_result)
+            if self.known.get(path) == signature:
+                self.pending.pop(path, None)
+                continue
+            if self.pending.get(path) != signature:
+                # Just appeared or still being written, wait for the next check
+                self.pending[path] = signature
+                continue
+
+            del self.pending[path]
+            (changes.modified if path in self.known else changes.added).append(ImagePath(path, stat_result))
+            self.known[path] = signature
+
+        for paths in (changes.added, changes.modified, changes.deleted):
+            paths.sort()
+        return changes
+
+    def iter_changes(self, cancel_flag=None):
+        """
+        Check the folder every `interval` seconds and yield the changes whenever there are any,
+        until `cancel_flag` returns True.
+        """
+        while not (cancel_flag and cancel_flag()):
+            deadline = time.monotonic() + self.interval
+            while time.monotonic() < deadline:
+                if cancel_flag and cancel_flag():
+                    return
+                time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+            changes = self.check()
+            if changes:
+                yield changes
+
+
+class WatchedGallery:
+    """
+    The face_data of a watched folder, kept in step with the folder's changes.
+
+    Images whose file is deleted or modified leave face_data, the face index and the metadata
+    index, unless another file in the folder holds the same image. Added and modified images are
+    then run through `iter_faces_from_folder`, which restores anything the embedding store already knows.
+    """
+
+    def __init__(self, folder_path, output_folder, face_data, store, face_index=None, known_paths=(), metadata_index=None,
+                 exif_cache=None, **ingest_options):
+        """
+        Parameters:
+        - folder_path (str): The watched folder.
+        - output_folder (str): Folder of the face crops and the embedding store.
+        - face_data (dict): Face data of the folder, updated in place.
+        - store (EmbeddingStore): The embedding store the folder was indexed with.
+        - face_index (FaceIndex, optional): Index kept in step with face_data.
+        - known_paths (iterable): Images of the folder that are already indexed, e.g. `FolderWatcher.known`.
+        - metadata_index (MetadataIndex, optional): Metadata index of face_data, e.g. the one built for
+          the first search, kept in step with face_data. Built on the first `select` if not given.
+        - exif_cache (ExifCache, optional): Cache of parsed EXIF data, read for the metadata index.
+        - ingest_options: Further arguments for `iter_faces_from_folder`, such as workers or crop_format.
+        """
+        self.folder_path = folder_path
+        self.output_folder = output_folder
+        self.face_data = face_data
+        self.store = store
+        self.face_index = face_index
+        self.metadata_index = metadata_index
+        self.exif_cache = exif_cache
+        self.ingest_options = ingest_options
+        known_paths = set(known_paths)
+        self.hash_by_path = {}
+        self.paths_by_hash = {}
+        for full_path, img_hash in store.iter_paths():
+            if full_path in known_paths:
+                self._link(full_path, img_hash)
+
+    def _link(self, path, img_hash):
+        self.hash_by_path[path] = img_hash
+        self.paths_by_hash.setdefault(img_hash, set()).add(path)
+
+    def _unlink(self, path, removed, added):
+        """Forget which image a path held, removing the image if no other file holds it."""
+        self.store.forget_path(path)
+        img_hash = self.hash_by_path.pop(path, None)
+        if img_hash is None:
+            return
+        paths = self.paths_by_hash.get(img_hash, set())
+        paths.discard(path)
+        face_entry = self.face_data.get(img_hash)
+        if face_entry is None:
+            return
+        if paths:
+            # A copy of the image remains, which its matches now point at. The entry is replaced
+            # rather than changed, since entries already handed to a GUI may still be read
+            if face_entry["full_path"] == path:
+                full_path = min(paths)
+                face_entry = dict(face_entry, full_path=full_path, file_name=os.path.basename(full_path))
+                self.face_data[img_hash] = face_entry
+                removed.add(img_hash)
+                added[img_hash] = face_entry
+            return
+
+        del self.face_data[img_hash]
+        self.paths_by_hash.pop(img_hash, None)
+        added.pop(img_hash, None)
+        removed.add(img_hash)
+        if self.face_index is not None:
+            self.face_index.remove([(img_hash, i) for i in range(len(face_entry["faces"]))])
+        if self.metadata_index is not None:
+            self.metadata_index.remove([img_hash])
+
+    def apply(self, changes, face_detector, cancel_flag=None):
+        """
+        Bring face_data up to date with a set of folder changes.
+
+        Parameters:
+        - changes (FolderChanges): The changes, from `FolderWatcher.check`.
+        - face_detector (MTCNN): The face detector.
+        - cancel_flag (callable, optional): Returns True to stop processing the changed images.
+
+        Returns:
+        - tuple: (hashes of the images removed from face_data, {img_hash: face_entry} of the images
+          added to it). An image whose path changed is in both.
+        """
+        removed = set()
+        added = {}
+        for path in changes.deleted + changes.modified:
+            self._unlink(path, removed, added)
+        self.store.commit()
+
+        image_paths = changes.added + changes.modified
+        if image_paths:
+            self._ingest(image_paths, face_detector, cancel_flag, added)
+        if self.metadata_index is not None and added:
+            resolve_exif_data(added, self.exif_cache)
+            self.metadata_index.add(added)
+        return removed, added
+
+    def _ingest(self, image_paths, face_detector, cancel_flag, added):
+        """Run added and modified images through the pipeline and add the new ones to face_data."""
+        for _, image_path, img_hash, face_entry in iter_faces_from_folder(self.folder_path, self.output_folder, face_detector,
+                                                                          cancel_flag=cancel_flag, store=self.store,
+                                                                          image_paths=image_paths, **self.ingest_options):
+            if img_hash is None:
+                # Exact copies of an image in the same batch are only remembered in the store
+                img_hash = self.store.path_hash(image_path)
+                if img_hash is None:
+                    continue
+            self._link(image_path, img_hash)
+            if face_entry is not None and img_hash not in self.face_data:
+                self.face_data[img_hash] = face_entry
+                added[img_hash] = face_entry
+                if self.face_index is not None:
+                    self.face_index.add([(img_hash, i) for i in range(len(face_entry["faces"]))], face_entry["faces"])
+
+    def select(self, query, img_hashes=None):
+        """
+        Find the images of face_data meeting a metadata query with the gallery's metadata index.
+
+        Parameters:
+        - query (MetadataQuery): The conditions.
+        - img_hashes (iterable, optional): Only consider these images.
+
+        Returns:
+        - list: img_hash of the matching images, in face_data order.
+        """
+        if self.metadata_index is None:
+            self.metadata_index = build_metadata_index(self.face_data, self.exif_cache)
+        return self.metadata_index.select(query, img_hashes)
+
+
+def watch_gallery(watcher, gallery, face_detector, probe_vectors, update_callback, threshold=.75, cancel_flag=None,
+                  metadata_query=None):
+    """
+    Apply the folder's changes to the gallery as they settle and search the changed images for the
+    probe faces, until `cancel_flag` returns True.
+
+    Parameters:
+    - watcher (FolderWatcher): The started watcher of the folder.
+    - gallery (WatchedGallery): The gallery of the folder.
+    - face_detector (MTCNN): The face detector.
+    - probe_vectors (list): Embedded faces of the standing searches.
+    - update_callback (callable): Called after every change with (hashes of the removed images,
+      new match tuples, {img_hash: face_entry} of the added images).
+    - threshold (float): Maximum cosine distance for a match.
+    - cancel_flag (callable, optional): Returns True to stop watching.
+    - metadata_query (MetadataQuery, optional): Only search the added images meeting these
+      conditions, selected with the gallery's metadata index.
+    """
+    for changes in watcher.iter_changes(cancel_flag):
+        if is_verbose(NORMAL):
+            print(f"Input folder changed: {changes}")
+        removed, added = gallery.apply(changes, face_detector, cancel_flag)
+        searched = added
+        if metadata_query and added:
+            searched = {img_hash: added[img_hash] for img_hash in gallery.select(metadata_query, added)}
+        matches = match_probe_vectors(probe_vectors, searched, threshold) if searched and len(probe_vectors) else []
+        update_callback(removed, matches, added)
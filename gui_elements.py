@@ -4,59 +4,196 @@ Handles table elements in the GUI
 '''
 
 
-from PyQt6.QtWidgets import QTableWidgetItem
+import numpy as np
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from results_export import RESULT_COLUMNS
+from match_store import MatchStore, TAGS_COLUMN
 
-class NumericTableWidgetItem(QTableWidgetItem):
+
+class ResultTableModel(QAbstractTableModel):
     """
-    A custom QTableWidgetItem designed to handle numeric values, 
-    especially ones represented as percentages.
+    Table model of the match results, backed by a columnar `MatchStore`.
+
+    The view only asks for the cells it draws, so nothing is created per row. The Tags column
+    is a checkable cell rather than an embedded checkbox widget, and sorting reorders a
+    permutation of the rows using numeric keys for the numeric columns.
     """
-    
-    def __init__(self, value):
+
+    def __init__(self, parent=None):
         """
-        Initialize the NumericTableWidgetItem with the given value.
+        Initialize the ResultTableModel with no matches.
 
         Parameters:
-        - value (str/int/float): A value to be stored in the table cell.
+        - parent (QObject, optional): Parent object.
         """
-        super().__init__(str(value))
+        super().__init__(parent)
+        self.store = MatchStore()
+        self.order = np.empty(0, dtype=np.int64)  # Store row shown at each table row
+        self.sort_column = -1
+        self.sort_order = Qt.SortOrder.AscendingOrder
 
-    def __lt__(self, other):
+    def store_row(self, row):
         """
-        Overload the less than operator to compare two NumericTableWidgetItem 
-        objects based on their numeric value.
+        Return the `MatchStore` row shown at a table row.
 
         Parameters:
-        - other (NumericTableWidgetItem): Another item to compare with.
+        - row (int): Row of the table, as shown after sorting.
 
         Returns:
-        - bool: True if current item's value is less than the other item's value, otherwise False.
+        - int: Row number in the store.
         """
-        # Extract the numeric value from the text, removing any trailing '%' if present
-        my_number = float(self.text().rstrip('%'))
-        other_number = float(other.text().rstrip('%'))
-        
-        return my_number < other_number
+        return int(self.order[row])
 
-  
-class MatchTableWidgetItem(QTableWidgetItem):
-    """
-    A custom QTableWidgetItem designed to handle match descriptions like 'Match 1', 'Match 2', etc.
-    """
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(RESULT_COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole:
+            if orientation == Qt.Orientation.Horizontal:
+                return RESULT_COLUMNS[section]
+            return str(section + 1)
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.store_row(index.row())
+        column = index.column()
+        if column == TAGS_COLUMN:
+            if role == Qt.ItemDataRole.CheckStateRole:
+                return Qt.CheckState.Checked if self.store.tagged[row] else Qt.CheckState.Unchecked
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.store.text(row, column)
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.isValid() and index.column() == TAGS_COLUMN:
+            flags |= Qt.ItemFlag.ItemIsUserCheckable
+        return flags
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or index.column() != TAGS_COLUMN or role != Qt.ItemDataRole.CheckStateRole:
+            return False
+        self.store.tagged[self.store_row(index.row())] = Qt.CheckState(value) == Qt.CheckState.Checked
+        self.dataChanged.emit(index, index, [role])
+        return True
 
-    def __lt__(self, other):
+    def _sorted_order(self):
+        """Return the display order of every store row under the current sort column."""
+        if self.sort_column < 0:
+            return np.arange(len(self.store), dtype=np.int64)
+        order = np.argsort(self.store.sort_keys(self.sort_column), kind='stable')
+        if self.sort_order == Qt.SortOrder.DescendingOrder:
+            order = order[::-1]
+        return order.astype(np.int64)
+
+    def _reorder(self, append=None, remove=None):
         """
-        Overload the less than operator to compare two MatchTableWidgetItem 
-        objects based on their numeric match number.
+        Recompute the display order, optionally after appending or removing matches, keeping the
+        selection and current row on the same matches.
 
         Parameters:
-        - other (MatchTableWidgetItem): Another item to compare with.
+        - append (tuple, optional): (matches, face_data) to add to the store first.
+        - remove (iterable, optional): Hashes of the images whose matches are removed from the store first.
+        """
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        store_rows = [self.store_row(index.row()) for index in persistent]
+        if append is not None:
+            self.store.append(*append)
+        if remove is not None:
+            row_map = self.store.remove_images(remove)
+            store_rows = [int(row_map[store_row]) for store_row in store_rows]
+        self.order = self._sorted_order()
 
-        Returns:
-        - bool: True if current item's match number is less than the other item's match number, otherwise False.
+        positions = np.empty(len(self.order), dtype=np.int64)
+        positions[self.order] = np.arange(len(self.order))
+        # Indexes of removed rows become invalid
+        self.changePersistentIndexList(persistent, [self.index(int(positions[store_row]), index.column()) if store_row >= 0 else QModelIndex()
+                                                    for index, store_row in zip(persistent, store_rows)])
+        self.layoutChanged.emit()
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        """
+        Sort the rows by a column. Called by the view when a header is clicked.
+        """
+        self.sort_column = column
+        self.sort_order = order
+        self._reorder()
+
+    def append_matches(self, matches, face_data):
+        """
+        Add matches to the table.
+
+        Parameters:
+        - matches (list): Match tuples as returned by find_matching_face.
+        - face_data (dict): Mapping of image hash to face information.
+        """
+        if not matches:
+            return
+        if self.sort_column < 0:
+            # Unsorted rows are shown in store order, so the new rows simply go at the end
+            start = len(self.order)
+            self.beginInsertRows(QModelIndex(), start, start + len(matches) - 1)
+            rows = self.store.append(matches, face_data)
+            self.order = np.concatenate([self.order, np.arange(rows.start, rows.stop, dtype=np.int64)])
+            self.endInsertRows()
+            return
+
+        # A sorted table puts the new rows in place
+        self._reorder((matches, face_data))
+
+    def remove_images(self, img_hashes):
+        """
+        Remove the matches of the given images from the table.
+
+        Parameters:
+        - img_hashes (iterable): Hashes of the images.
+        """
+        img_hashes = [img_hash for img_hash in img_hashes if img_hash in self.store.image_ids_by_hash]
+        if img_hashes:
+            self._reorder(remove=img_hashes)
+
+    def set_matches(self, matches, face_data):
+        """
+        Replace every row with the given matches, keeping the current sort column.
+        """
+        self.beginResetModel()
+        self.store.clear()
+        self.store.append(matches, face_data)
+        self.order = self._sorted_order()
+        self.endResetModel()
+
+    def clear(self):
+        """
+        Remove every row.
+        """
+        self.beginResetModel()
+        self.store.clear()
+        self.order = np.empty(0, dtype=np.int64)
+        self.endResetModel()
+
+    def row_values(self, row):
+        """
+        Return the text of every column of a table row, for the exports.
+        """
+        return self.store.row_values(self.store_row(row))
+
+    def tagged_paths(self):
+        """
+        Return the original image paths of the tagged matches, in table order and without repeats.
         """
-        # Extract the numeric match number from the text
-        my_number = int(self.text().split()[-1])
-        other_number = int(other.text().split()[-1])
-        
-        return my_number < other_number
\ No newline at end of file
+        tagged = self.store.tagged[self.order]
+        paths = []
+        seen = set()
+        for row in self.order[tagged]:
+            path = self.store.full_path(int(row))
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+        return paths
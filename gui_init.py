@@ -3,12 +3,13 @@
 Initialize the GUI elements
 '''
 
-from PyQt6.QtWidgets import  QSplitter, QLabel, QLineEdit, QPushButton, QVBoxLayout, QWidget, QProgressBar, QTableWidget
+from PyQt6.QtWidgets import  QSplitter, QLabel, QLineEdit, QPushButton, QVBoxLayout, QWidget, QProgressBar, QTableView, QHeaderView
 from PyQt6.QtCore import Qt
 from PyQt6.QtWidgets import QStyle
 from PyQt6.QtWidgets import QHBoxLayout
 from console_output import ConsoleWidget
-from PyQt6.QtWidgets import QDoubleSpinBox
+from gui_elements import ResultTableModel
+from PyQt6.QtWidgets import QDoubleSpinBox, QCheckBox
 import logging
 import os
 import sys
@@ -88,6 +89,24 @@ def initUI(self):
         match_buttons_layout.addWidget(self.cancel_button) 
         left_panel_layout.addLayout(match_buttons_layout)
 
+        # Low memory mode keeps only the matches instead of every face found in the input folder
+        self.low_memory_checkbox = QCheckBox('Low memory mode (keep matches only)')
+        left_panel_layout.addWidget(self.low_memory_checkbox)
+
+        # Watching keeps searching the images that arrive in the input folder until cancelled
+        self.watch_checkbox = QCheckBox('Watch input folder for new images')
+        left_panel_layout.addWidget(self.watch_checkbox)
+
+        # Metadata filter restricting the search to images by capture date, device and location
+        metadata_filter_layout = QHBoxLayout()
+        self.metadata_filter_edit = QLineEdit()
+        self.metadata_filter_edit.setPlaceholderText('e.g. from:2021-06-01 to:2021-06-30 device:pixel near:52.37,4.89,5')
+        self.metadata_filter_edit.setToolTip('Only search images meeting these conditions: from:DATE, to:DATE, device:TEXT,\n'
+                                             'near:LAT,LON[,KM] (5 km by default) and bbox:SOUTH,WEST,NORTH,EAST')
+        metadata_filter_layout.addWidget(QLabel('Metadata filter:'))
+        metadata_filter_layout.addWidget(self.metadata_filter_edit)
+        left_panel_layout.addLayout(metadata_filter_layout)
+
         # Image preview in left panel
         self.image_preview_label = QLabel()
         self.image_preview_label.setObjectName('image_preview_label')
@@ -124,7 +143,7 @@ def initUI(self):
         # Console output in right panel
         self.console_widget = ConsoleWidget()
         right_panel_layout.addWidget(self.console_widget)
-        self.console_widget.start_console_output_thread()
+        self.console_widget.start_console_output()
 
         # Image similarity threshold in right panel
         self.similarity_threshold_spinbox = QDoubleSpinBox(self)
@@ -172,10 +191,18 @@ def initUI(self):
         main_layout.addWidget(top_splitter)
 
         # Results table below the top splitter
-        self.result_table = QTableWidget(self)
-        self.result_table.itemSelectionChanged.connect(self.on_result_table_selection_changed)
+        # The view only renders the visible rows of the model, however many matches there are
+        self.result_model = ResultTableModel(self)
+        self.result_table = QTableView(self)
+        self.result_table.setModel(self.result_model)
+        self.result_table.setSelectionBehavior(QTableView.SelectionBehavior.SelectRows)
+        self.result_table.selectionModel().currentRowChanged.connect(self.on_result_table_selection_changed)
+        self.result_table.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
         self.result_table.setSortingEnabled(True)
+        self.result_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
         self.result_table.verticalHeader().setDefaultSectionSize(12)
+        # Column widths are fitted to a sample of rows rather than to every row
+        self.result_table.horizontalHeader().setResizeContentsPrecision(200)
         main_layout.addWidget(self.result_table)
 
     except Exception as e:
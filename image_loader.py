@@ -0,0 +1,89 @@
+'''
+@file image_loader.py
+Reads each image file once and shares the bytes between hashing, EXIF parsing and decoding.
+'''
+
+import io
+import time
+import hashlib
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class ImageBuffer:
+    """
+    The raw bytes of an image file, read with a single sequential read.
+
+    The file is read into memory rather than memory mapped: the md5 hash needs every byte anyway,
+    and on network file systems one large read is far cheaper than page faults spread over
+    hashing, header parsing and decoding.
+    """
+
+    def __init__(self, image_path, data, read_s=0.0):
+        """
+        Parameters:
+        - image_path (str): Path the bytes were read from.
+        - data (bytes): Contents of the file.
+        - read_s (float): Seconds the read took.
+        """
+        self.path = image_path
+        self.data = data
+        self.read_s = read_s
+        self._md5 = None
+
+    @classmethod
+    def read(cls, image_path):
+        """
+        Read an image file into memory.
+
+        Parameters:
+        - image_path (str): Path of the image.
+
+        Returns:
+        - ImageBuffer: The file contents.
+        """
+        start = time.perf_counter()
+        with open(image_path, 'rb') as image_file:
+            data = image_file.read()
+        return cls(image_path, data, time.perf_counter() - start)
+
+    @property
+    def nbytes(self):
+        """Number of bytes read from the file."""
+        return len(self.data)
+
+    def md5(self):
+        """Return the md5 hex digest of the file contents, used as the image hash."""
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.data).hexdigest()
+        return self._md5
+
+    def open_pil(self):
+        """Open the image with PIL. Only the header is parsed until pixel data is requested."""
+        return Image.open(io.BytesIO(self.data))
+
+    def header_size(self):
+        """
+        Return the (width, height) stored in the image header without decoding the pixels,
+        or None if the header can't be parsed.
+        """
+        try:
+            with self.open_pil() as pil_img:
+                return pil_img.size
+        except Exception:
+            return None
+
+    def decode(self, flags=cv2.IMREAD_COLOR):
+        """
+        Decode the image with OpenCV.
+
+        Parameters:
+        - flags (int): cv2 imread flags, e.g. a reduced decode mode.
+
+        Returns:
+        - numpy.ndarray or None: The BGR image, or None if it could not be decoded.
+        """
+        if not self.data:
+            return None
+        return cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), flags)
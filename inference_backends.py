@@ -0,0 +1,285 @@
+'''
+@file inference_backends.py
+TensorFlow Lite versions of the ResNet152 embedder and the MTCNN stages, with post-training
+float16 or int8 quantisation, as a faster CPU alternative to running the Keras models.
+
+The TFLite models are exported from the Keras models the first time a backend is used and kept
+in a model folder, so later runs load them directly. Float16 halves the model files; on CPU the
+weights are expanded back to float32 at load time, so its speed comes from the TFLite runtime
+rather than the smaller weights. Int8 stores 8 bit weights and runs quantised kernels; given
+calibration face crops it quantises the activations as well.
+
+Vectors from a TFLite backend are approximations of the Keras ones, so they are never compared
+with them: store records and index files carry the `inference_version` of the models that produced
+their vectors (the backend and its quantisation mode), and vectors of another version are embedded
+again. `benchmarks/bench_inference_backends.py` measures how closely the backends agree.
+'''
+
+import os
+import json
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger()
+
+KERAS_BACKEND = "keras"
+DEFAULT_INFERENCE_BACKEND = KERAS_BACKEND
+
+# Quantisation applied by each backend, None for the reference Keras models
+INFERENCE_BACKENDS = {
+    KERAS_BACKEND: None,
+    "tflite-fp16": "float16",
+    "tflite-int8": "int8",
+}
+
+DEFAULT_MODEL_DIR = os.path.join(os.path.expanduser('~'), '.face_matcher', 'models')
+
+RESNET_INPUT_SHAPE = (224, 224, 3)
+
+# Channels of each MTCNN stage's outputs, in the order the mtcnn package expects them
+MTCNN_STAGE_OUTPUTS = {
+    "pnet": (4, 2),
+    "rnet": (4, 2),
+    "onet": (4, 10, 2),
+}
+
+# Face crops used to calibrate int8 activations
+MAX_CALIBRATION_CROPS = 200
+
+
+class TFLiteModel:
+    """
+    A TFLite model with the `predict` and `predict_on_batch` methods of the Keras model it was
+    exported from, so it can stand in for it.
+    """
+
+    def __init__(self, model_path, output_channels=None, num_threads=None):
+        """
+        Parameters:
+        - model_path (str): Path of the .tflite file.
+        - output_channels (tuple, optional): Last dimension of each output, in the order the
+          outputs are returned. TFLite does not keep the Keras output order of multi-output models.
+        - num_threads (int, optional): Threads used by the interpreter. Defaults to one per CPU.
+        """
+        self.path = model_path
+        self.interpreter = create_interpreter(model_path, num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        outputs = self.interpreter.get_output_details()
+        if output_channels is not None:
+            by_channels = {output['shape'][-1]: output for output in outputs}
+            outputs = [by_channels[channels] for channels in output_channels]
+        self._outputs = outputs
+        self._input_shape = None
+        # An interpreter must not be invoked from two threads at once
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, batch):
+        """
+        Run the model on a batch.
+
+        Parameters:
+        - batch (numpy.ndarray): Input batch, preprocessed as for the Keras model.
+
+        Returns:
+        - numpy.ndarray or list: The output, or a list of outputs for multi-output models.
+        """
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        with self._lock:
+            # Reallocating is only needed when the batch size or image size changes
+            if self._input_shape != batch.shape:
+                self.interpreter.resize_tensor_input(self._input['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self._input_shape = batch.shape
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+            outputs = [self.interpreter.get_tensor(output['index']).copy() for output in self._outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def predict(self, batch, **kwargs):
+        """Keras style `predict`, as called by the mtcnn package."""
+        return self.predict_on_batch(batch)
+
+
+def create_interpreter(model_path, num_threads=None):
+    """
+    Create a TFLite interpreter, preferring the standalone tflite_runtime package when installed.
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count() or 1)
+
+
+def model_path(model_dir, name, backend):
+    """Return the path of an exported model."""
+    return os.path.join(model_dir, f"{name}-{backend}.tflite")
+
+
+def export_info_path(model_dir, backend):
+    """Return the path of the file describing how a backend's ResNet152 was exported."""
+    return os.path.join(model_dir, f"resnet152-{backend}.json")
+
+
+def inference_version(backend, model_dir=DEFAULT_MODEL_DIR):
+    """
+    Return the id of the models a backend embeds with: the backend and its quantisation mode,
+    e.g. 'keras', 'tflite-fp16/float16' or 'tflite-int8/int8-calibrated'.
+
+    Parameters:
+    - backend (str): One of `INFERENCE_BACKENDS`.
+    - model_dir (str): Folder of the exported models.
+    """
+    quantization = INFERENCE_BACKENDS[backend]
+    if quantization is None:
+        return backend
+    mode = quantization
+    if quantization == "int8":
+        # Exports from before the export info was written, and exports still to come, are weight only
+        try:
+            with open(export_info_path(model_dir, backend)) as info_file:
+                calibrated = json.load(info_file).get("calibrated", False)
+        except (OSError, ValueError):
+            calibrated = False
+        mode += "-calibrated" if calibrated else "-weights"
+    return f"{backend}/{mode}"
+
+
+def export_tflite(keras_model, path, quantization, representative_data=None):
+    """
+    Convert a Keras model to a quantised TFLite model.
+
+    Parameters:
+    - keras_model: The Keras model.
+    - path (str): Destination .tflite file.
+    - quantization (str): 'float16' or 'int8'.
+    - representative_data (list, optional): Preprocessed inputs used to calibrate int8 activations.
+      Without them only the weights are quantised.
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if representative_data:
+            converter.representative_dataset = lambda: ([sample[np.newaxis].astype(np.float32)] for sample in representative_data)
+    else:
+        raise ValueError(f"Unknown quantization '{quantization}'")
+    tflite_model = converter.convert()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Written under a temporary name so an interrupted export is never loaded
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as model_file:
+        model_file.write(tflite_model)
+    os.replace(temp_path, path)
+    logger.info(f"Exported {path} ({len(tflite_model) / 2**20:.1f} MB)")
+
+
+def load_calibration_crops(crops_folder, limit=MAX_CALIBRATION_CROPS):
+    """
+    Load and preprocess 224x224 face crops, such as an output folder, for int8 calibration.
+    """
+    import cv2
+    from itertools import islice
+    from tensorflow.keras.applications.resnet import preprocess_input
+    from crop_writer import iter_crop_paths
+
+    crops = [cv2.imread(path) for path in islice(iter_crop_paths(crops_folder), limit)]
+    crops = [cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) for crop in crops if crop is not None and crop.shape == RESNET_INPUT_SHAPE]
+    if not crops:
+        raise ValueError(f"No 224x224 face crops found in {crops_folder}")
+    return list(preprocess_input(np.stack(crops).astype(np.float32)))
+
+
+def export_resnet(backend, model_dir=DEFAULT_MODEL_DIR, calibration_crops=None):
+    """
+    Export the ResNet152 feature extractor for a backend.
+
+    Parameters:
+    - backend (str): A TFLite backend of `INFERENCE_BACKENDS`.
+    - model_dir (str): Folder of the exported models.
+    - calibration_crops (str, optional): Folder of face crops to calibrate int8 activations with.
+
+    Returns:
+    - str: Path of the exported model.
+    """
+    from tensorflow.keras.applications.resnet import ResNet152
+
+    print(f"Exporting ResNet152 for {backend}, this only happens once...")
+    # A fixed image size lets the converter fold every shape, leaving only the batch size free
+    keras_model = ResNet152(weights='imagenet', include_top=False, input_shape=RESNET_INPUT_SHAPE)
+    representative_data = load_calibration_crops(calibration_crops) if calibration_crops else None
+    path = model_path(model_dir, "resnet152", backend)
+    export_tflite(keras_model, path, INFERENCE_BACKENDS[backend], representative_data)
+    with open(export_info_path(model_dir, backend), 'w') as info_file:
+        json.dump({"quantization": INFERENCE_BACKENDS[backend], "calibrated": bool(representative_data)}, info_file)
+    return path
+
+
+def export_mtcnn(backend, model_dir=DEFAULT_MODEL_DIR):
+    """
+    Export the three MTCNN stages for a backend.
+
+    Parameters:
+    - backend (str): A TFLite backend of `INFERENCE_BACKENDS`.
+    - model_dir (str): Folder of the exported models.
+
+    Returns:
+    - dict: Path of each exported stage.
+    """
+    from mtcnn import MTCNN
+
+    print(f"Exporting MTCNN for {backend}, this only happens once...")
+    detector = MTCNN()
+    paths = {}
+    for stage in MTCNN_STAGE_OUTPUTS:
+        paths[stage] = model_path(model_dir, f"mtcnn-{stage}", backend)
+        # The stages are small, so only their weights are quantised
+        export_tflite(getattr(detector, f"_{stage}"), paths[stage], INFERENCE_BACKENDS[backend])
+    return paths
+
+
+def build_tflite_resnet(backend, model_dir=DEFAULT_MODEL_DIR, num_threads=None):
+    """
+    Load the TFLite ResNet152 feature extractor of a backend, exporting it first if needed.
+    """
+    path = model_path(model_dir, "resnet152", backend)
+    if not os.path.isfile(path):
+        export_resnet(backend, model_dir)
+    print(f"Loading {os.path.basename(path)}...")
+    return TFLiteModel(path, num_threads=num_threads)
+
+
+def ensure_mtcnn_exported(backend, model_dir=DEFAULT_MODEL_DIR):
+    """
+    Export the MTCNN stages of a backend unless they already are.
+
+    Returns:
+    - dict: Path of each exported stage.
+    """
+    paths = {stage: model_path(model_dir, f"mtcnn-{stage}", backend) for stage in MTCNN_STAGE_OUTPUTS}
+    if not all(os.path.isfile(path) for path in paths.values()):
+        export_mtcnn(backend, model_dir)
+    return paths
+
+
+def build_tflite_face_detector(backend, model_dir=DEFAULT_MODEL_DIR, num_threads=None):
+    """
+    Build an MTCNN detector whose three stages run as TFLite models, exporting them first if needed.
+    """
+    from mtcnn import MTCNN
+
+    paths = ensure_mtcnn_exported(backend, model_dir)
+
+    print(f"Loading MTCNN stages for {backend}...")
+    # The detector still builds its Keras stages, which are replaced and then released
+    face_detector = MTCNN()
+    for stage, output_channels in MTCNN_STAGE_OUTPUTS.items():
+        if not hasattr(face_detector, f"_{stage}"):
+            raise RuntimeError(f"This version of mtcnn has no '_{stage}' stage to replace")
+        setattr(face_detector, f"_{stage}", TFLiteModel(paths[stage], output_channels, num_threads))
+    return face_detector
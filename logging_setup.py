@@ -0,0 +1,29 @@
+'''
+@file logging_setup.py
+Debug log configuration, done once by each entry point.
+
+Logging used to be configured when the backend modules were imported. Face detection worker
+processes import those modules again, so every worker truncated the log of the main process.
+Only the entry points (main.py, face_cli.py and batch_search.py) call `setup_logging`; worker
+processes keep the default configuration and write no log file.
+'''
+
+import logging
+
+DEBUG_LOG_FILE = "debug.log"
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def setup_logging(path=DEBUG_LOG_FILE, level=logging.DEBUG):
+    """
+    Send log records to a file, replacing the log of the previous run.
+
+    Parameters:
+    - path (str): Path of the log file.
+    - level (int): Lowest level written to the file.
+    """
+    try:
+        logging.basicConfig(filename=path, filemode='w', level=level, format=LOG_FORMAT)
+        logging.debug('Logging setup successful')
+    except Exception as e:
+        print(f"Logging setup failed: {str(e)}")
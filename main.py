@@ -5,8 +5,13 @@ main function
 
 import sys
 import os
+import argparse
+import multiprocessing
 from PyQt6.QtWidgets import QApplication
 from face_matcher_app_class import FaceMatcherApp
+from logging_setup import setup_logging
+from model_registry import registry, set_inference_backend
+from inference_backends import INFERENCE_BACKENDS, DEFAULT_INFERENCE_BACKEND, DEFAULT_MODEL_DIR
 
 def set_up_paths():
     """
@@ -22,11 +27,33 @@ def set_up_paths():
 
     return os.path.join(app_path, "styles", "dark_theme.qss")
 
+def build_parser():
+    """
+    Build the parser of the application's command line options.
+    """
+    parser = argparse.ArgumentParser(description="Search image folders for a face.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of face detection processes")
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        help="Load the models on the first search instead of at start up")
+    parser.add_argument('--inference-backend', choices=list(INFERENCE_BACKENDS), default=DEFAULT_INFERENCE_BACKEND,
+                        help="Run the models with Keras or as quantised TFLite exports")
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR, help="Folder of the exported TFLite models")
+    return parser
+
 if __name__ == '__main__':
     """
     Main entry point of the Face Matcher application.
     """
-    app = QApplication(sys.argv)
-    face_matcher_app = FaceMatcherApp()
+    # Needed by the face detection worker processes in frozen builds
+    multiprocessing.freeze_support()
+    setup_logging()
+    # Options Qt understands, such as -style, are left for QApplication
+    args, qt_args = build_parser().parse_known_args()
+    set_inference_backend(args.inference_backend, args.model_dir)
+    app = QApplication(sys.argv[:1] + qt_args)
+    face_matcher_app = FaceMatcherApp(options=args)
     face_matcher_app.show()
+    # Load the models while the user picks folders, unless asked not to
+    if args.warm_up:
+        registry.warm_up_in_background()
     app.exec()
\ No newline at end of file
@@ -0,0 +1,206 @@
+'''
+@file match_store.py
+Columnar store of the matches shown in the results table.
+
+A row costs a few numbers and a crop name. Everything that is the same for every face of an
+image (its path and EXIF columns) is kept once per image, and cell text is only formatted
+when a cell is displayed, so the table stays light with hundreds of thousands of matches.
+'''
+
+import math
+import numpy as np
+from results_export import RESULT_COLUMNS, exif_columns
+
+MATCH_COLUMN = RESULT_COLUMNS.index('Match')
+SIMILARITY_COLUMN = RESULT_COLUMNS.index('Similarity')
+TAGS_COLUMN = RESULT_COLUMNS.index('Tags')
+PATH_COLUMN = RESULT_COLUMNS.index('Original Image File')
+LATITUDE_COLUMN = RESULT_COLUMNS.index('Latitude')
+LONGITUDE_COLUMN = RESULT_COLUMNS.index('Longitude')
+CROP_COLUMN = RESULT_COLUMNS.index('Resized Image Name')
+
+# Columns holding per-image values, in the order of `MatchStore.images` entries after the hash and file name
+IMAGE_COLUMNS = [PATH_COLUMN] + [RESULT_COLUMNS.index(name) for name in ('Latitude', 'Longitude', 'Device', 'Date', 'Time')]
+
+INITIAL_CAPACITY = 1024
+
+
+def parse_coordinate(text):
+    """Return a latitude or longitude column value as a float, NaN if it is empty or not a number."""
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class MatchStore:
+    """
+    Match results kept column by column.
+
+    Rows are numbered in the order they were appended. The per-row columns are numpy arrays
+    that grow by doubling; image level values are interned in `images` and referenced by index.
+    Removing the rows of an image renumbers the rows after them but keeps their match numbers.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove every row."""
+        self.size = 0
+        self.appended = 0  # Matches ever appended, which numbers the next one
+        self.match_numbers = np.empty(INITIAL_CAPACITY, dtype=np.int32)
+        self.similarities = np.empty(INITIAL_CAPACITY, dtype=np.float32)
+        self.image_ids = np.empty(INITIAL_CAPACITY, dtype=np.int32)
+        self.tagged = np.zeros(INITIAL_CAPACITY, dtype=bool)
+        self.crop_names = []
+        self.images = []  # (img_hash, file_name, full_path, latitude, longitude, device, date, time)
+        self.image_ids_by_hash = {}
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, count):
+        """Make room for `count` more rows."""
+        needed = self.size + count
+        capacity = len(self.similarities)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('match_numbers', 'similarities', 'image_ids', 'tagged'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def _image_id(self, img_hash, file_name, face_data):
+        image_id = self.image_ids_by_hash.get(img_hash)
+        if image_id is None:
+            face_info = face_data.get(img_hash, {})
+            image_id = len(self.images)
+            self.images.append((img_hash, file_name, face_info.get('full_path', '')) + exif_columns(face_info.get('exif_data', {})))
+            self.image_ids_by_hash[img_hash] = image_id
+        return image_id
+
+    def append(self, matches, face_data):
+        """
+        Add matches as new rows, numbered after the existing ones.
+
+        Parameters:
+        - matches (list): Match tuples as returned by find_matching_face.
+        - face_data (dict): Mapping of image hash to face information, for the image columns.
+
+        Returns:
+        - range: The row numbers of the added matches.
+        """
+        start = self.size
+        self._reserve(len(matches))
+        for row, (img_hash, file_name, _, similarity, resized_image_name) in enumerate(matches, start=start):
+            self.match_numbers[row] = self.appended + row - start + 1
+            self.similarities[row] = similarity
+            self.image_ids[row] = self._image_id(img_hash, file_name, face_data)
+            self.tagged[row] = False
+            self.crop_names.append(resized_image_name)
+        self.size = start + len(matches)
+        self.appended += len(matches)
+        return range(start, self.size)
+
+    def remove_images(self, img_hashes):
+        """
+        Remove the rows of the given images, e.g. because their files were deleted.
+
+        Parameters:
+        - img_hashes (iterable): Hashes of the images.
+
+        Returns:
+        - numpy.ndarray: The new row number of every previous row, -1 for removed rows.
+        """
+        image_ids = [self.image_ids_by_hash.pop(img_hash) for img_hash in img_hashes if img_hash in self.image_ids_by_hash]
+        keep = ~np.isin(self.image_ids[:self.size], image_ids)
+        kept = int(keep.sum())
+        row_map = np.full(self.size, -1, dtype=np.int64)
+        row_map[keep] = np.arange(kept)
+        for name in ('match_numbers', 'similarities', 'image_ids', 'tagged'):
+            column = getattr(self, name)
+            column[:kept] = column[:self.size][keep]
+        self.crop_names = [crop_name for crop_name, keep_row in zip(self.crop_names, keep) if keep_row]
+        # The interned values of removed images stay unreferenced, re-adding an image interns it anew
+        self.size = kept
+        return row_map
+
+    def image(self, row):
+        """Return the interned image values of a row."""
+        return self.images[self.image_ids[row]]
+
+    def img_hash(self, row):
+        return self.image(row)[0]
+
+    def file_name(self, row):
+        return self.image(row)[1]
+
+    def full_path(self, row):
+        return self.image(row)[2]
+
+    def similarity(self, row):
+        return float(self.similarities[row])
+
+    def crop_name(self, row):
+        return self.crop_names[row]
+
+    def text(self, row, column):
+        """
+        Return the display text of a cell.
+
+        Parameters:
+        - row (int): Row number.
+        - column (int): Index into `RESULT_COLUMNS`.
+        """
+        if column == MATCH_COLUMN:
+            return f"Match {self.match_numbers[row]}"
+        if column == SIMILARITY_COLUMN:
+            return f"{self.similarities[row] * 100:.2f}%"
+        if column == TAGS_COLUMN:
+            return "Yes" if self.tagged[row] else ""
+        if column == CROP_COLUMN:
+            return self.crop_names[row]
+        return self.image(row)[2 + IMAGE_COLUMNS.index(column)]
+
+    def row_values(self, row):
+        """Return the text of every column of a row, as written by the table exports."""
+        return [self.text(row, column) for column in range(len(RESULT_COLUMNS))]
+
+    def sort_keys(self, column):
+        """
+        Return one sort key per row for a column: numbers for the numeric columns, so they sort
+        by value rather than by text, and strings otherwise.
+
+        Parameters:
+        - column (int): Index into `RESULT_COLUMNS`.
+
+        Returns:
+        - numpy.ndarray: The keys, indexed by row number.
+        """
+        rows = slice(0, self.size)
+        if column == MATCH_COLUMN:
+            return self.match_numbers[rows]
+        if column == SIMILARITY_COLUMN:
+            return self.similarities[rows]
+        if column == TAGS_COLUMN:
+            return self.tagged[rows]
+        if column == CROP_COLUMN:
+            return np.array(self.crop_names, dtype=str)
+
+        # Image level keys are computed once per image and spread over its rows
+        position = 2 + IMAGE_COLUMNS.index(column)
+        if column in (LATITUDE_COLUMN, LONGITUDE_COLUMN):
+            image_keys = np.array([parse_coordinate(image[position]) for image in self.images], dtype=np.float64)
+        else:
+            image_keys = np.array([image[position] for image in self.images], dtype=str)
+        if not len(image_keys):
+            return image_keys
+        return image_keys[self.image_ids[rows]]
+
+    def tagged_rows(self):
+        """Return the row numbers of the tagged matches."""
+        return np.flatnonzero(self.tagged[:self.size])
@@ -0,0 +1,531 @@
+'''
+@file metadata_index.py
+Columnar index over the EXIF metadata of face_data, to restrict a search before any vectors are scored.
+
+Each image of face_data gets one row. Capture times are kept as a datetime64 column with a sorted
+copy, so a date range is two binary searches. Devices are dictionary encoded: the distinct device
+names are matched against the query once and rows are then selected by integer code. Positions are
+bucketed into a grid of `GRID_CELL_DEG` degree cells sorted by cell, so a radius or bounding box
+query only visits the rows of the cells it overlaps before checking exact distances.
+
+The index is built once per gallery with `build_metadata_index` and kept in step with face_data
+by `add` and `remove`, e.g. by a `WatchedGallery`, so searches after the first don't index again.
+`MetadataQuery.matches_entry` applies the same conditions to a single face_data entry, for images
+that are searched one at a time as they are processed.
+
+Indexing needs the EXIF data of every image, which is resolved through the EXIF cache of the
+output folder, so only images never filtered on before have their files read.
+'''
+
+import math
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+from results_export import exif_columns
+from exif_metadata import resolve_exif_data
+from pipeline_metrics import metrics
+from console_verbosity import NORMAL, is_verbose
+
+logger = logging.getLogger()
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Side of a grid cell in degrees, about 11 km of latitude
+GRID_CELL_DEG = 0.1
+GRID_COLUMNS = int(round(360 / GRID_CELL_DEG))
+DEFAULT_RADIUS_KM = 5.0
+NO_DEVICE = -1
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in kilometres between points given in decimal degrees. Works on
+    scalars and numpy arrays alike.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def capture_time(date_text, time_text=''):
+    """
+    Convert the EXIF date and time columns of an image to a datetime64.
+
+    Parameters:
+    - date_text (str): Date as "YYYY:MM:DD", as in the "Date" results column.
+    - time_text (str): Time as "HH:MM:SS", midnight if empty.
+
+    Returns:
+    - numpy.datetime64: The capture time in seconds, NaT if the date is missing or invalid.
+    """
+    if len(date_text) != 10 or len(time_text or '00:00:00') != 8:
+        return np.datetime64('NaT', 's')
+    # numpy parses ISO 8601 far faster than strptime, which matters when indexing large galleries
+    try:
+        return np.datetime64(f"{date_text.replace(':', '-')}T{time_text or '00:00:00'}", 's')
+    except ValueError:
+        return np.datetime64('NaT', 's')
+
+
+def image_metadata(exif_data):
+    """
+    Return the indexed values of an image: (capture time, device, latitude, longitude), with NaT,
+    '' and NaN for missing values.
+    """
+    latitude, longitude, device, date_text, time_text = exif_columns(exif_data)
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except ValueError:
+        latitude = longitude = math.nan
+    return capture_time(date_text, time_text), device, latitude, longitude
+
+
+def parse_query_time(value, end=False):
+    """
+    Convert a date given on a query to a datetime64 bound.
+
+    Parameters:
+    - value (str, date or datetime): "YYYY-MM-DD", optionally followed by "HH:MM[:SS]", or a date object.
+    - end (bool): If the value has no time, return the end of that day instead of its start.
+
+    Returns:
+    - numpy.datetime64: The bound in seconds.
+
+    Raises:
+    - ValueError: If a string isn't a date in one of the supported formats.
+    """
+    if isinstance(value, str):
+        text = value.strip().replace('T', ' ')
+        for date_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%Y:%m:%d"):
+            try:
+                value = datetime.strptime(text, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD")
+        if len(text) <= 10:
+            value = value.date()
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.min.time())
+        if end:
+            value += timedelta(days=1) - timedelta(seconds=1)
+    return np.datetime64(value, 's')
+
+
+class MetadataQuery:
+    """
+    Conditions on the capture time, device and location of images. Images missing a value that
+    a condition is set for don't match it.
+    """
+
+    def __init__(self, date_from=None, date_to=None, devices=(), near=None, radius_km=DEFAULT_RADIUS_KM, bbox=None):
+        """
+        Parameters:
+        - date_from (str, date or datetime, optional): Earliest capture time, see `parse_query_time`.
+        - date_to (str, date or datetime, optional): Latest capture time. A date includes that whole day.
+        - devices (iterable): Text to look for in the device name (make and model), case insensitive.
+          An image matches if any of them is found.
+        - near (tuple, optional): (latitude, longitude) the image must have been taken near.
+        - radius_km (float): Distance from `near` in kilometres.
+        - bbox (tuple, optional): (south, west, north, east) bounds in decimal degrees. West may be
+          greater than east for boxes that cross the antimeridian.
+
+        Raises:
+        - ValueError: If a date, coordinate or the radius is invalid.
+        """
+        self.date_from = parse_query_time(date_from) if date_from else None
+        self.date_to = parse_query_time(date_to, end=True) if date_to else None
+        self.devices = [device.lower() for device in devices if device]
+        self.near = None
+        self.radius_km = float(radius_km)
+        self.bbox = None
+        if near is not None:
+            latitude, longitude = (float(value) for value in near)
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise ValueError(f"Invalid location {latitude}, {longitude}")
+            if not self.radius_km > 0:
+                raise ValueError(f"Invalid radius {radius_km}, it must be above 0 km")
+            self.near = (latitude, longitude)
+        if bbox is not None:
+            south, west, north, east = (float(value) for value in bbox)
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+                raise ValueError(f"Invalid bounding box {south}, {west}, {north}, {east}")
+            self.bbox = (south, west, north, east)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Build a query from space separated conditions, as typed in the GUI:
+        "from:2021-06-01 to:2021-06-30 device:pixel near:52.37,4.89,5 bbox:52.3,4.8,52.4,5.0".
+        near takes latitude, longitude and an optional radius in km. device may be repeated.
+
+        Returns:
+        - MetadataQuery: The query, with no conditions if the text is empty.
+
+        Raises:
+        - ValueError: If a condition is unknown or its value is invalid.
+        """
+        options = {"devices": []}
+        for term in text.split():
+            name, _, value = term.partition(':')
+            name = name.lower()
+            if not value:
+                raise ValueError(f"Missing value in '{term}'")
+            if name == 'from':
+                options["date_from"] = value
+            elif name == 'to':
+                options["date_to"] = value
+            elif name == 'device':
+                options["devices"].append(value)
+            elif name in ('near', 'bbox'):
+                try:
+                    numbers = [float(number) for number in value.split(',')]
+                except ValueError:
+                    raise ValueError(f"Invalid coordinates in '{term}'")
+                if name == 'bbox' and len(numbers) == 4:
+                    options["bbox"] = numbers
+                elif name == 'near' and len(numbers) in (2, 3):
+                    options["near"] = numbers[:2]
+                    if len(numbers) == 3:
+                        options["radius_km"] = numbers[2]
+                else:
+                    raise ValueError(f"Wrong number of coordinates in '{term}'")
+            else:
+                raise ValueError(f"Unknown filter '{name}', expected from, to, device, near or bbox")
+        return cls(**options)
+
+    def __bool__(self):
+        return bool(self.date_from is not None or self.date_to is not None or self.devices or self.near or self.bbox)
+
+    def __str__(self):
+        conditions = []
+        if self.date_from is not None:
+            conditions.append(f"from {self.date_from}")
+        if self.date_to is not None:
+            conditions.append(f"to {self.date_to}")
+        if self.devices:
+            conditions.append("device " + " or ".join(self.devices))
+        if self.near:
+            conditions.append(f"within {self.radius_km:g} km of {self.near[0]:g}, {self.near[1]:g}")
+        if self.bbox:
+            conditions.append("inside {:g}, {:g}, {:g}, {:g}".format(*self.bbox))
+        return ", ".join(conditions) or "no conditions"
+
+    def regions(self):
+        """
+        Return the (south, west, north, east) boxes an image has to lie in, one per geographic
+        condition. The box of `near` encloses its circle, exact distances are checked afterwards.
+        """
+        regions = []
+        if self.near:
+            latitude, longitude = self.near
+            lat_delta = self.radius_km / KM_PER_DEGREE
+            south, north = max(-90.0, latitude - lat_delta), min(90.0, latitude + lat_delta)
+            cos_lat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+            if south == -90.0 or north == 90.0 or self.radius_km >= cos_lat * KM_PER_DEGREE * 180:
+                west, east = -180.0, 180.0  # The circle covers a pole or every longitude
+            else:
+                lon_delta = self.radius_km / (KM_PER_DEGREE * cos_lat)
+                west = (longitude - lon_delta + 180) % 360 - 180
+                east = (longitude + lon_delta + 180) % 360 - 180
+            regions.append((south, west, north, east))
+        if self.bbox:
+            regions.append(self.bbox)
+        return regions
+
+    def matches_location(self, latitudes, longitudes):
+        """
+        Check positions against the geographic conditions.
+
+        Parameters:
+        - latitudes, longitudes (numpy.ndarray): Positions in decimal degrees, NaN if unknown.
+
+        Returns:
+        - numpy.ndarray: True for the positions meeting every geographic condition.
+        """
+        keep = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        if self.near:
+            with np.errstate(invalid='ignore'):
+                keep &= haversine_km(self.near[0], self.near[1], latitudes, longitudes) <= self.radius_km
+        if self.bbox:
+            south, west, north, east = self.bbox
+            with np.errstate(invalid='ignore'):
+                keep &= (latitudes >= south) & (latitudes <= north)
+                if west <= east:
+                    keep &= (longitudes >= west) & (longitudes <= east)
+                else:
+                    keep &= (longitudes >= west) | (longitudes <= east)
+        return keep
+
+    def matches_device(self, device):
+        """Return True if the device name meets the device condition."""
+        if not self.devices:
+            return True
+        device = device.lower()
+        return any(text in device for text in self.devices)
+
+    def matches_entry(self, face_entry):
+        """
+        Check a single face_data entry against the query. Its EXIF data must have been resolved.
+
+        Parameters:
+        - face_entry (dict): The face_data entry.
+
+        Returns:
+        - bool: True if the image meets every condition.
+        """
+        captured, device, latitude, longitude = image_metadata(face_entry.get("exif_data"))
+        if self.date_from is not None or self.date_to is not None:
+            if np.isnat(captured):
+                return False
+            if self.date_from is not None and captured < self.date_from:
+                return False
+            if self.date_to is not None and captured > self.date_to:
+                return False
+        if not self.matches_device(device):
+            return False
+        if self.near or self.bbox:
+            return bool(self.matches_location(np.array([latitude]), np.array([longitude]))[0])
+        return True
+
+
+class MetadataIndex:
+    """
+    Capture time, device and location columns of the images of face_data, one row per image in
+    the order the images were added, which is face_data order.
+
+    Removed images stay in place as dead rows that selections skip, so the sorted columns don't
+    have to be rebuilt. An image that is added again gets a new row.
+    """
+
+    def __init__(self, face_data=None):
+        """
+        Build the index. The EXIF data of the entries must have been resolved, e.g. with
+        `resolve_exif_data`; entries without it are indexed as having no metadata.
+
+        Parameters:
+        - face_data (dict, optional): Face data entries by img_hash.
+        """
+        self.img_hashes = []
+        self.rows_by_hash = {}  # img_hash -> row of the images that haven't been removed
+        self.live = np.empty(0, dtype=bool)
+        self.capture_times = np.empty(0, dtype='datetime64[s]')
+        self.device_codes = np.empty(0, dtype=np.int32)
+        self.latitudes = np.empty(0, dtype=np.float64)
+        self.longitudes = np.empty(0, dtype=np.float64)
+        self.device_names = []
+        self.codes_by_device = {}
+        # Rows with a capture time, in time order
+        self.time_order = np.empty(0, dtype=np.int64)
+        self.sorted_times = np.empty(0, dtype='datetime64[s]')
+        # Rows with a position, in grid cell order
+        self.cell_order = np.empty(0, dtype=np.int64)
+        self.sorted_cells = np.empty(0, dtype=np.int64)
+        if face_data:
+            self.add(face_data)
+
+    def __len__(self):
+        return len(self.rows_by_hash)
+
+    def __contains__(self, img_hash):
+        return img_hash in self.rows_by_hash
+
+    def add(self, face_data):
+        """
+        Index images. Images that are already indexed are skipped, since an image's metadata is
+        fixed by the content it was hashed from.
+
+        Parameters:
+        - face_data (dict): Face data entries by img_hash, with their EXIF data resolved.
+        """
+        entries = [(img_hash, face_entry) for img_hash, face_entry in face_data.items() if img_hash not in self.rows_by_hash]
+        if not entries:
+            return
+        start = len(self.img_hashes)
+        count = len(entries)
+        capture_times = np.empty(count, dtype='datetime64[s]')
+        device_codes = np.empty(count, dtype=np.int32)
+        latitudes = np.empty(count, dtype=np.float64)
+        longitudes = np.empty(count, dtype=np.float64)
+        for n, (img_hash, face_entry) in enumerate(entries):
+            captured, device, latitude, longitude = image_metadata(face_entry.get("exif_data"))
+            capture_times[n] = captured
+            if device:
+                if device not in self.codes_by_device:
+                    self.codes_by_device[device] = len(self.device_names)
+                    self.device_names.append(device)
+                device_codes[n] = self.codes_by_device[device]
+            else:
+                device_codes[n] = NO_DEVICE
+            latitudes[n] = latitude
+            longitudes[n] = longitude
+            self.img_hashes.append(img_hash)
+            self.rows_by_hash[img_hash] = start + n
+
+        self.live = np.concatenate([self.live, np.ones(count, dtype=bool)])
+        self.capture_times = np.concatenate([self.capture_times, capture_times])
+        self.device_codes = np.concatenate([self.device_codes, device_codes])
+        self.latitudes = np.concatenate([self.latitudes, latitudes])
+        self.longitudes = np.concatenate([self.longitudes, longitudes])
+
+        # The new rows are merged into the sorted columns after the rows with equal keys
+        rows = np.arange(start, start + count)
+        dated = rows[~np.isnat(capture_times)]
+        dated = dated[np.argsort(self.capture_times[dated], kind='stable')]
+        positions = np.searchsorted(self.sorted_times, self.capture_times[dated], side='right')
+        self.time_order = np.insert(self.time_order, positions, dated)
+        self.sorted_times = np.insert(self.sorted_times, positions, self.capture_times[dated])
+
+        located = rows[~(np.isnan(latitudes) | np.isnan(longitudes))]
+        cells = self._cells(self.latitudes[located], self.longitudes[located])
+        order = np.argsort(cells, kind='stable')
+        positions = np.searchsorted(self.sorted_cells, cells[order], side='right')
+        self.cell_order = np.insert(self.cell_order, positions, located[order])
+        self.sorted_cells = np.insert(self.sorted_cells, positions, cells[order])
+
+    def remove(self, img_hashes):
+        """
+        Remove images from the index, e.g. those whose files were deleted.
+
+        Parameters:
+        - img_hashes (iterable): Hashes of the images. Images that aren't indexed are ignored.
+        """
+        for img_hash in img_hashes:
+            row = self.rows_by_hash.pop(img_hash, None)
+            if row is not None:
+                self.live[row] = False
+
+    @staticmethod
+    def _cell_row(latitudes):
+        return np.clip(np.floor((np.asarray(latitudes) + 90) / GRID_CELL_DEG), 0, 180 / GRID_CELL_DEG - 1).astype(np.int64)
+
+    @staticmethod
+    def _cell_column(longitudes):
+        return np.clip(np.floor((np.asarray(longitudes) + 180) / GRID_CELL_DEG), 0, GRID_COLUMNS - 1).astype(np.int64)
+
+    def _cells(self, latitudes, longitudes):
+        """Return the grid cell number of positions."""
+        return self._cell_row(latitudes) * GRID_COLUMNS + self._cell_column(longitudes)
+
+    def _rows_in_period(self, query):
+        """Return the rows captured within the query's dates, in time order."""
+        start = 0
+        stop = len(self.sorted_times)
+        if query.date_from is not None:
+            start = np.searchsorted(self.sorted_times, query.date_from, side='left')
+        if query.date_to is not None:
+            stop = np.searchsorted(self.sorted_times, query.date_to, side='right')
+        return self.time_order[start:max(start, stop)]
+
+    def _rows_in_region(self, region):
+        """Return the located rows in the grid cells overlapping a (south, west, north, east) box."""
+        south, west, north, east = region
+        first_row, last_row = self._cell_row([south, north])
+        if west <= east:
+            column_ranges = [tuple(self._cell_column([west, east]))]
+        else:
+            column_ranges = [(self._cell_column(west), GRID_COLUMNS - 1), (0, self._cell_column(east))]
+        # Each run of cells in one grid row is one contiguous slice of the sorted cells
+        starts = []
+        stops = []
+        for cell_row in range(int(first_row), int(last_row) + 1):
+            for first_column, last_column in column_ranges:
+                starts.append(cell_row * GRID_COLUMNS + first_column)
+                stops.append(cell_row * GRID_COLUMNS + last_column)
+        starts = np.searchsorted(self.sorted_cells, starts, side='left')
+        stops = np.searchsorted(self.sorted_cells, stops, side='right')
+        slices = [self.cell_order[start:stop] for start, stop in zip(starts, stops) if stop > start]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def select_rows(self, query, img_hashes=None):
+        """
+        Find the images meeting a query.
+
+        Parameters:
+        - query (MetadataQuery): The conditions.
+        - img_hashes (iterable, optional): Only consider these images, e.g. the ones just added.
+          Their rows are checked directly instead of through the sorted columns.
+
+        Returns:
+        - numpy.ndarray: Sorted row numbers of the matching images.
+        """
+        if img_hashes is not None:
+            rows = np.array(sorted(self.rows_by_hash[img_hash] for img_hash in img_hashes if img_hash in self.rows_by_hash),
+                            dtype=np.int64)
+            if query.date_from is not None or query.date_to is not None:
+                captured = self.capture_times[rows]
+                keep = ~np.isnat(captured)
+                if query.date_from is not None:
+                    keep &= captured >= query.date_from
+                if query.date_to is not None:
+                    keep &= captured <= query.date_to
+                rows = rows[keep]
+        else:
+            rows = None
+            if query.date_from is not None or query.date_to is not None:
+                rows = self._rows_in_period(query)
+            for region in query.regions():
+                region_rows = self._rows_in_region(region)
+                rows = region_rows if rows is None else np.intersect1d(rows, region_rows, assume_unique=True)
+            rows = np.flatnonzero(self.live) if rows is None else np.unique(rows)
+            rows = rows[self.live[rows]]
+
+        if query.devices:
+            codes = [code for code, name in enumerate(self.device_names) if query.matches_device(name)]
+            rows = rows[np.isin(self.device_codes[rows], codes)]
+        if query.near or query.bbox:
+            rows = rows[query.matches_location(self.latitudes[rows], self.longitudes[rows])]
+        return rows
+
+    def select(self, query, img_hashes=None):
+        """
+        Find the images meeting a query.
+
+        Parameters:
+        - query (MetadataQuery): The conditions.
+        - img_hashes (iterable, optional): Only consider these images.
+
+        Returns:
+        - list: img_hash of the matching images, in face_data order.
+        """
+        return [self.img_hashes[row] for row in self.select_rows(query, img_hashes)]
+
+
+def build_metadata_index(face_data, exif_cache=None):
+    """
+    Index the metadata of face_data, reading the EXIF data its entries don't have yet.
+
+    Parameters:
+    - face_data (dict): Face data entries by img_hash. Their EXIF data is filled in.
+    - exif_cache (ExifCache, optional): Cache of parsed EXIF data.
+
+    Returns:
+    - MetadataIndex: The index, to be kept in step with face_data by the caller.
+    """
+    resolve_exif_data(face_data, exif_cache)
+    with metrics.timer("metadata_filter"):
+        return MetadataIndex(face_data)
+
+
+def select_candidates(face_data, query, exif_cache=None, metadata_index=None):
+    """
+    Find the images of face_data meeting a query.
+
+    Parameters:
+    - face_data (dict): Face data entries by img_hash.
+    - query (MetadataQuery): The conditions.
+    - exif_cache (ExifCache, optional): Cache of parsed EXIF data, used to build the index.
+    - metadata_index (MetadataIndex, optional): Index of face_data from an earlier search. Built
+      with `build_metadata_index` if not given, which fills in the EXIF data of face_data.
+
+    Returns:
+    - list: img_hash of the matching images, in face_data order.
+    """
+    if metadata_index is None:
+        metadata_index = build_metadata_index(face_data, exif_cache)
+    with metrics.timer("metadata_filter"):
+        candidates = metadata_index.select(query)
+    if is_verbose(NORMAL):
+        print(f"Metadata filter ({query}) kept {len(candidates)} of {len(face_data)} images")
+    return candidates
@@ -0,0 +1,223 @@
+'''
+@file model_registry.py
+Lazily constructed, thread-safe registry of the face detection and embedding models.
+
+Importing this module does not import TensorFlow. Each model is built the first time it is
+requested, exactly once, even when several threads ask for it at the same time.
+
+The active inference backend decides whether the Keras models or their quantised TFLite exports
+are handed out (see `inference_backends`).
+'''
+
+import time
+import logging
+import threading
+from functools import partial
+from inference_backends import (INFERENCE_BACKENDS, KERAS_BACKEND, DEFAULT_INFERENCE_BACKEND, DEFAULT_MODEL_DIR,
+                                build_tflite_face_detector, build_tflite_resnet, inference_version)
+
+logger = logging.getLogger()
+
+MTCNN_MODEL = "mtcnn"
+RESNET_MODEL = "resnet152"
+
+
+class ModelRegistry:
+    """
+    Builds named models on first use and hands out the same instance afterwards.
+
+    Every model has its own lock, so a thread loading ResNet does not hold up one that
+    only needs the MTCNN detector.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._models = {}
+        self._locks = {}
+        self._load_times = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name, factory):
+        """
+        Register a factory that builds a model.
+
+        Parameters:
+        - name (str): Name of the model.
+        - factory (callable): Function without arguments returning the model.
+        """
+        with self._registry_lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        """
+        Return a model, building it first if this is the first request.
+
+        Parameters:
+        - name (str): Name of the model.
+
+        Returns:
+        - object: The model instance.
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._locks[name]:
+            # Another thread may have finished loading while this one waited
+            model = self._models.get(name)
+            if model is None:
+                start = time.perf_counter()
+                model = self._factories[name]()
+                self._load_times[name] = time.perf_counter() - start
+                logger.info(f"Loaded {name} in {self._load_times[name]:.2f}s")
+                self._models[name] = model
+        return model
+
+    def is_loaded(self, name):
+        """Return True if the model has already been built."""
+        return name in self._models
+
+    def load_times(self):
+        """Return the seconds each loaded model took to build."""
+        return dict(self._load_times)
+
+    def warm_up(self, names=None):
+        """
+        Build models ahead of their first use.
+
+        Parameters:
+        - names (list, optional): Models to build. Defaults to the models of the active inference backend.
+        """
+        for name in names or active_model_names():
+            try:
+                self.get(name)
+            except Exception:
+                logger.exception(f"Failed to warm up {name}")
+
+    def warm_up_in_background(self, names=None):
+        """
+        Build models on a daemon thread so they are ready by the time they are needed.
+
+        Parameters:
+        - names (list, optional): Models to build. Defaults to the models of the active inference backend.
+
+        Returns:
+        - threading.Thread: The started warm-up thread.
+        """
+        thread = threading.Thread(target=self.warm_up, args=(names,), name="model-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+
+def build_face_detector():
+    """
+    Build the MTCNN face detector.
+    """
+    print("Loading MTCNN Face Recognition...")
+    from mtcnn import MTCNN
+    face_detector = MTCNN()
+    print("MTCNN Face Recognition loaded.")
+    return face_detector
+
+
+def build_resnet_model():
+    """
+    Build the ResNet152 feature extractor, without its classification head.
+    """
+    print("Initialising Resnet models...")
+    from tensorflow.keras.applications.resnet import ResNet152
+    resnet_model = ResNet152(weights='imagenet', include_top=False)
+    print('Resnet models initialized successfully.')
+    return resnet_model
+
+
+# Backend whose models `get_face_detector` and `get_resnet_model` hand out
+_active_backend = DEFAULT_INFERENCE_BACKEND
+_model_dir = DEFAULT_MODEL_DIR
+_num_threads = None
+_inference_version = None
+
+
+def model_name(name, backend=None):
+    """
+    Return the registry name of a model for an inference backend.
+
+    Parameters:
+    - name (str): `MTCNN_MODEL` or `RESNET_MODEL`.
+    - backend (str, optional): Defaults to the active backend.
+    """
+    backend = backend or _active_backend
+    return name if backend == KERAS_BACKEND else f"{name}:{backend}"
+
+
+def active_model_names():
+    """Return the registry names of the active backend's models."""
+    return [model_name(MTCNN_MODEL), model_name(RESNET_MODEL)]
+
+
+def get_inference_backend():
+    """Return the active inference backend."""
+    return _active_backend
+
+
+def get_inference_version():
+    """
+    Return the `inference_version` of the active backend, stored with the vectors its models produce.
+    """
+    global _inference_version
+    if _inference_version is None:
+        _inference_version = inference_version(_active_backend, _model_dir)
+    return _inference_version
+
+
+def get_model_dir():
+    """Return the folder the TFLite models are exported to and loaded from."""
+    return _model_dir
+
+
+def set_inference_backend(backend, model_dir=None, num_threads=None):
+    """
+    Make a backend the one whose models are used from now on. Models of the previous backend
+    that were already loaded stay in the registry.
+
+    Parameters:
+    - backend (str): One of `INFERENCE_BACKENDS`.
+    - model_dir (str, optional): Folder the TFLite models are exported to and loaded from.
+    - num_threads (int, optional): Threads per TFLite interpreter. Defaults to one per CPU.
+    """
+    global _active_backend, _model_dir, _num_threads, _inference_version
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Choose from: {', '.join(INFERENCE_BACKENDS)}")
+    logger.info(f"Using inference backend {backend}")
+    _active_backend = backend
+    _model_dir = model_dir or DEFAULT_MODEL_DIR
+    _num_threads = num_threads
+    _inference_version = None
+
+
+def _build_tflite_model(builder, backend):
+    """Build a TFLite model with the model folder and thread count current at load time."""
+    return builder(backend, _model_dir, _num_threads)
+
+
+registry = ModelRegistry()
+registry.register(MTCNN_MODEL, build_face_detector)
+registry.register(RESNET_MODEL, build_resnet_model)
+for _backend in INFERENCE_BACKENDS:
+    if _backend != KERAS_BACKEND:
+        registry.register(model_name(MTCNN_MODEL, _backend), partial(_build_tflite_model, build_tflite_face_detector, _backend))
+        registry.register(model_name(RESNET_MODEL, _backend), partial(_build_tflite_model, build_tflite_resnet, _backend))
+
+
+def get_face_detector():
+    """Return the shared MTCNN face detector of the active backend, loading it on first use."""
+    return registry.get(model_name(MTCNN_MODEL))
+
+
+def get_resnet_model():
+    """
+    Return the shared ResNet152 model of the active backend, loading it on first use. Every
+    backend's model has a Keras style `predict_on_batch`.
+    """
+    return registry.get(model_name(RESNET_MODEL))
@@ -0,0 +1,200 @@
+'''
+@file parallel_pipeline.py
+Multi-process face detection feeding a single batched embedding stage.
+
+The calling process reads and hashes each image and decides, in folder order, whether it needs
+detection at all (see `triage_image`). Worker processes each build their own MTCNN detector and
+take care of decoding, EXIF parsing, detection and alignment of the images that do. The calling
+process receives the results in folder order and runs the batched ResNet embedding, the crop
+writing and the embedding store updates, so the output does not depend on the number of workers.
+'''
+
+import os
+import time
+import logging
+import multiprocessing
+from collections import deque
+from face_detection import (EMBEDDING_BATCH_SIZE, FaceIngestQueue, iter_image_paths, is_valid_image_extension,
+                            extract_aligned_faces, print_detections, triage_image, detect_faces_in_image,
+                            print_detection_timing, record_detection_timing, discovery_manifest_path)
+from model_registry import get_face_detector, get_inference_backend, get_model_dir, set_inference_backend
+from inference_backends import KERAS_BACKEND, ensure_mtcnn_exported
+from image_loader import ImageBuffer
+from crop_writer import DEFAULT_CROP_FORMAT
+from console_verbosity import DEFAULT_VERBOSITY, get_verbosity, set_verbosity
+
+logger = logging.getLogger()
+
+# MTCNN detector owned by a worker process
+_worker_detector = None
+
+
+def default_worker_count():
+    """
+    Number of detection workers to use by default: one per CPU, leaving one for embedding.
+    """
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def init_detection_worker(inference_backend=KERAS_BACKEND, model_dir=None, verbosity=DEFAULT_VERBOSITY):
+    """
+    Initialise a worker process with its own single-threaded MTCNN detector.
+
+    No log file is configured here: the debug log belongs to the main process, which configured it
+    in its entry point, and a worker opening it again would truncate it.
+
+    Parameters:
+    - inference_backend (str): Inference backend of the calling process.
+    - model_dir (str, optional): Folder of the calling process's TFLite models.
+    - verbosity (int or str): Console verbosity of the calling process.
+    """
+    global _worker_detector
+    set_verbosity(verbosity)
+    set_inference_backend(inference_backend, model_dir, num_threads=1)
+    try:
+        # Workers run side by side, so each one should only use a single core
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(1)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except Exception:
+        logger.exception("Could not limit TensorFlow threads in detection worker")
+
+    _worker_detector = get_face_detector()
+
+
+def detect_image(image_path, image_data, detection_max_edge=None):
+    """
+    Decode an image and detect and align its faces. Runs in a worker process.
+
+    Parameters:
+    - image_path (str): Path of the image.
+    - image_data (bytes): Contents of the image file, as read by the calling process.
+    - detection_max_edge (int, optional): Longest edge of the image passed to the detector.
+
+    Returns:
+    - dict: The detections, aligned face crops and detection timing, or an error message.
+    """
+    result = {"image_path": image_path, "error": None}
+    try:
+        image = ImageBuffer(image_path, image_data)
+        img, result["detected_faces"], result["timing"] = detect_faces_in_image(image, _worker_detector,
+                                                                                detection_max_edge)
+        # Timed here for the calling process's metrics, which this process can't update
+        start = time.perf_counter()
+        result["crops"] = extract_aligned_faces(img, result["detected_faces"])
+        result["timing"].update(align_s=time.perf_counter() - start, faces=len(result["detected_faces"]))
+    except Exception as e:
+        logger.exception(f"Error detecting faces in {image_path}")
+        result["error"] = str(e)
+    return result
+
+
+def iter_faces_from_folder_parallel(folder_path, output_folder, cancel_flag=None, store=None, batch_size=EMBEDDING_BATCH_SIZE,
+                                    face_index=None, workers=None, image_paths=None, detection_max_edge=None,
+                                    near_duplicate_distance=None, crop_format=DEFAULT_CROP_FORMAT, crop_quality=None, discovery_manifest=False):
+    """
+    Detect, embed and save faces using a pool of detection processes, yielding each image's result
+    as soon as it is ready. Takes the same arguments and yields the same results, in the same
+    order, as `iter_faces_from_folder`.
+
+    Parameters:
+    - workers (int, optional): Number of detection processes. Defaults to `default_worker_count()`.
+    """
+    workers = workers or default_worker_count()
+    queue = FaceIngestQueue(output_folder, batch_size=batch_size, store=store, face_index=face_index,
+                            near_duplicate_distance=near_duplicate_distance, crop_format=crop_format,
+                            crop_quality=crop_quality)
+    if image_paths is None:
+        image_paths = iter_image_paths(folder_path, discovery_manifest_path(output_folder, discovery_manifest))
+
+    # Images waiting for their detection results, in folder order
+    in_flight = deque()
+    max_in_flight = workers * 4
+    pool = None
+    cancelled = False
+
+    def submit(idx, image_path):
+        """Start detection of an image unless it is known, a duplicate or a near duplicate."""
+        nonlocal pool
+        logger.debug(f'Processing image {idx}: {os.path.basename(image_path)}')
+
+        # Triage runs here in folder order so only new images reach the workers, and the first
+        # of several copies is the one detected, exactly as in a sequential run
+        try:
+            triage = triage_image(queue, store, image_path, output_folder)
+        except Exception as e:
+            logger.exception(f"Error reading image {image_path}: {str(e)}")
+            return idx, image_path, None, None
+        if triage["action"] != "detect":
+            return idx, image_path, triage, None
+
+        if pool is None:
+            # Spawned workers don't inherit the TensorFlow runtime of this process
+            context = multiprocessing.get_context('spawn')
+            backend = get_inference_backend()
+            if backend != KERAS_BACKEND:
+                # Exported once here rather than by every worker at the same time
+                ensure_mtcnn_exported(backend, get_model_dir())
+            pool = context.Pool(processes=workers, initializer=init_detection_worker,
+                                initargs=(backend, get_model_dir(), get_verbosity()))
+        # The bytes already read for hashing are handed over so the file isn't read twice
+        image = triage.pop("image")
+        return idx, image_path, triage, pool.apply_async(detect_image, (image_path, image.data, detection_max_edge))
+
+    def handle_next():
+        """Pass the oldest in-flight image on to the ingest queue."""
+        idx, image_path, triage, async_result = in_flight.popleft()
+        image_name = os.path.basename(image_path)
+
+        if triage is None:
+            queue.add_skipped(idx, image_path)
+            return
+        if async_result is None:
+            queue.add_triaged(idx, image_path, triage)
+            return
+
+        result = async_result.get()
+        if result["error"] is not None:
+            queue.add_skipped(idx, image_path)
+            return
+
+        record_detection_timing(result["timing"])
+        print_detections(image_name, result["detected_faces"])
+        print_detection_timing(image_name, result["timing"])
+        queue.add_detected(idx, image_path, triage["img_hash"], triage["file_stat"], result["detected_faces"],
+                           result["crops"], triage["fingerprint"])
+
+    try:
+        for idx, image_path in enumerate(image_paths, start=1):
+            # Check if processing should be cancelled
+            if cancel_flag and cancel_flag():
+                cancelled = True
+                break
+
+            if not is_valid_image_extension(image_path):
+                logger.warning(f"{image_path} does not have a valid image extension. Skipping.")
+                in_flight.append((idx, image_path, None, None))
+            else:
+                in_flight.append(submit(idx, image_path))
+
+            # Hand over finished images in order, and wait for the oldest once enough are in flight
+            while in_flight and (len(in_flight) > max_in_flight or in_flight[0][3] is None or in_flight[0][3].ready()):
+                handle_next()
+                yield from queue.drain()
+
+        while in_flight and not cancelled:
+            if cancel_flag and cancel_flag():
+                cancelled = True
+                break
+            handle_next()
+            yield from queue.drain()
+    finally:
+        if pool is not None:
+            if cancelled or in_flight:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    # Embed whatever is still queued, including after a cancellation
+    yield from queue.finish()
@@ -0,0 +1,126 @@
+'''
+@file perceptual_hash.py
+Perceptual image hashes and a Hamming distance index to recognise resized or re-encoded copies.
+'''
+
+import cv2
+import numpy as np
+
+# Bits per side of the difference hash, giving a 64 bit hash
+DHASH_SIZE = 8
+
+# Largest relative difference in aspect ratio between an image and a near duplicate of it
+MAX_ASPECT_DIFFERENCE = 0.02
+
+
+def dhash(gray_img, hash_size=DHASH_SIZE):
+    """
+    Compute the difference hash of a grayscale image: one bit per horizontally adjacent pair of
+    pixels of a (hash_size + 1) x hash_size thumbnail, set where brightness increases.
+
+    Parameters:
+    - gray_img (numpy.ndarray): Grayscale image.
+    - hash_size (int): Number of bits per row and number of rows.
+
+    Returns:
+    - int: The hash as an unsigned integer.
+    """
+    thumbnail = cv2.resize(gray_img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def image_fingerprint(image):
+    """
+    Compute the perceptual hash and size of an image from its file contents.
+
+    Parameters:
+    - image (ImageBuffer): The image file contents.
+
+    Returns:
+    - dict or None: {"dhash": int, "image_size": (width, height)}, or None if the image can't be decoded.
+    """
+    # A heavily reduced grayscale decode is plenty for a 9x8 thumbnail
+    flags = cv2.IMREAD_REDUCED_GRAYSCALE_8 if image.path.lower().endswith(('.jpg', '.jpeg')) else cv2.IMREAD_GRAYSCALE
+    gray_img = image.decode(flags)
+    if gray_img is None:
+        return None
+    image_size = image.header_size() or (gray_img.shape[1], gray_img.shape[0])
+    # The header size ignores EXIF rotation, which the decoder applies
+    if (image_size[0] > image_size[1]) != (gray_img.shape[1] > gray_img.shape[0]):
+        image_size = (image_size[1], image_size[0])
+    return {"dhash": dhash(gray_img), "image_size": tuple(image_size)}
+
+
+def hamming(a, b):
+    """Return the number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+def similar_aspect(size_a, size_b):
+    """Return True if two (width, height) sizes have nearly the same aspect ratio."""
+    ratio_a = size_a[0] / max(1, size_a[1])
+    ratio_b = size_b[0] / max(1, size_b[1])
+    return abs(ratio_a - ratio_b) <= MAX_ASPECT_DIFFERENCE * max(ratio_a, ratio_b)
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes with Hamming distance, answering "every hash within
+    distance d" queries without comparing against every stored hash.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash_value, value):
+        """
+        Insert a hash with an associated value.
+
+        Parameters:
+        - hash_value (int): The hash.
+        - value: Value returned by `search`, e.g. an image hash and size.
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [hash_value, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, value, {}]
+                return
+            node = child
+
+    def search(self, hash_value, max_distance):
+        """
+        Find every stored hash within `max_distance` bits of the given one.
+
+        Parameters:
+        - hash_value (int): The hash to look up.
+        - max_distance (int): Largest Hamming distance to return.
+
+        Returns:
+        - list: (distance, value) pairs, closest first.
+        """
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(hash_value, node[0])
+            if distance <= max_distance:
+                results.append((distance, node[1]))
+            # By the triangle inequality only children in this distance band can be close enough
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
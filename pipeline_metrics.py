@@ -0,0 +1,279 @@
+'''
+@file pipeline_metrics.py
+Per-stage counters, timers and latency histograms of the face pipeline.
+
+The pipeline records how long each stage takes (reading, hashing, store lookups, decoding, EXIF,
+MTCNN, alignment, ResNet, crop writing and matching) and counts what it did with every image. The
+figures are read live by the GUI's diagnostics panel and summarised at the end of a run, both in the
+log and, from the command line, as a JSON file.
+
+Collection is off unless enabled. When it is off, `record` and `count` return after one attribute
+check and `timer` hands out a shared do-nothing context manager, so the calls can stay in hot loops.
+Latencies go into fixed geometric histograms, so recording is O(1) and memory does not grow with
+the number of images.
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Stages in pipeline order, as listed in summaries
+STAGES = ("discovery", "read", "hash", "store_lookup", "decode", "exif", "detect", "align", "embed", "write", "metadata_filter", "match")
+
+# Latency histogram buckets grow by 25% from 10 µs, reaching about 2.5 minutes
+HISTOGRAM_MIN_S = 1e-5
+HISTOGRAM_RATIO = 1.25
+HISTOGRAM_BUCKETS = 75
+_LOG_RATIO = math.log(HISTOGRAM_RATIO)
+
+
+class LatencyHistogram:
+    """
+    Counts of latencies in geometric buckets. Percentiles are accurate to within a bucket, i.e. 25%.
+    """
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.total = 0
+
+    def add(self, seconds):
+        if seconds <= HISTOGRAM_MIN_S:
+            bucket = 0
+        else:
+            bucket = min(HISTOGRAM_BUCKETS - 1, int(math.log(seconds / HISTOGRAM_MIN_S) / _LOG_RATIO) + 1)
+        self.counts[bucket] += 1
+        self.total += 1
+
+    def percentile(self, q):
+        """
+        Return the latency below which a fraction `q` of the samples fall, in seconds.
+
+        Parameters:
+        - q (float): Fraction between 0 and 1, e.g. 0.95.
+
+        Returns:
+        - float or None: The geometric middle of the bucket holding the percentile, None without samples.
+        """
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return HISTOGRAM_MIN_S * HISTOGRAM_RATIO ** max(0, bucket - 0.5)
+        return HISTOGRAM_MIN_S * HISTOGRAM_RATIO ** (HISTOGRAM_BUCKETS - 1)
+
+
+class StageStats:
+    """Calls, items and time spent in one stage."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.total_s = 0.0
+        self.histogram = LatencyHistogram()
+
+    def summary(self, elapsed_s):
+        """Return the statistics as a dict, with latencies in milliseconds per call."""
+        p50, p95 = self.histogram.percentile(0.5), self.histogram.percentile(0.95)
+        return {"calls": self.calls, "items": self.items, "total_s": self.total_s,
+                "mean_ms": self.total_s / self.calls * 1000 if self.calls else None,
+                "p50_ms": p50 * 1000 if p50 is not None else None,
+                "p95_ms": p95 * 1000 if p95 is not None else None,
+                "items_per_s": self.items / self.total_s if self.total_s > 0 else None,
+                "share": self.total_s / elapsed_s if elapsed_s > 0 else None}
+
+
+class _StageTimer:
+    """Context manager timing one call of a stage."""
+
+    __slots__ = ("metrics", "stage", "items", "start")
+
+    def __init__(self, metrics, stage, items):
+        self.metrics = metrics
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.record(self.stage, time.perf_counter() - self.start, self.items)
+        return False
+
+
+class _NullTimer:
+    """Shared context manager used while collection is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of this process in MB, or None if it can't be determined.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 2**20
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+class PipelineMetrics:
+    """
+    Stage timings and counters of the current run. Safe to update from several threads.
+    """
+
+    def __init__(self, enabled=False):
+        """
+        Parameters:
+        - enabled (bool): Whether anything is recorded.
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded and start timing a new run."""
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.started = time.perf_counter()
+            self.finished = None
+
+    def finish(self):
+        """Stop the run clock, so throughputs are computed over the run only."""
+        self.finished = time.perf_counter()
+
+    def elapsed(self):
+        """Seconds since the run started, or its duration once finished."""
+        return (self.finished or time.perf_counter()) - self.started
+
+    def record(self, stage, seconds, items=1):
+        """
+        Record one call of a stage.
+
+        Parameters:
+        - stage (str): Name of the stage, usually one of `STAGES`.
+        - seconds (float): Time the call took.
+        - items (int): Images or faces the call processed.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.items += items
+            stats.total_s += seconds
+            stats.histogram.add(seconds)
+
+    def timer(self, stage, items=1):
+        """
+        Return a context manager recording the time spent in its block as one call of a stage.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage, items)
+
+    def count(self, name, n=1):
+        """Add `n` to a counter, e.g. of images restored from the store."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Return the figures of the run so far.
+
+        Returns:
+        - dict: Elapsed seconds, images and faces per second, peak RSS in MB, the counters, and for
+          every stage its calls, items, total seconds, mean/p50/p95 milliseconds per call, items
+          per second and share of the elapsed time.
+        """
+        elapsed = self.elapsed()
+        with self._lock:
+            counters = dict(self.counters)
+            order = [stage for stage in STAGES if stage in self.stages] + sorted(set(self.stages) - set(STAGES))
+            stages = {stage: self.stages[stage].summary(elapsed) for stage in order}
+        images, faces = counters.get("images", 0), counters.get("faces", 0)
+        return {"elapsed_s": elapsed, "images": images, "faces": faces,
+                "images_per_s": images / elapsed if elapsed > 0 else None,
+                "faces_per_s": faces / elapsed if elapsed > 0 else None,
+                "peak_rss_mb": peak_rss_mb(), "counters": counters, "stages": stages}
+
+    def log_summary(self, path=None):
+        """
+        Write the run summary to the log, and as JSON to `path` if given.
+
+        Returns:
+        - dict: The summary.
+        """
+        summary = self.summary()
+        logger.info(f"Run summary: {json.dumps(summary)}")
+        if path:
+            with open(path, 'w') as summary_file:
+                json.dump(summary, summary_file, indent=2)
+        return summary
+
+
+def format_summary(summary):
+    """
+    Return a run summary as a few lines of text.
+    """
+    peak = f", peak RSS {summary['peak_rss_mb']:.0f} MB" if summary["peak_rss_mb"] is not None else ""
+    lines = [f"{summary['images']} images, {summary['faces']} faces in {summary['elapsed_s']:.1f}s "
+             f"({summary['images_per_s'] or 0:.2f} images/s, {summary['faces_per_s'] or 0:.2f} faces/s{peak})"]
+    for stage, stats in summary["stages"].items():
+        lines.append(f"  {stage:12s} {stats['total_s']:8.2f}s  {stats['calls']:7d} calls  "
+                     f"p50 {stats['p50_ms'] or 0:8.2f} ms  p95 {stats['p95_ms'] or 0:8.2f} ms")
+    return "\n".join(lines)
+
+
+# Metrics of this process. FACE_MATCHER_METRICS=1 turns collection on from the start.
+metrics = PipelineMetrics(enabled=os.environ.get("FACE_MATCHER_METRICS") == "1")
+
+
+def set_metrics_enabled(enabled):
+    """Turn metric collection on or off."""
+    metrics.enabled = bool(enabled)
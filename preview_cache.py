@@ -0,0 +1,188 @@
+'''
+@file preview_cache.py
+Bounded cache of face crop previews, filled ahead of time for the rows next to the selected one.
+
+Browsing the results table shows one face crop per row. Decoding it on the GUI thread for every
+selection stutters when the output folder is on a network share, so previews are kept in an LRU
+cache of ready to draw QPixmaps and the crops of the neighbouring rows are decoded on background
+threads while the user looks at the current one.
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from PyQt6.QtCore import QObject, Qt, pyqtSignal
+from PyQt6.QtGui import QImage, QPixmap
+
+logger = logging.getLogger()
+
+# Edge of the square the previews are scaled into, as shown next to the search image
+PREVIEW_SIZE = 100
+DEFAULT_MAX_ENTRIES = 1024
+# Rows before and after the selected one whose crops are prefetched
+DEFAULT_PREFETCH_ROWS = 8
+PREFETCH_WORKERS = 2
+
+
+def load_preview_image(path, size=PREVIEW_SIZE):
+    """
+    Read a face crop and scale it for display. Safe to call from any thread.
+
+    Parameters:
+    - path (str): Path of the crop.
+    - size (int): Edge of the square the preview is scaled into.
+
+    Returns:
+    - QImage or None: The preview, or None if the crop could not be read.
+    """
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    height, width, _ = img.shape
+    # The copy owns its pixels, so the numpy buffer can be released
+    image = QImage(img.data, width, height, width * 3, QImage.Format.Format_RGB888).copy()
+    return image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+
+
+class PreviewCache(QObject):
+    """
+    LRU cache of face crop previews keyed by crop name.
+
+    `get` is called on the GUI thread and decodes the crop itself on a miss. `prefetch` decodes
+    crops on background threads; the decoded QImages are turned into QPixmaps on the GUI thread,
+    as QPixmaps may only be created there.
+    """
+    image_loaded = pyqtSignal(int, str, object)  # Generation, crop name and the QImage decoded by a prefetch
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, parent=None):
+        """
+        Parameters:
+        - max_entries (int): Number of previews kept.
+        - parent (QObject, optional): Parent object.
+        """
+        super().__init__(parent)
+        self.max_entries = max_entries
+        self.pixmaps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0  # Previews added by prefetching
+        self.prefetch_hits = 0  # Hits on previews that were prefetched and not yet shown
+        self._unshown = set()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._generation = 0  # Bumped by `clear`, so prefetches of an earlier search are dropped
+        self._executor = self._new_executor()
+        self.image_loaded.connect(self._on_image_loaded)
+
+    @staticmethod
+    def _new_executor():
+        return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="preview")
+
+    def _insert(self, crop_name, pixmap):
+        self.pixmaps[crop_name] = pixmap
+        self.pixmaps.move_to_end(crop_name)
+        while len(self.pixmaps) > self.max_entries:
+            evicted, _ = self.pixmaps.popitem(last=False)
+            self._unshown.discard(evicted)
+
+    def get(self, crop_name, path):
+        """
+        Return the preview of a crop, reading it now if it isn't cached.
+
+        Parameters:
+        - crop_name (str): Name of the crop.
+        - path (str): Path of the crop.
+
+        Returns:
+        - QPixmap or None: The preview, or None if the crop could not be read.
+        """
+        pixmap = self.pixmaps.get(crop_name)
+        if pixmap is not None:
+            self.hits += 1
+            if crop_name in self._unshown:
+                self._unshown.discard(crop_name)
+                self.prefetch_hits += 1
+            self.pixmaps.move_to_end(crop_name)
+            return pixmap
+
+        self.misses += 1
+        image = load_preview_image(path)
+        if image is None:
+            return None
+        pixmap = QPixmap.fromImage(image)
+        self._insert(crop_name, pixmap)
+        return pixmap
+
+    def prefetch(self, crops):
+        """
+        Decode crops in the background so a later `get` finds them cached.
+
+        Parameters:
+        - crops (list): (crop_name, path) pairs, most wanted first.
+        """
+        for crop_name, path in crops:
+            with self._lock:
+                if crop_name in self.pixmaps or crop_name in self._in_flight:
+                    continue
+                self._in_flight.add(crop_name)
+            self._executor.submit(self._load, self._generation, crop_name, path)
+
+    def _load(self, generation, crop_name, path):
+        try:
+            image = load_preview_image(path)
+        except Exception:
+            logger.exception(f"Could not prefetch the preview of {crop_name}")
+            image = None
+        # Delivered to the GUI thread, which owns the cache
+        self.image_loaded.emit(generation, crop_name, image)
+
+    def _on_image_loaded(self, generation, crop_name, image):
+        if generation != self._generation:
+            return
+        with self._lock:
+            self._in_flight.discard(crop_name)
+        if image is None or crop_name in self.pixmaps:
+            return
+        self._insert(crop_name, QPixmap.fromImage(image))
+        self._unshown.add(crop_name)
+        self.prefetched += 1
+
+    def clear(self):
+        """
+        Drop every preview and reset the statistics, e.g. for a new search. Prefetches still queued
+        are cancelled on a fresh set of threads, and those already running are ignored when they finish.
+        """
+        logger.debug(self.summary())
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+        with self._lock:
+            self._generation += 1
+            self._in_flight.clear()
+        self.pixmaps.clear()
+        self._unshown.clear()
+        self.hits = self.misses = self.prefetched = self.prefetch_hits = 0
+
+    def stats(self):
+        """
+        Return the cache statistics.
+
+        Returns:
+        - dict: Lookups, hits, misses, hit rate, previews prefetched, hits served by prefetching and entries cached.
+        """
+        lookups = self.hits + self.misses
+        return {"lookups": lookups, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "prefetched": self.prefetched,
+                "prefetch_hits": self.prefetch_hits, "entries": len(self.pixmaps)}
+
+    def summary(self):
+        """Return the statistics as one line of text."""
+        stats = self.stats()
+        return (f"Preview cache: {stats['hits']}/{stats['lookups']} hits ({stats['hit_rate'] * 100:.0f}%), "
+                f"{stats['prefetch_hits']} from {stats['prefetched']} prefetched, {stats['entries']} cached")
+
+    def shutdown(self):
+        """Stop the prefetch threads, cancelling queued prefetches. Called when the window closes."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,69 @@
+'''
+@file results_export.py
+Table rows for match results and CSV/JSON writers, shared by the GUI and the command line tools.
+'''
+
+import csv
+import json
+
+# Columns of the results table, in display order
+RESULT_COLUMNS = ['Match', 'Similarity', 'Tags', 'Original Image File', 'Latitude', 'Longitude', 'Device', 'Date', 'Time', 'Resized Image Name']
+
+
+def exif_columns(exif_data):
+    """
+    Pull the values shown in the results table out of an image's EXIF data.
+
+    Parameters:
+    - exif_data (dict or None): EXIF data as returned by `get_image_exif_data`, None if it hasn't
+      been read.
+
+    Returns:
+    - tuple: (latitude, longitude, device, date, time) as strings.
+    """
+    exif_data = exif_data or {}
+    latitude = exif_data.get('GPSInfo', {}).get('Latitude', '')
+    longitude = exif_data.get('GPSInfo', {}).get('Longitude', '')
+    device = f"{exif_data.get('Make', '')} {exif_data.get('Model', '')}".strip()
+    date = exif_data.get('DateDigitized', '')
+    time = exif_data.get('TimeDigitized', '')
+    return str(latitude), str(longitude), device, str(date), str(time)
+
+
+def match_row(i, match, face_data):
+    """
+    Build the text of a results table row for a matching face.
+
+    Parameters:
+    - i (int): Index of the row in the results table.
+    - match (tuple): Match tuple as returned by find_matching_face.
+    - face_data (dict): Mapping of image hash to face information.
+
+    Returns:
+    - list: One string per column of `RESULT_COLUMNS`. Tags are left empty.
+    """
+    img_hash, original_image_name, face_vector, similarity, resized_image_name = match
+    face_info = face_data.get(img_hash, {})
+    latitude, longitude, device, date, time = exif_columns(face_info.get('exif_data', {}))
+    return [f"Match {i + 1}", f"{similarity * 100:.2f}%", "", face_info.get('full_path', ''),
+            latitude, longitude, device, date, time, resized_image_name]
+
+
+def write_rows(path, columns, rows):
+    """
+    Write table rows to a CSV file, or to a JSON list of objects if the path ends in `.json`.
+
+    Parameters:
+    - path (str): Output file path.
+    - columns (list): Column headers.
+    - rows (list): Rows of values, one per column.
+    """
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as json_file:
+            json.dump([dict(zip(columns, row)) for row in rows], json_file, indent=2)
+        return
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(columns)
+        writer.writerows(rows)
@@ -0,0 +1,382 @@
+'''
+@file similarity_search.py
+Vectorised cosine similarity search over the face vectors stored in face_data.
+'''
+
+import heapq
+import logging
+import numpy as np
+from crop_writer import crop_name_for
+
+logger = logging.getLogger()
+
+# Largest difference expected between a float32 matrix product distance and the float64 cosine
+# distance of the same vectors. Faces closer than this to the threshold are decided in float64.
+BORDERLINE_DISTANCE = 1e-4
+
+
+def select_matches(distances, threshold=.75, top_k=None):
+    """
+    Pick the rows of a cosine distance array that count as matches.
+
+    Parameters:
+    - distances (numpy.ndarray): One cosine distance per matrix row, NaN for rows that cannot be scored.
+    - threshold (float): Maximum cosine distance for a face to count as a match.
+    - top_k (int, optional): Only return the `top_k` most similar faces, best first.
+
+    Returns:
+    - list: (row, cosine distance) pairs. Without `top_k` they are in row order.
+    """
+    with np.errstate(invalid='ignore'):
+        rows = np.flatnonzero(distances < threshold)
+
+    if top_k is not None and len(rows) > top_k:
+        best = np.argpartition(distances[rows], top_k - 1)[:top_k]
+        rows = rows[best]
+    if top_k is not None:
+        rows = rows[np.argsort(distances[rows], kind='stable')]
+
+    return [(int(row), float(distances[row])) for row in rows]
+
+
+def decide_borderline(distances, face_vector, threshold, stored_face):
+    """
+    Recompute in float64 the distances close enough to the threshold that float32 rounding
+    could put them on the wrong side of it.
+
+    Parameters:
+    - distances (numpy.ndarray): float64 cosine distances. Updated in place.
+    - face_vector (numpy.ndarray): The probe face vector.
+    - threshold (float): Maximum cosine distance for a face to count as a match.
+    - stored_face (callable): Returns the stored face vector a position of `distances` was scored against.
+    """
+    with np.errstate(invalid='ignore'):
+        borderline = np.flatnonzero(np.abs(distances - threshold) < BORDERLINE_DISTANCE)
+    if len(borderline) == 0:
+        return
+    probe = np.asarray(face_vector, dtype=np.float64).ravel()
+    probe /= np.linalg.norm(probe)
+    for r in borderline:
+        face = np.asarray(stored_face(r), dtype=np.float64).ravel()
+        distances[r] = 1 - (face @ probe) / np.linalg.norm(face)
+
+
+class FaceMatrix:
+    """
+    All stored face vectors packed into one contiguous, L2 normalised float32 matrix.
+
+    Row `r` of `matrix` holds face number `face_indices[r]` (0 based) of image `img_hashes[r]`,
+    so a single matrix-vector product scores a probe against every stored face.
+
+    Faces whose float32 distance lies within `BORDERLINE_DISTANCE` of the threshold are scored
+    again in float64 from their stored vectors, so the matches are the ones a float64 loop over
+    face_data finds, with distances that differ only by float32 rounding.
+    """
+
+    def __init__(self, face_data):
+        """
+        Build the matrix from face data as produced by `save_faces_from_folder`.
+
+        Parameters:
+        - face_data (dict): Mapping of image hash to face information.
+        """
+        self.face_data = face_data
+        rows = []
+        img_hashes = []
+        face_indices = []
+        dim = None
+
+        for img_hash, stored_data in face_data.items():
+            for i, stored_face in enumerate(stored_data["faces"]):
+                if stored_face.size == 0:  # Skip empty vectors
+                    continue
+                if dim is None:
+                    dim = stored_face.size
+                elif stored_face.size != dim:
+                    logger.warning(f"Skipping face {i + 1} of {img_hash}: vector size {stored_face.size} does not match {dim}")
+                    continue
+                rows.append(stored_face)
+                img_hashes.append(img_hash)
+                face_indices.append(i)
+
+        self.dim = dim or 0
+        self.matrix = np.empty((len(rows), self.dim), dtype=np.float32)
+        for r, stored_face in enumerate(rows):
+            self.matrix[r] = stored_face.ravel()
+
+        norms = np.linalg.norm(self.matrix, axis=1)
+        # Zero vectors have no defined cosine similarity, so they can never match
+        self.valid = norms > 0
+        self.matrix[self.valid] /= norms[self.valid, None]
+
+        self.img_hashes = np.array(img_hashes, dtype=object)
+        self.face_indices = np.array(face_indices, dtype=np.int64)
+
+        # The rows of an image are contiguous: (first row, row after the last) by img_hash
+        self.image_rows = {}
+        for r, img_hash in enumerate(img_hashes):
+            start, _ = self.image_rows.get(img_hash, (r, r))
+            self.image_rows[img_hash] = (start, r + 1)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def rows_of(self, img_hashes):
+        """
+        Return the matrix rows holding the faces of the given images.
+
+        Parameters:
+        - img_hashes (iterable): Hashes of the images. Images without rows are ignored.
+
+        Returns:
+        - numpy.ndarray: The rows, image by image in the order given.
+        """
+        ranges = [self.image_rows[img_hash] for img_hash in img_hashes if img_hash in self.image_rows]
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def scores(self, face_vector, rows=None):
+        """
+        Compute the cosine similarity between a probe vector and every stored face.
+
+        Parameters:
+        - face_vector (numpy.ndarray): The probe face vector.
+        - rows (numpy.ndarray, optional): Only score these matrix rows.
+
+        Returns:
+        - numpy.ndarray: One cosine similarity per matrix row (or per row of `rows`), NaN for rows
+          that cannot be scored.
+        """
+        count = len(self) if rows is None else len(rows)
+        if count == 0:
+            return np.empty(0, dtype=np.float32)
+
+        probe = np.asarray(face_vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(probe)
+        if probe.size != self.dim or norm == 0:
+            return np.full(count, np.nan, dtype=np.float32)
+
+        if rows is None:
+            scores = self.matrix @ (probe / norm)
+            scores[~self.valid] = np.nan
+        else:
+            scores = self.matrix[rows] @ (probe / norm)
+            scores[~self.valid[rows]] = np.nan
+        return scores
+
+    def decide_borderline(self, distances, face_vector, threshold, rows=None):
+        """
+        Decide the faces near the threshold in float64, see `decide_borderline`.
+
+        Parameters:
+        - distances (numpy.ndarray): float64 cosine distances, per matrix row or per row of `rows`. Updated in place.
+        - face_vector (numpy.ndarray): The probe face vector.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - rows (numpy.ndarray, optional): Matrix rows the distances belong to.
+        """
+        def stored_face(r):
+            row = r if rows is None else rows[r]
+            return self.face_data[self.img_hashes[row]]["faces"][self.face_indices[row]]
+        decide_borderline(distances, face_vector, threshold, stored_face)
+
+    def search(self, face_vector, threshold=.75, top_k=None, candidates=None):
+        """
+        Find the stored faces whose cosine distance to the probe is below the threshold.
+
+        Parameters:
+        - face_vector (numpy.ndarray): The probe face vector.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - top_k (int, optional): Only return the `top_k` most similar faces, best first.
+        - candidates (iterable, optional): Hashes of the images to search, e.g. from a
+          `MetadataIndex`. Only their rows are scored.
+
+        Returns:
+        - list: (row, cosine distance) pairs. Without `top_k` they are in face_data order, or
+          in the order of `candidates`.
+        """
+        rows = None if candidates is None else self.rows_of(candidates)
+        distances = 1 - self.scores(face_vector, rows).astype(np.float64)
+        self.decide_borderline(distances, face_vector, threshold, rows)
+        if rows is None:
+            return select_matches(distances, threshold, top_k)
+        return [(int(rows[r]), distance) for r, distance in select_matches(distances, threshold, top_k)]
+
+    def match_tuple(self, row, distance):
+        """
+        Build the match tuple the GUI consumes for a matrix row.
+
+        Parameters:
+        - row (int): Matrix row of the matched face.
+        - distance (float): Cosine distance between the probe and the matched face.
+
+        Returns:
+        - tuple: (img_hash, file_name, face_vector, similarity, resized image name).
+        """
+        img_hash = self.img_hashes[row]
+        i = int(self.face_indices[row])
+        stored_data = self.face_data[img_hash]
+        p_similarity = abs(distance - 1)
+        return (img_hash, stored_data["file_name"], stored_data["faces"][i], p_similarity, crop_name_for(stored_data, img_hash, i))
+
+    def find_matches(self, face_vector, threshold=.75, top_k=None, candidates=None):
+        """
+        Search for a probe vector and return the matches as GUI match tuples.
+
+        Parameters:
+        - face_vector (numpy.ndarray): The probe face vector.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - top_k (int, optional): Only return the `top_k` most similar faces, best first.
+        - candidates (iterable, optional): Hashes of the only images to search.
+
+        Returns:
+        - list: Match tuples as returned by `find_matching_face`.
+        """
+        return [self.match_tuple(row, distance) for row, distance in self.search(face_vector, threshold, top_k, candidates)]
+
+    def search_many(self, probe_vectors, threshold=.75, top_k=None, chunk_size=256):
+        """
+        Score many probe vectors at once with matrix-matrix products.
+
+        Parameters:
+        - probe_vectors (list): Probe face vectors.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - top_k (int, optional): Only return the `top_k` most similar faces per probe.
+        - chunk_size (int): Number of probes scored per product, bounding the size of the score matrix.
+
+        Returns:
+        - list: For every probe, (row, cosine distance) pairs as returned by `search`.
+        """
+        results = []
+        if len(self) == 0:
+            return [[] for _ in probe_vectors]
+
+        for start in range(0, len(probe_vectors), chunk_size):
+            chunk = [np.asarray(v, dtype=np.float32).ravel() for v in probe_vectors[start:start + chunk_size]]
+            usable = [v.size == self.dim and np.linalg.norm(v) > 0 for v in chunk]
+            probes = np.zeros((len(chunk), self.dim), dtype=np.float32)
+            for p, v in enumerate(chunk):
+                if usable[p]:
+                    probes[p] = v / np.linalg.norm(v)
+
+            distances = 1 - self.matrix @ probes.T
+            distances[~self.valid] = np.nan
+            for p in range(len(chunk)):
+                if not usable[p]:
+                    results.append([])
+                    continue
+                probe_distances = distances[:, p].astype(np.float64)
+                self.decide_borderline(probe_distances, chunk[p], threshold)
+                results.append(select_matches(probe_distances, threshold, top_k))
+        return results
+
+
+class ProbeMatcher:
+    """
+    Scores gallery faces against already embedded probe faces as they are produced, keeping only
+    the matches and the lightweight metadata of their images so memory use does not grow with
+    the size of the gallery.
+
+    Without `top_k` every face within the threshold is kept, in the order the faces were added.
+    With `top_k` only the `top_k` most similar faces per probe face are kept in a bounded heap.
+    Matches are decided like `FaceMatrix.search` decides them, borderline faces in float64, so
+    both search modes find the same faces.
+    """
+
+    def __init__(self, probe_vectors, threshold=.75, top_k=None):
+        """
+        Parameters:
+        - probe_vectors (list): Feature vectors of the faces to search for.
+        - threshold (float): Maximum cosine distance for a face to count as a match.
+        - top_k (int, optional): Number of best matches to keep per probe face.
+        """
+        self.threshold = threshold
+        self.top_k = top_k
+        self.probes = [np.asarray(v, dtype=np.float32).ravel() for v in probe_vectors]
+        self.probe_matrix = np.stack(self.probes) if self.probes else np.empty((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(self.probe_matrix, axis=1) if self.probes else np.empty(0)
+        self.valid_probes = norms > 0
+        self.probe_matrix[self.valid_probes] /= norms[self.valid_probes, None]
+
+        self.matches = [[] for _ in self.probes]  # Per probe face: lists, or heaps when top_k is set
+        self.metadata = {}  # img_hash -> lightweight face_data entry of images with retained matches
+        self.references = {}  # img_hash -> number of retained matches pointing at the image
+        self.faces_scored = 0
+        self.order = 0
+
+    def _retain(self, img_hash, face_entry):
+        if img_hash not in self.metadata:
+            self.metadata[img_hash] = {"file_name": face_entry["file_name"], "full_path": face_entry["full_path"],
+                                       "exif_data": face_entry.get("exif_data", {}),
+                                       "crop_names": list(face_entry.get("crop_names", []))}
+        self.references[img_hash] = self.references.get(img_hash, 0) + 1
+
+    def _release(self, img_hash):
+        self.references[img_hash] -= 1
+        if self.references[img_hash] == 0:
+            del self.references[img_hash]
+            del self.metadata[img_hash]
+
+    def add(self, img_hash, face_entry):
+        """
+        Score the faces of a newly processed image against every probe face.
+
+        Parameters:
+        - img_hash (str): Hash of the image.
+        - face_entry (dict): The image's face_data entry.
+
+        Returns:
+        - list: Match tuples for the faces of this image that are currently retained.
+        """
+        faces = [(i, face) for i, face in enumerate(face_entry["faces"]) if face.size == self.probe_matrix.shape[1]]
+        if not faces or not self.probes:
+            return []
+
+        gallery = np.stack([face.ravel() for _, face in faces]).astype(np.float32)
+        norms = np.linalg.norm(gallery, axis=1)
+        valid = norms > 0
+        gallery[valid] /= norms[valid, None]
+        with np.errstate(invalid='ignore'):
+            distances = 1 - (gallery @ self.probe_matrix.T).astype(np.float64)
+        distances[~valid] = np.nan
+        self.faces_scored += len(faces)
+
+        new_matches = []
+        for p in range(len(self.probes)):
+            if not self.valid_probes[p]:
+                continue
+            probe_distances = distances[:, p]
+            decide_borderline(probe_distances, self.probes[p], self.threshold, lambda row: faces[row][1])
+            for row, distance in select_matches(probe_distances, self.threshold):
+                i, face = faces[row]
+                match = (img_hash, face_entry["file_name"], face, abs(distance - 1), crop_name_for(face_entry, img_hash, i))
+                self.order += 1
+                if self.top_k is None:
+                    self.matches[p].append(match)
+                else:
+                    heap = self.matches[p]
+                    entry = (match[3], -self.order, match)
+                    if len(heap) < self.top_k:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        self._release(heapq.heapreplace(heap, entry)[2][0])
+                    else:
+                        continue
+                self._retain(img_hash, face_entry)
+                new_matches.append(match)
+        return new_matches
+
+    def results(self):
+        """
+        Return the retained matches in the format of `find_matching_face`.
+
+        Returns:
+        - tuple: (match tuples grouped by probe face, lightweight face_data of the matched images).
+        """
+        matching_faces = []
+        for probe_matches in self.matches:
+            if self.top_k is None:
+                matching_faces.extend(probe_matches)
+            else:
+                matching_faces.extend(match for _, _, match in sorted(probe_matches, reverse=True))
+        return matching_faces, dict(self.metadata)
@@ -0,0 +1,95 @@
+'''
+@file test_batched_embedding.py
+Tests that embedding faces in batches gives every face the vector it gets on its own, in the
+image it was cropped from.
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+import face_detection
+from face_detection import FaceIngestQueue, convert_images_to_vectors
+
+
+class StubResNet:
+    """
+    Linear stand-in for ResNet152. Like the real model it multiplies the whole batch at once in
+    float32, so its results may differ from a single image's in the last bits.
+    """
+
+    def __init__(self, seed=0):
+        self.weights = np.random.default_rng(seed).standard_normal((8 * 8 * 3, 4 * 4 * 32)).astype(np.float32)
+        self.batch_sizes = []
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        self.batch_sizes.append(len(batch))
+        pixels = batch[:, ::28, ::28, :].reshape(len(batch), -1)
+        return (pixels @ self.weights).reshape(len(batch), 4, 4, 32)
+
+
+@pytest.fixture
+def resnet(monkeypatch):
+    model = StubResNet()
+    monkeypatch.setattr(face_detection, "get_resnet_model", lambda: model)
+    return model
+
+
+def face_images(count, seed=1):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (224, 224, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def assert_same_vector(vector, expected):
+    """The tolerance stated by `convert_images_to_vectors`: 1e-5 of the largest component."""
+    np.testing.assert_allclose(vector, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+def test_batches_give_every_face_its_own_vector(resnet):
+    imgs = face_images(11)
+
+    alone = convert_images_to_vectors(imgs, batch_size=1)
+    batched = convert_images_to_vectors(imgs, batch_size=4)
+
+    assert resnet.batch_sizes == [1] * 11 + [4, 4, 3]
+    assert len(batched) == len(imgs)
+    for vector, expected in zip(batched, alone):
+        assert_same_vector(vector, expected)
+    # Each vector is closest to the one of its own face, so no face took another's place
+    distances = np.linalg.norm(np.stack(batched)[:, None] - np.stack(alone)[None], axis=2)
+    assert list(distances.argmin(axis=1)) == list(range(len(imgs)))
+
+
+def test_batches_spanning_images_keep_faces_with_their_image(resnet, tmp_path):
+    faces_per_image = [2, 0, 3, 1, 4, 1]
+    imgs = face_images(sum(faces_per_image))
+    expected = convert_images_to_vectors(imgs, batch_size=1)
+
+    results = {}
+    for batch_size in (1, 4):
+        queue = FaceIngestQueue(str(tmp_path / f"batch{batch_size}"), batch_size=batch_size)
+        found = []
+        start = 0
+        for idx, count in enumerate(faces_per_image, start=1):
+            detections = [{"box": [0, 0, 100, 100], "keypoints": {}, "confidence": 1.0} for _ in range(count)]
+            crops = list(zip(detections, imgs[start:start + count]))
+            start += count
+            queue.add_detected(idx, f"/gallery/{idx}.jpg", f"img{idx}", None, detections, crops)
+            found.extend(queue.drain())
+        found.extend(queue.finish())
+        results[batch_size] = found
+
+    for found in results.values():
+        assert [(idx, img_hash) for idx, _, img_hash, _ in found] == [(n, f"img{n}") for n in range(1, 7)]
+        start = 0
+        for (_, _, img_hash, face_entry), count in zip(found, faces_per_image):
+            if count == 0:
+                assert face_entry is None
+                continue
+            assert face_entry["crop_names"] == [f"{img_hash}_{n}.png" for n in range(1, count + 1)]
+            assert len(face_entry["faces"]) == count
+            for vector, own in zip(face_entry["faces"], expected[start:start + count]):
+                assert_same_vector(vector, own)
+            start += count
@@ -0,0 +1,86 @@
+'''
+@file test_crop_writer.py
+Tests of the sharded face crop writer and of finding crops written before sharding.
+'''
+
+import os
+import cv2
+import numpy as np
+import pytest
+from crop_writer import CropWriter, crop_exists, crop_name_for, crop_path, iter_crop_paths, resolve_crop_path
+
+IMG_HASH = "ab" + "0" * 30
+
+
+def face_crop(value=128):
+    return np.full((32, 32, 3), value, dtype=np.uint8)
+
+
+def test_crops_are_sharded_by_image_hash(tmp_path):
+    assert crop_path(str(tmp_path), f"{IMG_HASH}_1.png") == os.path.join(str(tmp_path), "ab", f"{IMG_HASH}_1.png")
+
+
+def test_resolve_crop_path_falls_back_to_the_top_level(tmp_path):
+    name = f"{IMG_HASH}_1.png"
+    legacy_path = tmp_path / name
+    cv2.imwrite(str(legacy_path), face_crop())
+
+    assert resolve_crop_path(str(tmp_path), name) == str(legacy_path)
+    assert crop_exists(str(tmp_path), name)
+
+
+def test_resolve_crop_path_prefers_the_shard(tmp_path):
+    name = f"{IMG_HASH}_1.png"
+    cv2.imwrite(str(tmp_path / name), face_crop())
+    os.makedirs(tmp_path / "ab")
+    cv2.imwrite(str(tmp_path / "ab" / name), face_crop())
+
+    assert resolve_crop_path(str(tmp_path), name) == crop_path(str(tmp_path), name)
+
+
+def test_missing_crops_resolve_to_their_shard(tmp_path):
+    name = f"{IMG_HASH}_1.png"
+
+    assert resolve_crop_path(str(tmp_path), name) == crop_path(str(tmp_path), name)
+    assert not crop_exists(str(tmp_path), name)
+
+
+@pytest.mark.parametrize("crop_format, extension", [("png", ".png"), ("jpeg", ".jpg"), ("webp", ".webp")])
+def test_writer_writes_every_queued_crop(tmp_path, crop_format, extension):
+    with CropWriter(str(tmp_path), crop_format, max_queued=2) as writer:
+        names = [writer.crop_name(IMG_HASH, n) for n in range(1, 6)]
+        for n, name in enumerate(names):
+            writer.write(name, face_crop(n * 40))
+
+    assert all(name.endswith(extension) for name in names)
+    assert writer.crops_written == 5 and writer.failed == []
+    for n, name in enumerate(names):
+        img = cv2.imread(crop_path(str(tmp_path), name))
+        assert img.shape == (32, 32, 3)
+        assert abs(int(img[16, 16, 0]) - n * 40) <= 3
+    assert not [name for name in os.listdir(tmp_path / "ab") if name.endswith(".tmp")]
+
+
+def test_link_copies_a_legacy_crop_into_its_shard(tmp_path):
+    legacy_name = f"{IMG_HASH}_1.png"
+    cv2.imwrite(str(tmp_path / legacy_name), face_crop())
+    copy_name = "cd" + "0" * 30 + "_1.png"
+
+    with CropWriter(str(tmp_path)) as writer:
+        writer.link(legacy_name, copy_name)
+
+    assert os.path.exists(crop_path(str(tmp_path), copy_name))
+
+
+def test_iter_crop_paths_lists_sharded_and_legacy_crops(tmp_path):
+    cv2.imwrite(str(tmp_path / f"{IMG_HASH}_2.png"), face_crop())
+    with CropWriter(str(tmp_path)) as writer:
+        writer.write(f"{IMG_HASH}_1.png", face_crop())
+    (tmp_path / "notes.txt").write_text("")
+
+    assert [os.path.basename(path) for path in iter_crop_paths(str(tmp_path))] == [f"{IMG_HASH}_1.png", f"{IMG_HASH}_2.png"]
+
+
+def test_crop_name_for_falls_back_to_png_names():
+    assert crop_name_for({"crop_names": [f"{IMG_HASH}_1.webp"]}, IMG_HASH, 0) == f"{IMG_HASH}_1.webp"
+    assert crop_name_for({}, IMG_HASH, 1) == f"{IMG_HASH}_2.png"
@@ -0,0 +1,82 @@
+'''
+@file test_detection_scaling.py
+Tests that faces detected on a downscaled image are mapped back to full resolution coordinates.
+'''
+
+import cv2
+import numpy as np
+import pytest
+from image_loader import ImageBuffer
+from face_detection import detect_faces_in_image, rescale_detections
+
+WIDTH, HEIGHT = 1600, 1200
+
+
+class StubDetector:
+    """Finds one face at fixed fractions of whatever image it is given."""
+
+    def __init__(self, confidence):
+        self.confidence = confidence
+        self.shapes = []
+
+    def detect_faces(self, img):
+        height, width = img.shape[:2]
+        self.shapes.append((height, width))
+        return [{'box': [round(0.25 * width), round(0.5 * height), round(0.1 * width), round(0.1 * height)],
+                 'confidence': self.confidence,
+                 'keypoints': {'left_eye': (round(0.28 * width), round(0.53 * height)),
+                               'right_eye': (round(0.32 * width), round(0.53 * height))}}]
+
+
+def read_image(path):
+    return ImageBuffer.read(path)
+
+
+@pytest.fixture(params=['.jpg', '.png'])
+def image_path(request, tmp_path):
+    path = str(tmp_path / f"large{request.param}")
+    img = np.random.default_rng(0).integers(0, 255, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    cv2.imwrite(path, img)
+    return path
+
+
+def assert_full_resolution(face, tolerance):
+    expected_box = [0.25 * WIDTH, 0.5 * HEIGHT, 0.1 * WIDTH, 0.1 * HEIGHT]
+    assert np.allclose(face['box'], expected_box, atol=tolerance)
+    assert np.allclose(face['keypoints']['left_eye'], (0.28 * WIDTH, 0.53 * HEIGHT), atol=tolerance)
+    assert np.allclose(face['keypoints']['right_eye'], (0.32 * WIDTH, 0.53 * HEIGHT), atol=tolerance)
+
+
+def test_rescale_detections():
+    faces = [{'box': [10, 20, 30, 40], 'keypoints': {'nose': (25, 35)}}]
+    rescale_detections(faces, 2.0, 3.0)
+    assert faces == [{'box': [20, 60, 60, 120], 'keypoints': {'nose': (50, 105)}}]
+
+
+@pytest.mark.parametrize('max_edge', [400, 800, 1000])
+def test_boxes_of_a_downscaled_detection_are_in_full_resolution(image_path, max_edge):
+    detector = StubDetector(confidence=0.99)
+    img, faces, timing = detect_faces_in_image(read_image(image_path), detector, max_edge)
+
+    assert max(detector.shapes[0]) <= max_edge
+    assert timing['detection_size'] == detector.shapes[0][::-1]
+    assert img.shape[:2] == (HEIGHT, WIDTH)
+    # One detection pixel spans up to WIDTH / max_edge original pixels
+    assert_full_resolution(faces[0], WIDTH / max_edge)
+
+
+def test_low_confidence_faces_are_mapped_without_a_full_decode(image_path):
+    detector = StubDetector(confidence=0.5)
+    img, faces, _ = detect_faces_in_image(read_image(image_path), detector, 400)
+    # Only JPEGs can be decoded straight at a reduced size
+    if image_path.endswith('.jpg'):
+        assert img is None
+    assert_full_resolution(faces[0], WIDTH / 400)
+
+
+def test_without_a_cap_the_detector_sees_the_full_image(image_path):
+    detector = StubDetector(confidence=0.99)
+    img, faces, _ = detect_faces_in_image(read_image(image_path), detector)
+    assert detector.shapes == [(HEIGHT, WIDTH)]
+    assert img.shape[:2] == (HEIGHT, WIDTH)
+    assert_full_resolution(faces[0], 1)
@@ -0,0 +1,88 @@
+'''
+@file test_embedding_heads.py
+Tests of the pooled embedding heads and the PCA whitening.
+'''
+
+import numpy as np
+import pytest
+from embedding_heads import FlattenHead, GeMHead, GlobalAveragePoolingHead, PCAWhitening, create_embedding_head
+
+
+def feature_maps(count, seed=0):
+    return np.random.default_rng(seed).random((count, 7, 7, 2048), dtype=np.float32)
+
+
+def test_flat_head_keeps_the_whole_feature_map():
+    maps = feature_maps(3)
+    vectors = FlattenHead()(maps)
+    assert len(vectors) == 3
+    for vector, feature_map in zip(vectors, maps):
+        assert vector.dtype == np.float32 and vector.shape == (7 * 7 * 2048,)
+        assert np.array_equal(vector, feature_map.ravel())
+
+
+def test_average_pooling_averages_every_channel():
+    maps = feature_maps(2)
+    vectors = GlobalAveragePoolingHead()(maps)
+    for vector, feature_map in zip(vectors, maps):
+        assert vector.shape == (2048,)
+        assert np.allclose(vector, feature_map.astype(np.float64).mean(axis=(0, 1)), atol=1e-6)
+
+
+def test_gem_pooling_lies_between_the_mean_and_the_maximum():
+    maps = feature_maps(2)
+    vectors = GeMHead()(maps)
+    for vector, feature_map in zip(vectors, maps):
+        expected = np.power(np.power(feature_map.astype(np.float64), 3).mean(axis=(0, 1)), 1 / 3)
+        assert np.allclose(vector, expected, rtol=1e-5)
+        assert np.all(vector >= feature_map.mean(axis=(0, 1)) - 1e-6)
+        assert np.all(vector <= feature_map.max(axis=(0, 1)) + 1e-6)
+
+
+def test_a_constant_map_pools_to_its_value():
+    maps = np.full((1, 7, 7, 2048), 0.5, dtype=np.float32)
+    for head in (GlobalAveragePoolingHead(), GeMHead()):
+        assert np.allclose(head(maps)[0], 0.5, rtol=1e-5)
+
+
+def test_whitening_decorrelates_to_unit_variance():
+    rng = np.random.default_rng(1)
+    # Correlated vectors with very different scales along each axis
+    vectors = rng.normal(size=(500, 16)) @ (rng.normal(size=(16, 16)) * np.arange(1, 17))
+    whitening = PCAWhitening.fit(vectors, dims=8, source_head="gap-v1")
+    whitened = whitening.transform(vectors.astype(np.float32))
+
+    assert whitened.shape == (500, 8)
+    assert np.allclose(whitened.mean(axis=0), 0, atol=1e-3)
+    assert np.allclose(np.cov(whitened, rowvar=False), np.eye(8), atol=1e-2)
+
+
+def test_whitening_dims_are_capped_by_the_samples():
+    whitening = PCAWhitening.fit(np.random.default_rng(2).random((5, 32)), dims=256)
+    assert len(whitening.components) == 4
+    with pytest.raises(ValueError):
+        PCAWhitening.fit(np.ones((1, 32)))
+
+
+def test_whitened_head_applies_and_identifies_its_whitening(tmp_path):
+    pooled = GlobalAveragePoolingHead()(feature_maps(40))
+    whitening = PCAWhitening.fit(pooled, dims=16, source_head="gap-v1")
+    path = str(tmp_path / "whitening.npz")
+    whitening.save(path)
+
+    head = create_embedding_head("gap", path)
+    assert head.id == f"gap-v1+{whitening.id}"
+    assert head.whitening.id == whitening.id
+    vectors = head(feature_maps(40))
+    assert vectors[0].dtype == np.float32 and vectors[0].shape == (16,)
+    assert np.allclose(np.stack(vectors), whitening.transform(np.stack(pooled)), atol=1e-5)
+
+
+def test_heads_refuse_a_whitening_fitted_on_other_vectors():
+    whitening = PCAWhitening.fit(np.random.default_rng(3).random((10, 2048)), dims=4, source_head="gap-v1")
+    with pytest.raises(ValueError):
+        GeMHead(whitening)
+    with pytest.raises(ValueError):
+        FlattenHead(whitening)
+    with pytest.raises(ValueError):
+        create_embedding_head("nope")
@@ -0,0 +1,96 @@
+'''
+@file test_embedding_store.py
+Tests of the on-disk embedding store.
+'''
+
+import os
+import numpy as np
+import pytest
+from embedding_store import EmbeddingStore, LEGACY_INFERENCE_VERSION, crops_exist, record_matches_models
+from embedding_heads import LEGACY_HEAD_ID
+
+
+@pytest.fixture
+def store(tmp_path):
+    with EmbeddingStore(str(tmp_path / "store" / "face_store.db")) as store:
+        yield store
+
+
+def make_record(faces=1, head="gem", version="keras"):
+    return {"num_detected": faces, "faces": [np.ones(4, dtype=np.float32)] * faces,
+            "crop_names": [f"abc_{i + 1}.png" for i in range(faces)], "embedding_head": head,
+            "inference_version": version}
+
+
+def test_lookup_path_hits_only_while_size_and_mtime_are_unchanged(store):
+    store.put("abc", make_record(), "/photos/a.jpg", 100, 1.5)
+
+    assert store.lookup_path("/photos/a.jpg", 100, 1.5) == "abc"
+    assert store.lookup_path("/photos/a.jpg", 101, 1.5) is None
+    assert store.lookup_path("/photos/a.jpg", 100, 2.5) is None
+    assert store.lookup_path("/photos/b.jpg", 100, 1.5) is None
+
+
+def test_records_survive_reopening_once_committed(tmp_path):
+    db_path = str(tmp_path / "face_store.db")
+    with EmbeddingStore(db_path) as store:
+        store.put("abc", make_record(), "/photos/a.jpg", 100, 1.5)
+        store.commit()
+    with EmbeddingStore(db_path) as store:
+        record = store.get("abc")
+        assert store.lookup_path("/photos/a.jpg", 100, 1.5) == "abc"
+        assert len(store) == 1
+    np.testing.assert_array_equal(record["faces"][0], np.ones(4, dtype=np.float32))
+
+
+def test_get_misses_records_of_other_models(store):
+    store.put("abc", make_record(head="gem", version="tflite-int8/int8-weights"))
+
+    assert store.get("abc", "gem", "tflite-int8/int8-weights") is not None
+    assert store.get("abc", "flat", "tflite-int8/int8-weights") is None
+    assert store.get("abc", "gem", "keras") is None
+    # A mismatching record is kept until the image is processed again
+    assert len(store) == 1
+
+
+def test_records_without_model_ids_are_legacy():
+    record = {"num_detected": 1, "faces": [np.ones(4)]}
+
+    assert record_matches_models(record, LEGACY_HEAD_ID, LEGACY_INFERENCE_VERSION)
+    assert not record_matches_models(record, "gem", LEGACY_INFERENCE_VERSION)
+    # The head plays no part in a record without faces
+    assert record_matches_models({"num_detected": 0, "faces": []}, "gem", LEGACY_INFERENCE_VERSION)
+
+
+def test_forget_path_keeps_the_record(store):
+    store.put("abc", make_record(), "/photos/a.jpg", 100, 1.5)
+    store.forget_path("/photos/a.jpg")
+
+    assert store.lookup_path("/photos/a.jpg", 100, 1.5) is None
+    assert store.get("abc") is not None
+
+
+def test_delete_removes_the_record_and_its_paths(store):
+    store.put("abc", make_record(), "/photos/a.jpg", 100, 1.5)
+    store.remember_path("/photos/copy.jpg", 100, 1.5, "abc")
+    store.delete("abc")
+
+    assert store.get("abc") is None
+    assert list(store.iter_paths()) == []
+
+
+def test_unreadable_records_are_discarded(store):
+    store.conn.execute("INSERT INTO images (img_hash, record) VALUES (?, ?)", ("abc", b"not a pickle"))
+
+    assert store.get("abc") is None
+    assert len(store) == 0
+
+
+def test_crops_exist(tmp_path):
+    record = make_record(faces=2)
+    for name in record["crop_names"]:
+        (tmp_path / name).write_bytes(b"")
+    assert crops_exist(record, str(tmp_path))
+
+    os.remove(tmp_path / record["crop_names"][1])
+    assert not crops_exist(record, str(tmp_path))
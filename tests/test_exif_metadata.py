@@ -0,0 +1,142 @@
+'''
+@file test_exif_metadata.py
+Tests of the header-only EXIF reader and the EXIF cache.
+'''
+
+import io
+import struct
+import pytest
+from PIL import Image
+from exif_metadata import ExifCache, read_image_exif, resolve_exif_data, resolve_match_exif
+
+EXPECTED = {"Make": "Canon", "Model": "EOS 5D", "DateDigitized": "2021:06:12", "TimeDigitized": "14:30:05",
+            "GPSInfo": {"Latitude": 52.370217, "Longitude": -4.895167}}
+
+
+def camera_exif():
+    exif = Image.Exif()
+    exif[0x010F] = "Canon"
+    exif[0x0110] = "EOS 5D"
+    exif.get_ifd(0x8769)[0x9004] = "2021:06:12 14:30:05"
+    gps = exif.get_ifd(0x8825)
+    gps[1], gps[2] = "N", (52.0, 22.0, 12.78)
+    gps[3], gps[4] = "W", (4.0, 53.0, 42.6)
+    return exif
+
+
+def encode(image_format, exif=None, **params):
+    buffer = io.BytesIO()
+    if exif is not None:
+        params["exif"] = exif.tobytes()
+    Image.new("RGB", (16, 16), (200, 100, 50)).save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def app_segment(marker, payload):
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_reads_camera_date_and_position(image_format):
+    assert read_image_exif("photo", encode(image_format, camera_exif())) == EXPECTED
+
+
+def test_matches_the_exif_pil_reads_from_the_decoded_image():
+    data = encode("JPEG", camera_exif())
+    pil_exif = Image.open(io.BytesIO(data)).getexif()
+
+    exif_data = read_image_exif("photo.jpg", data)
+
+    assert (exif_data["Make"], exif_data["Model"]) == (pil_exif[0x010F], pil_exif[0x0110])
+    assert " ".join((exif_data["DateDigitized"], exif_data["TimeDigitized"])) == pil_exif.get_ifd(0x8769)[0x9004]
+
+
+def test_skips_xmp_and_other_segments_before_the_exif_block():
+    data = encode("JPEG", camera_exif())
+    xmp = app_segment(0xE1, b"http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>")
+    comment = app_segment(0xFE, b"a comment")
+    # Inserted straight after the SOI marker, with fill bytes before one of the markers
+    data = data[:2] + xmp + b"\xff" + comment + data[2:]
+
+    assert read_image_exif("photo.jpg", data) == EXPECTED
+
+
+def test_images_without_exif():
+    assert read_image_exif("photo.jpg", encode("JPEG")) == {}
+    assert read_image_exif("photo.png", encode("PNG")) == {}
+    assert read_image_exif("photo.bmp", encode("BMP")) == {}
+
+
+def test_truncated_and_malformed_headers():
+    data = encode("JPEG", camera_exif())
+
+    assert read_image_exif("photo.jpg", data[:20]) == {}
+    assert read_image_exif("photo.jpg", b"\xff\xd8\xff\xe1\x00") == {}
+    # A valid segment holding garbage instead of TIFF data
+    assert read_image_exif("photo.jpg", b"\xff\xd8" + app_segment(0xE1, b"Exif\x00\x00garbage") + b"\xff\xd9") == {}
+
+
+def test_unreadable_files(tmp_path):
+    assert read_image_exif(str(tmp_path / "missing.jpg")) is None
+
+
+def test_reads_from_the_file_when_no_data_is_given(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(encode("JPEG", camera_exif()))
+
+    assert read_image_exif(str(path)) == EXPECTED
+
+
+def test_resolve_exif_data_parses_each_image_once(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(encode("JPEG", camera_exif()))
+    with ExifCache(str(tmp_path / "exif_cache.db")) as cache:
+        face_data = {"abc": {"full_path": str(path), "exif_data": None},
+                     "known": {"full_path": str(tmp_path / "missing.jpg"), "exif_data": {"Make": "Nikon"}},
+                     "gone": {"full_path": str(tmp_path / "gone.jpg"), "exif_data": None}}
+
+        assert resolve_exif_data(face_data, cache) == 1
+        assert face_data["abc"]["exif_data"] == EXPECTED
+        assert face_data["known"]["exif_data"] == {"Make": "Nikon"}
+        # Unreadable files are not cached, so they are tried again later
+        assert face_data["gone"]["exif_data"] == {}
+        assert set(cache.get_many(["abc", "known", "gone"])) == {"abc"}
+
+        path.unlink()
+        again = {"abc": {"full_path": str(path), "exif_data": None}}
+        assert resolve_exif_data(again, cache) == 0
+        assert again["abc"]["exif_data"] == EXPECTED
+
+
+def test_resolve_match_exif_only_reads_matched_images(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(encode("JPEG", camera_exif()))
+    face_data = {"abc": {"full_path": str(path), "exif_data": None},
+                 "other": {"full_path": str(path), "exif_data": None}}
+
+    resolve_match_exif([("abc", "photo.jpg", None, .9, "abc_1.png")], face_data)
+
+    assert face_data["abc"]["exif_data"] == EXPECTED
+    assert face_data["other"]["exif_data"] is None
+
+
+def test_cache_lookups_beyond_one_query(tmp_path):
+    with ExifCache(str(tmp_path / "exif_cache.db")) as cache:
+        cache.put_many((f"img{n}", {"Make": str(n)}) for n in range(1200))
+
+        found = cache.get_many([f"img{n}" for n in range(1300)])
+
+    assert len(found) == 1200
+    assert found["img1199"] == {"Make": "1199"}
+
+
+def test_store_records_keep_no_exif_data():
+    from face_detection import build_store_record, face_entry_from_record, new_face_entry
+
+    face_entry = new_face_entry("/g/photo.jpg")
+    face_entry["exif_data"] = dict(EXPECTED)
+    record = build_store_record(face_entry, 1, [])
+    assert "exif_data" not in record
+    # Records of older versions carried it, the cache is the only source now
+    record["exif_data"] = dict(EXPECTED)
+    assert face_entry_from_record(dict(record, faces=[]), "/g/photo.jpg")["exif_data"] is None
@@ -0,0 +1,160 @@
+'''
+@file test_face_index.py
+Tests of the flat, IVF and HNSW face indexes.
+'''
+
+import numpy as np
+import pytest
+from face_index import DEFAULT_SEARCH_K, EXACT_SCAN_FRACTION, create_index, load_index, normalise, open_index
+
+DIM = 64
+
+
+def clustered_vectors(rng, count, clusters=40, spread=.3):
+    centres = rng.standard_normal((clusters, DIM))
+    return (centres[rng.integers(clusters, size=count)] + spread * rng.standard_normal((count, DIM))).astype(np.float32)
+
+
+def build_index(kind, vectors, **params):
+    index = create_index(kind, **params)
+    index.add([(f"img{n:05d}", 0) for n in range(len(vectors))], vectors)
+    return index
+
+
+def index_params(kind):
+    # Small enough for the IVF quantiser to be trained on the test vectors
+    return {"nlist": 32, "nprobe": 16} if kind == "ivf" else {}
+
+
+@pytest.mark.parametrize("nprobe, min_recall", [(8, .9), (32, 1.0)])
+def test_ivf_recall_against_an_exact_scan(nprobe, min_recall):
+    rng = np.random.default_rng(0)
+    index = build_index("ivf", clustered_vectors(rng, 3000), nlist=32, nprobe=nprobe)
+
+    assert index.centroids is not None
+    assert index.recall(clustered_vectors(rng, 50), k=10) >= min_recall
+
+
+def test_hnsw_recall_against_an_exact_scan():
+    rng = np.random.default_rng(0)
+    index = build_index("hnsw", clustered_vectors(rng, 2000))
+    queries = clustered_vectors(rng, 50)
+
+    assert index.recall(queries, k=10) >= .8
+    index.ef_search = 200
+    assert index.recall(queries, k=10) >= .95
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf", "hnsw"])
+def test_removed_faces_are_never_returned(kind):
+    rng = np.random.default_rng(1)
+    vectors = clustered_vectors(rng, 1000)
+    index = build_index(kind, vectors, **index_params(kind))
+    probe = vectors[0]
+    nearest = [key for key, _ in index.search(probe, k=20)]
+
+    index.remove(nearest[:10])
+
+    assert len(index) == 990
+    assert nearest[0] not in index
+    found = [key for key, _ in index.search(probe, k=10)]
+    assert len(found) == 10
+    assert not set(found) & set(nearest[:10])
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf", "hnsw"])
+def test_removed_keys_can_be_added_again(kind):
+    rng = np.random.default_rng(2)
+    vectors = clustered_vectors(rng, 500)
+    index = build_index(kind, vectors, **index_params(kind))
+
+    index.remove([("img00007", 0)])
+    index.add([("img00007", 0)], [vectors[7]])
+
+    assert ("img00007", 0) in index
+    assert index.search(vectors[7], k=1)[0][0] == ("img00007", 0)
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf", "hnsw"])
+def test_find_matches_returns_every_match_within_the_threshold(kind):
+    rng = np.random.default_rng(3)
+    probe = rng.standard_normal(DIM).astype(np.float32)
+    close = probe + .1 * rng.standard_normal((DEFAULT_SEARCH_K * 3, DIM)).astype(np.float32)
+    vectors = np.concatenate([close, clustered_vectors(rng, 1000)])
+    index = build_index(kind, vectors, **index_params(kind))
+    face_data = {f"img{n:05d}": {"file_name": f"{n}.jpg", "faces": [vector], "crop_names": []}
+                 for n, vector in enumerate(vectors)}
+    # Faces of images missing from face_data, e.g. deleted ones, don't count towards the matches
+    for n in range(0, DEFAULT_SEARCH_K * 3, 2):
+        del face_data[f"img{n:05d}"]
+
+    fetches = []
+    search = index.search
+    index.search = lambda face_vector, k=10, keys=None: fetches.append(k) or search(face_vector, k, keys)
+    matches = index.find_matches(face_data, probe, threshold=.5)
+
+    # The matches outgrow the approximate searches, so every kind ends with an exact scan
+    similarities = normalise(vectors) @ normalise(probe)[0]
+    expected = [f"img{n:05d}" for n in np.argsort(-similarities, kind='stable')
+                if f"img{n:05d}" in face_data and 1 - float(similarities[n]) < .5]
+    assert len(expected) == DEFAULT_SEARCH_K * 3 // 2
+    assert [img_hash for img_hash, *_ in matches] == expected
+    assert fetches and max(fetches) < len(vectors) * EXACT_SCAN_FRACTION
+    assert [img_hash for img_hash, *_ in index.find_matches(face_data, probe, threshold=.5, k=5)] == expected[:5]
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf", "hnsw"])
+def test_find_matches_stops_early_when_few_faces_match(kind):
+    rng = np.random.default_rng(6)
+    vectors = clustered_vectors(rng, 2000)
+    index = build_index(kind, vectors, **index_params(kind))
+    face_data = {f"img{n:05d}": {"file_name": f"{n}.jpg", "faces": [vector], "crop_names": []}
+                 for n, vector in enumerate(vectors)}
+    fetches = []
+    search = index.search
+    index.search = lambda face_vector, k=10, keys=None: fetches.append(k) or search(face_vector, k, keys)
+
+    matches = index.find_matches(face_data, vectors[0], threshold=.05)
+
+    assert fetches == [DEFAULT_SEARCH_K]
+    assert matches[0][0] == "img00000"
+
+
+def test_candidates_are_scored_exactly():
+    rng = np.random.default_rng(4)
+    vectors = clustered_vectors(rng, 300)
+    index = build_index("hnsw", vectors)
+    face_data = {f"img{n:05d}": {"file_name": f"{n}.jpg", "faces": [vector], "crop_names": []}
+                 for n, vector in enumerate(vectors)}
+
+    matches = index.find_matches(face_data, vectors[5], threshold=2, candidates=["img00009", "img00005"])
+
+    assert [img_hash for img_hash, *_ in matches] == ["img00005", "img00009"]
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf", "hnsw"])
+def test_save_and_load_keep_the_tombstones(tmp_path, kind):
+    rng = np.random.default_rng(5)
+    vectors = clustered_vectors(rng, 600)
+    index = build_index(kind, vectors, **index_params(kind))
+    index.remove([("img00000", 0)])
+    path = str(tmp_path / "face_index.pkl")
+    index.save(path)
+
+    loaded = load_index(path)
+
+    assert len(loaded) == len(index)
+    assert ("img00000", 0) not in loaded
+    assert loaded.search(vectors[3], k=5) == index.search(vectors[3], k=5)
+
+
+def test_open_index_rebuilds_an_index_of_other_models(tmp_path):
+    path = str(tmp_path / "face_index.pkl")
+    index = open_index(path, "flat", embedding_head="gem", inference_version="keras")
+    index.add([("img", 0)], [np.ones(DIM, dtype=np.float32)])
+    index.save(path)
+
+    assert len(open_index(path, "flat", embedding_head="gem", inference_version="keras")) == 1
+    assert len(open_index(path, "flat", embedding_head="gem", inference_version="tflite-fp16/float16")) == 0
+    assert len(open_index(path, "flat", embedding_head="flat", inference_version="keras")) == 0
+    assert len(open_index(path, "hnsw", embedding_head="gem", inference_version="keras")) == 0
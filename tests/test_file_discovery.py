@@ -0,0 +1,115 @@
+'''
+@file test_file_discovery.py
+Tests of the concurrent image discovery and its directory manifest.
+'''
+
+import os
+import json
+import pytest
+from file_discovery import MANIFEST_VERSION, discover_images, load_manifest, scan_directory
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as image_file:
+        image_file.write(b"image")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "photos"
+    for name in ["b.jpg", "a.PNG", "notes.txt", "sub/c.jpeg", "sub/deeper/d.bmp", "other/e.jpg"]:
+        touch(str(root / name))
+    if os.name != 'nt':
+        # Hidden outside Windows, where the hidden attribute counts instead
+        touch(str(root / ".hidden.jpg"))
+    return root
+
+
+def names(paths, root):
+    return [os.path.relpath(path, root).replace(os.sep, "/") for path in paths]
+
+
+def manifest_dirs(manifest_path):
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)["directories"]
+
+
+def test_images_in_directory_order(tree):
+    found = list(discover_images(str(tree), threads=3))
+
+    assert names(found, tree) == ["a.PNG", "b.jpg", "other/e.jpg", "sub/c.jpeg", "sub/deeper/d.bmp"]
+    assert all(path.stat_result.st_size == 5 for path in found)
+
+
+def test_unchanged_directories_are_listed_from_the_manifest(tree, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    first = names(discover_images(str(tree), manifest_path=manifest_path), tree)
+    directories = manifest_dirs(manifest_path)
+    assert set(directories) == {str(tree), str(tree / "sub"), str(tree / "sub" / "deeper"), str(tree / "other")}
+
+    # A name only the manifest knows shows the listing was reused; it is dropped as the file is missing
+    directories[str(tree / "sub")]["files"].append("gone.jpg")
+    directories[str(tree)]["files"].remove("b.jpg")
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "root": str(tree), "directories": directories}, manifest_file)
+
+    assert names(discover_images(str(tree), manifest_path=manifest_path), tree) == [name for name in first if name != "b.jpg"]
+
+
+def test_a_changed_directory_is_listed_again(tree, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    list(discover_images(str(tree), manifest_path=manifest_path))
+    before = manifest_dirs(manifest_path)[str(tree / "sub")]["mtime_ns"]
+
+    touch(str(tree / "sub" / "new.jpg"))
+    os.utime(tree / "sub", ns=(before + 10 ** 9, before + 10 ** 9))
+
+    found = names(discover_images(str(tree), manifest_path=manifest_path), tree)
+    assert "sub/new.jpg" in found
+    assert manifest_dirs(manifest_path)[str(tree / "sub")]["files"] == ["c.jpeg", "new.jpg"]
+
+
+def test_new_subdirectories_are_found(tree, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    list(discover_images(str(tree), manifest_path=manifest_path))
+    mtime_ns = os.stat(tree / "other").st_mtime_ns
+
+    touch(str(tree / "other" / "added" / "f.jpg"))
+    os.utime(tree / "other", ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+
+    assert "other/added/f.jpg" in names(discover_images(str(tree), manifest_path=manifest_path), tree)
+
+
+def test_manifests_of_another_root_or_version_are_ignored(tree, tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    list(discover_images(str(tree), manifest_path=manifest_path))
+
+    assert load_manifest(manifest_path, str(tree))
+    assert load_manifest(manifest_path, str(tmp_path)) == {}
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest["version"] = MANIFEST_VERSION + 1
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    assert load_manifest(manifest_path, str(tree)) == {}
+
+
+def test_unreadable_manifests_are_ignored(tree, tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text("{not json")
+
+    assert len(list(discover_images(str(tree), manifest_path=str(manifest_path)))) == 5
+    assert load_manifest(str(manifest_path), str(tree))
+
+
+def test_scan_directory_reuses_a_matching_entry_only(tree):
+    images, dirs, entry, from_manifest = scan_directory(str(tree))
+    assert not from_manifest
+
+    assert scan_directory(str(tree), entry)[3]
+    assert not scan_directory(str(tree), dict(entry, mtime_ns=entry["mtime_ns"] - 1))[3]
+
+
+def test_missing_folders_yield_nothing(tmp_path):
+    assert list(discover_images(str(tmp_path / "missing"))) == []
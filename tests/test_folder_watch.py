@@ -0,0 +1,218 @@
+'''
+@file test_folder_watch.py
+Tests of watch mode in polling mode: which changes settle, and how the gallery follows them.
+'''
+
+import os
+import shutil
+import cv2
+import numpy as np
+import pytest
+import face_detection
+from embedding_store import EmbeddingStore
+from face_detection import save_faces_from_folder
+from folder_watch import FolderWatcher, WatchedGallery
+from metadata_index import build_metadata_index
+
+
+class StubDetector:
+    """Stand-in for MTCNN that finds one face in the middle of every image."""
+
+    def detect_faces(self, img):
+        height, width = img.shape[:2]
+        left, top = width // 4, height // 4
+        return [{"box": [left, top, width // 2, height // 2], "confidence": .99,
+                 "keypoints": {"left_eye": (left + 10, top + 10), "right_eye": (left + 30, top + 10)}}]
+
+
+def stub_vectors(imgs, batch_size=None):
+    """Stand-in for the ResNet embedding: a thumbnail of each face crop."""
+    return [np.ascontiguousarray(img[::16, ::16], dtype=np.float32).ravel() for img in imgs]
+
+
+def write_image(path, seed, mtime_ns=None):
+    """Write a distinct image, optionally with a given modification time so a rewrite always shows."""
+    rng = np.random.default_rng(seed)
+    cv2.imwrite(str(path), cv2.resize(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), (160, 120)))
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def settle(watcher):
+    """Check twice, so changes made before the first check have stayed the same for a whole interval."""
+    first = watcher.check()
+    return first, watcher.check()
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "gallery"
+    folder.mkdir()
+    return folder
+
+
+def test_changes_are_passed_on_once_settled(folder):
+    write_image(folder / "known.png", 0)
+    watcher = FolderWatcher(str(folder), use_events=False)
+    watcher.start()
+    assert not watcher.check()
+
+    write_image(folder / "new.png", 1)
+    first, second = settle(watcher)
+    assert not first
+    assert second.added == [str(folder / "new.png")] and not second.modified and not second.deleted
+
+    write_image(folder / "new.png", 2, mtime_ns=10 ** 18)
+    first, second = settle(watcher)
+    assert not first
+    assert second.modified == [str(folder / "new.png")] and not second.added and not second.deleted
+
+    os.remove(folder / "new.png")
+    changes = watcher.check()
+    assert changes.deleted == [str(folder / "new.png")] and not changes.added and not changes.modified
+    assert list(watcher.known) == [str(folder / "known.png")]
+
+
+def test_a_file_still_being_written_waits(folder):
+    watcher = FolderWatcher(str(folder), use_events=False)
+    watcher.start()
+
+    write_image(folder / "copying.png", 0, mtime_ns=10 ** 18)
+    assert not watcher.check()
+    write_image(folder / "copying.png", 1, mtime_ns=10 ** 18 + 1)
+    assert not watcher.check()
+    assert watcher.check().added == [str(folder / "copying.png")]
+
+
+def test_a_file_deleted_before_it_settles_is_never_passed_on(folder):
+    watcher = FolderWatcher(str(folder), use_events=False)
+    watcher.start()
+
+    write_image(folder / "brief.png", 0)
+    assert not watcher.check()
+    os.remove(folder / "brief.png")
+
+    assert not watcher.check()
+    assert not watcher.check()
+    assert watcher.known == {} and watcher.pending == {}
+
+
+@pytest.fixture
+def watched(folder, tmp_path, monkeypatch):
+    """A gallery of three images, one of them with an exact copy, indexed and being watched."""
+    monkeypatch.setattr(face_detection, "convert_images_to_vectors", stub_vectors)
+    write_image(folder / "a.png", 0)
+    write_image(folder / "b.png", 1)
+    shutil.copyfile(folder / "b.png", folder / "b_copy.png")
+    write_image(folder / "c.png", 2)
+    output_folder = str(tmp_path / "output")
+    store = EmbeddingStore(os.path.join(output_folder, "store.db"))
+    face_data = save_faces_from_folder(str(folder), output_folder, StubDetector(), store=store)
+    watcher = FolderWatcher(str(folder), exclude=output_folder, use_events=False)
+    watcher.start()
+    gallery = WatchedGallery(str(folder), output_folder, face_data, store, known_paths=watcher.known,
+                             metadata_index=build_metadata_index(face_data))
+    yield watcher, gallery
+    store.close()
+
+
+def hash_of(gallery, name):
+    return next(img_hash for img_hash, entry in gallery.face_data.items() if entry["file_name"] == name)
+
+
+def apply_settled(watcher, gallery):
+    _, changes = settle(watcher)
+    return gallery.apply(changes, StubDetector())
+
+
+def test_added_modified_and_deleted_images(folder, watched):
+    watcher, gallery = watched
+    assert len(gallery.face_data) == 3
+
+    write_image(folder / "d.png", 3)
+    removed, added = apply_settled(watcher, gallery)
+    d_hash = hash_of(gallery, "d.png")
+    assert removed == set() and list(added) == [d_hash]
+    assert d_hash in gallery.metadata_index and len(gallery.metadata_index) == 4
+
+    a_hash = hash_of(gallery, "a.png")
+    write_image(folder / "a.png", 4, mtime_ns=10 ** 18)
+    removed, added = apply_settled(watcher, gallery)
+    new_a_hash = hash_of(gallery, "a.png")
+    assert removed == {a_hash} and list(added) == [new_a_hash] and new_a_hash != a_hash
+    assert a_hash not in gallery.face_data and a_hash not in gallery.metadata_index
+    assert new_a_hash in gallery.metadata_index
+
+    os.remove(folder / "d.png")
+    removed, added = gallery.apply(watcher.check(), StubDetector())
+    assert removed == {d_hash} and added == {}
+    assert d_hash not in gallery.face_data and d_hash not in gallery.metadata_index
+    assert len(gallery.face_data) == len(gallery.metadata_index) == 3
+
+
+def test_a_copy_takes_over_when_the_original_is_deleted(folder, watched):
+    watcher, gallery = watched
+    c_hash = hash_of(gallery, "c.png")
+    entry = gallery.face_data[c_hash]
+
+    shutil.copyfile(folder / "c.png", folder / "moved.png")
+    removed, added = apply_settled(watcher, gallery)
+    # The copy is already in face_data under the original's path
+    assert removed == set() and added == {}
+
+    os.remove(folder / "c.png")
+    removed, added = gallery.apply(watcher.check(), StubDetector())
+
+    assert removed == {c_hash} and list(added) == [c_hash]
+    assert gallery.face_data[c_hash]["full_path"] == str(folder / "moved.png")
+    assert gallery.face_data[c_hash]["faces"] is entry["faces"]
+    # The entry handed out before is left as it was
+    assert entry["full_path"] == str(folder / "c.png")
+    assert c_hash in gallery.metadata_index
+
+
+def test_a_copy_and_its_original_deleted_in_the_same_change(folder, watched):
+    watcher, gallery = watched
+    c_hash = hash_of(gallery, "c.png")
+
+    shutil.copyfile(folder / "c.png", folder / "moved.png")
+    assert not watcher.check()
+    os.remove(folder / "c.png")
+    changes = watcher.check()
+    assert changes.added == [str(folder / "moved.png")] and changes.deleted == [str(folder / "c.png")]
+
+    removed, added = gallery.apply(changes, StubDetector())
+
+    assert removed == {c_hash} and list(added) == [c_hash]
+    assert gallery.face_data[c_hash]["full_path"] == str(folder / "moved.png")
+    assert c_hash in gallery.metadata_index and len(gallery.metadata_index) == 3
+
+
+def test_a_modified_file_whose_image_another_file_holds(folder, watched):
+    watcher, gallery = watched
+    b_hash = hash_of(gallery, "b.png")
+    assert gallery.face_data[b_hash]["full_path"] == str(folder / "b.png")
+
+    write_image(folder / "b.png", 5, mtime_ns=10 ** 18)
+    removed, added = apply_settled(watcher, gallery)
+    new_b_hash = hash_of(gallery, "b.png")
+
+    # The old image stays, now found at its copy, and the new contents are a new image
+    assert removed == {b_hash} and set(added) == {b_hash, new_b_hash}
+    assert gallery.face_data[b_hash]["full_path"] == str(folder / "b_copy.png")
+    assert gallery.face_data[new_b_hash]["full_path"] == str(folder / "b.png")
+    assert b_hash in gallery.metadata_index and new_b_hash in gallery.metadata_index
+    assert len(gallery.face_data) == len(gallery.metadata_index) == 4
+
+
+def test_a_file_deleted_before_it_settles_leaves_the_gallery_alone(folder, watched):
+    watcher, gallery = watched
+    face_data = dict(gallery.face_data)
+
+    write_image(folder / "brief.png", 6)
+    assert not watcher.check()
+    os.remove(folder / "brief.png")
+    removed, added = gallery.apply(watcher.check(), StubDetector())
+
+    assert removed == set() and added == {}
+    assert gallery.face_data == face_data and len(gallery.metadata_index) == 3
@@ -0,0 +1,99 @@
+'''
+@file test_match_store.py
+Tests of the columnar store behind the results table.
+'''
+
+import numpy as np
+from match_store import (CROP_COLUMN, LATITUDE_COLUMN, MATCH_COLUMN, PATH_COLUMN, SIMILARITY_COLUMN, TAGS_COLUMN,
+                         MatchStore)
+from results_export import RESULT_COLUMNS, match_row
+
+DEVICE_COLUMN = RESULT_COLUMNS.index('Device')
+
+FACE_DATA = {
+    "h1": {"full_path": "/g/a.jpg", "exif_data": {"GPSInfo": {"Latitude": 51.5, "Longitude": -0.1}, "Make": "Canon",
+                                                  "Model": "R5", "DateDigitized": "2024:01:02", "TimeDigitized": "10:00:00"}},
+    "h2": {"full_path": "/g/b.jpg", "exif_data": {"GPSInfo": {"Latitude": -33.9, "Longitude": 151.2}, "Make": "Apple"}},
+    "h3": {"full_path": "/g/c.jpg", "exif_data": {}},
+}
+
+
+def match(img_hash, similarity, crop):
+    return (img_hash, FACE_DATA[img_hash]["full_path"].rsplit('/', 1)[-1], None, similarity, crop)
+
+
+def filled_store():
+    store = MatchStore()
+    store.append([match("h1", 0.91, "a_0.jpg"), match("h2", 0.55, "b_0.jpg")], FACE_DATA)
+    store.append([match("h3", 0.78, "c_0.jpg"), match("h1", 0.62, "a_1.jpg"), match("h2", 0.99, "b_1.jpg")], FACE_DATA)
+    return store
+
+
+def sorted_column(store, column, reverse=False):
+    order = np.argsort(store.sort_keys(column), kind='stable')
+    if reverse:
+        order = order[::-1]
+    return [store.text(row, column) for row in order]
+
+
+def test_rows_match_the_exported_rows():
+    store = filled_store()
+    matches = [match("h1", 0.91, "a_0.jpg"), match("h2", 0.55, "b_0.jpg"), match("h3", 0.78, "c_0.jpg"),
+               match("h1", 0.62, "a_1.jpg"), match("h2", 0.99, "b_1.jpg")]
+    assert len(store) == 5
+    assert len(store.images) == 3
+    for row, m in enumerate(matches):
+        assert store.row_values(row) == match_row(row, m, FACE_DATA)
+
+
+def test_numeric_columns_sort_by_value():
+    store = MatchStore()
+    # 10 matches so "Match 10" would sort before "Match 2" as text
+    store.append([match("h1", similarity, f"a_{n}.jpg") for n, similarity in enumerate(np.linspace(0.1, 0.9, 10))], FACE_DATA)
+    assert sorted_column(store, MATCH_COLUMN) == [f"Match {n}" for n in range(1, 11)]
+    assert sorted_column(store, SIMILARITY_COLUMN, reverse=True)[0] == "90.00%"
+    assert sorted_column(store, SIMILARITY_COLUMN)[:2] == ["10.00%", "18.89%"]
+
+
+def test_image_columns_sort_per_row():
+    store = filled_store()
+    assert sorted_column(store, PATH_COLUMN) == ["/g/a.jpg", "/g/a.jpg", "/g/b.jpg", "/g/b.jpg", "/g/c.jpg"]
+    assert sorted_column(store, DEVICE_COLUMN) == ["", "Apple", "Apple", "Canon R5", "Canon R5"]
+    # Latitudes sort numerically with the missing one last
+    assert sorted_column(store, LATITUDE_COLUMN) == ["-33.9", "-33.9", "51.5", "51.5", ""]
+    assert sorted_column(store, CROP_COLUMN) == ["a_0.jpg", "a_1.jpg", "b_0.jpg", "b_1.jpg", "c_0.jpg"]
+
+
+def test_tags():
+    store = filled_store()
+    store.tagged[[1, 3]] = True
+    assert list(store.tagged_rows()) == [1, 3]
+    assert [store.text(row, TAGS_COLUMN) for row in range(len(store))] == ["", "Yes", "", "Yes", ""]
+    assert sorted_column(store, TAGS_COLUMN, reverse=True)[:2] == ["Yes", "Yes"]
+
+    # Tags follow their rows when an image is removed, and appended rows start untagged
+    row_map = store.remove_images(["h1"])
+    assert list(row_map) == [-1, 0, 1, -1, 2]
+    assert list(store.tagged_rows()) == [0]
+    store.append([match("h3", 0.5, "c_1.jpg")], FACE_DATA)
+    assert list(store.tagged_rows()) == [0]
+
+
+def test_removing_an_image_keeps_the_match_numbers():
+    store = filled_store()
+    store.remove_images(["h2", "unknown"])
+    assert [store.text(row, MATCH_COLUMN) for row in range(len(store))] == ["Match 1", "Match 3", "Match 4"]
+    assert [store.crop_name(row) for row in range(len(store))] == ["a_0.jpg", "c_0.jpg", "a_1.jpg"]
+    store.append([match("h2", 0.7, "b_2.jpg")], FACE_DATA)
+    assert store.text(3, MATCH_COLUMN) == "Match 6"
+    assert store.full_path(3) == "/g/b.jpg"
+
+
+def test_growing_past_the_initial_capacity():
+    store = MatchStore()
+    for n in range(5):
+        store.append([match("h1", 0.5, f"a_{n}_{i}.jpg") for i in range(700)], FACE_DATA)
+    assert len(store) == 3500
+    assert store.text(3499, MATCH_COLUMN) == "Match 3500"
+    assert store.crop_name(3499) == "a_4_699.jpg"
+    assert len(store.sort_keys(SIMILARITY_COLUMN)) == 3500
@@ -0,0 +1,180 @@
+'''
+@file test_metadata_index.py
+Tests of the metadata filter, checked against evaluating the query image by image.
+'''
+
+import numpy as np
+import pytest
+from metadata_index import MetadataIndex, MetadataQuery, haversine_km, select_candidates
+
+DEVICES = ["Canon EOS 5D", "Google Pixel 7", "Apple iPhone 12", ""]
+
+
+def exif(date=None, device="", position=None):
+    exif_data = {}
+    if date:
+        exif_data["DateDigitized"], exif_data["TimeDigitized"] = date.split()
+    if device:
+        exif_data["Make"], exif_data["Model"] = device.split(" ", 1)
+    if position:
+        exif_data["GPSInfo"] = {"Latitude": position[0], "Longitude": position[1]}
+    return exif_data
+
+
+def gallery(count=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    # Positions cluster around a few places, including either side of the antimeridian and near a pole
+    places = [(52.37, 4.89), (-16.5, 179.95), (-16.5, -179.95), (89.9, 10.0), (0.0, 0.0)]
+    face_data = {}
+    for n in range(count):
+        day = rng.integers(0, 730)
+        date = None if rng.random() < .1 else \
+            str(np.datetime64('2020-01-01T00:00:00') + np.timedelta64(int(day * 86400 + rng.integers(86400)), 's')).replace('-', ':').replace('T', ' ')
+        position = None
+        if rng.random() < .8:
+            latitude, longitude = places[rng.integers(len(places))]
+            latitude = float(np.clip(latitude + rng.normal(0, .2), -90, 90))
+            longitude = float((longitude + rng.normal(0, .2) + 180) % 360 - 180)
+            position = (round(latitude, 6), round(longitude, 6))
+        face_data[f"img{n:05d}"] = {"full_path": f"/photos/{n}.jpg",
+                                    "exif_data": exif(date, DEVICES[rng.integers(len(DEVICES))], position)}
+    return face_data
+
+
+QUERIES = [
+    {},
+    {"date_from": "2020-03-01"},
+    {"date_to": "2020-06-30"},
+    {"date_from": "2021-02-01", "date_to": "2021-02-01"},
+    {"date_from": "2020-05-01 12:00", "date_to": "2020-05-03 08:30:00"},
+    {"devices": ["pixel"]},
+    {"devices": ["CANON", "iphone"]},
+    {"devices": ["nokia"]},
+    {"near": (52.37, 4.89), "radius_km": 5},
+    {"near": (52.37, 4.89), "radius_km": 40, "date_from": "2020-06-01", "devices": ["pixel"]},
+    # Circles and boxes crossing the antimeridian
+    {"near": (-16.5, 180.0), "radius_km": 15},
+    {"near": (-16.5, -179.9), "radius_km": 30},
+    {"bbox": (-17, 179.9, -16, -179.9)},
+    {"bbox": (-17, 170, -16, -170), "date_to": "2020-12-31"},
+    # Circles around and near a pole, and one covering every longitude
+    {"near": (90, 0), "radius_km": 50},
+    {"near": (89.8, 100), "radius_km": 40},
+    {"near": (0, 0), "radius_km": 20000},
+    {"bbox": (52, 4, 53, 6), "near": (52.37, 4.89), "radius_km": 10},
+]
+
+
+@pytest.fixture(scope="module")
+def face_data():
+    return gallery()
+
+
+@pytest.fixture(scope="module")
+def index(face_data):
+    return MetadataIndex(face_data)
+
+
+@pytest.mark.parametrize("conditions", QUERIES, ids=[str(MetadataQuery(**conditions)) for conditions in QUERIES])
+def test_index_equals_checking_every_image(face_data, index, conditions):
+    query = MetadataQuery(**conditions)
+
+    expected = [img_hash for img_hash, face_entry in face_data.items() if query.matches_entry(face_entry)]
+
+    assert index.select(query) == expected
+    if conditions.get("near") == (-16.5, 180.0):
+        # Both sides of the antimeridian are found
+        longitudes = [face_data[img_hash]["exif_data"]["GPSInfo"]["Longitude"] for img_hash in expected]
+        assert min(longitudes) < 0 < max(longitudes)
+
+
+def test_dates_include_the_whole_last_day():
+    face_data = {"morning": {"exif_data": exif("2021:06:30 00:00:00")},
+                 "night": {"exif_data": exif("2021:06:30 23:59:59")},
+                 "next": {"exif_data": exif("2021:07:01 00:00:00")},
+                 "undated": {"exif_data": exif()},
+                 "invalid": {"exif_data": exif("2021:02:30 10:00:00")}}
+
+    assert MetadataIndex(face_data).select(MetadataQuery(date_from="2021-06-30", date_to="2021-06-30")) == ["morning", "night"]
+
+
+def test_position_on_the_antimeridian():
+    face_data = {"east": {"exif_data": exif(position=(0, 179.99))},
+                 "west": {"exif_data": exif(position=(0, -179.99))},
+                 "far": {"exif_data": exif(position=(0, 179.5))}}
+    index = MetadataIndex(face_data)
+
+    assert index.select(MetadataQuery(near=(0, 180), radius_km=5)) == ["east", "west"]
+    assert index.select(MetadataQuery(near=(0, -179.99), radius_km=5)) == ["east", "west"]
+    assert index.select(MetadataQuery(bbox=(-1, 179.9, 1, -179.9))) == ["east", "west"]
+    assert haversine_km(0, 179.99, 0, -179.99) == pytest.approx(2.22, abs=.01)
+
+
+def test_images_missing_a_value_fail_its_condition():
+    face_data = {"nothing": {"exif_data": None}, "all": {"exif_data": exif("2021:06:30 10:00:00", "Google Pixel", (1, 1))}}
+    index = MetadataIndex(face_data)
+
+    assert index.select(MetadataQuery(date_from="2000-01-01")) == ["all"]
+    assert index.select(MetadataQuery(devices=["pixel"])) == ["all"]
+    assert index.select(MetadataQuery(near=(1, 1))) == ["all"]
+    assert index.select(MetadataQuery()) == ["nothing", "all"]
+
+
+def test_parse():
+    query = MetadataQuery.parse("from:2021-06-01 to:2021-06-30 device:pixel device:Canon near:52.37,4.89,7 bbox:52,4,53,6")
+
+    assert (query.devices, query.near, query.radius_km, query.bbox) == (["pixel", "canon"], (52.37, 4.89), 7, (52, 4, 53, 6))
+    assert str(query.date_to) == "2021-06-30T23:59:59"
+    assert not MetadataQuery.parse("")
+
+
+@pytest.mark.parametrize("text", ["from:2021-13-01", "near:95,0", "near:1,2,0", "bbox:1,2,3", "when:today", "device:",
+                                  "bbox:10,0,5,1"])
+def test_parse_rejects_invalid_conditions(text):
+    with pytest.raises(ValueError):
+        MetadataQuery.parse(text)
+
+
+def test_select_candidates_only_reads_images_without_exif(tmp_path):
+    face_data = {"known": {"full_path": str(tmp_path / "missing.jpg"), "exif_data": exif(device="Google Pixel")},
+                 "unread": {"full_path": str(tmp_path / "gone.jpg"), "exif_data": None}}
+
+    assert select_candidates(face_data, MetadataQuery(devices=["pixel"])) == ["known"]
+    assert face_data["unread"]["exif_data"] == {}
+
+
+def test_added_and_removed_images_equal_a_rebuilt_index(face_data):
+    hashes = list(face_data)
+    index = MetadataIndex({img_hash: face_data[img_hash] for img_hash in hashes[:1000]})
+    # Grow in batches, remove a share of the rows and add some of them back, as watch mode does
+    for start in range(1000, len(hashes), 500):
+        index.add({img_hash: face_data[img_hash] for img_hash in hashes[start:start + 500]})
+    removed = hashes[::7]
+    index.remove(removed + ["unknown"])
+    index.add({img_hash: face_data[img_hash] for img_hash in removed[::3]})
+    # Already indexed images are not added twice
+    index.add({hashes[1]: face_data[hashes[1]]})
+
+    current = {img_hash: face_data[img_hash] for img_hash in hashes if img_hash not in set(removed)}
+    current.update((img_hash, face_data[img_hash]) for img_hash in removed[::3])
+    rebuilt = MetadataIndex(current)
+    assert len(index) == len(rebuilt) == len(current)
+    for conditions in QUERIES:
+        query = MetadataQuery(**conditions)
+        assert index.select(query) == rebuilt.select(query)
+
+
+def test_select_among_given_images(face_data, index):
+    hashes = list(face_data)[::5]
+    for conditions in QUERIES:
+        query = MetadataQuery(**conditions)
+        assert index.select(query, reversed(hashes + ["unknown"])) == [img_hash for img_hash in index.select(query)
+                                                                         if img_hash in set(hashes)]
+
+
+def test_select_candidates_reuses_an_index(face_data, index):
+    unindexed = {"new": {"full_path": "/photos/new.jpg", "exif_data": exif(device="Google Pixel 7")}}
+    query = MetadataQuery(devices=["pixel"])
+
+    assert select_candidates(dict(face_data, **unindexed), query, metadata_index=index) == index.select(query)
+    assert "new" not in index
@@ -0,0 +1,115 @@
+'''
+@file test_parallel_pipeline.py
+Tests that the number of detection workers changes nothing about the faces that are found.
+'''
+
+import multiprocessing.dummy
+import os
+import shutil
+import time
+import types
+import zlib
+import cv2
+import numpy as np
+import pytest
+import face_detection
+import model_registry
+import parallel_pipeline
+from embedding_store import EmbeddingStore
+from face_detection import save_faces_from_folder
+from model_registry import MTCNN_MODEL, model_name, registry
+
+NEAR_DUPLICATE_DISTANCE = 6
+
+
+class StubDetector:
+    """
+    Stand-in for MTCNN that finds up to three faces, the number depending on the image contents.
+    It takes a different time for every image, so parallel detections finish out of order.
+    """
+
+    def detect_faces(self, img):
+        seed = zlib.crc32(img.tobytes())
+        time.sleep(seed % 4 * .01)
+        height, width = img.shape[:2]
+        faces = []
+        for n in range(seed % 4):
+            left, top = 5 + 20 * n, 10 + 10 * n
+            faces.append({"box": [left, top, width // 3, height // 3], "confidence": .99 if n < 2 else .5,
+                          "keypoints": {"left_eye": (left + 8, top + 12), "right_eye": (left + 24, top + 12 + n)}})
+        return faces
+
+
+def stub_vectors(imgs, batch_size=None):
+    """Stand-in for the ResNet embedding: a thumbnail of each face crop."""
+    return [np.ascontiguousarray(img[::16, ::16], dtype=np.float32).ravel() for img in imgs]
+
+
+def smooth_image(rng, width=160, height=120):
+    """A smooth picture whose perceptual hash survives resizing, unlike plain noise."""
+    return cv2.resize(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+@pytest.fixture
+def gallery(tmp_path):
+    rng = np.random.default_rng(0)
+    folder = tmp_path / "gallery"
+    (folder / "sub").mkdir(parents=True)
+    for n in range(14):
+        cv2.imwrite(str(folder / ("sub" if n % 3 == 0 else "") / f"img{n:02d}.png"), smooth_image(rng))
+    # An exact copy and a resized copy of images that come earlier in folder order
+    shutil.copyfile(folder / "img01.png", folder / "sub" / "zz_copy.png")
+    original = smooth_image(np.random.default_rng(1))
+    cv2.imwrite(str(folder / "aa_original.png"), original)
+    cv2.imwrite(str(folder / "sub" / "zz_resized.png"), cv2.resize(original, (120, 90), interpolation=cv2.INTER_AREA))
+    return folder
+
+
+@pytest.fixture
+def stub_models(monkeypatch):
+    monkeypatch.setitem(registry._models, model_name(MTCNN_MODEL), StubDetector())
+    monkeypatch.setattr(face_detection, "convert_images_to_vectors", stub_vectors)
+    # Worker processes would build their own detector, so the workers run on threads of this
+    # process, which share the stub. Results are still handed over in completion order.
+    monkeypatch.setattr(parallel_pipeline, "multiprocessing",
+                        types.SimpleNamespace(get_context=lambda method: multiprocessing.dummy))
+    # The worker initialiser limits the inference threads of the whole process
+    monkeypatch.setattr(model_registry, "_num_threads", model_registry._num_threads)
+
+
+def process_gallery(gallery, output_folder, workers):
+    with EmbeddingStore(os.path.join(output_folder, "store.db")) as store:
+        face_data = save_faces_from_folder(str(gallery), output_folder, registry.get(model_name(MTCNN_MODEL)),
+                                           store=store, batch_size=3, workers=workers,
+                                           near_duplicate_distance=NEAR_DUPLICATE_DISTANCE)
+    crop_files = sorted(os.path.relpath(os.path.join(root, name), output_folder)
+                        for root, _, names in os.walk(output_folder) for name in names if name != "store.db")
+    return face_data, crop_files
+
+
+def test_worker_count_does_not_change_the_results(gallery, tmp_path, stub_models):
+    runs = {workers: process_gallery(gallery, str(tmp_path / f"output{workers}"), workers) for workers in (None, 1, 3)}
+
+    face_data, crop_files = runs[None]
+    copy_hash = face_detection.ImageBuffer.read(str(gallery / "sub" / "zz_copy.png")).md5()
+    resized_path = str(gallery / "sub" / "zz_resized.png")
+    resized = [entry for entry in face_data.values() if entry["full_path"] == resized_path]
+    original = [entry for entry in face_data.values() if entry["full_path"] == str(gallery / "aa_original.png")]
+    # The run covers images without faces, an exact copy and a near duplicate taking over its original's faces
+    assert 0 < len(face_data) < 16
+    assert copy_hash in face_data and face_data[copy_hash]["full_path"] == str(gallery / "img01.png")
+    assert original and resized and len(resized[0]["faces"]) == len(original[0]["faces"]) > 0
+    assert len(crop_files) == sum(len(entry["crop_names"]) for entry in face_data.values())
+
+    for workers in (1, 3):
+        other_face_data, other_crop_files = runs[workers]
+        assert list(other_face_data) == list(face_data)
+        for img_hash, entry in face_data.items():
+            other = other_face_data[img_hash]
+            assert other["full_path"] == entry["full_path"]
+            assert other["crop_names"] == entry["crop_names"]
+            assert other["boxes"] == entry["boxes"]
+            assert len(other["faces"]) == len(entry["faces"])
+            for vector, other_vector in zip(entry["faces"], other["faces"]):
+                assert np.array_equal(vector, other_vector)
+        assert other_crop_files == crop_files
@@ -0,0 +1,80 @@
+'''
+@file test_perceptual_hash.py
+Tests of the perceptual hash and the BK-tree used to find near duplicate images.
+'''
+
+import random
+import cv2
+import numpy as np
+from image_loader import ImageBuffer
+from perceptual_hash import BKTree, dhash, hamming, image_fingerprint, similar_aspect
+
+
+def flip_bits(hash_value, count, rng):
+    for bit in rng.sample(range(64), count):
+        hash_value ^= 1 << bit
+    return hash_value
+
+
+def test_search_equals_a_brute_force_scan():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    # Clusters of near copies, and exact repeats which must all be kept
+    hashes += [flip_bits(hashes[n], rng.randint(0, 8), rng) for n in range(0, 300, 3)]
+    hashes += hashes[:20]
+    tree = BKTree()
+    for n, hash_value in enumerate(hashes):
+        tree.add(hash_value, n)
+
+    assert len(tree) == len(hashes)
+    for query in hashes[:50] + [rng.getrandbits(64) for _ in range(20)]:
+        for max_distance in (0, 4, 10, 30):
+            expected = sorted((hamming(query, h), n) for n, h in enumerate(hashes) if hamming(query, h) <= max_distance)
+            found = tree.search(query, max_distance)
+            assert sorted(found) == expected
+            assert [distance for distance, _ in found] == sorted(distance for distance, _ in found)
+
+
+def test_search_of_an_empty_tree():
+    assert BKTree().search(0, 64) == []
+
+
+def test_similar_aspect():
+    assert similar_aspect((4000, 3000), (1024, 768))
+    assert similar_aspect((4000, 3000), (1024, 770))
+    assert not similar_aspect((4000, 3000), (1024, 1024))
+    assert not similar_aspect((4000, 3000), (3000, 4000))
+
+
+def scene(width=640, height=480):
+    rng = np.random.default_rng(0)
+    img = cv2.resize(rng.integers(0, 255, (12, 16, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.GaussianBlur(img, (0, 0), 5)
+
+
+def jpeg_buffer(path, img, quality=90):
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok
+    return ImageBuffer(path, encoded.tobytes())
+
+
+def test_resized_and_reencoded_copies_stay_close():
+    original = image_fingerprint(jpeg_buffer("original.jpg", scene()))
+    copy = image_fingerprint(jpeg_buffer("copy.jpg", cv2.resize(scene(), (320, 240), interpolation=cv2.INTER_AREA), 60))
+    other = image_fingerprint(jpeg_buffer("other.jpg", cv2.flip(scene(), 1)))
+
+    assert original["image_size"] == (640, 480)
+    assert copy["image_size"] == (320, 240)
+    assert hamming(original["dhash"], copy["dhash"]) <= 6
+    assert hamming(original["dhash"], other["dhash"]) > 12
+
+
+def test_fingerprint_of_an_undecodable_file():
+    assert image_fingerprint(ImageBuffer("broken.jpg", b"not an image")) is None
+
+
+def test_dhash_has_64_bits():
+    gradient = np.tile(np.arange(256, dtype=np.uint8), (64, 1))
+
+    assert dhash(gradient) == 2 ** 64 - 1
+    assert dhash(gradient[:, ::-1]) == 0
@@ -0,0 +1,51 @@
+'''
+@file test_pipeline_metrics.py
+Tests of the latency histogram behind the per-stage percentiles.
+'''
+
+import random
+from pipeline_metrics import HISTOGRAM_MIN_S, HISTOGRAM_RATIO, LatencyHistogram
+
+
+def test_percentiles_are_within_a_bucket_of_the_exact_value():
+    rng = random.Random(0)
+    samples = sorted(rng.lognormvariate(-5, 1.5) for _ in range(5000))
+    histogram = LatencyHistogram()
+    for seconds in samples:
+        histogram.add(seconds)
+
+    for q in (0.01, 0.25, 0.5, 0.9, 0.95, 0.99):
+        exact = samples[int(q * len(samples)) - 1]
+        estimate = histogram.percentile(q)
+        assert exact / HISTOGRAM_RATIO <= estimate <= exact * HISTOGRAM_RATIO
+
+
+def test_percentiles_do_not_decrease():
+    histogram = LatencyHistogram()
+    for seconds in (0.001, 0.002, 0.002, 0.05, 0.3, 2.0):
+        histogram.add(seconds)
+    estimates = [histogram.percentile(q / 20) for q in range(1, 21)]
+    assert estimates == sorted(estimates)
+
+
+def test_single_sample():
+    histogram = LatencyHistogram()
+    histogram.add(0.1)
+    for q in (0.0, 0.5, 1.0):
+        assert 0.1 / HISTOGRAM_RATIO <= histogram.percentile(q) <= 0.1 * HISTOGRAM_RATIO
+
+
+def test_out_of_range_latencies_land_in_the_end_buckets():
+    histogram = LatencyHistogram()
+    histogram.add(0)
+    histogram.add(HISTOGRAM_MIN_S / 10)
+    assert histogram.counts[0] == 2
+    assert histogram.percentile(1.0) == HISTOGRAM_MIN_S
+
+    histogram.add(1e9)
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(1.0) == HISTOGRAM_MIN_S * HISTOGRAM_RATIO ** (len(histogram.counts) - 1.5)
+
+
+def test_no_samples():
+    assert LatencyHistogram().percentile(0.5) is None
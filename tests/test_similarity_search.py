@@ -0,0 +1,171 @@
+'''
+@file test_similarity_search.py
+Tests of the vectorised similarity search against the per-pair scipy loop it replaced.
+'''
+
+import numpy as np
+import pytest
+from similarity_search import FaceMatrix, ProbeMatcher, select_matches
+
+distance = pytest.importorskip("scipy.spatial.distance")
+
+DIM = 2048
+
+
+def scipy_matches(probe, face_data, threshold, dtype=None):
+    """
+    The matching loop of find_matching_face before the faces were packed into a matrix. scipy
+    computes the distance of float32 vectors in float32, so `dtype` can ask for another precision.
+    """
+    matches = []
+    for img_hash, stored_data in face_data.items():
+        for i, stored_face in enumerate(stored_data["faces"]):
+            if stored_face.size == 0:
+                continue
+            if dtype is not None:
+                probe, stored_face = probe.astype(dtype), stored_face.astype(dtype)
+            cosine_distance = distance.cosine(probe, stored_face)
+            if cosine_distance < threshold:
+                matches.append((img_hash, i, abs(cosine_distance - 1)))
+    return matches
+
+
+def matrix_matches(probe, face_data, threshold, top_k=None):
+    face_matrix = FaceMatrix(face_data)
+    return [(face_matrix.img_hashes[row], int(face_matrix.face_indices[row]), abs(cosine_distance - 1))
+            for row, cosine_distance in face_matrix.search(probe, threshold, top_k)]
+
+
+def make_face_data(rng, images=200, faces_per_image=3):
+    face_data = {}
+    for n in range(images):
+        faces = [rng.standard_normal(DIM).astype(np.float32) for _ in range(faces_per_image)]
+        face_data[f"img{n:04d}"] = {"file_name": f"{n}.jpg", "faces": faces, "crop_names": []}
+    return face_data
+
+
+def vector_at_distance(probe, target_distance, rng):
+    """Return a float32 vector whose float64 cosine distance to the probe is close to the target."""
+    unit = probe.astype(np.float64) / np.linalg.norm(probe)
+    other = rng.standard_normal(probe.size)
+    other -= (other @ unit) * unit
+    other /= np.linalg.norm(other)
+    similarity = 1 - target_distance
+    return (similarity * unit + np.sqrt(1 - similarity ** 2) * other).astype(np.float32)
+
+
+@pytest.mark.parametrize("threshold", [.75, .6, .3])
+def test_matches_equal_the_scipy_loop(threshold):
+    rng = np.random.default_rng(0)
+    face_data = make_face_data(rng)
+    probe = rng.standard_normal(DIM).astype(np.float32)
+    # Faces spread around the threshold, so some of them fall on either side
+    for n, target in enumerate(np.linspace(threshold - .05, threshold + .05, 60)):
+        face_data[f"near{n:02d}"] = {"file_name": f"near{n}.jpg", "faces": [vector_at_distance(probe, target, rng)],
+                                     "crop_names": []}
+
+    expected = scipy_matches(probe, face_data, threshold)
+    found = matrix_matches(probe, face_data, threshold)
+
+    assert [(img_hash, i) for img_hash, i, _ in found] == [(img_hash, i) for img_hash, i, _ in expected]
+    np.testing.assert_allclose([s for *_, s in found], [s for *_, s in expected], atol=1e-6)
+
+
+def test_faces_on_the_threshold_are_decided_in_float64():
+    # Within float32 rounding of the threshold the float32 scipy loop itself is arbitrary, so
+    # faces this close are compared with a float64 loop instead
+    rng = np.random.default_rng(1)
+    probe = rng.standard_normal(DIM).astype(np.float32)
+    face_data = {}
+    for n in range(400):
+        face = vector_at_distance(probe, .75 + rng.uniform(-1e-6, 1e-6), rng)
+        face_data[f"img{n:04d}"] = {"file_name": f"{n}.jpg", "faces": [face], "crop_names": []}
+
+    expected = scipy_matches(probe, face_data, .75, dtype=np.float64)
+    assert 0 < len(expected) < len(face_data)
+    assert [(img_hash, i) for img_hash, i, _ in matrix_matches(probe, face_data, .75)] == \
+        [(img_hash, i) for img_hash, i, _ in expected]
+
+
+def test_empty_and_zero_vectors_never_match():
+    probe = np.ones(DIM, dtype=np.float32)
+    face_data = {"empty": {"file_name": "e.jpg", "faces": [np.empty(0, dtype=np.float32)], "crop_names": []},
+                 "zero": {"file_name": "z.jpg", "faces": [np.zeros(DIM, dtype=np.float32)], "crop_names": []},
+                 "same": {"file_name": "s.jpg", "faces": [np.ones(DIM, dtype=np.float32)], "crop_names": []}}
+
+    assert [img_hash for img_hash, *_ in matrix_matches(probe, face_data, .75)] == ["same"]
+    assert FaceMatrix(face_data).search(np.zeros(DIM, dtype=np.float32)) == []
+
+
+def test_top_k_keeps_the_best_matches_best_first():
+    rng = np.random.default_rng(2)
+    face_data = make_face_data(rng, images=50, faces_per_image=1)
+    probe = rng.standard_normal(DIM).astype(np.float32)
+    for n, target in enumerate([.1, .4, .2, .3]):
+        face_data[f"near{n}"] = {"file_name": f"near{n}.jpg", "faces": [vector_at_distance(probe, target, rng)],
+                                 "crop_names": []}
+
+    found = matrix_matches(probe, face_data, .75, top_k=3)
+
+    assert [img_hash for img_hash, *_ in found] == ["near0", "near2", "near3"]
+
+
+def test_candidates_restrict_the_scored_images():
+    rng = np.random.default_rng(3)
+    probe = rng.standard_normal(DIM).astype(np.float32)
+    face_data = {f"img{n}": {"file_name": f"{n}.jpg", "faces": [vector_at_distance(probe, .1, rng)], "crop_names": []}
+                 for n in range(5)}
+    face_matrix = FaceMatrix(face_data)
+
+    rows = face_matrix.search(probe, candidates=["img3", "missing", "img1"])
+
+    assert [face_matrix.img_hashes[row] for row, _ in rows] == ["img3", "img1"]
+
+
+def test_search_many_equals_search():
+    rng = np.random.default_rng(4)
+    face_matrix = FaceMatrix(make_face_data(rng, images=100))
+    probes = [face_matrix.matrix[r] + rng.normal(0, .02, DIM).astype(np.float32) for r in (0, 10, 20)]
+    probes.append(np.zeros(DIM, dtype=np.float32))
+
+    results = face_matrix.search_many(probes, threshold=.75, top_k=5, chunk_size=2)
+
+    for found, expected in zip(results, [face_matrix.search(probe, .75, 5) for probe in probes]):
+        assert [row for row, _ in found] == [row for row, _ in expected]
+        np.testing.assert_allclose([d for _, d in found], [d for _, d in expected], atol=1e-6)
+
+
+@pytest.mark.parametrize("top_k", [None, 5])
+def test_probe_first_finds_the_faces_the_matrix_finds(top_k):
+    rng = np.random.default_rng(5)
+    probes = [rng.standard_normal(DIM).astype(np.float32) for _ in range(3)]
+    face_data = make_face_data(rng, images=50)
+    for n, face_entry in enumerate(face_data.values()):
+        face_entry["full_path"] = f"/g/{n}.jpg"
+    # Faces within float32 rounding of the threshold of every probe, and a few clear matches
+    for p, probe in enumerate(probes):
+        for n in range(100):
+            face = vector_at_distance(probe, .75 + rng.uniform(-1e-6, 1e-6), rng)
+            face_data[f"near{p}_{n:03d}"] = {"file_name": f"near{p}_{n}.jpg", "full_path": f"/g/near{p}_{n}.jpg",
+                                             "faces": [face], "crop_names": []}
+        face_data[f"close{p}"] = {"file_name": f"close{p}.jpg", "full_path": f"/g/close{p}.jpg",
+                                  "faces": [vector_at_distance(probe, .2, rng)], "crop_names": []}
+    face_matrix = FaceMatrix(face_data)
+    matcher = ProbeMatcher(probes, threshold=.75, top_k=top_k)
+    for img_hash, face_entry in face_data.items():
+        matcher.add(img_hash, face_entry)
+
+    found, _ = matcher.results()
+
+    expected = [match for probe in probes for match in face_matrix.find_matches(probe, .75, top_k)]
+    assert 3 < len(expected) < 300
+    assert [(img_hash, crop) for img_hash, _, _, _, crop in found] == \
+        [(img_hash, crop) for img_hash, _, _, _, crop in expected]
+    np.testing.assert_allclose([m[3] for m in found], [m[3] for m in expected], atol=1e-6)
+
+
+def test_select_matches_skips_nan_rows():
+    distances = np.array([.5, np.nan, .9, .1], dtype=np.float32)
+
+    assert [row for row, _ in select_matches(distances, .75)] == [0, 3]
+    assert [row for row, _ in select_matches(distances, .75, top_k=1)] == [3]